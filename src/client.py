@@ -275,14 +275,15 @@ def usage(usage_error=None, cmd=None, retcode=EXIT_BADOPT, full=False,
             "            [-o attribute ...] [-s sort_key] [-t action_type ...]\n"
             "            [pkg_fmri_pattern ...]")
         adv_usage["search"] = _(
-            "[-HIaflpr] [-o attribute ...] [-s repo_uri] query")
+            "[-HIaflpr] [-n number] [-o attribute ...] [-s repo_uri]\n"
+            "            query")
 
-        adv_usage["verify"] = _("[-Hqv] [pkg_fmri_pattern ...]")
+        adv_usage["verify"] = _("[-Hqv] [--rehash] [pkg_fmri_pattern ...]")
         adv_usage["fix"] = _(
             "[-Hnvq] [--no-be-activate]\n"
             "            [--no-backup-be | --require-backup-be] [--backup-be-name name]\n"
             "            [--deny-new-be | --require-new-be] [--be-name name]\n"
-            "            [--accept] [--licenses] [pkg_fmri_pattern ...]")
+            "            [--accept] [--licenses] [--rehash] [pkg_fmri_pattern ...]")
         adv_usage["revert"] = _(
             "[-nv] [--no-be-activate]\n"
             "            [--no-backup-be | --require-backup-be] [--backup-be-name name]\n"
@@ -2395,21 +2396,24 @@ def rehydrate(op, api_inst, pargs, noexecute, publishers, quiet, verbose):
 
 def fix(op, api_inst, pargs, accept, backup_be, backup_be_name, be_activate,
     be_name, new_be, noexecute, omit_headers, parsable_version, quiet,
-    show_licenses, verbose):
+    rehash, show_licenses, verbose):
         """Fix packaging errors found in the image."""
 
         return __api_op(op, api_inst, args=pargs, _accept=accept,
             _noexecute=noexecute, _omit_headers=omit_headers, _quiet=quiet,
             _show_licenses=show_licenses, _verbose=verbose, backup_be=backup_be,
             backup_be_name=backup_be_name, be_activate=be_activate,
-            be_name=be_name, new_be=new_be, _parsable_version=parsable_version)
+            be_name=be_name, new_be=new_be, _parsable_version=parsable_version,
+            rehash=rehash)
 
-def verify(op, api_inst, pargs, omit_headers, parsable_version, quiet, verbose):
+def verify(op, api_inst, pargs, omit_headers, parsable_version, quiet, rehash,
+    verbose):
         """Determine if installed packages match manifests."""
 
         rval = __api_op(PKG_OP_FIX, api_inst, args=pargs, _noexecute=True,
             _omit_headers=omit_headers, _quiet=quiet, _quiet_plan=True,
-            _verbose=verbose, _parsable_version=parsable_version)
+            _verbose=verbose, _parsable_version=parsable_version,
+            rehash=rehash)
 
         if rval == EXIT_NOP:
                 # Nothing to fix.
@@ -2934,7 +2938,7 @@ def search(api_inst, args):
         search_prefixes = valid_special_prefixes[:]
         search_prefixes.extend(["search."])
 
-        opts, pargs = getopt.getopt(args, "Haflo:prs:I")
+        opts, pargs = getopt.getopt(args, "Hafln:o:prs:I")
 
         default_attrs_action = ["search.match_type", "action.name",
             "search.match", "pkg.shortfmri"]
@@ -2949,6 +2953,7 @@ def search(api_inst, args):
         prune_versions = True
         return_actions = True
         use_default_attrs = True
+        num_to_return = None
 
         for opt, arg in opts:
                 if opt == "-H":
@@ -2959,6 +2964,14 @@ def search(api_inst, args):
                         prune_versions = False
                 elif opt == "-l":
                         local = True
+                elif opt == "-n":
+                        try:
+                                num_to_return = int(arg)
+                        except ValueError:
+                                num_to_return = 0
+                        if num_to_return <= 0:
+                                usage(_("-n must be a positive integer"),
+                                    cmd="search")
                 elif opt == "-o":
                         attrs.extend(arg.split(","))
                         use_default_attrs = False
@@ -3003,7 +3016,7 @@ def search(api_inst, args):
 
         try:
                 query = [api.Query(qtext, case_sensitive,
-                    return_actions)]
+                    return_actions, num_to_return=num_to_return)]
         except api_errors.BooleanQueryException as e:
                 error(e)
                 return EXIT_OOPS
@@ -3032,6 +3045,9 @@ def search(api_inst, args):
                 header_attrs = attrs
                 last_line = None
                 shown_headers = False
+                # Each publisher searched limits its own results, so the
+                # total shown must be limited here as well.
+                remaining = num_to_return
                 while page_again:
                         unprocessed_res = []
                         page_again = False
@@ -3083,6 +3099,10 @@ def search(api_inst, args):
                                         if ret:
                                                 good_res = True
                                                 unprocessed_res.append(ret)
+                                                if remaining is not None:
+                                                        remaining -= 1
+                                                        if remaining <= 0:
+                                                                break
                                         # Check whether the paging timeout
                                         # should be increased.
                                         if time.time() - st > page_timeout:
@@ -5215,6 +5235,8 @@ opts_mapping = {
 
     "refresh_catalogs" :  ("",  "no-refresh"),
 
+    "rehash" :            ("",  "rehash"),
+
     "reject_pats" :       ("",  "reject"),
 
     "verbose" :           ("v",  ""),
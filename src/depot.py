@@ -144,9 +144,11 @@ def usage(text=None, retcode=2, full=False):
 
         print("""\
 Usage: /usr/lib/pkg.depotd [-a address] [-d inst_root] [-p port] [-s threads]
-           [-t socket_timeout] [--cfg] [--content-root]
+           [-t socket_timeout] [--catalog-compact-interval seconds]
+           [--cfg] [--content-root]
            [--disable-ops op[/1][,...]] [--debug feature_list]
-           [--image-root dir] [--log-access dest] [--log-errors dest]
+           [--image-root dir] [--index-jobs jobs] [--log-access dest]
+           [--log-errors dest]
            [--mirror] [--nasty] [--nasty-sleep] [--proxy-base url]
            [--readonly] [--ssl-cert-file] [--ssl-dialog] [--ssl-key-file]
            [--sort-file-max-size size] [--writable-root dir]
@@ -167,6 +169,12 @@ Usage: /usr/lib/pkg.depotd [-a address] [-d inst_root] [-p port] [-s threads]
         -t timeout      The maximum number of seconds the server should wait for
                         a response from a client before closing a connection.
                         The default value is 60.
+        --catalog-compact-interval
+                        If greater than zero, packages added to the catalog
+                        are offered to clients as incremental updates at
+                        once, and the catalog parts are saved with them every
+                        this many seconds instead of each time.  The default
+                        value is 0.
         --cfg           The pathname of the file to use when reading and writing
                         depot configuration data, or a fully qualified service
                         fault management resource identifier (FMRI) of the SMF
@@ -186,6 +194,9 @@ Usage: /usr/lib/pkg.depotd [-a address] [-d inst_root] [-p port] [-s threads]
                         hash=sha256, hash=sha1+sha512_256, hash=sha512_256
         --image-root    The path to the image whose file information will be
                         used as a cache for file data.
+        --index-jobs    The number of processes used to read package manifests
+                        when the search indexes are rebuilt.  The default
+                        value is 0, which uses one per CPU.
         --log-access    The destination for any access related information
                         logged by the depot process.  Possible values are:
                         stderr, stdout, none, or an absolute pathname.  The
@@ -282,9 +293,11 @@ if __name__ == "__main__":
         socket_path = ""
         user_cfg = None
         try:
-                long_opts = ["add-content", "cfg=", "cfg-file=",
+                long_opts = ["add-content", "catalog-compact-interval=",
+                    "cfg=", "cfg-file=",
                     "content-root=", "debug=", "disable-ops=", "exit-ready",
-                    "help", "image-root=", "log-access=", "log-errors=",
+                    "help", "image-root=", "index-jobs=", "log-access=",
+                    "log-errors=",
                     "llmirror", "mirror", "nasty=", "nasty-sleep=",
                     "proxy-base=", "readonly", "rebuild", "refresh-index",
                     "set-property=", "ssl-cert-file=", "ssl-dialog=",
@@ -318,6 +331,9 @@ if __name__ == "__main__":
                                 ivalues["pkg"]["socket_timeout"] = arg
                         elif opt == "--add-content":
                                 add_content = True
+                        elif opt == "--catalog-compact-interval":
+                                ivalues["pkg"]["catalog_compact_interval"] = \
+                                    arg
                         elif opt == "--cfg":
                                 user_cfg  = arg
                         elif opt == "--cfg-file":
@@ -368,6 +384,8 @@ if __name__ == "__main__":
                                 exit_ready = True
                         elif opt == "--image-root":
                                 ivalues["pkg"]["image_root"] = arg
+                        elif opt == "--index-jobs":
+                                ivalues["pkg"]["index_jobs"] = arg
                         elif opt.startswith("--log-"):
                                 prop = "log_{0}".format(opt.lstrip("--log-"))
                                 ivalues["pkg"][prop] = arg
@@ -839,12 +857,17 @@ if __name__ == "__main__":
         try:
                 sort_file_max_size = dconf.get_property("pkg",
                     "sort_file_max_size")
+                index_jobs = dconf.get_property("pkg", "index_jobs")
+                search_cache_size = dconf.get_property("pkg",
+                    "search_cache_size")
 
                 repo = sr.Repository(cfgpathname=repo_config_file,
                     log_obj=cherrypy, mirror=mirror, properties=repo_props,
                     read_only=readonly, root=inst_root,
                     sort_file_max_size=sort_file_max_size,
-                    writable_root=writable_root)
+                    writable_root=writable_root,
+                    index_jobs=index_jobs or None,
+                    search_cache_size=search_cache_size)
         except (RuntimeError, sr.RepositoryError) as _e:
                 emsg("pkg.depotd: {0}".format(_e))
                 sys.exit(1)
@@ -332,7 +332,12 @@ class FileAction(generic.Action):
 
                 In detail, this verifies that the file is present, and if
                 the preserve attribute is not present, that the hashes
-                and other attributes of the file match."""
+                and other attributes of the file match.
+
+                If 'verify_cache' is provided, it is a VerifyCache object
+                used to skip checking the content of files whose content has
+                already been found to match and that haven't changed since,
+                and to record those that match now."""
 
                 if self.attrs.get("preserve") == "abandon":
                         return [], [], []
@@ -399,7 +404,23 @@ class FileAction(generic.Action):
                         ehash_attr, elfhash_val, hash_func = \
                             digest.get_preferred_hash(self,
                                 hash_type=pkg.digest.CONTENT_HASH)
-                        if ehash_attr and haveelf and not is_mtpt:
+                        hash_attr, hash_val, hash_func = \
+                            digest.get_preferred_hash(self)
+
+                        # If the file hasn't changed since its content was
+                        # last found to match, there's no need to read it.
+                        vcache = args.get("verify_cache")
+                        if not vcache or is_mtpt or \
+                            not stat.S_ISREG(lstat.st_mode):
+                                vcache = None
+                                verified = False
+                        else:
+                                verified = vcache.lookup(path, lstat)
+                                verified = verified is not None and \
+                                    verified in (elfhash_val, hash_val)
+
+                        if ehash_attr and haveelf and not is_mtpt and \
+                            not verified:
                                 #
                                 # It's possible for the elf module to
                                 # throw while computing the hash,
@@ -429,6 +450,8 @@ class FileAction(generic.Action):
                                             "should be {expected}").format(
                                             found=elfhash,
                                             expected=elfhash_val)
+                                elif elfhash is not None and vcache:
+                                        vcache.record(path, lstat, elfhash)
 
                         # If we failed to compute the content hash, or the
                         # content hash failed to verify, try the file hash.
@@ -436,11 +459,12 @@ class FileAction(generic.Action):
                         # matches, it indicates that the content hash algorithm
                         # changed, since obviously the file hash is a superset
                         # of the content hash.
-                        if (elfhash is None or elferror) and not is_mtpt:
-                                hash_attr, hash_val, hash_func = \
-                                    digest.get_preferred_hash(self)
+                        if (elfhash is None or elferror) and not is_mtpt and \
+                            not verified:
                                 sha_hash, data = misc.get_data_digest(path,
                                     hash_func=hash_func)
+                                if sha_hash == hash_val and vcache:
+                                        vcache.record(path, lstat, sha_hash)
                                 if sha_hash != hash_val:
                                         # Prefer the content hash error message.
                                         if "preserve" in self.attrs:
@@ -68,7 +68,12 @@ class GroupAction(generic.Action):
 
                 template = self.extract(["groupname", "gid"])
 
-                gr = GroupFile(pkgplan.image)
+                db = pkgplan.image._user_db
+                if db:
+                        # Plan execution is batching changes to the files.
+                        gr = db.get_group()
+                else:
+                        gr = GroupFile(pkgplan.image)
 
                 cur_attrs = gr.getvalue(template)
 
@@ -84,6 +89,8 @@ class GroupAction(generic.Action):
                                 return
                 # XXX needs modification if more attrs are used
                 gr.setvalue(template)
+                if db:
+                        return
                 try:
                         gr.writefile()
                 except EnvironmentError as e:
@@ -164,7 +171,11 @@ class GroupAction(generic.Action):
                         # The user action is ignored if cfgfiles is not
                         # available.
                         return
-                gr = GroupFile(pkgplan.image)
+                db = pkgplan.image._user_db
+                if db:
+                        gr = db.get_group()
+                else:
+                        gr = GroupFile(pkgplan.image)
                 cur_attrs = gr.getvalue(self.attrs)
                 # groups need to be first added, last removed
                 if "user-list" not in cur_attrs:
@@ -174,7 +185,8 @@ class GroupAction(generic.Action):
                                 # Already gone; don't care.
                                 pass
                         else:
-                                gr.writefile()
+                                if not db:
+                                        gr.writefile()
 
         def generate_indices(self):
                 """Generates the indices needed by the search dictionary.  See
@@ -94,10 +94,17 @@ class UserAction(generic.Action):
 
         def readstate(self, image, username, lock=False):
                 """read state of user from files.  May raise KeyError"""
-                root = image.get_root()
-                pw = PasswordFile(root, lock)
-                gr = GroupFile(image)
-                ftp = FtpusersFile(root)
+                db = image._user_db
+                if db:
+                        # Plan execution is batching changes to the files.
+                        pw = db.get_passwd()
+                        gr = db.get_group()
+                        ftp = db.get_ftpusers()
+                else:
+                        root = image.get_root()
+                        pw = PasswordFile(root, lock)
+                        gr = GroupFile(image)
+                        ftp = FtpusersFile(root)
 
                 username = self.attrs["username"]
 
@@ -170,9 +177,10 @@ class UserAction(generic.Action):
                         ftp.setuser(username,
                             final_attrs.get("ftpuser", "true") == "true")
 
-                        pw.writefile()
-                        gr.writefile()
-                        ftp.writefile()
+                        if not pkgplan.image._user_db:
+                                pw.writefile()
+                                gr.writefile()
+                                ftp.writefile()
                 except EnvironmentError as e:
                         if e.errno != errno.ENOENT:
                                 raise
@@ -197,7 +205,7 @@ class UserAction(generic.Action):
                             details=txt, fmri=pkgplan.destination_fmri)
 
                 finally:
-                        if "pw" in locals():
+                        if "pw" in locals() and not pkgplan.image._user_db:
                                 pw.unlock()
 
         def postinstall(self, pkgplan, orig):
@@ -286,11 +294,19 @@ class UserAction(generic.Action):
                         # available.
                         return
 
-                root = pkgplan.image.get_root()
-                pw = PasswordFile(root, lock=True)
+                db = pkgplan.image._user_db
+                if db:
+                        pw = db.get_passwd()
+                else:
+                        root = pkgplan.image.get_root()
+                        pw = PasswordFile(root, lock=True)
                 try:
-                        gr = GroupFile(pkgplan.image)
-                        ftp = FtpusersFile(root)
+                        if db:
+                                gr = db.get_group()
+                                ftp = db.get_ftpusers()
+                        else:
+                                gr = GroupFile(pkgplan.image)
+                                ftp = FtpusersFile(root)
 
                         pw.removevalue(self.attrs)
                         gr.removeuser(self.attrs["username"])
@@ -298,15 +314,17 @@ class UserAction(generic.Action):
                         # negative logic
                         ftp.setuser(self.attrs["username"], True)
 
-                        pw.writefile()
-                        gr.writefile()
-                        ftp.writefile()
+                        if not db:
+                                pw.writefile()
+                                gr.writefile()
+                                ftp.writefile()
                 except KeyError as e:
                         # Already gone; don't care.
                         if e.args[0] != (self.attrs["username"],):
                                 raise
                 finally:
-                        pw.unlock()
+                        if not db:
+                                pw.unlock()
 
         def generate_indices(self):
                 """Generates the indices needed by the search dictionary.  See
@@ -35,10 +35,12 @@ import os
 import simplejson as json
 import stat
 import statvfs
+import tempfile
 import threading
 import types
 
 import pkg.actions
+import pkg.catalogindex as catalogindex
 import pkg.client.api_errors as api_errors
 import pkg.client.pkgdefs as pkgdefs
 import pkg.fmri as fmri
@@ -346,18 +348,16 @@ class CatalogPartBase(object):
                 should be serialized in a single pass.  This is significantly
                 faster, but requires that the entire set of data be serialized
                 in-memory instead of iteratively writing it to the target
-                storage object."""
-
-                f = _JSONWriter(data, single_pass=single_pass,
-                    pathname=self.pathname, sign=self.sign)
-                f.save()
+                storage object.
 
-                # Update in-memory copy to reflect stored data.
-                self.signatures = f.signatures()
+                The data is written to a temporary file in the same directory
+                which is then renamed into place, so that readers only ever see
+                the previous or the new content of the part."""
 
-                # Ensure the permissions on the new file are correct.
                 try:
-                        os.chmod(self.pathname, self.__file_mode)
+                        fd, tmp_path = tempfile.mkstemp(dir=self.meta_root,
+                            prefix=".{0}.".format(self.name))
+                        os.close(fd)
                 except EnvironmentError as e:
                         if e.errno == errno.EACCES:
                                 raise api_errors.PermissionsException(
@@ -367,11 +367,40 @@ class CatalogPartBase(object):
                                     e.filename)
                         raise
 
-                # Finally, set the file times to match the last catalog change.
-                if self.last_modified:
-                        mtime = calendar.timegm(
-                            self.last_modified.utctimetuple())
-                        os.utime(self.pathname, (mtime, mtime))
+                try:
+                        f = _JSONWriter(data, single_pass=single_pass,
+                            pathname=tmp_path, sign=self.sign)
+                        f.save()
+
+                        # Ensure the permissions on the new file are correct.
+                        try:
+                                os.chmod(tmp_path, self.__file_mode)
+                        except EnvironmentError as e:
+                                if e.errno == errno.EACCES:
+                                        raise api_errors.PermissionsException(
+                                            e.filename)
+                                if e.errno == errno.EROFS:
+                                        raise api_errors.ReadOnlyFileSystemException(
+                                            e.filename)
+                                raise
+
+                        # Set the file times to match the last catalog change.
+                        if self.last_modified:
+                                mtime = calendar.timegm(
+                                    self.last_modified.utctimetuple())
+                                os.utime(tmp_path, (mtime, mtime))
+
+                        # Finally, replace the existing file, if any.
+                        portable.rename(tmp_path, self.pathname)
+                except:
+                        try:
+                                portable.remove(tmp_path)
+                        except EnvironmentError:
+                                pass
+                        raise
+
+                # Update in-memory copy to reflect stored data.
+                self.signatures = f.signatures()
 
         meta_root = property(__get_meta_root, __set_meta_root)
 
@@ -380,19 +409,96 @@ class CatalogPart(CatalogPartBase):
         """A CatalogPart object is the representation of a subset of the package
         FMRIs available from a package repository."""
 
+        # The file mode to be used for the index of the part's entries.
+        __file_mode = stat.S_IRUSR|stat.S_IWUSR|stat.S_IRGRP|stat.S_IROTH
+
         __data = None
+        __index = None
+        __index_versions = None
+        indexed = False
         ordered = None
 
-        def __init__(self, name, meta_root=None, ordered=True, sign=True):
-                """Initializes a CatalogPart object."""
+        def __init__(self, name, meta_root=None, ordered=True, sign=True,
+            indexed=False):
+                """Initializes a CatalogPart object.
+
+                'indexed' is an optional boolean value indicating whether an
+                index of the part's entries by package stem should be written
+                when the part is saved, and used, when valid, to look up the
+                entries for individual packages without loading the part."""
 
                 self.__data = {}
+                self.__index_versions = {}
+                self.indexed = indexed
                 self.ordered = ordered
                 if not name.startswith("catalog."):
                         raise UnrecognizedCatalogPart(name)
                 CatalogPartBase.__init__(self, name, meta_root=meta_root,
                     sign=sign)
 
+        def __close_index(self):
+                """Discard the index of the part's entries, if open."""
+
+                if self.__index:
+                        self.__index.close()
+                self.__index = None
+                self.__index_versions = {}
+
+        def __get_index(self):
+                """Returns the CatalogIndex for the part, or None if the part
+                is loaded or has no valid index."""
+
+                if self.loaded or not self.indexed:
+                        return None
+                if self.__index is None:
+                        # Only try to open the index once.
+                        self.__index = False
+                        try:
+                                self.__index = catalogindex.CatalogIndex(
+                                    self.index_pathname,
+                                    os.stat(self.pathname))
+                        except (EnvironmentError, ValueError):
+                                pass
+                return self.__index or None
+
+        def __get_versions(self, pub, stem):
+                """Returns the list of entries for the package with the given
+                publisher and stem.  If the part isn't loaded, but has a valid
+                index, only the entries for that package are read."""
+
+                index = self.__get_index()
+                if index is None:
+                        self.load()
+                        return self.__data.get(pub, EmptyDict).get(stem, ())
+
+                key = (pub, stem)
+                ver_list = self.__index_versions.get(key)
+                if ver_list is None:
+                        ver_list = index.get(pub, stem) or ()
+                        self.__index_versions[key] = ver_list
+                return ver_list
+
+        def __gen_stem_versions(self, name, pubs=EmptyI):
+                """A generator function that produces tuples of the form (pub,
+                entries) for each publisher with a package named 'name', where
+                entries is the list of entries for the package.
+
+                'pubs' is an optional list of publisher prefixes to restrict
+                the results to."""
+
+                index = self.__get_index()
+                if index is None:
+                        self.load()
+                        for pub in self.publishers(pubs=pubs):
+                                ver_list = self.__data[pub].get(name)
+                                if ver_list:
+                                        yield pub, ver_list
+                        return
+
+                for pub in index.publishers(name):
+                        if not pubs or pub in pubs:
+                                yield pub, self.__get_versions(pub, name)
+
         def __iter_entries(self, last=False, ordered=False, pubs=EmptyI):
                 """Private generator function to iterate over catalog entries.
 
@@ -495,6 +601,13 @@ class CatalogPart(CatalogPartBase):
                 discards all content."""
 
                 self.__data = {}
+                self.__close_index()
+                if self.indexed and self.meta_root:
+                        try:
+                                portable.remove(self.index_pathname)
+                        except EnvironmentError as e:
+                                if e.errno != errno.ENOENT:
+                                        raise api_errors._convert_error(e)
                 return CatalogPartBase.destroy(self)
 
         def entries(self, cb=None, last=False, ordered=False, pubs=EmptyI):
@@ -544,12 +657,9 @@ class CatalogPart(CatalogPartBase):
                 'pubs' is an optional list of publisher prefixes to restrict
                 the results to."""
 
-                self.load()
-
                 versions = {}
                 entries = {}
-                for pub in self.publishers(pubs=pubs):
-                        ver_list = self.__data[pub].get(name, ())
+                for pub, ver_list in self.__gen_stem_versions(name, pubs=pubs):
                         for entry in ver_list:
                                 sver = entry["version"]
                                 pfmri = fmri.PkgFmri(name=name, publisher=pub,
@@ -608,15 +718,9 @@ class CatalogPart(CatalogPartBase):
                 'pubs' is an optional list of publisher prefixes to restrict
                 the results to."""
 
-                self.load()
-
                 versions = {}
                 entries = {}
-                for pub in self.publishers(pubs=pubs):
-                        ver_list = self.__data[pub].get(name, None)
-                        if not ver_list:
-                                continue
-
+                for pub, ver_list in self.__gen_stem_versions(name, pubs=pubs):
                         for entry in ver_list:
                                 sver = entry["version"]
                                 pfmri = fmri.PkgFmri(name=name, publisher=pub,
@@ -637,20 +741,20 @@ class CatalogPart(CatalogPartBase):
                 if pfmri and not pfmri.publisher:
                         raise api_errors.AnarchicalCatalogFMRI(str(pfmri))
 
-                # Since this is a hot path, this function checks for loaded
-                # status before attempting to call the load function.
-                if not self.loaded:
-                        self.load()
-
                 if pfmri:
                         pub, stem, ver = pfmri.tuple()
                         ver = str(ver)
 
-                pkg_list = self.__data.get(pub, None)
-                if not pkg_list:
-                        return
+                # Since this is a hot path, this function checks for loaded
+                # status before looking for an index or loading the part.
+                if self.loaded:
+                        pkg_list = self.__data.get(pub, None)
+                        if not pkg_list:
+                                return
+                        ver_list = pkg_list.get(stem, ())
+                else:
+                        ver_list = self.__get_versions(pub, stem)
 
-                ver_list = pkg_list.get(stem, ())
                 for entry in ver_list:
                         if entry["version"] == ver:
                                 return entry
@@ -690,6 +794,16 @@ class CatalogPart(CatalogPartBase):
                                     len(self.__data[pub][stem])
                         yield pub, package_count, package_version_count
 
+        @property
+        def index_pathname(self):
+                """The absolute path of the file used to store the index of the
+                part's entries or None if meta_root or name is not set."""
+
+                pathname = self.pathname
+                if not pathname:
+                        return None
+                return pathname + ".idx"
+
         def load(self):
                 """Load and transform the catalog part's data, preparing it
                 for use."""
@@ -698,6 +812,7 @@ class CatalogPart(CatalogPartBase):
                         # Already loaded, or only in-memory.
                         return
                 self.__data = CatalogPartBase.load(self)
+                self.__close_index()
 
         def names(self, pubs=EmptyI):
                 """Returns a set containing the names of all the packages in
@@ -819,6 +934,32 @@ class CatalogPart(CatalogPartBase):
                 self.load()
 
                 CatalogPartBase.save(self, self.__data, single_pass=single_pass)
+                if self.indexed:
+                        self.__save_index()
+
+        def __save_index(self):
+                """Store the index of the part's entries.  Failure to do so
+                isn't an error, as the part is loaded instead of using an
+                index that's missing or out of date."""
+
+                ipath = self.index_pathname
+                try:
+                        fd, tmp_path = tempfile.mkstemp(dir=self.meta_root,
+                            prefix=".{0}.".format(os.path.basename(ipath)))
+                except EnvironmentError:
+                        return
+
+                try:
+                        with os.fdopen(fd, "wb") as f:
+                                catalogindex.write(f, os.stat(self.pathname),
+                                    self.__data)
+                        os.chmod(tmp_path, self.__file_mode)
+                        portable.rename(tmp_path, ipath)
+                except EnvironmentError:
+                        try:
+                                portable.remove(tmp_path)
+                        except EnvironmentError:
+                                pass
 
         def sort(self, pfmris=None, pubs=None):
                 """Re-sorts the contents of the CatalogPart such that version
@@ -1339,6 +1480,7 @@ class Catalog(object):
         # found near the end of the class definition.
         _attrs = None
         __batch_mode = None
+        __indexed = None
         __lock = None
         __manifest_cb = None
         __meta_root = None
@@ -1354,7 +1496,7 @@ class Catalog(object):
         DEPENDENCY, SUMMARY = range(2)
 
         def __init__(self, batch_mode=False, meta_root=None, log_updates=False,
-            manifest_cb=None, read_only=False, sign=True):
+            manifest_cb=None, read_only=False, sign=True, indexed=False):
                 """Initializes a Catalog object.
 
                 'batch_mode' is an optional boolean value that indicates that
@@ -1389,9 +1531,16 @@ class Catalog(object):
                 the catalog data should have signature data generated and
                 embedded when serialized.  This option is primarily a matter
                 of convenience for callers that wish to trade integrity checks
-                for improved catalog serialization performance."""
+                for improved catalog serialization performance.
+
+                'indexed' is an optional boolean value that indicates that an
+                index of the entries in each catalog part should be stored with
+                it, so that the entries for individual packages can be looked
+                up without loading the whole part.  The index is only a cache;
+                it's ignored if it no longer matches the part."""
 
                 self.__batch_mode = batch_mode
+                self.__indexed = indexed
                 self.__manifest_cb = manifest_cb
                 self.__parts = {}
                 self.__updates = {}
@@ -1553,6 +1702,11 @@ class Catalog(object):
                                         continue
                                 parts.append(part)
 
+                # The entries of every package are needed, so load the parts
+                # instead of looking each one up in their indexes.
+                for part in parts:
+                        part.load()
+
                 def merge_entry(src, dest):
                         for k, v in src.iteritems():
                                 if k == "actions":
@@ -1878,9 +2032,10 @@ class Catalog(object):
                                 error = e
                         yield (pat, error, npat, matcher)
 
-        def __save(self):
+        def __save(self, parts=True):
                 """Private save function.  Caller is responsible for locking
-                the catalog."""
+                the catalog.  If 'parts' is False, the catalog parts aren't
+                saved."""
 
                 attrs = self._attrs
                 if self.log_updates:
@@ -1899,6 +2054,8 @@ class Catalog(object):
                 # updating their related information in catalog.attrs
                 # as they are saved.
                 for name, part in self.__parts.iteritems():
+                        if not parts:
+                                break
                         # Must save first so that signature data is
                         # current.
 
@@ -1963,14 +2120,17 @@ class Catalog(object):
                 for name in files:
                         pathname = os.path.join(self.meta_root, name)
                         try:
+                                # Only change the mode if needed; a change of
+                                # mode also changes the file's ctime, which
+                                # would invalidate the index of a part.
+                                fmode = stat.S_IMODE(os.stat(
+                                    pathname).st_mode)
+                                if fmode == self.__file_mode:
+                                        continue
                                 if self.read_only:
-                                        fmode = stat.S_IMODE(os.stat(
-                                            pathname).st_mode)
-                                        if fmode != self.__file_mode:
-                                                bad_modes.append((pathname,
-                                                    "{0:o}".format(
-                                                    self.__file_mode),
-                                                    "{0:o}".format(fmode)))
+                                        bad_modes.append((pathname,
+                                            "{0:o}".format(self.__file_mode),
+                                            "{0:o}".format(fmode)))
                                 else:
                                         os.chmod(pathname, self.__file_mode)
                         except EnvironmentError as e:
@@ -2385,8 +2545,11 @@ class Catalog(object):
                 # an interrupted destroy in the past that they are removed
                 # as well.
                 for fname in os.listdir(self.meta_root):
-                        if not fname.startswith("catalog.") and \
-                            not fname.startswith("update."):
+                        # Temporary files left by an interrupted save are
+                        # named after the file being saved with a leading '.'.
+                        name = fname.lstrip(".")
+                        if not name.startswith("catalog.") and \
+                            not name.startswith("update."):
                                 continue
 
                         pname = os.path.join(self.meta_root, fname)
@@ -2844,6 +3007,16 @@ class Catalog(object):
                         else:
                                 return EmptyI
 
+        @staticmethod
+        def gen_entry_actions(pfmri, actions, excludes=EmptyI):
+                """A generator function that produces Actions from a list of
+                action strings taken from the catalog entry of the specified
+                FMRI, such as the 'actions' returned by get_entry().  Actions
+                are filtered using 'excludes' as they are by
+                get_entry_actions()."""
+
+                return Catalog.__gen_actions(pfmri, actions, excludes)
+
         def get_entry_all_variants(self, pfmri):
                 """A generator function that yields tuples of the format
                 (var_name, variants); where var_name is the name of the
@@ -3397,7 +3570,8 @@ class Catalog(object):
                 # Next, since the part hasn't been cached, create an object
                 # for it and add it to catalog attributes.
                 part = CatalogPart(name, meta_root=self.meta_root,
-                    ordered=not self.__batch_mode, sign=self.__sign)
+                    ordered=not self.__batch_mode, sign=self.__sign,
+                    indexed=self.__indexed)
                 if must_exist and self.meta_root and not part.exists:
                         # This is a double-check for the client case where
                         # there is a part that is known to the catalog but
@@ -3667,6 +3841,67 @@ class Catalog(object):
                 finally:
                         self.__unlock_catalog()
 
+        def save_updates(self):
+                """Save the update logs and the catalog attributes, but not the
+                catalog parts.  The changes made to the catalog since its
+                parts were last saved are then only available from the update
+                logs, and the catalog attributes hold no signature data for
+                the parts until save() is called.  See replay_updates()."""
+
+                self.__lock_catalog()
+                try:
+                        self.__save(parts=False)
+                finally:
+                        self.__unlock_catalog()
+
+        def replay_updates(self, last_saved):
+                """Apply the changes recorded in the catalog's update logs after
+                'last_saved', a UTC datetime object indicating when the catalog
+                parts were last saved, to the catalog parts.  This brings the
+                parts up to date after save_updates() has been used; the
+                catalog must then be saved."""
+
+                self.__lock_catalog()
+                try:
+                        old_batch_mode = self.batch_mode
+                        self.batch_mode = True
+
+                        entries = []
+                        for name, uattrs in self.updates.iteritems():
+                                if uattrs["last-modified"] <= last_saved:
+                                        continue
+                                ulog = self.__get_update(name, cache=False,
+                                    must_exist=True)
+                                if ulog is None:
+                                        continue
+                                entries.extend(
+                                    u for u in ulog.updates()
+                                    if u[2] > last_saved
+                                )
+
+                        # Each update log only orders its entries by stem,
+                        # so all of them are applied in the order they were
+                        # made.
+                        entries.sort(key=lambda u: u[2])
+                        for pfmri, op_type, op_time, metadata in entries:
+                                for pname, pdata in metadata.iteritems():
+                                        # Parts first added to after they
+                                        # were last saved don't exist yet.
+                                        part = self.get_part(pname)
+                                        if op_type == CatalogUpdate.ADD:
+                                                part.add(pfmri, metadata=pdata,
+                                                    op_time=op_time)
+                                        elif op_type == CatalogUpdate.REMOVE:
+                                                part.remove(pfmri,
+                                                    op_time=op_time)
+                                        else:
+                                                raise api_errors.UnknownUpdateType(
+                                                    op_type)
+                finally:
+                        self.batch_mode = old_batch_mode
+                        self.__unlock_catalog()
+                self.finalize()
+
         @property
         def signatures(self):
                 """Returns a dict of the files the catalog is composed of along
@@ -0,0 +1,195 @@
+#!/usr/bin/python2.7
+#
+# CDDL HEADER START
+#
+# The contents of this file are subject to the terms of the
+# Common Development and Distribution License (the "License").
+# You may not use this file except in compliance with the License.
+#
+# You can obtain a copy of the license at usr/src/OPENSOLARIS.LICENSE
+# or http://www.opensolaris.org/os/licensing.
+# See the License for the specific language governing permissions
+# and limitations under the License.
+#
+# When distributing Covered Code, include this CDDL HEADER in each
+# file and include the License file at usr/src/OPENSOLARIS.LICENSE.
+# If applicable, add the following below this CDDL HEADER, with the
+# fields enclosed by brackets "[]" replaced with your own identifying
+# information: Portions Copyright [yyyy] [name of copyright owner]
+#
+# CDDL HEADER END
+#
+
+#
+# Copyright 2026 OmniOS Community Edition (OmniOSce) Association.
+#
+
+"""Index of the entries in a catalog part file, by package stem.
+
+A catalog part is stored as a single JSON object, so finding the entries
+for one package means parsing the whole file.  The index holds a copy of
+each package's entries, separately encoded, so that they can be read
+without reading anything else.  It consists of a fixed size header, a table
+of fixed width entries, and a heap:
+
+        header  magic (8 bytes), version, number of entries, and the size,
+                inode number, modification time and change time of the part
+                file the index was written for
+
+        table   for each package (publisher and stem), the offset of its key
+                in the heap, the length of the key, and the length of the
+                JSON encoding of its list of entries, which follows the key
+
+        heap    for each package, the key, as the stem, a NUL, and the
+                publisher, followed by its entries
+
+The table is sorted by key so that the packages with a given stem can be
+found by a binary search of a memory-mapped file.
+
+The part file remains the authoritative copy of the data.  An index is only
+used if the part file still has the metadata recorded in the header, so one
+that's out of date, because the part was replaced without the index being
+rewritten, is ignored."""
+
+import mmap
+import os
+import simplejson as json
+import struct
+
+MAGIC = "PKG5CIDX"
+VERSION = 1
+
+_HEADER = struct.Struct("<8sIIQQdd")
+_ENTRY = struct.Struct("<QII")
+
+
+def _stat_key(st):
+        return st.st_size, st.st_ino, st.st_mtime, st.st_ctime
+
+
+def _encode(s):
+        if isinstance(s, unicode):
+                return s.encode("utf-8")
+        return s
+
+
+def _decode(s):
+        # Like the JSON decoder, only use unicode objects for strings that
+        # aren't ASCII.
+        try:
+                s.decode("ascii")
+        except UnicodeError:
+                return s.decode("utf-8")
+        return s
+
+
+def _key(pub, stem):
+        return "{0}\0{1}".format(_encode(stem), _encode(pub))
+
+
+def write(fobj, st, data):
+        """Write the index for 'data', the dictionary of the entries of a
+        catalog part by publisher and stem, to the file object 'fobj'.  'st'
+        is the stat result of the part file 'data' was saved to."""
+
+        entries = []
+        for pub, stems in data.iteritems():
+                # Entries starting with "_" are part of the reserved catalog
+                # namespace, not publishers.
+                if pub[0] == "_":
+                        continue
+                for stem, ver_list in stems.iteritems():
+                        entries.append((_key(pub, stem), json.dumps(ver_list,
+                            separators=(",", ":"))))
+        entries.sort()
+
+        size, ino, mtime, ctime = _stat_key(st)
+        fobj.write(_HEADER.pack(MAGIC, VERSION, len(entries), size, ino,
+            mtime, ctime))
+        heap_off = 0
+        for key, enc in entries:
+                fobj.write(_ENTRY.pack(heap_off, len(key), len(enc)))
+                heap_off += len(key) + len(enc)
+        for key, enc in entries:
+                fobj.write(key)
+                fobj.write(enc)
+
+
+class CatalogIndex(object):
+        """A read-only view of an index written by write()."""
+
+        def __init__(self, path, st):
+                """Map the index at 'path' for the part file with the stat
+                result 'st'.  ValueError is raised if it isn't a valid index
+                for that file, and EnvironmentError if it can't be read."""
+
+                with open(path, "rb") as f:
+                        size = os.fstat(f.fileno()).st_size
+                        if size < _HEADER.size:
+                                raise ValueError(path)
+                        self.__map = mmap.mmap(f.fileno(), 0,
+                            access=mmap.ACCESS_READ)
+
+                hdr = _HEADER.unpack_from(self.__map)
+                magic, version, self.__count = hdr[:3]
+                self.__heap = _HEADER.size + self.__count * _ENTRY.size
+                if magic != MAGIC or version != VERSION or \
+                    self.__heap > size or hdr[3:] != _stat_key(st):
+                        self.close()
+                        raise ValueError(path)
+
+        def __len__(self):
+                return self.__count
+
+        def __entry(self, i):
+                """Return the key of the i'th entry, and the offset and length
+                of its encoded entries."""
+
+                off, klen, dlen = _ENTRY.unpack_from(self.__map,
+                    _HEADER.size + i * _ENTRY.size)
+                off += self.__heap
+                return self.__map[off:off + klen], off + klen, dlen
+
+        def __find(self, key):
+                """Return the index of the first entry with a key not less
+                than 'key'."""
+
+                lo, hi = 0, self.__count
+                while lo < hi:
+                        mid = (lo + hi) // 2
+                        if self.__entry(mid)[0] < key:
+                                lo = mid + 1
+                        else:
+                                hi = mid
+                return lo
+
+        def close(self):
+                """Unmap the index."""
+
+                self.__map.close()
+
+        def get(self, pub, stem):
+                """Return the list of catalog entries for the package with the
+                given publisher and stem, or None if there are none."""
+
+                key = _key(pub, stem)
+                i = self.__find(key)
+                if i == self.__count:
+                        return None
+                ekey, off, dlen = self.__entry(i)
+                if ekey != key:
+                        return None
+                return json.loads(self.__map[off:off + dlen])
+
+        def publishers(self, stem):
+                """A generator function that produces the prefixes of the
+                publishers with a package named 'stem', in sorted order."""
+
+                prefix = _key("", stem)
+                i = self.__find(prefix)
+                while i < self.__count:
+                        key = self.__entry(i)[0]
+                        if not key.startswith(prefix):
+                                break
+                        yield _decode(key[len(prefix):])
+                        i += 1
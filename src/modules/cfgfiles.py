@@ -422,6 +422,107 @@ class FtpusersFile(CfgFile):
         elif value and not self.getuser(username):
             self.subuser(username)
 
+class UserDatabase(object):
+    """The passwd, shadow, group and ftpusers files of an image, read once
+    so that a series of user and group changes can be made to them in memory
+    and written back together by flush().  The password file lock is held
+    until close() is called."""
+
+    def __init__(self, image):
+        root = image.get_root()
+        self.__passwd = PasswordFile(root, lock=True)
+        try:
+            self.__group = GroupFile(image)
+            self.__ftpusers = FtpusersFile(root)
+        except:
+            self.__passwd.unlock()
+            raise
+
+    @staticmethod
+    def available(image):
+        """Returns a boolean indicating whether all of the files exist, so
+        that they can be written back by flush()."""
+
+        root = image.get_root()
+        return all(os.path.exists(os.path.join(root, f)) for f in (
+            "etc/passwd", "etc/shadow", "etc/group", "etc/ftpd/ftpusers"))
+
+    def get_passwd(self):
+        """Returns the PasswordFile; its default uid is the next free one
+        given the changes made so far."""
+
+        self.__passwd.password_file.default_values["uid"] = \
+            self.__passwd.getnextuid()
+        return self.__passwd
+
+    def get_group(self):
+        """Returns the GroupFile; its default gid is the next free one given
+        the changes made so far."""
+
+        self.__group.default_values["gid"] = self.__group.getnextgid()
+        return self.__group
+
+    def get_ftpusers(self):
+        return self.__ftpusers
+
+    # The lookups below give the same results that pkg.portable would give
+    # once the files have been written back; entries with non-numeric ids are
+    # ignored, and where ids are shared, the first entry in the file is used.
+
+    @staticmethod
+    def __byname(cfgfile, name, idcol):
+        entry = cfgfile.index.get((name,))
+        if entry and entry[1]:
+            try:
+                return int(entry[1][idcol])
+            except ValueError:
+                pass
+        return None
+
+    @staticmethod
+    def __byid(cfgfile, ident, namecol, idcol):
+        found = None
+        for line, dic, lineno in cfgfile.index.itervalues():
+            if dic and str(dic[idcol]) == str(ident) and \
+                (found is None or lineno < found[0]):
+                found = (lineno, dic[namecol])
+        return found and found[1]
+
+    def get_user_by_name(self, name):
+        uid = self.__byname(self.__passwd.password_file, name, "uid")
+        if uid is None:
+            raise KeyError("user name not found: {0}".format(name))
+        return uid
+
+    def get_name_by_uid(self, uid):
+        name = self.__byid(self.__passwd.password_file, uid, "username",
+            "uid")
+        if name is None:
+            raise KeyError("user ID not found: {0:d}".format(uid))
+        return name
+
+    def get_group_by_name(self, name):
+        gid = self.__byname(self.__group, name, "gid")
+        if gid is None:
+            raise KeyError("group name not found: {0}".format(name))
+        return gid
+
+    def get_name_by_gid(self, gid):
+        name = self.__byid(self.__group, gid, "groupname", "gid")
+        if name is None:
+            raise KeyError("group ID not found: {0}".format(gid))
+        return name
+
+    def flush(self):
+        """Write back any files that have changed."""
+
+        self.__passwd.writefile()
+        self.__group.writefile()
+        self.__ftpusers.writefile()
+
+    def close(self):
+        self.__passwd.unlock()
+
 class UserattrFile(CfgFile):
     """ manage the userattr file """
     def __init__(self, path_prefix):
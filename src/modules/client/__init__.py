@@ -113,6 +113,24 @@ class GlobalSettings(object):
                 # Maximum number of transient errors before we abort an
                 # endpoint.
                 self.pkg_client_max_consecutive_error_default = 4
+                # Maximum compressed size of a file that may be retrieved as
+                # part of a batched filelist request.  Larger files are always
+                # retrieved individually.  A value of 0 disables batching.
+                self.pkg_client_filelist_max_size_default = 64 * 1024
+                # Maximum number of files retrieved by a single batched
+                # filelist request.
+                self.pkg_client_filelist_max_files = 100
+                # Default number of publisher origins whose catalogs are
+                # retrieved at once during a refresh.
+                self.pkg_client_refresh_concurrency_default = 8
+
+                # Default number of payloads uploaded at once when publishing
+                # to a depot.
+                self.pkg_client_publish_concurrency_default = 8
+
+                # Default number of threads compressing the payloads published
+                # to a file repository; 0 means one for each CPU.
+                self.pkg_client_compress_jobs_default = 0
 
                 # The location within the image of the cache for pkg.sysrepo(1M)
                 self.sysrepo_pub_cache_path = \
@@ -162,6 +180,42 @@ class GlobalSettings(object):
                 except ValueError:
                         self.PKG_CLIENT_MAX_REDIRECT = \
                             self.pkg_client_max_redirect_default
+                try:
+                        # Maximum size of a file that is retrieved as part of a
+                        # batched request.
+                        self.PKG_CLIENT_FILELIST_MAX_SIZE = int(
+                            os.environ.get("PKG_CLIENT_FILELIST_MAX_SIZE",
+                            self.pkg_client_filelist_max_size_default))
+                except ValueError:
+                        self.PKG_CLIENT_FILELIST_MAX_SIZE = \
+                            self.pkg_client_filelist_max_size_default
+                try:
+                        # Number of origins whose catalogs are retrieved at
+                        # once during a refresh.
+                        self.PKG_CLIENT_REFRESH_CONCURRENCY = int(
+                            os.environ.get("PKG_CLIENT_REFRESH_CONCURRENCY",
+                            self.pkg_client_refresh_concurrency_default))
+                except ValueError:
+                        self.PKG_CLIENT_REFRESH_CONCURRENCY = \
+                            self.pkg_client_refresh_concurrency_default
+                try:
+                        # Number of payloads uploaded at once when publishing
+                        # to a depot.
+                        self.PKG_CLIENT_PUBLISH_CONCURRENCY = int(
+                            os.environ.get("PKG_CLIENT_PUBLISH_CONCURRENCY",
+                            self.pkg_client_publish_concurrency_default))
+                except ValueError:
+                        self.PKG_CLIENT_PUBLISH_CONCURRENCY = \
+                            self.pkg_client_publish_concurrency_default
+                try:
+                        # Number of threads compressing the payloads published
+                        # to a file repository.
+                        self.PKG_CLIENT_COMPRESS_JOBS = int(
+                            os.environ.get("PKG_CLIENT_COMPRESS_JOBS",
+                            self.pkg_client_compress_jobs_default))
+                except ValueError:
+                        self.PKG_CLIENT_COMPRESS_JOBS = \
+                            self.pkg_client_compress_jobs_default
                 self.reset_logging()
 
         def __get_error_log_handler(self):
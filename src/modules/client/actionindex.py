@@ -0,0 +1,146 @@
+#!/usr/bin/python2.7
+#
+# CDDL HEADER START
+#
+# The contents of this file are subject to the terms of the
+# Common Development and Distribution License (the "License").
+# You may not use this file except in compliance with the License.
+#
+# You can obtain a copy of the license at usr/src/OPENSOLARIS.LICENSE
+# or http://www.opensolaris.org/os/licensing.
+# See the License for the specific language governing permissions
+# and limitations under the License.
+#
+# When distributing Covered Code, include this CDDL HEADER in each
+# file and include the License file at usr/src/OPENSOLARIS.LICENSE.
+# If applicable, add the following below this CDDL HEADER, with the
+# fields enclosed by brackets "[]" replaced with your own identifying
+# information: Portions Copyright [yyyy] [name of copyright owner]
+#
+# CDDL HEADER END
+#
+
+#
+# Copyright 2026 OmniOS Community Edition (OmniOSce) Association.
+#
+
+"""Binary form of the image's actions.offsets file.
+
+The file consists of a fixed size header, a table of fixed width entries,
+and a heap of strings:
+
+        header  magic (8 bytes), version, number of entries, and the
+                timestamp shared with the actions.stripped file
+
+        table   for each (action name, key attribute value) pair, a 64-bit
+                hash of the pair, the offset of its first line in the
+                actions.stripped file, the number of lines there, and the
+                offset and length of the pair in the string heap
+
+        heap    the pairs, each as the action name, a NUL, and the key
+                attribute value
+
+The table is sorted by hash so that a pair can be found by a binary search
+of a memory-mapped file, without reading the whole file or building a
+dictionary from it.  Entries with the same hash are told apart by comparing
+the pair in the heap."""
+
+import hashlib
+import mmap
+import os
+import struct
+
+MAGIC = "PKG5AIDX"
+VERSION = 1
+
+_HEADER = struct.Struct("<8sIIQ")
+_ENTRY = struct.Struct("<QQIII")
+_HASH = struct.Struct("<Q")
+
+
+def _hash(pair):
+        """Return the 64-bit hash of the string 'pair'."""
+
+        return _HASH.unpack_from(hashlib.sha1(pair).digest())[0]
+
+
+def write(fobj, timestamp, actdict):
+        """Write the index for 'actdict', a dictionary mapping (action name,
+        key attribute value) to (offset, count) in the actions.stripped file
+        created at 'timestamp', to the file object 'fobj'."""
+
+        entries = []
+        for (name, key), (offset, cnt) in actdict.iteritems():
+                pair = "{0}\0{1}".format(name, key)
+                entries.append((_hash(pair), pair, offset, cnt))
+        entries.sort()
+
+        fobj.write(_HEADER.pack(MAGIC, VERSION, len(entries), timestamp))
+        heap_off = 0
+        for h, pair, offset, cnt in entries:
+                fobj.write(_ENTRY.pack(h, offset, cnt, heap_off, len(pair)))
+                heap_off += len(pair)
+        for h, pair, offset, cnt in entries:
+                fobj.write(pair)
+
+
+class ActionIndex(object):
+        """A read-only view of an index written by write().  It provides the
+        subset of the dictionary interface used to look up actions in the
+        actions.stripped file."""
+
+        def __init__(self, path):
+                """Map the index at 'path'.  ValueError is raised if it isn't
+                a valid index, and EnvironmentError if it can't be read."""
+
+                with open(path, "rb") as f:
+                        size = os.fstat(f.fileno()).st_size
+                        if size < _HEADER.size:
+                                raise ValueError(path)
+                        self.__map = mmap.mmap(f.fileno(), 0,
+                            access=mmap.ACCESS_READ)
+
+                magic, version, self.__count, self.timestamp = \
+                    _HEADER.unpack_from(self.__map)
+                self.__heap = _HEADER.size + self.__count * _ENTRY.size
+                if magic != MAGIC or version != VERSION or self.__heap > size:
+                        self.close()
+                        raise ValueError(path)
+
+        def __len__(self):
+                return self.__count
+
+        def close(self):
+                """Unmap the index."""
+
+                self.__map.close()
+
+        def get(self, pair, default=None):
+                """Return the (offset, count) of the lines in the
+                actions.stripped file for 'pair', a tuple of action name and
+                key attribute value, or 'default' if there are none."""
+
+                pair = "{0}\0{1}".format(*pair)
+                h = _hash(pair)
+                m = self.__map
+
+                # Find the first entry with the given hash.
+                lo, hi = 0, self.__count
+                while lo < hi:
+                        mid = (lo + hi) // 2
+                        if _HASH.unpack_from(m,
+                            _HEADER.size + mid * _ENTRY.size)[0] < h:
+                                lo = mid + 1
+                        else:
+                                hi = mid
+
+                while lo < self.__count:
+                        eh, offset, cnt, soff, slen = _ENTRY.unpack_from(m,
+                            _HEADER.size + lo * _ENTRY.size)
+                        if eh != h:
+                                break
+                        soff += self.__heap
+                        if m[soff:soff + slen] == pair:
+                                return offset, cnt
+                        lo += 1
+                return default
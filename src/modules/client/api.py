@@ -1237,6 +1237,7 @@ in the environment or by setting simulate_cmdpath in DebugValues.""")
                     "pkgs_inst":            (iter,                 True),
                     "pkgs_to_uninstall":    (iter,                 True),
                     "pkgs_update":          (iter,                 True),
+                    "rehash":               (bool,                 False),
                     "reject_list":          (iter,                 True),
                     "variants":             (dict,                 True),
                 }
@@ -2255,7 +2256,8 @@ in the environment or by setting simulate_cmdpath in DebugValues.""")
                     publishers=publishers)
 
         def gen_plan_fix(self, args, backup_be=None, backup_be_name=None,
-            be_activate=True, be_name=None, new_be=None, noexecute=True):
+            be_activate=True, be_name=None, new_be=None, noexecute=True,
+            rehash=False):
                 """This is a generator function that yields a PlanDescription
                 object.
 
@@ -2269,6 +2271,10 @@ in the environment or by setting simulate_cmdpath in DebugValues.""")
                 'accept' indicates whether we agree to and accept the terms
                 of the licenses.
 
+                'rehash' indicates whether the content of every file should
+                be checked, even if it hasn't changed since it was last found
+                to be correct.
+
                 For all other parameters, refer to the 'gen_plan_install'
                 function for an explanation of their usage and effects."""
 
@@ -2276,7 +2282,8 @@ in the environment or by setting simulate_cmdpath in DebugValues.""")
                 return self.__plan_op(op, args=args, _be_activate=be_activate,
                     _backup_be=backup_be, _backup_be_name=backup_be_name,
                     _be_name=be_name, _new_be=new_be, _noexecute=noexecute,
-                    _refresh_catalogs=False, _update_index=False)
+                    _refresh_catalogs=False, _update_index=False,
+                    rehash=rehash)
 
         def attach_linked_child(self, lin, li_path, li_props=None,
             accept=False, allow_relink=False, force=False, li_md_only=False,
@@ -32,8 +32,10 @@ import copy
 import datetime
 import errno
 import hashlib
+import itertools
 import os
 import platform
+import Queue
 import shutil
 import simplejson as json
 import stat
@@ -43,6 +45,7 @@ import time
 import urllib
 
 from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
 from pkg.client import global_settings
 logger = global_settings.logger
 from cryptography import x509
@@ -50,6 +53,7 @@ from cryptography.hazmat.backends import default_backend
 
 import pkg.actions
 import pkg.catalog
+import pkg.client.actionindex           as actionindex
 import pkg.client.api_errors            as apx
 import pkg.client.bootenv               as bootenv
 import pkg.client.history               as history
@@ -62,7 +66,9 @@ import pkg.client.plandesc              as plandesc
 import pkg.client.progress              as progress
 import pkg.client.publisher             as publisher
 import pkg.client.sigpolicy             as sigpolicy
+import pkg.client.solvercache           as solvercache
 import pkg.client.transport.transport   as transport
+import pkg.client.verifycache           as verifycache
 import pkg.config                       as cfg
 import pkg.file_layout.layout           as fl
 import pkg.fmri
@@ -119,6 +125,7 @@ class Image(object):
         IMG_CATALOG_KNOWN = "known"
         IMG_CATALOG_INSTALLED = "installed"
 
+        __STATE_SOLVER_CACHE_FILE = "solver_cache"
         __STATE_UPDATING_FILE = "state_updating"
 
         def __init__(self, root, user_provided_dir=False, progtrack=None,
@@ -208,6 +215,11 @@ in the environment or by setting simulate_cmdpath in DebugValues.""")
                 self._usersbyname = {}
                 self._groupsbyname = {}
 
+                # While plan execution runs a series of user and group actions,
+                # the pkg.cfgfiles.UserDatabase they change, which is the
+                # authority for user and group names until it's written back.
+                self._user_db = None
+
                 # Set of pkg stems being avoided
                 self.__avoid_set = None
                 self.__avoid_set_altered = False
@@ -1149,9 +1161,9 @@ in the environment or by setting simulate_cmdpath in DebugValues.""")
 
                 # Create the new image catalogs.
                 kcat = pkg.catalog.Catalog(batch_mode=True,
-                    manifest_cb=self._manifest_cb, sign=False)
+                    manifest_cb=self._manifest_cb, sign=False, indexed=True)
                 icat = pkg.catalog.Catalog(batch_mode=True,
-                    manifest_cb=self._manifest_cb, sign=False)
+                    manifest_cb=self._manifest_cb, sign=False, indexed=True)
 
                 # XXX For backwards compatibility, 'upgradability' of packages
                 # is calculated and stored based on whether a given pkg stem
@@ -2190,6 +2202,29 @@ in the environment or by setting simulate_cmdpath in DebugValues.""")
                 # Only after success should the configuration be saved.
                 self.save_config()
 
+        def get_verify_cache(self, rehash=False):
+                """Return a pkg.client.verifycache.VerifyCache object for the
+                image, used to avoid reading installed files which haven't
+                changed since their content was last verified.  If 'rehash' is
+                True, the stored cache is ignored and will be replaced."""
+
+                return verifycache.VerifyCache(os.path.join(
+                    self.__action_cache_dir, "verify"), load=not rehash)
+
+        def get_solver_cache(self):
+                """Return a pkg.client.solvercache.SolverCache object for the
+                image's known catalog, used by the solver to avoid looking up
+                the same dependency information in the catalog for every
+                plan.  None is returned while alternate package sources are
+                in use, as their packages are merged into the known catalog
+                without changing it on disk."""
+
+                if self.__alt_pkg_pub_map:
+                        return None
+                return solvercache.SolverCache(os.path.join(self._statedir,
+                    self.__STATE_SOLVER_CACHE_FILE),
+                    self.get_catalog(self.IMG_CATALOG_KNOWN))
+
         def verify(self, fmri, progresstracker, **kwargs):
                 """Generator that returns a tuple of the form (action, errors,
                 warnings, info) if there are any error, warning, or other
@@ -2205,6 +2240,77 @@ in the environment or by setting simulate_cmdpath in DebugValues.""")
                 'kwargs' is a dict of additional keyword arguments to be passed
                 to each action verification routine."""
 
+                for entry in self.__gen_verify_results(self.__verify_pkg(fmri,
+                    progresstracker, None, kwargs)):
+                        yield entry
+
+        def gen_verify(self, fmris, progresstracker, jobs=1, **kwargs):
+                """Generator that returns a tuple of the form (fmri, entries)
+                for each package in 'fmris', in the same order, where
+                'entries' is the list of tuples verify() would produce for
+                the package.
+
+                If 'jobs' is greater than one, the file system objects
+                delivered by the packages are verified by that many threads,
+                and the packages that follow the one being returned are
+                verified in the meantime.
+
+                'progresstracker' and 'kwargs' are as for verify()."""
+
+                pool = None
+                window = 0
+                if jobs > 1:
+                        pool = ThreadPool(jobs)
+                        window = jobs * self.__VERIFY_WINDOW
+
+                pending = collections.deque()
+                try:
+                        for pfmri in fmris:
+                                pending.append((pfmri, self.__verify_pkg(pfmri,
+                                    progresstracker, pool, kwargs)))
+                                while len(pending) > window:
+                                        pfmri, results = pending.popleft()
+                                        yield pfmri, list(
+                                            self.__gen_verify_results(results))
+                        while pending:
+                                pfmri, results = pending.popleft()
+                                yield pfmri, list(
+                                    self.__gen_verify_results(results))
+                finally:
+                        if pool:
+                                pool.terminate()
+                                pool.join()
+
+        # The number of packages, for each thread, that gen_verify() may
+        # verify ahead of the one being returned.
+        __VERIFY_WINDOW = 4
+
+        # The types of actions that gen_verify() may verify in other threads;
+        # these only examine the file system object at their path.
+        __VERIFY_THREADED = frozenset(["dir", "file", "hardlink", "link"])
+
+        @staticmethod
+        def __gen_verify_results(results):
+                """Generate the tuples that verify() returns from a list of
+                tuples of the form (action, result) returned by __verify_pkg(),
+                where 'result' is a tuple of the form (errors, warnings, info)
+                or the AsyncResult of a call producing one."""
+
+                for act, result in results:
+                        if not isinstance(result, tuple):
+                                result = result.get()
+                        errors, warnings, info = result
+                        if errors or warnings or info:
+                                yield act, errors, warnings, info
+
+        def __verify_pkg(self, fmri, progresstracker, pool, kwargs):
+                """Verify the package 'fmri' and return a list of tuples of
+                the form (action, result) as described in
+                __gen_verify_results().  If 'pool' is not None, the
+                verification of file system objects is started in its
+                threads."""
+
+                results = []
                 try:
                         pub = self.get_publisher(prefix=fmri.publisher)
                 except apx.UnknownPublisher:
@@ -2234,10 +2340,9 @@ in the environment or by setting simulate_cmdpath in DebugValues.""")
                                         "check-certificate-revocation"))
                         except apx.SigningException as e:
                                 e.pfmri = fmri
-                                yield e.sig, [e], [], []
+                                results.append((e.sig, ([e], [], [])))
                         except apx.InvalidResourceLocation as e:
-                                yield None, [e], [], []
-
+                                results.append((None, ([e], [], [])))
                 progresstracker.plan_add_progress(
                     progresstracker.PLAN_PKG_VERIFY, nitems=0)
                 def mediation_allowed(act):
@@ -2289,6 +2394,11 @@ in the environment or by setting simulate_cmdpath in DebugValues.""")
                         warnings = []
                         info = []
                         if act.include_this(excludes, publisher=fmri.publisher):
+                                if pool and act.name in self.__VERIFY_THREADED:
+                                        results.append((act, pool.apply_async(
+                                            act.verify, (self,),
+                                            dict(kwargs, pfmri=fmri))))
+                                        continue
                                 errors, warnings, info = act.verify(
                                     self, pfmri=fmri, **kwargs)
                         elif act.include_this(vardrate_excludes,
@@ -2306,8 +2416,9 @@ in the environment or by setting simulate_cmdpath in DebugValues.""")
                                 # or has been dehydrated.
                                 continue
 
-                        if errors or warnings or info:
-                                yield act, errors, warnings, info
+                        results.append((act, (errors, warnings, info)))
+
+                return results
 
         def image_config_update(self, new_variants, new_facets, new_mediators):
                 """update variants in image config"""
@@ -2673,6 +2784,10 @@ in the environment or by setting simulate_cmdpath in DebugValues.""")
                         for p in os.listdir(self._statedir):
                                 progtrack.job_add_progress(
                                     progtrack.JOB_IMAGE_STATE)
+                                if p == self.__STATE_SOLVER_CACHE_FILE:
+                                        # The known catalog has changed, so
+                                        # the solver cache is outdated.
+                                        continue
                                 fp = os.path.join(self._statedir, p)
                                 if os.path.isfile(fp):
                                         portable.copyfile(fp,
@@ -2780,7 +2895,8 @@ in the environment or by setting simulate_cmdpath in DebugValues.""")
                 # image upgrade or metadata refresh.  In both cases, the catalog
                 # is resorted and finalized so this is always safe to use.
                 cat = pkg.catalog.Catalog(batch_mode=True,
-                    manifest_cb=self._manifest_cb, meta_root=croot, sign=False)
+                    manifest_cb=self._manifest_cb, meta_root=croot, sign=False,
+                    indexed=True)
                 return cat
 
         def __remove_catalogs(self):
@@ -2984,8 +3100,10 @@ in the environment or by setting simulate_cmdpath in DebugValues.""")
 
                 # Copy any regular files placed in the state directory
                 for p in os.listdir(self._statedir):
-                        if p == self.__STATE_UPDATING_FILE:
-                                # don't copy the state updating file
+                        if p in (self.__STATE_UPDATING_FILE,
+                            self.__STATE_SOLVER_CACHE_FILE):
+                                # don't copy the state updating file, or
+                                # the solver cache for the old catalog
                                 continue
                         fp = os.path.join(self._statedir, p)
                         if os.path.isfile(fp):
@@ -2993,7 +3111,7 @@ in the environment or by setting simulate_cmdpath in DebugValues.""")
 
                 kcat = pkg.catalog.Catalog(batch_mode=True,
                     meta_root=os.path.join(tmp_state_root,
-                    self.IMG_CATALOG_KNOWN), sign=False)
+                    self.IMG_CATALOG_KNOWN), sign=False, indexed=True)
 
                 # XXX if any of the below fails for any reason, the old 'known'
                 # catalog needs to be re-loaded so the client is in a consistent
@@ -3045,7 +3163,7 @@ in the environment or by setting simulate_cmdpath in DebugValues.""")
                 # Create the new installed catalog in a temporary location.
                 icat = pkg.catalog.Catalog(batch_mode=True,
                     meta_root=os.path.join(tmp_state_root,
-                    self.IMG_CATALOG_INSTALLED), sign=False)
+                    self.IMG_CATALOG_INSTALLED), sign=False, indexed=True)
 
                 excludes = self.list_excludes()
 
@@ -3324,24 +3442,37 @@ in the environment or by setting simulate_cmdpath in DebugValues.""")
                 total = 0
                 succeeded = set()
                 updated = self.__start_state_update()
-                for pub in pubs_to_refresh:
-                        total += 1
-                        progtrack.refresh_start_pub(pub)
-                        try:
-                                if pub.refresh(full_refresh=full_refresh,
-                                    immediate=immediate, progtrack=progtrack):
-                                        updated = True
-                        except apx.PermissionsException as e:
-                                failed.append((pub, e))
-                                # No point in continuing since no data can
-                                # be written.
-                                break
-                        except apx.ApiException as e:
-                                failed.append((pub, e))
-                                continue
-                        finally:
-                                progtrack.refresh_end_pub(pub)
-                        succeeded.add(pub.prefix)
+                fetched = self.__fetch_catalogs(pubs_to_refresh, full_refresh,
+                    immediate)
+                try:
+                        for pub in pubs_to_refresh:
+                                total += 1
+                                progtrack.refresh_start_pub(pub)
+                                try:
+                                        if pub.refresh(
+                                            full_refresh=full_refresh,
+                                            immediate=immediate,
+                                            progtrack=progtrack,
+                                            fetched=fetched.pop(pub.prefix,
+                                            None)):
+                                                updated = True
+                                except apx.PermissionsException as e:
+                                        failed.append((pub, e))
+                                        # No point in continuing since no data
+                                        # can be written.
+                                        break
+                                except apx.ApiException as e:
+                                        failed.append((pub, e))
+                                        continue
+                                finally:
+                                        progtrack.refresh_end_pub(pub)
+                                succeeded.add(pub.prefix)
+                finally:
+                        # Discard the data retrieved for publishers that
+                        # weren't refreshed.
+                        for pfetched in fetched.itervalues():
+                                for fetch in pfetched.itervalues():
+                                        fetch.discard()
 
                 progtrack.refresh_done()
 
@@ -3362,6 +3493,64 @@ in the environment or by setting simulate_cmdpath in DebugValues.""")
                         return
                 self.history.log_operation_end()
 
+        def __fetch_catalogs(self, pubs, full_refresh, immediate):
+                """Retrieve the catalog data that refreshing the publishers in
+                'pubs' needs from their origins, from several origins at once,
+                so that it can be merged into each publisher's catalog in turn
+                afterwards.  Returns a dictionary, indexed by publisher
+                prefix, of the 'fetched' dictionaries to pass to
+                Publisher.refresh().  Nothing is retrieved, and any errors are
+                left for the refresh to report, if the data can't be retrieved
+                this way."""
+
+                jobs = global_settings.PKG_CLIENT_REFRESH_CONCURRENCY
+                if jobs <= 1:
+                        return {}
+
+                fetches = []
+                for pub in pubs:
+                        try:
+                                fetches.extend(
+                                    (pub.prefix, opath, fetch)
+                                    for opath, fetch in pub.get_catalog_fetches(
+                                        full_refresh=full_refresh,
+                                        immediate=immediate)
+                                )
+                        except (apx.ApiException, EnvironmentError):
+                                continue
+                if len(fetches) <= 1:
+                        # Nothing would be retrieved at the same time.
+                        return {}
+
+                # A Transport's operations are serialized, so each thread
+                # uses its own.
+                jobs = min(jobs, len(fetches))
+                xports = Queue.Queue()
+                for i in range(jobs):
+                        xports.put(self.transport.copy())
+
+                def run(fetch):
+                        xport = xports.get()
+                        try:
+                                return fetch(xport)
+                        finally:
+                                xports.put(xport)
+
+                pool = ThreadPool(jobs)
+                try:
+                        results = pool.map(run,
+                            [fetch for prefix, opath, fetch in fetches])
+                finally:
+                        pool.terminate()
+                        pool.join()
+                        while not xports.empty():
+                                xports.get().shutdown()
+
+                fetched = {}
+                for (prefix, opath, fetch), result in zip(fetches, results):
+                        fetched.setdefault(prefix, {})[opath] = result
+                return fetched
+
         def _get_publisher_meta_dir(self):
                 if self.version >= 3:
                         return IMG_PUB_DIR
@@ -3514,14 +3703,7 @@ in the environment or by setting simulate_cmdpath in DebugValues.""")
                 if not progtrack:
                         progtrack = progress.NullProgressTracker()
 
-                self.__actdict = None
-                self.__actdict_timestamp = None
-                stripped_path = os.path.join(self.__action_cache_dir,
-                    "actions.stripped")
-                offsets_path = os.path.join(self.__action_cache_dir,
-                    "actions.offsets")
-                conflicting_keys_path = os.path.join(self.__action_cache_dir,
-                    "keys.conflicting")
+                self.__set_actdict(None, None)
 
                 excludes = self.list_excludes()
                 heap = []
@@ -3640,53 +3822,304 @@ in the environment or by setting simulate_cmdpath in DebugValues.""")
                         raise
 
                 progtrack.job_add_progress(progtrack.JOB_FAST_LOOKUP)
+                self.__install_fast_lookups(sp, op, bp, actdict,
+                    timestamp)
+
+                progtrack.job_add_progress(progtrack.JOB_FAST_LOOKUP)
+                progtrack.job_done(progtrack.JOB_FAST_LOOKUP)
+                return actdict, timestamp
+
+        def __install_fast_lookups(self, sp, op, bp, actdict, timestamp):
+                """Rename the temporary stripped actions, offsets, and
+                conflicting keys files 'sp', 'op', and 'bp' into their final
+                place, along with a binary index (see pkg.client.actionindex)
+                created from 'actdict' and 'timestamp'."""
+
+                # The binary index is only an optimization of the offsets
+                # file, so failing to write it isn't fatal.
+                xp = None
+                try:
+                        xf, xp = self.temporary_file(close=False)
+                        with os.fdopen(xf, "wb") as xf:
+                                actionindex.write(xf, timestamp, actdict)
+                        os.chmod(xp, misc.PKG_FILE_MODE)
+                except EnvironmentError:
+                        if xp:
+                                try:
+                                        os.unlink(xp)
+                                except:
+                                        pass
+                        xp = None
+
+                names = ("actions.stripped", "actions.offsets",
+                    "keys.conflicting", "actions.index")
+                tmps = (sp, op, bp, xp)
+
+                def install():
+                        for tmp, fname in zip(tmps, names):
+                                path = os.path.join(self.__action_cache_dir,
+                                    fname)
+                                if tmp is not None:
+                                        portable.rename(tmp, path)
+                                elif os.path.exists(path):
+                                        portable.remove(path)
 
-                # Finally, rename the temporary files into their final place.
                 # If we have any problems, do our best to remove them, and we'll
                 # try to recreate them on the read-side.
                 try:
                         if not os.path.exists(self.__action_cache_dir):
                                 os.makedirs(self.__action_cache_dir)
-                        portable.rename(sp, stripped_path)
-                        portable.rename(op, offsets_path)
-                        portable.rename(bp, conflicting_keys_path)
+                        install()
                 except EnvironmentError as e:
                         if e.errno == errno.EACCES or e.errno == errno.EROFS:
                                 self.__action_cache_dir = self.temporary_dir()
-                                stripped_path = os.path.join(
-                                    self.__action_cache_dir, "actions.stripped")
-                                offsets_path = os.path.join(
-                                    self.__action_cache_dir, "actions.offsets")
-                                conflicting_keys_path = os.path.join(
-                                    self.__action_cache_dir, "keys.conflicting")
-                                portable.rename(sp, stripped_path)
-                                portable.rename(op, offsets_path)
-                                portable.rename(bp, conflicting_keys_path)
+                                install()
                         else:
                                 exc_info = sys.exc_info()
-                                try:
-                                        os.unlink(stripped_path)
-                                        os.unlink(offsets_path)
-                                        os.unlink(conflicting_keys_path)
-                                except:
-                                        pass
+                                for fname in names:
+                                        try:
+                                                os.unlink(os.path.join(
+                                                    self.__action_cache_dir,
+                                                    fname))
+                                        except:
+                                                pass
                                 raise exc_info[0], exc_info[1], exc_info[2]
 
+        def _update_fast_lookups(self, removed, added, progtrack=None):
+                """Update the on-disk database moved aside by
+                _suspend_fast_lookups() so that it no longer contains the
+                actions of the packages in 'removed' and does contain those of
+                the packages in 'added', then put it back in place.  Only the
+                manifests of the added packages are loaded, and only the keys
+                touched by either set are re-checked for conflicts.  If the
+                database is missing or can't be parsed, it is rebuilt from
+                scratch instead."""
+
+                if not progtrack:
+                        progtrack = progress.NullProgressTracker()
+
+                try:
+                        try:
+                                self.__update_fast_lookups(removed, added,
+                                    progtrack)
+                        except EnvironmentError as e:
+                                if e.errno != errno.ENOENT:
+                                        raise
+                                # The previous database is missing.
+                                progtrack.job_done(progtrack.JOB_FAST_LOOKUP)
+                                self._create_fast_lookups(progtrack=progtrack)
+                        except (ValueError, pkg.actions.ActionError,
+                            pkg.fmri.FmriError):
+                                # The previous database is corrupt or out of
+                                # sync.
+                                progtrack.job_done(progtrack.JOB_FAST_LOOKUP)
+                                self._create_fast_lookups(progtrack=progtrack)
+                finally:
+                        self.__remove_fast_lookups(suffix=".prev")
+
+        def __update_fast_lookups(self, removed, added, progtrack):
+                """Implementation of _update_fast_lookups."""
+
+                from heapq import merge
+
+                self.__set_actdict(None, None)
+                stripped_path = os.path.join(self.__action_cache_dir,
+                    "actions.stripped.prev")
+                offsets_path = os.path.join(self.__action_cache_dir,
+                    "actions.offsets.prev")
+                conflicting_keys_path = os.path.join(self.__action_cache_dir,
+                    "keys.conflicting.prev")
+
+                progtrack.job_start(progtrack.JOB_FAST_LOOKUP)
+
+                with open(conflicting_keys_path, "rb") as fh:
+                        if fh.readline().rstrip() != "VERSION 1":
+                                raise ValueError(conflicting_keys_path)
+                        bad_keys = set(l.rstrip() for l in fh)
+
+                osf = open(stripped_path, "rb")
+                oof = open(offsets_path, "rb")
+                if osf.readline().rstrip() != "VERSION 1" or \
+                    oof.readline().rstrip() != "VERSION 2" or \
+                    osf.readline() != oof.readline():
+                        osf.close()
+                        oof.close()
+                        raise ValueError(offsets_path)
+
+                # Keys whose set of actions has changed; only these need to be
+                # checked for conflicts again.
+                touched = set()
+                removed = set(str(f) for f in removed)
+
+                def gen_old():
+                        # The offsets file lists the (name, key) pairs in
+                        # order, along with the lines of the stripped file that
+                        # belong to each.
+                        for line in oof:
+                                name, offset, cnt, key = \
+                                    line.rstrip("\n").split(None, 3)
+                                if int(offset) != osf.tell():
+                                        raise ValueError(offsets_path)
+                                lines = []
+                                for i in xrange(int(cnt)):
+                                        aline = osf.readline()
+                                        if not aline.endswith("\n"):
+                                                raise ValueError(stripped_path)
+                                        if aline.split(" ", 1)[0] in removed:
+                                                touched.add(key)
+                                                continue
+                                        lines.append(aline)
+                                yield name, key, lines
+
+                excludes = self.list_excludes()
+                new = []
+                for pfmri in added:
+                        progtrack.job_add_progress(progtrack.JOB_FAST_LOOKUP)
+                        m = self.get_manifest(pfmri, ignore_excludes=True)
+                        for act in m.gen_actions(excludes=excludes):
+                                if not act.globally_identical:
+                                        continue
+                                act.strip()
+                                key = act.attrs[act.key_attr]
+                                touched.add(key)
+                                new.append((act.name, key, pfmri, act))
+                new.sort()
+
+                def gen_new():
+                        for (name, key), items in itertools.groupby(new,
+                            lambda item: item[:2]):
+                                yield name, key, [
+                                    "{0} {1}\n".format(item[2], item[3])
+                                    for item in items
+                                ]
+
+                progtrack.job_add_progress(progtrack.JOB_FAST_LOOKUP)
+
+                try:
+                        actdict = {}
+                        sf, sp = self.temporary_file(close=False)
+                        of, op = self.temporary_file(close=False)
+                        bf, bp = self.temporary_file(close=False)
+
+                        sf = os.fdopen(sf, "wb")
+                        of = os.fdopen(of, "wb")
+                        bf = os.fdopen(bf, "wb")
+
+                        timestamp = int(time.time())
+                        sf.write("VERSION 1\n{0}\n".format(timestamp))
+                        of.write("VERSION 2\n{0}\n".format(timestamp))
+                        bf.write("VERSION 1\n")
+
+                        # Both sources are ordered by name and key, so a
+                        # single merge pass produces a correctly ordered
+                        # database; any actions for the same name and key are
+                        # written together.
+                        for (name, key), groups in itertools.groupby(
+                            merge(gen_old(), gen_new()),
+                            lambda group: group[:2]):
+                                lines = [
+                                    l
+                                    for group in groups
+                                    for l in group[2]
+                                ]
+                                if not lines:
+                                        continue
+                                offset = sf.tell()
+                                of.write("{0} {1} {2} {3}\n".format(name,
+                                    offset, len(lines), key))
+                                actdict[(name, key)] = offset, len(lines)
+                                sf.writelines(lines)
+                        osf.close()
+                        oof.close()
+
+                        progtrack.job_add_progress(progtrack.JOB_FAST_LOOKUP)
+
+                        # Rebuild the namespace dictionary (see
+                        # _create_fast_lookups) for the touched keys only.
+                        nsd = {}
+                        sf.flush()
+                        with open(sp, "rb") as rsf:
+                                for (name, key), (offset, cnt) in \
+                                    actdict.iteritems():
+                                        if key not in touched:
+                                                continue
+                                        rsf.seek(offset)
+                                        for i in xrange(cnt):
+                                                fmristr, actstr = \
+                                                    rsf.readline().rstrip(
+                                                    "\n").split(" ", 1)
+                                                act = pkg.actions.fromstr(
+                                                    actstr)
+                                                nsd.setdefault(
+                                                    act.namespace_group, {})
+                                                nsd[act.namespace_group] \
+                                                    .setdefault(key, []) \
+                                                    .append((act,
+                                                    pkg.fmri.PkgFmri(fmristr)))
+
+                        bad_keys -= touched
+                        bad_keys |= imageplan.ImagePlan._check_actions(nsd)
+                        for k in sorted(bad_keys):
+                                bf.write("{0}\n".format(k))
+
+                        progtrack.job_add_progress(progtrack.JOB_FAST_LOOKUP)
+                        sf.close()
+                        of.close()
+                        bf.close()
+                        os.chmod(sp, misc.PKG_FILE_MODE)
+                        os.chmod(op, misc.PKG_FILE_MODE)
+                        os.chmod(bp, misc.PKG_FILE_MODE)
+                except BaseException as e:
+                        try:
+                                osf.close()
+                                oof.close()
+                                os.unlink(sp)
+                                os.unlink(op)
+                                os.unlink(bp)
+                        except:
+                                pass
+                        raise
+
+                self.__install_fast_lookups(sp, op, bp, actdict,
+                    timestamp)
+
                 progtrack.job_add_progress(progtrack.JOB_FAST_LOOKUP)
                 progtrack.job_done(progtrack.JOB_FAST_LOOKUP)
                 return actdict, timestamp
 
+        def _suspend_fast_lookups(self):
+                """Move the on-disk database created by _create_fast_lookups
+                aside.  Should be called before updating image state to prevent
+                the client from seeing stale state if the update is
+                interrupted; _update_fast_lookups will then use the database
+                that was moved aside to create the new one."""
+
+                self.__remove_fast_lookups(suffix=".prev")
+                for fname in ("actions.stripped", "actions.offsets",
+                    "keys.conflicting", "actions.index"):
+                        path = os.path.join(self.__action_cache_dir, fname)
+                        try:
+                                portable.rename(path, path + ".prev")
+                        except EnvironmentError as e:
+                                if e.errno == errno.ENOENT:
+                                        continue
+                                raise apx._convert_error(e)
+
         def _remove_fast_lookups(self):
                 """Remove on-disk database created by _create_fast_lookups.
                 Should be called before updating image state to prevent the
                 client from seeing stale state if _create_fast_lookups is
                 interrupted."""
 
+                self.__remove_fast_lookups()
+                self.__remove_fast_lookups(suffix=".prev")
+
+        def __remove_fast_lookups(self, suffix=""):
                 for fname in ("actions.stripped", "actions.offsets",
-                    "keys.conflicting"):
+                    "keys.conflicting", "actions.index"):
                         try:
                                 portable.remove(os.path.join(
-                                    self.__action_cache_dir, fname))
+                                    self.__action_cache_dir, fname + suffix))
                         except EnvironmentError as e:
                                 if e.errno == errno.ENOENT:
                                         continue
@@ -3695,7 +4128,13 @@ in the environment or by setting simulate_cmdpath in DebugValues.""")
         def _load_actdict(self, progtrack):
                 """Read the file of offsets created in _create_fast_lookups()
                 and return the dictionary mapping action name and key value to
-                offset."""
+                offset.  If the binary index of that file is usable, a
+                pkg.client.actionindex.ActionIndex is returned instead; it
+                supports the get() method of the dictionary."""
+
+                actdict = self.__load_actindex()
+                if actdict is not None:
+                        return actdict
 
                 try:
                         of = open(os.path.join(self.__action_cache_dir,
@@ -3705,8 +4144,7 @@ in the environment or by setting simulate_cmdpath in DebugValues.""")
                                 raise
                         actdict, otimestamp = self._create_fast_lookups()
                         assert actdict is not None
-                        self.__actdict = actdict
-                        self.__actdict_timestamp = otimestamp
+                        self.__set_actdict(actdict, otimestamp)
                         return actdict
 
                 # Make sure the files are paired, and try to create them if not.
@@ -3729,8 +4167,7 @@ in the environment or by setting simulate_cmdpath in DebugValues.""")
                         of.close()
                         actdict, otimestamp = self._create_fast_lookups()
                         assert actdict is not None
-                        self.__actdict = actdict
-                        self.__actdict_timestamp = otimestamp
+                        self.__set_actdict(actdict, otimestamp)
                         return actdict
 
                 # At this point, the original actions.offsets file existed, no
@@ -3755,10 +4192,53 @@ in the environment or by setting simulate_cmdpath in DebugValues.""")
                                     progtrack.PLAN_ACTION_CONFLICT)
 
                 of.close()
-                self.__actdict = actdict
-                self.__actdict_timestamp = otimestamp
+                self.__set_actdict(actdict, otimestamp)
                 return actdict
 
+        def __set_actdict(self, actdict, timestamp):
+                """Replace the action dictionary returned by _load_actdict(),
+                unmapping the previous one if it's an ActionIndex."""
+
+                if self.__actdict is not actdict and \
+                    isinstance(self.__actdict, actionindex.ActionIndex):
+                        self.__actdict.close()
+                self.__actdict = actdict
+                self.__actdict_timestamp = timestamp
+
+        def __load_actindex(self):
+                """Map the binary index created by _create_fast_lookups() and
+                return it, or return None if it is missing, unreadable, or
+                doesn't match the actions.stripped file."""
+
+                if DebugValues["text-actdict"]:
+                        return None
+
+                try:
+                        idx = actionindex.ActionIndex(os.path.join(
+                            self.__action_cache_dir, "actions.index"))
+                except (EnvironmentError, ValueError):
+                        return None
+
+                stimestamp = str(idx.timestamp)
+                if isinstance(self.__actdict, actionindex.ActionIndex) and \
+                    stimestamp == self.__actdict_timestamp:
+                        idx.close()
+                        return self.__actdict
+
+                try:
+                        sversion, stimestamp = \
+                            self._get_stripped_actions_file(internal=True)
+                except EnvironmentError:
+                        idx.close()
+                        return None
+                if sversion != "VERSION 1" or \
+                    stimestamp != str(idx.timestamp):
+                        idx.close()
+                        return None
+
+                self.__set_actdict(idx, stimestamp)
+                return idx
+
         def _get_stripped_actions_file(self, internal=False):
                 """Open the actions file described in _create_fast_lookups() and
                 return the corresponding file object."""
@@ -3831,12 +4311,16 @@ in the environment or by setting simulate_cmdpath in DebugValues.""")
                 uid = self._usersbyname.get(name, None)
                 if uid is not None:
                         return uid
+                if self._user_db and self.type != IMG_USER:
+                        return self._user_db.get_user_by_name(name)
                 return portable.get_user_by_name(name, self.root,
                     self.type != IMG_USER)
 
         def get_name_by_uid(self, uid, returnuid = False):
                 # XXX What to do about IMG_PARTIAL?
                 try:
+                        if self._user_db and self.type != IMG_USER:
+                                return self._user_db.get_name_by_uid(uid)
                         return portable.get_name_by_uid(uid, self.root,
                             self.type != IMG_USER)
                 except KeyError:
@@ -3849,11 +4333,15 @@ in the environment or by setting simulate_cmdpath in DebugValues.""")
                 gid = self._groupsbyname.get(name, None)
                 if gid is not None:
                         return gid
+                if self._user_db and self.type != IMG_USER:
+                        return self._user_db.get_group_by_name(name)
                 return portable.get_group_by_name(name, self.root,
                     self.type != IMG_USER)
 
         def get_name_by_gid(self, gid, returngid = False):
                 try:
+                        if self._user_db and self.type != IMG_USER:
+                                return self._user_db.get_name_by_gid(gid)
                         return portable.get_name_by_gid(gid, self.root,
                             self.type != IMG_USER)
                 except KeyError:
@@ -4490,12 +4978,13 @@ in the environment or by setting simulate_cmdpath in DebugValues.""")
                     noexecute, publishers=publishers)
                 progtrack.plan_all_done()
 
-        def make_fix_plan(self, op, progtrack, check_cancel, noexecute, args):
+        def make_fix_plan(self, op, progtrack, check_cancel, noexecute, args,
+            rehash=False):
                 """Create an image plan to fix the image."""
 
                 progtrack.plan_all_start()
                 self.__make_plan_common(op, progtrack, check_cancel, noexecute,
-                    args=args)
+                    args=args, rehash=rehash)
                 progtrack.plan_all_done()
 
         def make_noop_plan(self, op, progtrack, check_cancel,
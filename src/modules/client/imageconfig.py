@@ -64,6 +64,7 @@ EXCLUDE_PATTERNS = "exclude-patterns"
 KEY_FILES = "key-files"
 DEFAULT_RECURSE = "default-recurse"
 DEFAULT_CONCURRENCY = "recursion-concurrency"
+VERIFY_CONCURRENCY = "verify-concurrency"
 
 default_policies = {
     BE_POLICY: "default",
@@ -89,6 +90,7 @@ default_properties = {
         # Path default is intentionally relative for this case.
         "trust-anchor-directory": os.path.join("etc", "ssl", "pkg"),
         DEFAULT_CONCURRENCY: 1,
+        VERIFY_CONCURRENCY: 1,
 }
 
 # Assume the repository metadata should be checked no more than once every
@@ -204,6 +206,9 @@ class ImageConfig(cfg.FileConfig):
                     cfg.PropInt(DEFAULT_CONCURRENCY,
                         minimum=0,
                         default=default_properties[DEFAULT_CONCURRENCY]),
+                    cfg.PropInt(VERIFY_CONCURRENCY,
+                        minimum=0,
+                        default=default_properties[VERIFY_CONCURRENCY]),
                 ]),
                 cfg.PropertySection("facet", properties=[
                     cfg.PropertyTemplate("^facet\..*", prop_type=cfg.PropBool),
@@ -66,6 +66,11 @@ import pkg.mediator as med
 import pkg.search_errors as se
 import pkg.version
 
+try:
+        import pkg.cfgfiles as cfgfiles
+except ImportError:
+        cfgfiles = None
+
 from pkg.client.debugvalues import DebugValues
 from pkg.client.plandesc import _ActionPlan
 from pkg.mediator import mediator_impl_matches
@@ -405,11 +410,26 @@ class ImagePlan(object):
                 operation once while relaxing installed parent
                 dependencies."""
 
+                # The catalog information looked up by the solver is kept for
+                # later plans, whether or not a solution is found.
+                solver_cache = self.image.get_solver_cache()
+                try:
+                        return self.__run_solver_cb(solver_cb, solver_cache,
+                            retry_wo_parent_deps)
+                finally:
+                        if solver_cache is not None:
+                                solver_cache.save()
+
+        def __run_solver_cb(self, solver_cb, solver_cache,
+            retry_wo_parent_deps):
+                """Private helper function for __run_solver that calls
+                solver_cb with the solver cache 'solver_cache'."""
+
                 # have the solver try to satisfy parent dependencies.
                 ignore_inst_parent_deps = False
 
                 try:
-                        return solver_cb(ignore_inst_parent_deps)
+                        return solver_cb(ignore_inst_parent_deps, solver_cache)
                 except api_errors.PlanCreationException as e:
                         # if we're currently in sync don't retry the
                         # operation
@@ -432,7 +452,7 @@ class ImagePlan(object):
                         # user won't be able to take the image further
                         # out of sync.
                         ignore_inst_parent_deps = True
-                        return solver_cb(ignore_inst_parent_deps)
+                        return solver_cb(ignore_inst_parent_deps, solver_cache)
 
         def __add_actuator(self, trigger_fmri, trigger_op, exec_op, values,
             solver_inst, installed_dict):
@@ -610,7 +630,7 @@ class ImagePlan(object):
                         installed_dict_tmp = installed_dict.copy()
                         installed_dict = {}
 
-                def solver_cb(ignore_inst_parent_deps):
+                def solver_cb(ignore_inst_parent_deps, solver_cache):
                         avoid_set = self.image.avoid_set_get()
                         frozen_list = self.image.get_frozen_list()
                         # If exact_install is on, ignore avoid_set and
@@ -628,7 +648,7 @@ class ImagePlan(object):
                             variants,
                             avoid_set,
                             self.image.linked.parent_fmris(),
-                            self.__progtrack)
+                            self.__progtrack, solver_cache=solver_cache)
 
                         if reject_set:
                                 self.__set_pkg_actuators(reject_set,
@@ -1205,7 +1225,7 @@ class ImagePlan(object):
                 installed_dict = ImagePlan.__fmris2dict(
                     self.image.gen_installed_pkgs())
 
-                def solver_cb(ignore_inst_parent_deps):
+                def solver_cb(ignore_inst_parent_deps, solver_cache):
                         # instantiate solver
                         solver = pkg_solver.PkgSolver(
                             self.image.get_catalog(
@@ -1215,7 +1235,7 @@ class ImagePlan(object):
                             self.image.get_variants(),
                             self.image.avoid_set_get(),
                             self.image.linked.parent_fmris(),
-                            self.__progtrack)
+                            self.__progtrack, solver_cache=solver_cache)
 
                         # check for triggered ops
                         self.__set_pkg_actuators(pkgs_to_uninstall,
@@ -1281,7 +1301,7 @@ class ImagePlan(object):
                             reject_set=reject_set)
                         self.__match_update = references
 
-                def solver_cb(ignore_inst_parent_deps):
+                def solver_cb(ignore_inst_parent_deps, solver_cache):
                         # instantiate solver
                         solver = pkg_solver.PkgSolver(
                             self.image.get_catalog(
@@ -1291,7 +1311,7 @@ class ImagePlan(object):
                             self.image.get_variants(),
                             self.image.avoid_set_get(),
                             self.image.linked.parent_fmris(),
-                            self.__progtrack)
+                            self.__progtrack, solver_cache=solver_cache)
 
                         if reject_set:
                                 self.__set_pkg_actuators(reject_set,
@@ -1572,8 +1592,12 @@ class ImagePlan(object):
                             mode=mode, owner="root",
                             group="bin", path=pubpath)
 
-        def plan_fix(self, args):
-                """Determine the changes needed to fix the image."""
+        def plan_fix(self, args, rehash=False):
+                """Determine the changes needed to fix the image.
+
+                Files whose content was found to match when the image was last
+                verified, and which haven't changed since, aren't read again
+                unless 'rehash' is True."""
 
                 self.__plan_op()
                 self.__evaluate_excludes()
@@ -1600,9 +1624,14 @@ class ImagePlan(object):
                 if proposed_fixes:
                         pt.plan_start(pt.PLAN_PKG_VERIFY, goal=len(proposed_fixes))
                 repairs = []
-
-                for pfmri in proposed_fixes:
-                        entries = []
+                vcache = self.image.get_verify_cache(rehash=rehash)
+                jobs = self.image.get_property(imageconfig.VERIFY_CONCURRENCY)
+                if jobs < 1:
+                        jobs = os.sysconf("SC_NPROCESSORS_ONLN")
+
+                for pfmri, entries in self.image.gen_verify(proposed_fixes,
+                    pt, jobs=jobs, verbose=True, forever=True,
+                    verify_cache=vcache):
                         needs_fix = []
                         result = _("OK")
                         failed = False
@@ -1615,8 +1644,7 @@ class ImagePlan(object):
                         # for each package must be accumulated first to find
                         # an overall success/failure result and then the
                         # related messages output for it.
-                        for act, errors, warnings, pinfo in self.image.verify(
-                            pfmri, pt, verbose=True, forever=True):
+                        for act, errors, warnings, pinfo in entries:
                                 # determine the package's status and message
                                 # type
                                 if errors:
@@ -1631,8 +1659,6 @@ class ImagePlan(object):
                                         result = _("WARNING")
                                         msg_type = MSG_WARNING
 
-                                entries.append((act, errors, warnings, pinfo))
-
                         self.pd.add_item_message(ffmri, timestamp,
                             msg_type, _("{pkg_name:70} {result:>7}").format(
                             pkg_name=pfmri.get_pkg_stem(),
@@ -1675,6 +1701,10 @@ class ImagePlan(object):
                 if proposed_fixes:
                         pt.plan_done(pt.PLAN_PKG_VERIFY)
 
+                # Entries for files no longer in the image are only dropped
+                # when the whole image has been verified.
+                vcache.save(prune=not args)
+
                 # Repair anything we failed to verify
                 if not repairs:
                         # No repairs for this image.
@@ -4486,9 +4516,7 @@ class ImagePlan(object):
                                 raise api_errors.PlanLicenseErrors(lic_errors)
 
                         try:
-                                for p in self.pd.pkg_plans:
-                                        p.download(self.__progtrack,
-                                            self.__check_cancel)
+                                self.__download()
                         except EnvironmentError as e:
                                 if e.errno == errno.EACCES:
                                         raise api_errors.PermissionsException(
@@ -4497,11 +4525,6 @@ class ImagePlan(object):
                                         raise api_errors.ReadOnlyFileSystemException(
                                             e.filename)
                                 raise
-                        except (api_errors.InvalidDepotResponseException,
-                            api_errors.TransportError) as e:
-                                if p and p._autofix_pkgs:
-                                        e._autofix_pkgs = p._autofix_pkgs
-                                raise
 
                         self.image.transport.shutdown()
                         self.__progtrack.download_done()
@@ -4519,6 +4542,77 @@ class ImagePlan(object):
                             pd_json1, pd_json2, pd_json1, pd_json2)
                         del pd_json1, pd_json2
 
+        def __download(self):
+                """Retrieve the data needed by all of the package plans.  The
+                files needed by every package are queued at once so that the
+                transport can keep all of its connections busy; the
+                'serial-download' debug value retrieves them one package at
+                a time instead."""
+
+                if DebugValues["serial-download"]:
+                        p = None
+                        try:
+                                for p in self.pd.pkg_plans:
+                                        p.download(self.__progtrack,
+                                            self.__check_cancel)
+                        except (api_errors.InvalidDepotResponseException,
+                            api_errors.TransportError) as e:
+                                if p and p._autofix_pkgs:
+                                        e._autofix_pkgs = p._autofix_pkgs
+                                raise
+                        return
+
+                mplan = self.image.transport.multi_file_plan(
+                    self.__progtrack, self.__check_cancel)
+                try:
+                        for p in self.pd.pkg_plans:
+                                p.queue_download(mplan)
+                        mplan.wait_files()
+                except (api_errors.InvalidDepotResponseException,
+                    api_errors.TransportError) as e:
+                        # Attribute the failure to the packages whose files
+                        # could not be retrieved.
+                        failed = mplan.get_failed_pkgs()
+                        autofix = []
+                        for p in self.pd.pkg_plans:
+                                if p.get_xferfmri() in failed:
+                                        autofix.extend(p._autofix_pkgs)
+                        if autofix:
+                                e._autofix_pkgs = autofix
+                        raise
+
+        def __sync_user_db(self, act):
+                """Called before 'act' is executed.  Each run of consecutive
+                user and group actions shares a single UserDatabase, so that
+                the user database files are read and written only once for
+                all of them; it's written back before any other action is
+                executed, since that action may depend on the result.  The
+                actions of each phase are already sorted by type, and group
+                and user actions are adjacent in that order, so all of those
+                in a phase form a single run."""
+
+                if act.name in ("user", "group"):
+                        if self.image._user_db is None and cfgfiles and \
+                            cfgfiles.UserDatabase.available(self.image):
+                                self.image._user_db = \
+                                    cfgfiles.UserDatabase(self.image)
+                else:
+                        self.__end_user_db()
+
+        def __end_user_db(self, flush=True):
+                """Write back the UserDatabase in use, if any, unless 'flush'
+                is False, and release it."""
+
+                db = self.image._user_db
+                if db is None:
+                        return
+                self.image._user_db = None
+                try:
+                        if flush:
+                                db.flush()
+                finally:
+                        db.close()
+
         def execute(self):
                 """Invoke the evaluated image plan
                 preexecute, execute and postexecute
@@ -4609,10 +4703,10 @@ class ImagePlan(object):
                 empty_image = self.__is_image_empty()
 
                 if not empty_image:
-                        # Before proceeding, remove fast lookups database so
-                        # that if _create_fast_lookups is interrupted later the
-                        # client isn't left with invalid state.
-                        self.image._remove_fast_lookups()
+                        # Before proceeding, move the fast lookups database
+                        # aside so that if the update of it is interrupted
+                        # later the client isn't left with invalid state.
+                        self.image._suspend_fast_lookups()
 
                 if not self.image.is_liveroot():
                         # Check if the child is a running zone. If so run the
@@ -4648,9 +4742,11 @@ class ImagePlan(object):
 
                                 # execute removals
                                 for p, src, dest in self.pd.removal_actions:
+                                        self.__sync_user_db(src)
                                         p.execute_removal(src, dest)
                                         pt.actions_add_progress(
                                             pt.ACTION_REMOVE)
+                                self.__end_user_db()
                                 pt.actions_done(pt.ACTION_REMOVE)
 
                                 # Update driver alias database to reflect the
@@ -4668,9 +4764,11 @@ class ImagePlan(object):
 
                                 # execute installs
                                 for p, src, dest in self.pd.install_actions:
+                                        self.__sync_user_db(dest)
                                         p.execute_install(src, dest)
                                         pt.actions_add_progress(
                                             pt.ACTION_INSTALL)
+                                self.__end_user_db()
                                 pt.actions_done(pt.ACTION_INSTALL)
 
                                 # Done with installs, so discard them so memory
@@ -4679,9 +4777,11 @@ class ImagePlan(object):
 
                                 # execute updates
                                 for p, src, dest in self.pd.update_actions:
+                                        self.__sync_user_db(dest)
                                         p.execute_update(src, dest)
                                         pt.actions_add_progress(
                                             pt.ACTION_UPDATE)
+                                self.__end_user_db()
 
                                 pt.actions_done(pt.ACTION_UPDATE)
                                 pt.actions_all_done()
@@ -4743,6 +4843,10 @@ class ImagePlan(object):
                                             "and try again.").format(
                                             e.filename))
                                 raise
+                        finally:
+                                # Changes to the user database made by a failed
+                                # series of actions are discarded.
+                                self.__end_user_db(flush=False)
                 except pkg.actions.ActionError:
                         exc_type, exc_value, exc_tb = sys.exc_info()
                         self.pd.state = plandesc.EXECUTED_ERROR
@@ -4768,7 +4872,19 @@ class ImagePlan(object):
                 else:
                         self.pd._actuators.exec_post_actuators(self.image)
 
-                self.image._create_fast_lookups(progtrack=self.__progtrack)
+                if empty_image or self.pd._new_variants or \
+                    self.pd._new_facets is not None:
+                        # The set of excluded actions may have changed for
+                        # every installed package, so start over.
+                        self.image._create_fast_lookups(
+                            progtrack=self.__progtrack)
+                else:
+                        self.image._update_fast_lookups(
+                            [p.origin_fmri for p in self.pd.pkg_plans
+                                if p.origin_fmri],
+                            [p.destination_fmri for p in self.pd.pkg_plans
+                                if p.destination_fmri],
+                            progtrack=self.__progtrack)
                 self.__save_release_notes()
 
                 # success
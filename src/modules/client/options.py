@@ -78,6 +78,7 @@ ORIGINS               = "origins"
 PARSABLE_VERSION      = "parsable_version"
 QUIET                 = "quiet"
 REFRESH_CATALOGS      = "refresh_catalogs"
+REHASH                = "rehash"
 REJECT_PATS           = "reject_pats"
 REQUIRE_BACKUP_BE     = "require_backup_be"
 REQUIRE_NEW_BE        = "require_new_be"
@@ -1220,12 +1221,17 @@ opts_dehydrate = \
     opts_table_publishers + \
     []
 
+opts_table_rehash = [
+    (REHASH,               False, [], {"type": "boolean"}),
+]
+
 opts_fix = \
     opts_table_beopts + \
     opts_table_nqv + \
     opts_table_licenses + \
     opts_table_no_headers + \
     opts_table_parsable + \
+    opts_table_rehash + \
     []
 
 opts_verify = \
@@ -1233,6 +1239,7 @@ opts_verify = \
     opts_table_verbose + \
     opts_table_no_headers + \
     opts_table_parsable + \
+    opts_table_rehash + \
     [
     opts_table_cb_nqv
 ]
@@ -118,19 +118,23 @@ class PkgSolver(object):
         operation."""
 
         def __init__(self, cat, installed_dict, pub_ranks, variants, avoids,
-            parent_pkgs, progtrack):
+            parent_pkgs, progtrack, solver_cache=None):
                 """Create a PkgSolver instance; catalog should contain all
                 known pkgs, installed fmris should be a dict of fmris indexed
                 by name that define pkgs current installed in the image.
                 Pub_ranks dict contains (rank, stickiness, enabled) for each
                 publisher.  variants are the current image variants; avoids is
-                the set of pkg stems being avoided in the image."""
+                the set of pkg stems being avoided in the image.  If provided,
+                solver_cache is a pkg.client.solvercache.SolverCache for the
+                catalog, used to look up the dependency information of
+                packages."""
 
                 # check if we're allowed to use the solver
                 if DebugValues["no_solver"]:
                         raise RuntimeError("no_solver set, but solver invoked")
 
                 self.__catalog = cat
+                self.__solver_cache = solver_cache
                 self.__known_incs = set()       # stems with incorporate deps
                 self.__publisher = {}           # indexed by stem
                 self.__possible_dict = defaultdict(list) # indexed by stem
@@ -255,6 +259,7 @@ class PkgSolver(object):
                 be performed after a solution is successfully returned."""
 
                 self.__catalog = None
+                self.__solver_cache = None
                 self.__installed_dict = {}
                 self.__installed_pkgs = frozenset()
                 self.__installed_fmris = frozenset()
@@ -1647,14 +1652,25 @@ class PkgSolver(object):
                 return self.__comb_common(fmri, dotrim, version.CONSTRAINT_AUTO,
                     obsolete_ok)
 
+        def __get_entry_actions(self, fmri, excludes=EmptyI):
+                """Return the actions in the Catalog.DEPENDENCY section of the
+                catalog entry for this fmri, using the solver cache if there
+                is one."""
+
+                if self.__solver_cache is None:
+                        return self.__catalog.get_entry_actions(fmri,
+                            [catalog.Catalog.DEPENDENCY], excludes=excludes)
+                return self.__solver_cache.get_entry_actions(fmri,
+                    excludes=excludes)
+
         def __fmri_loadstate(self, fmri, excludes):
                 """load fmri state (obsolete == True, renamed == True)"""
 
                 try:
                         relevant = dict([
                                 (a.attrs["name"], a.attrs["value"])
-                                for a in self.__catalog.get_entry_actions(fmri,
-                                [catalog.Catalog.DEPENDENCY], excludes=excludes)
+                                for a in self.__get_entry_actions(fmri,
+                                    excludes)
                                 if a.name == "set" and \
                                     a.attrs["name"] in ["pkg.renamed",
                                     "pkg.obsolete"]
@@ -1695,8 +1711,7 @@ class PkgSolver(object):
                 try:
                         self.__actcache[(fmri, name)] = [
                             a
-                            for a in self.__catalog.get_entry_actions(fmri,
-                            [catalog.Catalog.DEPENDENCY], excludes=excludes)
+                            for a in self.__get_entry_actions(fmri, excludes)
                             if a.name == name
                         ]
                         return self.__actcache[(fmri, name)]
@@ -1729,8 +1744,11 @@ class PkgSolver(object):
                 """Return dictionary of variants suppported by fmri"""
                 try:
                         if fmri not in self.__variant_dict:
+                                source = self.__solver_cache
+                                if source is None:
+                                        source = self.__catalog
                                 self.__variant_dict[fmri] = dict(
-                                    self.__catalog.get_entry_all_variants(fmri))
+                                    source.get_entry_all_variants(fmri))
                 except api_errors.InvalidPackageErrors:
                         # Trim package entries that have unparseable action data
                         # so that they can be filtered out later.
@@ -2681,8 +2699,7 @@ class PkgSolver(object):
 
                 installed_incs = []
                 for f in self.__installed_fmris - self.__removal_fmris:
-                        for d in self.__catalog.get_entry_actions(f,
-                            [catalog.Catalog.DEPENDENCY], excludes=excludes):
+                        for d in self.__get_entry_actions(f, excludes):
                                 if (d.name == "set" and d.attrs["name"] ==
                                     "pkg.depend.install-hold"):
                                         installed_incs.append(f)
@@ -2710,9 +2727,7 @@ class PkgSolver(object):
                 # dependencies, those packages that are depended on by explict
                 # version, and those that have pkg.depend.install-hold values.
                 for f in self.__installed_fmris - self.__removal_fmris:
-                        for d in self.__catalog.get_entry_actions(f,
-                            [catalog.Catalog.DEPENDENCY],
-                            excludes=excludes):
+                        for d in self.__get_entry_actions(f, excludes):
                                 if d.name == "depend":
                                         fmris = []
                                         for fl in d.attrlist("fmri"):
@@ -537,6 +537,17 @@ class PkgPlan(object):
                 mfile.wait_files()
                 progtrack.download_end_pkg(self.get_xferfmri())
 
+        def queue_download(self, mplan):
+                """Add data for any actions that need it to the plan-wide
+                download object 'mplan'; the data is retrieved when the
+                caller waits for mplan's files."""
+
+                mplan.add_package(self.get_xferfmri(), (
+                    dest
+                    for src, dest in itertools.chain(*self.actions)
+                    if dest and dest.needsdata(src, self)
+                ))
+
         def cacheload(self):
                 """Load previously downloaded data for actions that need it."""
 
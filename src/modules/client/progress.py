@@ -36,6 +36,7 @@ import itertools
 import math
 import sys
 import simplejson as json
+import threading
 import time
 from functools import wraps
 
@@ -1709,6 +1710,38 @@ class MultiProgressTracker(ProgressTrackerFrontend):
                 return
 
 
+class LockedProgressTracker(ProgressTrackerFrontend):
+        """This class is a proxy, passing incoming progress tracking calls
+        on to another progress tracker (in self._tracker) one at a time, so
+        that progress can be recorded from several threads at once without
+        the tracker's counts or output being garbled.
+
+        As with MultiProgressTracker, each of the methods of the front-end
+        superclass is replaced with a closure, which calls the contained
+        tracker's method with a lock held."""
+
+        def __init__(self, tracker):
+                ProgressTrackerFrontend.__init__(self)
+
+                self._tracker = tracker
+                self._lock = threading.RLock()
+
+                def make_locked(method_name):
+                        f = getattr(tracker, method_name)
+                        def locked(*args, **kwargs):
+                                with self._lock:
+                                        return f(*args, **kwargs)
+                        return locked
+
+                for methname, m in ProgressTrackerFrontend.__dict__.iteritems():
+                        if methname == "__init__":
+                                continue
+                        if not inspect.isfunction(m):
+                                continue
+                        setattr(self, methname, make_locked(methname))
+                return
+
+
 class QuietProgressTracker(ProgressTracker):
         """This progress tracker outputs nothing, but is semantically
         intended to be "quiet."  See also NullProgressTracker below."""
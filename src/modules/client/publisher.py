@@ -44,6 +44,7 @@ import hashlib
 import os
 import pycurl
 import shutil
+import sys
 import tempfile
 import time
 import urllib
@@ -142,6 +143,13 @@ POSSIBLE_USES = [CODE_SIGNING_USE, CERT_SIGNING_USE, CRL_SIGNING_USE]
 # system-repository.
 SYSREPO_PROXY = "<sysrepo>"
 
+# The results of retrieving the catalog/1 files for an origin; see
+# Publisher.__fetch_v1.
+_FETCH_UPDATED = 0      # The files needed to update the catalog were retrieved.
+_FETCH_CURRENT = 1      # The catalog is already up to date.
+_FETCH_V0 = 2           # The origin doesn't provide catalog/1.
+_FETCH_V1_LOST = 3      # The origin stopped providing catalog/1 part way.
+
 class RepositoryURI(object):
         """Class representing a repository URI and any transport-related
         information."""
@@ -1108,6 +1116,36 @@ class Repository(object):
                         attribute.""")
 
 
+class _CatalogFetch(object):
+        """The catalog data retrieved for an origin of a publisher, held until
+        it's merged into the publisher's catalog."""
+
+        def __init__(self, tempdir, repo, exc_info=None):
+                # The directory holding the retrieved files, and the
+                # Repository object for the origin they were retrieved from.
+                self.tempdir = tempdir
+                self.repo = repo
+                # One of the _FETCH_* values.
+                self.result = None
+                # The exception raised while retrieving the data, if any.
+                self.exc_info = exc_info
+
+        def reraise(self):
+                """Raise the exception raised while retrieving the data, if
+                any."""
+
+                if self.exc_info:
+                        raise self.exc_info[0], self.exc_info[1], \
+                            self.exc_info[2]
+
+        def discard(self):
+                """Remove the retrieved data."""
+
+                if self.tempdir:
+                        shutil.rmtree(self.tempdir, True)
+                        self.tempdir = None
+
+
 class Publisher(object):
         """Class representing a publisher object and a set of interfaces to set
         and retrieve its information.
@@ -1983,15 +2021,14 @@ pkg unset-publisher {0}
                         return True, True
                 return False, True
 
-        def __refresh_v1(self, croot, tempdir, full_refresh, immediate,
-            mismatched, repo, progtrack=None, include_updates=False):
-                """The method to refresh the publisher's metadata against
-                a catalog/1 source.  If the more recent catalog/1 version
-                isn't supported, __refresh_v0 is invoked as a fallback.
-                Returns a tuple of (changed, refreshed) where 'changed'
-                indicates whether new catalog data was found and 'refreshed'
-                indicates that catalog data was actually retrieved to determine
-                if there were any updates."""
+        def __fetch_v1(self, croot, tempdir, full_refresh, mismatched, repo,
+            xport, progtrack=None, include_updates=False):
+                """The method to retrieve the catalog/1 files from 'repo'
+                needed to bring the catalog at 'croot' up to date into
+                'tempdir', using the Transport object 'xport'.  It doesn't
+                change the catalog, so it may be used for several origins
+                at once.  Returns one of the _FETCH_* values describing the
+                result."""
 
                 # If full_refresh is True, then redownload should be True to
                 # ensure a non-cached version of the catalog is retrieved.
@@ -2002,27 +2039,15 @@ pkg unset-publisher {0}
                 redownload = full_refresh
                 revalidate = not redownload and mismatched
 
-                v1_cat = pkg.catalog.Catalog(meta_root=croot)
+                v1_cat = pkg.catalog.Catalog(meta_root=croot, read_only=True)
                 try:
-                        self.transport.get_catalog1(self, ["catalog.attrs"],
+                        xport.get_catalog1(self, ["catalog.attrs"],
                             path=tempdir, redownload=redownload,
                             revalidate=revalidate, alt_repo=repo,
                             progtrack=progtrack)
                 except api_errors.UnsupportedRepositoryOperation:
                         # No v1 catalogs available.
-                        if v1_cat.exists:
-                                # Ensure v1 -> v0 transition works right.
-                                v1_cat.destroy()
-                                self._catalog = None
-                        return self.__refresh_v0(croot, full_refresh, immediate,
-                            repo)
-
-                # If a v0 catalog is present, remove it before proceeding to
-                # ensure transitions between catalog versions work correctly.
-                v0_cat = old_catalog.ServerCatalog(croot, read_only=True,
-                    publisher=self.prefix)
-                if v0_cat.exists:
-                        v0_cat.destroy(root=croot)
+                        return _FETCH_V0
 
                 # If above succeeded, we now have a catalog.attrs file.  Parse
                 # this to determine what other constituent parts need to be
@@ -2031,7 +2056,7 @@ pkg unset-publisher {0}
                 if not full_refresh and v1_cat.exists:
                         flist = v1_cat.get_updates_needed(tempdir)
                         if flist == None:
-                                return False, True
+                                return _FETCH_CURRENT
                 else:
                         attrs = pkg.catalog.CatalogAttrs(meta_root=tempdir)
                         for name in attrs.parts:
@@ -2048,7 +2073,7 @@ pkg unset-publisher {0}
                 if flist:
                         # More catalog files to retrieve.
                         try:
-                                self.transport.get_catalog1(self, flist,
+                                xport.get_catalog1(self, flist,
                                     path=tempdir, redownload=redownload,
                                     revalidate=revalidate, alt_repo=repo,
                                     progtrack=progtrack)
@@ -2056,8 +2081,41 @@ pkg unset-publisher {0}
                                 # Couldn't find a v1 catalog after getting one
                                 # before.  This would be a bizzare error, but we
                                 # can try for a v0 catalog anyway.
-                                return self.__refresh_v0(croot, full_refresh,
-                                    immediate, repo)
+                                return _FETCH_V1_LOST
+                return _FETCH_UPDATED
+
+        def __merge_v1(self, croot, tempdir, fetched, full_refresh, immediate,
+            repo):
+                """The method to update the catalog at 'croot' using the
+                catalog/1 files retrieved into 'tempdir' by __fetch_v1, which
+                returned 'fetched'.  If the more recent catalog/1 version
+                isn't supported, __refresh_v0 is invoked as a fallback.
+                Returns a tuple of (changed, refreshed) where 'changed'
+                indicates whether new catalog data was found and 'refreshed'
+                indicates that catalog data was actually retrieved to determine
+                if there were any updates."""
+
+                if fetched == _FETCH_V0:
+                        v1_cat = pkg.catalog.Catalog(meta_root=croot)
+                        if v1_cat.exists:
+                                # Ensure v1 -> v0 transition works right.
+                                v1_cat.destroy()
+                                self._catalog = None
+                        return self.__refresh_v0(croot, full_refresh, immediate,
+                            repo)
+
+                # If a v0 catalog is present, remove it before proceeding to
+                # ensure transitions between catalog versions work correctly.
+                v0_cat = old_catalog.ServerCatalog(croot, read_only=True,
+                    publisher=self.prefix)
+                if v0_cat.exists:
+                        v0_cat.destroy(root=croot)
+
+                if fetched == _FETCH_CURRENT:
+                        return False, True
+                if fetched == _FETCH_V1_LOST:
+                        return self.__refresh_v0(croot, full_refresh,
+                            immediate, repo)
 
                 # Clear _catalog, so we'll read in the new catalog.
                 self._catalog = None
@@ -2102,13 +2160,11 @@ pkg unset-publisher {0}
                                 raise api_errors.MismatchedCatalog(self.prefix)
                 return True, True
 
-        def __refresh_origin(self, croot, full_refresh, immediate, mismatched,
-            origin, progtrack=None, include_updates=False):
-                """Private helper method used to refresh catalog data for each
-                origin.  Returns a tuple of (changed, refreshed) where 'changed'
-                indicates whether new catalog data was found and 'refreshed'
-                indicates that catalog data was actually retrieved to determine
-                if there were any updates."""
+        def __fetch_origin(self, croot, full_refresh, mismatched, origin,
+            xport, progtrack=None, include_updates=False):
+                """Private helper method used to retrieve the catalog data for
+                an origin using the Transport object 'xport'.  Returns a
+                _CatalogFetch object to be passed to __merge_origin."""
 
                 # Create a copy of the current repository object that only
                 # contains the origin specified.
@@ -2128,29 +2184,57 @@ pkg unset-publisher {0}
                                     e.filename)
                         raise
 
-                # Ensure that the temporary directory gets removed regardless
-                # of success or failure.
+                fetch = _CatalogFetch(tempdir, repo)
                 try:
-                        rval = self.__refresh_v1(croot, tempdir,
-                            full_refresh, immediate, mismatched, repo,
+                        fetch.result = self.__fetch_v1(croot, tempdir,
+                            full_refresh, mismatched, repo, xport,
                             progtrack=progtrack,
                             include_updates=include_updates)
+                except:
+                        fetch.discard()
+                        raise
+                return fetch
+
+        def __merge_origin(self, croot, full_refresh, immediate, fetch):
+                """Private helper method used to update the catalog data for
+                an origin using the _CatalogFetch object 'fetch'.  Returns a
+                tuple of (changed, refreshed) where 'changed' indicates
+                whether new catalog data was found and 'refreshed' indicates
+                that catalog data was actually retrieved to determine if there
+                were any updates."""
+
+                # Ensure that the temporary directory gets removed regardless
+                # of success or failure.
+                try:
+                        fetch.reraise()
+                        rval = self.__merge_v1(croot, fetch.tempdir,
+                            fetch.result, full_refresh, immediate, fetch.repo)
 
                         # Perform publisher metadata sanity checks.
-                        self.__validate_metadata(croot, repo)
+                        self.__validate_metadata(croot, fetch.repo)
 
                         return rval
                 finally:
                         # Cleanup tempdir.
-                        shutil.rmtree(tempdir, True)
+                        fetch.discard()
 
-        def __refresh(self, full_refresh, immediate, mismatched=False,
-            progtrack=None, include_updates=False):
-                """The method to handle the overall refresh process.  It
-                determines if a refresh is actually needed, and then calls
-                the first version-specific refresh method in the chain."""
+        def __refresh_origin(self, croot, full_refresh, immediate, mismatched,
+            origin, progtrack=None, include_updates=False):
+                """Private helper method used to refresh catalog data for each
+                origin.  Returns a tuple of (changed, refreshed) where 'changed'
+                indicates whether new catalog data was found and 'refreshed'
+                indicates that catalog data was actually retrieved to determine
+                if there were any updates."""
 
-                assert self.transport
+                fetch = self.__fetch_origin(croot, full_refresh, mismatched,
+                    origin, self.transport, progtrack=progtrack,
+                    include_updates=include_updates)
+                return self.__merge_origin(croot, full_refresh, immediate,
+                    fetch)
+
+        def __refresh_needed(self, full_refresh, immediate):
+                """Determines whether the publisher's catalog data needs to be
+                retrieved by a refresh."""
 
                 if full_refresh:
                         immediate = True
@@ -2175,18 +2259,48 @@ pkg unset-publisher {0}
                         if not immediate and not self.needs_refresh:
                                 # No refresh needed.
                                 return False
+                return True
 
-                any_changed = False
-                any_refreshed = False
-                for origin, opath in self.__gen_origin_paths():
-                        changed, refreshed = self.__refresh_origin(opath,
-                            full_refresh, immediate, mismatched, origin,
-                            progtrack=progtrack,
-                            include_updates=include_updates)
-                        if changed:
-                                any_changed = True
-                        if refreshed:
-                                any_refreshed = True
+        def __refresh(self, full_refresh, immediate, mismatched=False,
+            progtrack=None, include_updates=False, fetched=None):
+                """The method to handle the overall refresh process.  It
+                determines if a refresh is actually needed, and then calls
+                the first version-specific refresh method in the chain.
+
+                'fetched' is an optional dictionary of the _CatalogFetch
+                objects returned by get_catalog_fetches(), indexed by origin
+                path; catalog data for other origins is retrieved here."""
+
+                assert self.transport
+
+                if full_refresh:
+                        immediate = True
+
+                fetched = dict(fetched or {})
+                try:
+                        if not self.__refresh_needed(full_refresh, immediate):
+                                return False
+
+                        any_changed = False
+                        any_refreshed = False
+                        for origin, opath in self.__gen_origin_paths():
+                                fetch = fetched.pop(opath, None)
+                                if fetch is None:
+                                        fetch = self.__fetch_origin(opath,
+                                            full_refresh, mismatched, origin,
+                                            self.transport,
+                                            progtrack=progtrack,
+                                            include_updates=include_updates)
+                                changed, refreshed = self.__merge_origin(opath,
+                                    full_refresh, immediate, fetch)
+                                if changed:
+                                        any_changed = True
+                                if refreshed:
+                                        any_refreshed = True
+                finally:
+                        # Discard anything retrieved that wasn't used.
+                        for fetch in fetched.itervalues():
+                                fetch.discard()
 
                 if any_refreshed:
                         # Update refresh time.
@@ -2199,8 +2313,40 @@ pkg unset-publisher {0}
 
                 return any_changed
 
-        def refresh(self, full_refresh=False, immediate=False, progtrack=None,
+        def get_catalog_fetches(self, full_refresh=False, immediate=False,
             include_updates=False):
+                """Returns a list of tuples of the form (opath, fetch) for each
+                origin whose catalog data would be retrieved by refresh(),
+                where 'fetch' is a function which retrieves it using the
+                Transport object it's passed and returns an object to be
+                passed to refresh() in its 'fetched' dictionary, indexed by
+                'opath'.  The functions may be called from other threads,
+                each with its own Transport; the objects they return hold
+                any exception raised, which refresh() raises in turn.
+
+                The arguments are as for refresh()."""
+
+                if not self.__refresh_needed(full_refresh, immediate):
+                        return []
+
+                def make_fetch(opath, origin):
+                        def fetch(xport):
+                                try:
+                                        return self.__fetch_origin(opath,
+                                            full_refresh, False, origin, xport,
+                                            include_updates=include_updates)
+                                except Exception:
+                                        return _CatalogFetch(None, None,
+                                            exc_info=sys.exc_info())
+                        return fetch
+
+                return [
+                    (opath, make_fetch(opath, origin))
+                    for origin, opath in self.__gen_origin_paths()
+                ]
+
+        def refresh(self, full_refresh=False, immediate=False, progtrack=None,
+            include_updates=False, fetched=None):
                 """Refreshes the publisher's metadata, returning a boolean
                 value indicating whether any updates to the publisher's
                 metadata occurred.
@@ -2217,12 +2363,17 @@ pkg unset-publisher {0}
 
                 'include_updates' is an optional boolean value indicating
                 whether all catalog updates should be retrieved additionally to
-                the catalog."""
+                the catalog.
+
+                'fetched' is an optional dictionary of the catalog data already
+                retrieved using the functions returned by
+                get_catalog_fetches(), which must have been called with the
+                same arguments."""
 
                 try:
                         return self.__refresh(full_refresh, immediate,
                             progtrack=progtrack,
-                            include_updates=include_updates)
+                            include_updates=include_updates, fetched=fetched)
                 except (api_errors.BadCatalogUpdateIdentity,
                     api_errors.DuplicateCatalogEntry,
                     api_errors.ObsoleteCatalogUpdate,
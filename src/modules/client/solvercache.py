@@ -0,0 +1,164 @@
+#!/usr/bin/python2.7
+#
+# CDDL HEADER START
+#
+# The contents of this file are subject to the terms of the
+# Common Development and Distribution License (the "License").
+# You may not use this file except in compliance with the License.
+#
+# You can obtain a copy of the license at usr/src/OPENSOLARIS.LICENSE
+# or http://www.opensolaris.org/os/licensing.
+# See the License for the specific language governing permissions
+# and limitations under the License.
+#
+# When distributing Covered Code, include this CDDL HEADER in each
+# file and include the License file at usr/src/OPENSOLARIS.LICENSE.
+# If applicable, add the following below this CDDL HEADER, with the
+# fields enclosed by brackets "[]" replaced with your own identifying
+# information: Portions Copyright [yyyy] [name of copyright owner]
+#
+# CDDL HEADER END
+#
+
+#
+# Copyright 2026 OmniOS Community Edition (OmniOSce) Association.
+#
+
+"""Cache of the catalog data used by the package solver.
+
+Planning an operation looks up the dependency, obsoletion, renaming and
+variant information of every package version the solver considers in the
+image's known catalog.  For each package version looked up, the cache
+records the action strings of its catalog entry in the dependency part,
+which is the same for every plan made until the known catalog changes.  The
+cache is stored with the last-modified time and signatures of the catalog it
+was made from, and is discarded when loaded for any other catalog.
+
+The action strings are recorded before any variant or facet filtering, so
+the cache doesn't depend on the image's variants or facets."""
+
+import os
+import simplejson as json
+
+import pkg.catalog as catalog
+import pkg.portable as portable
+
+from pkg.misc import EmptyI
+
+VERSION = 1
+
+
+class SolverCache(object):
+        """A cache of the dependency information in the catalog 'cat',
+        stored at 'path'."""
+
+        def __init__(self, path, cat, load=True):
+                """Load the cache stored at 'path' if it was made from the
+                catalog 'cat', unless 'load' is False, in which case the cache
+                starts out empty.  A missing, unreadable or outdated cache is
+                treated as empty."""
+
+                self.path = path
+                self.__catalog = cat
+                self.__entries = {}
+                self.__fmri_entries = {}        # entries by FMRI object
+                self.__changed = False
+                self.__key = None
+                if cat.last_modified is not None:
+                        self.__key = [cat.last_modified.strftime(
+                            "%Y-%m-%dT%H:%M:%S.%f"), cat.signatures]
+                if load:
+                        self.__load()
+
+        def __load(self):
+                if self.__key is None:
+                        return
+                try:
+                        with open(self.path, "rb") as f:
+                                version, key, entries = json.load(f)
+                except (EnvironmentError, ValueError, TypeError):
+                        return
+                if version != VERSION or key != self.__key or \
+                    not isinstance(entries, dict):
+                        return
+                self.__entries = entries
+
+        def __get_entry_strings(self, pfmri):
+                """Return the list of action strings in the dependency part of
+                the catalog entry for 'pfmri', or None if the entry has no
+                action data."""
+
+                try:
+                        return self.__fmri_entries[pfmri]
+                except KeyError:
+                        pass
+
+                fstr = pfmri.get_fmri(include_scheme=False)
+                astrs = self.__entries.get(fstr)
+                if astrs is not None:
+                        self.__fmri_entries[pfmri] = astrs
+                        return astrs
+
+                entry = self.__catalog.get_entry(pfmri,
+                    info_needed=[catalog.Catalog.DEPENDENCY])
+                if entry is None or "actions" not in entry:
+                        # Unknown packages and those whose action data has to
+                        # be loaded from their manifest are left to the
+                        # catalog.
+                        return None
+                astrs = self.__fmri_entries[pfmri] = entry["actions"]
+                if self.__key is not None:
+                        self.__entries[fstr] = astrs
+                        self.__changed = True
+                return astrs
+
+        def get_entry_actions(self, pfmri, excludes=EmptyI):
+                """A generator function that produces the Actions in the
+                Catalog.DEPENDENCY section of the catalog entry for 'pfmri', as
+                pkg.catalog.Catalog.get_entry_actions() does."""
+
+                astrs = self.__get_entry_strings(pfmri)
+                if astrs is None:
+                        return self.__catalog.get_entry_actions(pfmri,
+                            [catalog.Catalog.DEPENDENCY], excludes=excludes)
+                return catalog.Catalog.gen_entry_actions(pfmri, astrs,
+                    excludes=excludes)
+
+        def get_entry_all_variants(self, pfmri):
+                """A generator function that yields tuples of the format
+                (var_name, variants) for the catalog entry for 'pfmri', as
+                pkg.catalog.Catalog.get_entry_all_variants() does."""
+
+                astrs = self.__get_entry_strings(pfmri)
+                if astrs is None:
+                        return self.__catalog.get_entry_all_variants(pfmri)
+
+                # All of the actions are parsed, so that a package with any
+                # invalid action data is reported as the catalog would.
+                return (
+                    (a.attrs["name"], a.attrs["value"])
+                    for a in catalog.Catalog.gen_entry_actions(pfmri, astrs)
+                    if a.name == "set" and
+                        a.attrs["name"].startswith("variant")
+                )
+
+        def save(self):
+                """Store the cache if it has changed.  Failure to store the
+                cache isn't an error, as it's only an optimization."""
+
+                if not self.__changed:
+                        return
+
+                tmp_path = "{0}.{1:d}".format(self.path, os.getpid())
+                try:
+                        with open(tmp_path, "wb") as f:
+                                json.dump((VERSION, self.__key,
+                                    self.__entries), f)
+                        portable.rename(tmp_path, self.path)
+                except EnvironmentError:
+                        try:
+                                portable.remove(tmp_path)
+                        except EnvironmentError:
+                                pass
+                        return
+                self.__changed = False
@@ -124,7 +124,7 @@ class CurlTransportEngine(TransportEngine):
         def add_url(self, url, filepath=None, writefunc=None, header=None,
             progclass=None, progtrack=None, sslcert=None, sslkey=None,
             repourl=None, compressible=False, failonerror=True, proxy=None,
-            runtime_proxy=None):
+            runtime_proxy=None, data=None, data_fp=None):
                 """Add a URL to the transport engine.  Caller must supply
                 either a filepath where the file should be downloaded,
                 or a callback to a function that will peform the write.
@@ -133,18 +133,29 @@ class CurlTransportEngine(TransportEngine):
                 it should pass the tracker in progtrack.  The caller should
                 also supply a class that wraps the tracker in progclass.
 
+                If 'data' is provided, the request is performed as a POST
+                and 'data' is sent as the request body.  Likewise, if
+                'data_fp' is provided, the contents of the file at that
+                path are sent as the request body.
+
                 'proxy' is the persistent proxy value for this url and is
                 stored as part of the transport stats accounting.
 
                 'runtime_proxy' is the actual proxy value that is used by pycurl
                 to retrieve this resource."""
 
+                if data is not None or data_fp:
+                        httpmethod = "POST"
+                else:
+                        httpmethod = "GET"
+
                 t = TransportRequest(url, filepath=filepath,
                     writefunc=writefunc, header=header, progclass=progclass,
                     progtrack=progtrack, sslcert=sslcert, sslkey=sslkey,
                     repourl=repourl, compressible=compressible,
                     failonerror=failonerror, proxy=proxy,
-                    runtime_proxy=runtime_proxy)
+                    runtime_proxy=runtime_proxy, data=data,
+                    read_filepath=data_fp, httpmethod=httpmethod)
 
                 self.__req_q.appendleft(t)
 
@@ -597,6 +608,13 @@ class CurlTransportEngine(TransportEngine):
 
                 return bool(self.__req_q) or self.__active_handles > 0
 
+        @property
+        def outstanding(self):
+                """Returns the number of requests that are queued or in
+                progress."""
+
+                return len(self.__req_q) + self.__active_handles
+
         def run(self):
                 """Run the transport engine.  This polls the underlying
                 framework to complete any asynchronous I/O.  Synchronous
@@ -25,12 +25,14 @@
 #
 
 import cStringIO
+import collections
 import errno
 import httplib
 import itertools
 import os
 import simplejson as json
 import sys
+import tarfile
 import urlparse
 import urllib
 
@@ -45,6 +47,7 @@ import pkg.server.repository as svr_repo
 import pkg.server.query_parser as sqp
 
 from email.utils import formatdate
+from pkg.client import global_settings
 from pkg.misc import N_
 import tempfile
 import shutil
@@ -87,11 +90,14 @@ class TransportRepo(object):
 
                 raise NotImplementedError
 
-        def get_files(self, filelist, dest, progtrack, version, header=None, pub=None):
+        def get_files(self, filelist, dest, progtrack, version, header=None,
+            pub=None, batches=None):
                 """Get multiple files from the repo at once.
                 The files are named by hash and supplied in filelist.
                 If dest is specified, download to the destination
-                directory that is given. Progtrack is a ProgressTracker"""
+                directory that is given. Progtrack is a ProgressTracker.
+                Batches is an optional list of lists of hashes from filelist
+                that the repo may retrieve together in a single request."""
 
                 raise NotImplementedError
 
@@ -138,17 +144,46 @@ class TransportRepo(object):
                 raise NotImplementedError
 
         def publish_add(self, action, header=None, progtrack=None,
-            trans_id=None):
+            trans_id=None, flush=True):
                 """The publish operation that adds content to a repository.
                 The action must be populated with a data property.
                 Callers may supply a header, and should supply a transaction
-                id in trans_id."""
+                id in trans_id.  If 'flush' is False, the repository may leave
+                the action pending until the transaction is closed."""
 
                 raise NotImplementedError
 
         def publish_add_file(self, action, header=None, trans_id=None):
                 raise NotImplementedError
 
+        def publish_add_files(self, files, header=None, progtrack=None,
+            trans_id=None, window=1):
+                """Sends the files named in the dictionary 'files', which maps
+                the hash names of the payloads of actions to the paths of the
+                files holding them, to the transaction given in trans_id, so
+                that the actions can then be added using publish_add_actions.
+                No more than 'window' files are sent at once.  Returns a list
+                of the transient errors encountered, each with a 'request'
+                attribute naming the file concerned."""
+
+                raise NotImplementedError
+
+        def publish_add_actions(self, lines, header=None, trans_id=None):
+                """Adds the actions in the list 'lines', each in manifest form
+                and naming its payload by hash, to the transaction given in
+                trans_id in that order.  Their payloads must have been sent
+                by publish_add_files, or be stored by the repository."""
+
+                raise NotImplementedError
+
+        def publish_have(self, hashes, header=None, pub=None):
+                """Returns the subset of the list of file hash names 'hashes'
+                that the repository already stores, so that actions with that
+                content can be added to a transaction without it being sent
+                again."""
+
+                raise NotImplementedError
+
         def publish_abandon(self, header=None, trans_id=None):
                 """The 'abandon' publication operation, that tells a
                 Repository to abort the current transaction.  The caller
@@ -379,12 +414,15 @@ class HTTPRepo(TransportRepo):
                     self._repouri)
 
         def _add_file_url(self, url, filepath=None, progclass=None,
-            progtrack=None, header=None, compress=False):
+            progtrack=None, header=None, compress=False, data=None,
+            data_fp=None, writefunc=None, failonerror=True):
                 self._engine.add_url(url, filepath=filepath,
-                    progclass=progclass, progtrack=progtrack, repourl=self._url,
+                    writefunc=writefunc, progclass=progclass,
+                    progtrack=progtrack, repourl=self._url,
                     header=header, compressible=compress,
+                    failonerror=failonerror,
                     runtime_proxy=self._repouri.runtime_proxy,
-                    proxy=self._repouri.proxy)
+                    proxy=self._repouri.proxy, data=data, data_fp=data_fp)
 
         def _fetch_url(self, url, header=None, compress=False, ccancel=None,
             failonerror=True, system=False):
@@ -683,13 +721,19 @@ class HTTPRepo(TransportRepo):
 
                 return self._annotate_exceptions(errors, urlmapping)
 
-        def get_files(self, filelist, dest, progtrack, version, header=None, pub=None):
+        def get_files(self, filelist, dest, progtrack, version, header=None,
+            pub=None, batches=None):
                 """Get multiple files from the repo at once.
                 The files are named by hash and supplied in filelist.
                 If dest is specified, download to the destination
                 directory that is given.  If progtrack is not None,
                 it contains a ProgressTracker object for the
-                downloads."""
+                downloads.
+
+                If the repository supports the filelist operation, each
+                list of hashes in 'batches' is retrieved as a single tar
+                stream that is unpacked into dest.  Any file that could
+                not be retrieved that way is then retrieved individually."""
 
                 baseurl = self.__get_request_url("file/{0}/".format(version),
                     pub=pub)
@@ -699,7 +743,19 @@ class HTTPRepo(TransportRepo):
                 if progtrack:
                         progclass = FileProgress
 
+                flmapping = {}
+                if batches and self.supports_version("filelist", [0]) > -1:
+                        flmapping = self.__add_filelist_urls(batches, dest,
+                            progtrack, header=header, pub=pub)
+                batched = set(
+                    f
+                    for batch, tpath in flmapping.itervalues()
+                    for f in batch
+                )
+
                 for f in filelist:
+                        if f in batched:
+                                continue
                         url = urlparse.urljoin(baseurl, f)
                         urllist.append(url)
                         fn = os.path.join(dest, f)
@@ -712,19 +768,31 @@ class HTTPRepo(TransportRepo):
                                 self._engine.run()
                 except tx.ExcessiveTransientFailure as e:
                         # Attach a list of failed and successful
-                        # requests to this exception.
+                        # requests to this exception.  Requests that were
+                        # part of a failed filelist are treated as not
+                        # attempted.
+                        fl_errors, fl_success = self._engine.check_status(
+                            flmapping.keys(), True)
                         errors, success = self._engine.check_status(urllist,
                             True)
 
                         errors = self._annotate_exceptions(errors)
                         success = self._url_to_request(success)
-                        e.failures = errors
-                        e.success = success
 
-                        # Reset the engine before propagating exception.
+                        # Reset the engine before unpacking any completed
+                        # filelists and propagating the exception.
                         self._engine.reset()
+                        success.extend(self.__extract_filelists(fl_success,
+                            flmapping, dest, progtrack))
+                        e.failures = errors
+                        e.success = success
                         raise
 
+                # The filelist requests have to be claimed first; checking
+                # the status of the other requests discards the list of
+                # successful ones.
+                fl_errors, fl_success = self._engine.check_status(
+                    flmapping.keys(), True)
                 errors = self._engine.check_status(urllist)
 
                 # Transient errors are part of standard control flow.
@@ -735,7 +803,110 @@ class HTTPRepo(TransportRepo):
                 # This adds an attribute that describes the request to the
                 # exception, if we were able to figure it out.
 
-                return self._annotate_exceptions(errors)
+                errors = self._annotate_exceptions(errors)
+                if not flmapping:
+                        return errors
+
+                # Errors for filelist requests aren't returned to the caller;
+                # instead, anything that wasn't unpacked from a filelist is
+                # retrieved individually.
+                done = self.__extract_filelists(fl_success, flmapping, dest,
+                    progtrack)
+                done = set(done)
+                retry = [f for f in filelist if f in batched and f not in done]
+                if not retry:
+                        return errors
+
+                try:
+                        errors.extend(self.get_files(retry, dest, progtrack,
+                            version, header=header, pub=pub))
+                except tx.ExcessiveTransientFailure as e:
+                        e.failures = errors + e.failures
+                        e.success.extend(done)
+                        raise
+                return errors
+
+        def __add_filelist_urls(self, batches, dest, progtrack, header=None,
+            pub=None):
+                """Queue a filelist/0 request for each list of hashes in
+                'batches'.  Each tar stream is downloaded to a temporary file
+                in 'dest'.  Returns a dictionary mapping each request url to
+                a tuple of (batch, tarpath)."""
+
+                baseurl = self.__get_request_url("filelist/0/", pub=pub)
+                progclass = None
+                flmapping = {}
+
+                if progtrack:
+                        progclass = FilelistProgress
+
+                for i, batch in enumerate(batches):
+                        # The depot ignores any trailing path components,
+                        # but they give each request a unique url so that
+                        # its status can be tracked by the engine.
+                        url = urlparse.urljoin(baseurl, str(i))
+                        fd, tpath = tempfile.mkstemp(dir=dest,
+                            prefix="filelist.")
+                        os.close(fd)
+                        data = urllib.urlencode([
+                            (str(n), f)
+                            for n, f in enumerate(batch)
+                        ])
+                        flmapping[url] = (batch, tpath)
+                        self._add_file_url(url, filepath=tpath,
+                            progclass=progclass, progtrack=progtrack,
+                            header=header, data=data)
+
+                return flmapping
+
+        @staticmethod
+        def __extract_filelists(urllist, flmapping, dest, progtrack):
+                """Unpack the files named in the batch for each filelist url
+                in 'urllist' from its tar stream into 'dest'.  Entries in the
+                stream that were not requested are ignored.  All of the
+                temporary tar files named in 'flmapping' are removed.  Returns
+                the list of hashes that were unpacked; content verification is
+                left to the caller."""
+
+                done = []
+                for url in urllist:
+                        batch, tpath = flmapping[url]
+                        wanted = set(batch)
+                        fn = None
+                        try:
+                                tfile = tarfile.open(tpath, mode="r|")
+                                for ti in tfile:
+                                        if ti.name not in wanted or \
+                                            not ti.isfile():
+                                                continue
+                                        wanted.discard(ti.name)
+                                        fn = os.path.join(dest, ti.name)
+                                        src = tfile.extractfile(ti)
+                                        with open(fn, "wb") as dst:
+                                                shutil.copyfileobj(src, dst)
+                                        fn = None
+                                        done.append(ti.name)
+                                        if progtrack:
+                                                progtrack.download_add_progress(
+                                                    1, ti.size)
+                                tfile.close()
+                        except tarfile.TarError:
+                                # A truncated or corrupt stream; whatever
+                                # wasn't unpacked is retrieved individually.
+                                if fn:
+                                        try:
+                                                os.remove(fn)
+                                        except EnvironmentError:
+                                                pass
+
+                for batch, tpath in flmapping.itervalues():
+                        try:
+                                os.remove(tpath)
+                        except EnvironmentError as e:
+                                if e.errno != errno.ENOENT:
+                                        raise
+
+                return done
 
         def get_url(self):
                 """Returns the repo's url."""
@@ -784,7 +955,7 @@ class HTTPRepo(TransportRepo):
                 return self._verdata is not None
 
         def publish_add(self, action, header=None, progtrack=None,
-            trans_id=None):
+            trans_id=None, flush=True):
                 """The publish operation that adds content to a repository.
                 The action must be populated with a data property.
                 Callers may supply a header, and should supply a transaction
@@ -821,6 +992,118 @@ class HTTPRepo(TransportRepo):
                     progclass=progclass, progtrack=progtrack)
                 self.__check_response_body(fobj)
 
+        def publish_have(self, hashes, header=None, pub=None):
+                """Returns the subset of the list of file hash names 'hashes'
+                that the repository already stores, so that actions with that
+                content can be added to a transaction without it being sent
+                again."""
+
+                requesturl = self.__get_request_url("have/0/", pub=pub)
+                data = urllib.urlencode([
+                    (str(n), h)
+                    for n, h in enumerate(hashes)
+                ])
+                fobj = self._post_url(requesturl, data=data, header=header,
+                    failonerror=False)
+
+                try:
+                        fobj.free_buffer = False
+                        return fobj.read().split()
+                except tx.TransportProtoError as e:
+                        if e.code == httplib.BAD_REQUEST:
+                                exc_type, exc_value, exc_tb = sys.exc_info()
+                                try:
+                                        e.details = self._parse_html_error(
+                                            fobj.read())
+                                except:
+                                        # If parse fails, raise original
+                                        # exception.
+                                        raise exc_value, None, exc_tb
+                        raise
+                finally:
+                        fobj.close()
+
+        def publish_add_files(self, files, header=None, progtrack=None,
+            trans_id=None, window=1):
+                """Sends the files named in the dictionary 'files', which maps
+                the hash names of the payloads of actions to the paths of the
+                files holding them, to the transaction given in trans_id, so
+                that the actions can then be added using publish_add_actions.
+                No more than 'window' files are sent at once.  Returns a list
+                of the transient errors encountered, each with a 'request'
+                attribute naming the file concerned."""
+
+                baseurl = self.__get_request_url("file/1/")
+                progclass = None
+
+                if progtrack:
+                        progclass = FileProgress
+
+                # Each file is sent to a URL ending with its name, which the
+                # depot ignores, so that errors can be traced back to it.
+                queue = collections.deque(sorted(files))
+                urllist = []
+                bodies = {}
+                try:
+                        while queue or self._engine.pending:
+                                while queue and \
+                                    self._engine.outstanding < window:
+                                        f = queue.popleft()
+                                        url = urlparse.urljoin(baseurl,
+                                            "{0}/{1}".format(trans_id, f))
+                                        urllist.append(url)
+                                        body = bodies[url] = []
+                                        self._add_file_url(url,
+                                            writefunc=body.append,
+                                            progclass=progclass,
+                                            progtrack=progtrack, header=header,
+                                            data_fp=files[f],
+                                            failonerror=False)
+                                self._engine.run()
+                except tx.ExcessiveTransientFailure as e:
+                        # Attach a list of failed and successful
+                        # requests to this exception.
+                        errors, success = self._engine.check_status(urllist,
+                            True)
+                        e.failures = self._annotate_exceptions(errors)
+                        e.success = self._url_to_request(success)
+                        self._engine.reset()
+                        raise
+                except tx.TransportException as e:
+                        # A permanent failure; include the explanation the
+                        # depot gave for it, if any.
+                        self._engine.reset()
+                        if getattr(e, "url", None):
+                                self._annotate_exceptions([e])
+                        if getattr(e, "code", None) == httplib.BAD_REQUEST:
+                                try:
+                                        e.details = self._parse_html_error(
+                                            "".join(bodies.get(e.url, [])))
+                                except Exception:
+                                        # If parse fails, raise original
+                                        # exception.
+                                        pass
+                        raise
+                except:
+                        self._engine.reset()
+                        raise
+
+                return self._annotate_exceptions(
+                    self._engine.check_status(urllist))
+
+        def publish_add_actions(self, lines, header=None, trans_id=None):
+                """Adds the actions in the list 'lines', each in manifest form
+                and naming its payload by hash, to the transaction given in
+                trans_id in that order.  Their payloads must have been sent
+                by publish_add_files, or be stored by the repository."""
+
+                baseurl = self.__get_request_url("add/1/")
+                requesturl = urlparse.urljoin(baseurl, trans_id)
+                data = "".join("{0}\n".format(l) for l in lines)
+                fobj = self._post_url(requesturl, header=header, data=data,
+                    failonerror=False)
+                self.__check_response_body(fobj)
+
         def publish_add_file(self, pth, header=None, trans_id=None):
                 """The publish operation that adds content to a repository.
                 The action must be populated with a data property.
@@ -1092,14 +1375,16 @@ class HTTPSRepo(HTTPRepo):
 
         # override the download functions to use ssl cert/key
         def _add_file_url(self, url, filepath=None, progclass=None,
-            progtrack=None, header=None, compress=False):
+            progtrack=None, header=None, compress=False, data=None,
+            data_fp=None, writefunc=None, failonerror=True):
                 self._engine.add_url(url, filepath=filepath,
-                    progclass=progclass, progtrack=progtrack,
-                    sslcert=self._repouri.ssl_cert,
+                    writefunc=writefunc, progclass=progclass,
+                    progtrack=progtrack, sslcert=self._repouri.ssl_cert,
                     sslkey=self._repouri.ssl_key, repourl=self._url,
                     header=header, compressible=compress,
+                    failonerror=failonerror,
                     runtime_proxy=self._repouri.runtime_proxy,
-                    proxy=self._repouri.proxy)
+                    proxy=self._repouri.proxy, data=data, data_fp=data_fp)
 
         def _fetch_url(self, url, header=None, compress=False, ccancel=None,
             failonerror=True):
@@ -1165,7 +1450,8 @@ class _FilesystemRepo(TransportRepo):
                             allow_fragments=0)
                         path = urllib.url2pathname(path)
                         self._frepo = svr_repo.Repository(read_only=True,
-                            root=path)
+                            root=path, compress_jobs=
+                            global_settings.PKG_CLIENT_COMPRESS_JOBS or None)
                 except cfg.ConfigError as e:
                         reason = _("The configuration file for the repository "
                             "is invalid or incomplete:\n{0}").format(e)
@@ -1185,9 +1471,11 @@ class _FilesystemRepo(TransportRepo):
                         raise ex
 
         def __del__(self):
-                # Dump search cache if repo goes out of scope.
+                # Dump search cache, and stop any threads publication
+                # started, if repo goes out of scope.
                 if self._frepo:
                         self._frepo.reset_search()
+                        self._frepo.shutdown()
                         self._frepo = None
 
         def _add_file_url(self, url, filepath=None, progclass=None,
@@ -1488,13 +1776,15 @@ class _FilesystemRepo(TransportRepo):
 
                 return errors + pre_exec_errors
 
-        def get_files(self, filelist, dest, progtrack, version, header=None, pub=None):
+        def get_files(self, filelist, dest, progtrack, version, header=None,
+            pub=None, batches=None):
                 """Get multiple files from the repo at once.
                 The files are named by hash and supplied in filelist.
                 If dest is specified, download to the destination
                 directory that is given.  If progtrack is not None,
                 it contains a ProgressTracker object for the
-                downloads."""
+                downloads.  The 'batches' argument is ignored as
+                there is no per-request overhead to amortize."""
 
                 urllist = []
                 progclass = None
@@ -1588,6 +1878,7 @@ class _FilesystemRepo(TransportRepo):
                     "catalog": ["1"],
                     "close": ["0"],
                     "file": ["0", "1"],
+                    "have": ["0"],
                     "manifest": ["0"],
                     "open": ["0"],
                     "publisher": ["0", "1"],
@@ -1611,12 +1902,13 @@ class _FilesystemRepo(TransportRepo):
                 return self._verdata is not None
 
         def publish_add(self, action, header=None, progtrack=None,
-            trans_id=None):
+            trans_id=None, flush=True):
                 """The publish operation that adds an action and its
                 payload (if applicable) to an existing transaction in a
                 repository.  The action must be populated with a data property.
                 Callers may supply a header, and should supply a transaction
-                id in trans_id."""
+                id in trans_id.  If 'flush' is False, the action may be left
+                pending until the transaction is closed."""
 
                 # Calling any publication operation sets read_only to False.
                 self._frepo.read_only = False
@@ -1627,16 +1919,31 @@ class _FilesystemRepo(TransportRepo):
                         progtrack = progclass(progtrack)
 
                 try:
-                        self._frepo.add(trans_id, action)
+                        self._frepo.add(trans_id, action, flush=flush)
                 except svr_repo.RepositoryError as e:
                         if progtrack:
                                 progtrack.abort()
                         raise tx.TransportOperationError(str(e))
                 else:
-                        if progtrack:
+                        if progtrack and action.data:
                                 sz = int(action.attrs.get("pkg.size", 0))
                                 progtrack.progress_callback(0, 0, sz, sz)
 
+        def publish_have(self, hashes, header=None, pub=None):
+                """Returns the subset of the list of file hash names 'hashes'
+                that the repository already stores, so that actions with that
+                content can be added to a transaction without it being sent
+                again."""
+
+                try:
+                        return self._frepo.has_files(hashes,
+                            pub=getattr(pub, "prefix", None))
+                except svr_repo.RepositoryUnknownPublisher:
+                        # Nothing has been published for the publisher yet.
+                        return []
+                except svr_repo.RepositoryError as e:
+                        raise tx.TransportOperationError(str(e))
+
         def publish_add_file(self, pth, header=None, trans_id=None):
                 """The publish operation that adds a file to an existing
                 transaction."""
@@ -2044,13 +2351,15 @@ class _ArchiveRepo(TransportRepo):
                                 continue
                 return errors
 
-        def get_files(self, filelist, dest, progtrack, version, header=None, pub=None):
+        def get_files(self, filelist, dest, progtrack, version, header=None,
+            pub=None, batches=None):
                 """Get multiple files from the repo at once.
                 The files are named by hash and supplied in filelist.
                 If dest is specified, download to the destination
                 directory that is given.  If progtrack is not None,
                 it contains a ProgressTracker object for the
-                downloads."""
+                downloads.  The 'batches' argument is ignored as
+                there is no per-request overhead to amortize."""
 
                 pub_prefix = getattr(pub, "prefix", None)
                 errors = []
@@ -2287,6 +2596,14 @@ class ManifestProgress(ProgressCallback):
                 self.progtrack.manifest_fetch_progress(completion=False)
                 return 0
 
+class FilelistProgress(ProgressCallback):
+        """This class bridges the interfaces between a ProgressTracker
+        object and the progress callback for a filelist request.  The
+        tar stream contains headers and padding, so bytes aren't reported
+        as they arrive; instead, each file's size is added to the tracker
+        as it is unpacked.  Only cancelation is checked here."""
+
+
 class FileProgress(ProgressCallback):
         """This class bridges the interfaces between a ProgressTracker
         object and the progress callback that's provided by Pycurl.
@@ -604,6 +604,16 @@ class Transport(object):
                 finally:
                         self._lock.release()
 
+        def copy(self):
+                """Returns a new Transport object with the same configuration
+                as this one, for use by another thread; the operations of a
+                Transport are serialized.  Whether the captive portal test
+                has been performed is shared with the copy."""
+
+                xport = Transport(self.cfg)
+                xport.__portal_test_executed = self.__portal_test_executed
+                return xport
+
         def shutdown(self):
                 """Shuts down any portions of the transport that can
                 actively be connected to remote endpoints."""
@@ -881,12 +891,16 @@ class Transport(object):
                             " may be used, but not both.")
 
                 # download_dir is temporary download path.  Completed_dir
-                # is the cache where valid content lives.
+                # is the cache where valid content lives.  A directory given
+                # by the caller is private to it, so the files are downloaded
+                # there directly; this allows several transports to retrieve
+                # catalogs at once.
                 if path:
                         completed_dir = path
+                        download_dir = path
                 else:
                         completed_dir = pub.catalog_root
-                download_dir = self.cfg.incoming_root
+                        download_dir = self.cfg.incoming_root
 
                 # Call setup if the transport isn't configured or was shutdown.
                 if not self.__engine:
@@ -1850,7 +1864,9 @@ class Transport(object):
                         # unless we want to supress a permanant failure.
                         try:
                                 errlist = d.get_files(filelist, download_dir,
-                                    progtrack, v, header, pub=pub)
+                                    progtrack, v, header, pub=pub,
+                                    batches=self.__get_file_batches(mfile,
+                                    filelist))
                         except tx.ExcessiveTransientFailure as ex:
                                 # If an endpoint experienced so many failures
                                 # that we just gave up, record this for later
@@ -1929,6 +1945,31 @@ class Transport(object):
                                 tfailurex.append(f)
                         raise tfailurex
 
+        @staticmethod
+        def __get_file_batches(mfile, filelist):
+                """Group the small files in 'filelist' into lists of hashes
+                that may be retrieved using a single request.  Files larger
+                than PKG_CLIENT_FILELIST_MAX_SIZE are not batched, nor are
+                batches of a single file returned."""
+
+                maxsize = global_settings.PKG_CLIENT_FILELIST_MAX_SIZE
+                maxfiles = global_settings.pkg_client_filelist_max_files
+                if maxsize <= 0:
+                        return []
+
+                batches = []
+                batch = []
+                for f in filelist:
+                        if misc.get_pkg_otw_size(mfile[f][0]) > maxsize:
+                                continue
+                        batch.append(f)
+                        if len(batch) >= maxfiles:
+                                batches.append(batch)
+                                batch = []
+                if len(batch) > 1:
+                        batches.append(batch)
+                return batches
+
         @LockedTransport()
         def _get_files(self, mfile):
                 """Perform an operation that gets multiple files at once.
@@ -2462,6 +2503,18 @@ class Transport(object):
 
                 return mfile
 
+        def multi_file_plan(self, progtrack, ccancel):
+                """Creates a MultiFilePlan object for this transport.
+                The caller may add the actions of any number of packages
+                to the object and then wait for all of the downloads to
+                complete at once."""
+
+                # Call setup if the transport isn't configured or was shutdown.
+                if not self.__engine:
+                        self.__setup()
+
+                return MultiFilePlan(self, progtrack, ccancel)
+
         def multi_file_ni(self, publisher, final_dir, decompress=False,
             progtrack=None, ccancel=None, alt_repo=None):
                 """Creates a MultiFileNI object for this transport.
@@ -2657,9 +2710,11 @@ class Transport(object):
 
         @LockedTransport()
         def publish_add(self, pub, action=None, ccancel=None, progtrack=None,
-            trans_id=None):
+            trans_id=None, flush=True):
                 """Perform the 'add' publication operation to the publisher
-                supplied in pub.  The transaction-id is passed in trans_id."""
+                supplied in pub.  The transaction-id is passed in trans_id.
+                If 'flush' is False, a repository that supports it may leave
+                the action pending until the transaction is closed."""
 
                 failures = tx.TransportFailures()
                 retry_count = global_settings.PKG_CLIENT_MAX_TIMEOUT
@@ -2674,7 +2729,8 @@ class Transport(object):
                     versions=[0]):
                         try:
                                 d.publish_add(action, header=header,
-                                    progtrack=progtrack, trans_id=trans_id)
+                                    progtrack=progtrack, trans_id=trans_id,
+                                    flush=flush)
                                 return
                         except tx.ExcessiveTransientFailure as ex:
                                 # If an endpoint experienced so many failures
@@ -2724,6 +2780,95 @@ class Transport(object):
 
                 raise failures
 
+        @LockedTransport()
+        def publish_add_files(self, pub, files, trans_id=None, progtrack=None):
+                """Perform the 'file' publication operation to the publisher
+                supplied in pub for each of the files in the dictionary
+                'files', which maps the hash names of the payloads of actions
+                to the paths of the files holding them, so that the actions
+                can then be added to the transaction given in trans_id using
+                publish_add_actions.  Up to PKG_CLIENT_PUBLISH_CONCURRENCY
+                files are sent at once; this returns once all of them have
+                been received.  If one can't be sent, the exception raised
+                has a 'request' attribute naming it."""
+
+                retry_count = global_settings.PKG_CLIENT_MAX_TIMEOUT
+                failures = tx.TransportFailures()
+                header = self.__build_header(uuid=self.__get_uuid(pub),
+                    variant=self.__get_variant(pub))
+                window = max(global_settings.PKG_CLIENT_PUBLISH_CONCURRENCY, 1)
+                files = files.copy()
+
+                for d, retries, v in self.__gen_repo(pub, retry_count,
+                    origin_only=True, single_repository=True, operation="add",
+                    versions=[1]):
+                        try:
+                                errlist = d.publish_add_files(files,
+                                    header=header, progtrack=progtrack,
+                                    trans_id=trans_id, window=window)
+                                success = None
+                        except tx.ExcessiveTransientFailure as ex:
+                                # If an endpoint experienced so many failures
+                                # that we just gave up, only what was sent
+                                # successfully needn't be sent again.
+                                errlist = ex.failures
+                                success = ex.success
+
+                        for e in errlist:
+                                if not getattr(e, "request", None):
+                                        raise e
+                                failures.append(e)
+
+                        if success is not None:
+                                for f in success:
+                                        files.pop(f, None)
+                        else:
+                                failed = set(e.request for e in errlist)
+                                for f in files.keys():
+                                        if f not in failed:
+                                                del files[f]
+
+                        if not files:
+                                return
+
+                raise failures
+
+        @LockedTransport()
+        def publish_add_actions(self, pub, lines, trans_id=None):
+                """Perform the version 1 'add' publication operation to the
+                publisher supplied in pub, which adds the actions in the list
+                'lines', each in manifest form, to the transaction given in
+                trans_id in that order.  The actions name their payloads by
+                hash; these must have been sent using publish_add_files, or be
+                stored by the repository already."""
+
+                failures = tx.TransportFailures()
+                # Don't retry, since the repository may have added some of the
+                # actions before the request failed, and would add them again.
+                retry_count = 1
+                header = self.__build_header(uuid=self.__get_uuid(pub),
+                    variant=self.__get_variant(pub))
+
+                for d, retries, v in self.__gen_repo(pub, retry_count,
+                    origin_only=True, single_repository=True, operation="add",
+                    versions=[1]):
+                        try:
+                                d.publish_add_actions(lines, header=header,
+                                    trans_id=trans_id)
+                                return
+                        except tx.ExcessiveTransientFailure as ex:
+                                # If an endpoint experienced so many failures
+                                # that we just gave up, grab the list of
+                                # failures that it contains
+                                failures.extend(ex.failures)
+                        except tx.TransportException as e:
+                                if e.retryable:
+                                        failures.append(e)
+                                else:
+                                        raise
+
+                raise failures
+
         @LockedTransport()
         def publish_abandon(self, pub, trans_id=None):
                 """Perform an 'abandon' publication operation to the
@@ -2889,6 +3034,41 @@ class Transport(object):
 
                 raise failures
 
+        @LockedTransport()
+        def publish_have(self, pub, hashes):
+                """Returns the subset of the list of file hash names 'hashes'
+                that the repository named by Publisher pub already stores.
+                Actions with that content can be added to a transaction
+                without it being sent again."""
+
+                failures = tx.TransportFailures()
+                retry_count = global_settings.PKG_CLIENT_MAX_TIMEOUT
+                header = self.__build_header(uuid=self.__get_uuid(pub),
+                    variant=self.__get_variant(pub))
+
+                # Call setup if transport isn't configured, or was shutdown.
+                if not self.__engine:
+                        self.__setup()
+
+                for d, retries, v in self.__gen_repo(pub, retry_count,
+                    origin_only=True, single_repository=True,
+                    operation="have", versions=[0]):
+                        try:
+                                return d.publish_have(hashes, header=header,
+                                    pub=pub)
+                        except tx.ExcessiveTransientFailure as ex:
+                                # If an endpoint experienced so many failures
+                                # that we just gave up, grab the list of
+                                # failures that it contains
+                                failures.extend(ex.failures)
+                        except tx.TransportException as e:
+                                if e.retryable:
+                                        failures.append(e)
+                                else:
+                                        raise
+
+                raise failures
+
         @LockedTransport()
         def publish_rebuild_indexes(self, pub):
                 """Instructs the repositories named by Publisher pub
@@ -3057,6 +3237,24 @@ class Transport(object):
 
                 self.__repo_cache.update_repo(rs, ruri, repo)
 
+        @LockedTransport()
+        def supports_version(self, pub, op, verlist):
+                """Returns version-id of highest supported version of the
+                operation 'op' in 'verlist' by the origin of the publisher
+                supplied in pub.  If none of them is supported, -1 is
+                returned instead."""
+
+                retry_count = global_settings.PKG_CLIENT_MAX_TIMEOUT
+
+                try:
+                        for d, retries, v in self.__gen_repo(pub, retry_count,
+                            origin_only=True, single_repository=True,
+                            operation=op, versions=verlist):
+                                return v
+                except apx.UnsupportedRepositoryOperation:
+                        pass
+                return -1
+
         def publish_cache_contains(self, pub):
                 """Returns true if the publisher's origin is cached
                 in the repo cache."""
@@ -3413,6 +3611,195 @@ class MultiFileNI(MultiFile):
                                     e.filename)
                         raise
 
+class PlanMultiFile(MultiFile):
+        """A MultiFile that is part of a MultiFilePlan.  It records which
+        packages need each hash so that the plan can be told when each
+        package's downloads are complete, and it hands out its hashes
+        largest-first so that big transfers start early while the small
+        ones fill in around them."""
+
+        def __init__(self, plan, pub, xport, progtrack, ccancel,
+            alt_repo=None):
+                MultiFile.__init__(self, pub, xport, progtrack, ccancel,
+                    alt_repo=alt_repo)
+
+                self._plan = plan
+                self._owner = None
+                self._owners = {}
+                self._order = None
+
+        def __iter__(self):
+                if self._order is None:
+                        self._order = sorted(self._hash, key=lambda h:
+                            misc.get_pkg_otw_size(self._hash[h][0]),
+                            reverse=True)
+                for k in self._order:
+                        if k in self._hash:
+                                # The packages that need the file are
+                                # started before it's requested.
+                                self._plan._file_requested(
+                                    self._owners.get(k, ()))
+                                yield k
+
+        def add_pkg_action(self, pfmri, action):
+                """Add the file for 'action', which is delivered by the
+                package 'pfmri', to the retrieval list."""
+
+                self._owner = pfmri
+                try:
+                        self.add_action(action)
+                finally:
+                        self._owner = None
+
+        def add_hash(self, hashval, item):
+                """Add 'item' to list of values that exist for
+                hash value 'hashval'."""
+
+                MultiFile.add_hash(self, hashval, item)
+                self._owners.setdefault(hashval, set()).add(self._owner)
+                self._plan._file_needed(hashval, self._owner)
+                self._order = None
+
+        def file_done(self, hashval, current_path):
+                """Tell MFile that the transfer completed successfully."""
+
+                MultiFile.file_done(self, hashval, current_path)
+                self._plan._file_done(hashval, self._owners.pop(hashval, ()))
+
+        def get_owners(self, hashval):
+                """Return the set of packages that need the file named by
+                'hashval'."""
+
+                return self._owners.get(hashval, set())
+
+
+class MultiFilePlan(object):
+        """A transport object that retrieves the files needed by all of the
+        packages in a plan at once instead of one package at a time.  The
+        files are grouped into a PlanMultiFile for each publisher and
+        alternate repository.  Each package is reported to the progress
+        tracker as started when the first file it needs is requested, and
+        as done when the last one has been retrieved."""
+
+        def __init__(self, xport, progtrack, ccancel):
+                self._transport = xport
+                self._progtrack = progtrack
+                self._ccancel = ccancel
+                # Keyed by (publisher prefix, alternate repository).
+                self._mfiles = {}
+                self._mfile_order = []
+                # The set of hashes each package is still waiting on.
+                self._pending = {}
+                self._failed = set()
+                # The packages reported to the progress tracker as started.
+                self._started = set()
+
+        def __get_mfile(self, pfmri):
+                alt_repo = self._transport.cfg.get_pkg_alt_repo(pfmri)
+                key = (pfmri.publisher, id(alt_repo))
+                mfile = self._mfiles.get(key)
+                if mfile:
+                        return mfile
+
+                try:
+                        pub = self._transport.cfg.get_publisher(
+                            pfmri.publisher)
+                except apx.UnknownPublisher:
+                        # Allow publishers that don't exist in configuration
+                        # to be used so that if data exists in the cache for
+                        # them, the operation will still succeed.
+                        pub = publisher.Publisher(pfmri.publisher)
+
+                mfile = PlanMultiFile(self, pub, self._transport,
+                    self._progtrack, self._ccancel, alt_repo=alt_repo)
+                self._mfiles[key] = mfile
+                self._mfile_order.append(mfile)
+                return mfile
+
+        def add_package(self, pfmri, actions):
+                """Add the files needed by 'actions', delivered by the
+                package 'pfmri', to the retrieval list.  If none of them
+                need to be retrieved, the package is reported as done
+                immediately."""
+
+                # The first package queued starts the download, so that the
+                # progress tracker is ready for progress made before any
+                # package's files are requested, such as files found in the
+                # cache.
+                if not self._started:
+                        self.__pkg_start(pfmri)
+
+                mfile = None
+                for a in actions:
+                        if not mfile:
+                                mfile = self.__get_mfile(pfmri)
+                        mfile.add_pkg_action(pfmri, a)
+
+                if pfmri not in self._pending:
+                        self.__pkg_done(pfmri)
+
+        def __pkg_start(self, pfmri):
+                if pfmri in self._started:
+                        return
+                self._started.add(pfmri)
+                if self._progtrack:
+                        self._progtrack.download_start_pkg(pfmri)
+
+        def __pkg_done(self, pfmri):
+                self.__pkg_start(pfmri)
+                if self._progtrack:
+                        self._progtrack.download_end_pkg(pfmri)
+
+        def _file_needed(self, hashval, pfmri):
+                """Called by a PlanMultiFile when the file named by
+                'hashval' must be retrieved for the package 'pfmri'."""
+
+                self._pending.setdefault(pfmri, set()).add(hashval)
+
+        def _file_requested(self, owners):
+                """Called by a PlanMultiFile before a file needed by the
+                packages in 'owners' is requested."""
+
+                for pfmri in owners:
+                        self.__pkg_start(pfmri)
+
+        def _file_done(self, hashval, owners):
+                """Called by a PlanMultiFile when the file named by
+                'hashval', needed by the packages in 'owners', has been
+                retrieved."""
+
+                for pfmri in owners:
+                        pending = self._pending.get(pfmri)
+                        if pending is None:
+                                continue
+                        pending.discard(hashval)
+                        if not pending:
+                                del self._pending[pfmri]
+                                self.__pkg_done(pfmri)
+
+        def get_failed_pkgs(self):
+                """Return the set of packages that needed a file that could
+                not be retrieved by the last call to wait_files()."""
+
+                return self._failed
+
+        def wait_files(self):
+                """Wait for all outstanding file retrieval operations to
+                complete."""
+
+                self._failed = set()
+                for mfile in self._mfile_order:
+                        try:
+                                mfile.wait_files()
+                        except tx.TransportFailures as e:
+                                for ex in e.exceptions:
+                                        req = getattr(ex, "request", None)
+                                        if req:
+                                                self._failed.update(
+                                                    mfile.get_owners(req))
+                                raise
+
+
 # The following two methods are to be used by clients without an Image that
 # need to configure a transport and or publishers.
 
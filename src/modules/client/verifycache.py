@@ -0,0 +1,151 @@
+#!/usr/bin/python2.7
+#
+# CDDL HEADER START
+#
+# The contents of this file are subject to the terms of the
+# Common Development and Distribution License (the "License").
+# You may not use this file except in compliance with the License.
+#
+# You can obtain a copy of the license at usr/src/OPENSOLARIS.LICENSE
+# or http://www.opensolaris.org/os/licensing.
+# See the License for the specific language governing permissions
+# and limitations under the License.
+#
+# When distributing Covered Code, include this CDDL HEADER in each
+# file and include the License file at usr/src/OPENSOLARIS.LICENSE.
+# If applicable, add the following below this CDDL HEADER, with the
+# fields enclosed by brackets "[]" replaced with your own identifying
+# information: Portions Copyright [yyyy] [name of copyright owner]
+#
+# CDDL HEADER END
+#
+
+#
+# Copyright 2026 OmniOS Community Edition (OmniOSce) Association.
+#
+
+"""Cache of the content hashes of installed files that have been verified.
+
+For each path whose content was found to match the hash expected by the
+package delivering it, the cache records that hash along with the device,
+inode number, size, modification time and change time of the file when it
+was verified.  A later verification can skip reading the file if none of
+these have changed since, and the expected hash is the same.
+
+A file's change time is updated by the system whenever its content or
+metadata is modified and can't be set by users, so a file with the same
+metadata as when it was verified is assumed to have the same content.
+Files changed very recently are not recorded, since a further change within
+the resolution of the file system's timestamps could go unnoticed."""
+
+import errno
+import os
+import simplejson as json
+import time
+
+import pkg.portable as portable
+
+VERSION = 1
+
+# Files whose change time is within this many seconds of the time they are
+# verified are not recorded.
+_RACY_WINDOW = 2
+
+
+class VerifyCache(object):
+        """A cache of verified file content hashes, stored at 'path'."""
+
+        def __init__(self, path, load=True):
+                """Load the cache stored at 'path', unless 'load' is False, in
+                which case the cache starts out empty and replaces the stored
+                one when saved.  A missing or unreadable cache is treated as
+                empty."""
+
+                self.path = path
+                self.__entries = {}
+                self.__used = set()
+                self.__changed = not load
+                if load:
+                        self.__load()
+
+        def __load(self):
+                try:
+                        with open(self.path, "rb") as f:
+                                version, entries = json.load(f)
+                except (EnvironmentError, ValueError, TypeError):
+                        return
+                if version != VERSION or not isinstance(entries, dict):
+                        return
+                # Paths are stored as UTF-8, but looked up as byte strings.
+                self.__entries = dict(
+                    (path.encode("utf-8"), entry)
+                    for path, entry in entries.iteritems()
+                )
+
+        @staticmethod
+        def __stat_key(st):
+                return [st.st_dev, st.st_ino, st.st_size, st.st_mtime,
+                    st.st_ctime]
+
+        def lookup(self, path, st):
+                """Return the hash recorded for 'path' if the stat result 'st'
+                matches the one recorded with it, or None otherwise."""
+
+                self.__used.add(path)
+                entry = self.__entries.get(path)
+                if entry is None or entry[:-1] != self.__stat_key(st):
+                        return None
+                return entry[-1]
+
+        def record(self, path, st, hashval):
+                """Record that the content of the file at 'path', with the stat
+                result 'st', was verified to have the hash 'hashval'."""
+
+                self.__used.add(path)
+                if st.st_ctime > time.time() - _RACY_WINDOW:
+                        self.discard(path)
+                        return
+                try:
+                        path.decode("utf-8")
+                except UnicodeError:
+                        # Can't be stored.
+                        return
+                entry = self.__stat_key(st) + [hashval]
+                if self.__entries.get(path) != entry:
+                        self.__entries[path] = entry
+                        self.__changed = True
+
+        def discard(self, path):
+                """Remove any entry for 'path'."""
+
+                if self.__entries.pop(path, None) is not None:
+                        self.__changed = True
+
+        def save(self, prune=False):
+                """Store the cache if it has changed.  If 'prune' is True,
+                entries for paths that weren't looked up or recorded since the
+                cache was loaded are dropped.  Failure to store the cache
+                isn't an error, as it's only an optimization."""
+
+                if prune:
+                        for path in set(self.__entries) - self.__used:
+                                del self.__entries[path]
+                                self.__changed = True
+                if not self.__changed:
+                        return
+
+                tmp_path = "{0}.{1:d}".format(self.path, os.getpid())
+                try:
+                        with open(tmp_path, "wb") as f:
+                                json.dump((VERSION, self.__entries), f)
+                        portable.rename(tmp_path, self.path)
+                except EnvironmentError as e:
+                        if e.errno not in (errno.EACCES, errno.ENOENT,
+                            errno.EPERM, errno.EROFS):
+                                raise
+                        try:
+                                portable.remove(tmp_path)
+                        except EnvironmentError:
+                                pass
+                        return
+                self.__changed = False
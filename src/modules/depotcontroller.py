@@ -71,6 +71,7 @@ class DepotController(object):
                 self.__state = self.HALTED
                 self.__writable_root = None
                 self.__sort_file_max_size = None
+                self.__catalog_compact_interval = None
                 self.__ssl_dialog = None
                 self.__ssl_cert_file = None
                 self.__ssl_key_file = None
@@ -237,6 +238,12 @@ class DepotController(object):
         def get_sort_file_max_size(self):
                 return self.__sort_file_max_size
 
+        def set_catalog_compact_interval(self, interval):
+                self.__catalog_compact_interval = interval
+
+        def get_catalog_compact_interval(self):
+                return self.__catalog_compact_interval
+
         def set_debug_feature(self, feature):
                 self.__debug_features[feature] = True
 
@@ -389,6 +396,10 @@ class DepotController(object):
                 if self.__sort_file_max_size:
                         args.append("--sort-file-max-size={0}".format(self.__sort_file_max_size))
 
+                if self.__catalog_compact_interval:
+                        args.append("--catalog-compact-interval={0:d}".format(
+                            self.__catalog_compact_interval))
+
                 # Always log access and error information.
                 args.append("--log-access=stdout")
                 args.append("--log-errors=stderr")
@@ -25,6 +25,8 @@
 #
 
 import errno
+import heapq
+import multiprocessing
 import os
 import platform
 import shutil
@@ -55,6 +57,14 @@ SORT_FILE_PREFIX = "sort."
 
 SORT_FILE_MAX_SIZE = 128 * 1024 * 1024
 
+# The fewest packages that will be indexed by a pool of processes; for fewer
+# than this, starting the pool costs more than it saves.
+MIN_PARALLEL_INDEXED_PKGS = 100
+
+# The state which the worker processes of a parallel index update inherit
+# from the indexer when the pool is started.
+_worker_state = None
+
 
 def makedirs(pathname):
         """Create a directory at the specified location if it does not
@@ -74,6 +84,62 @@ def makedirs(pathname):
                         raise
 
 
+def _write_sorted_run(file_name, lines):
+        """Sorts the given lines of a main dictionary by token and writes
+        them to the named file."""
+
+        l = [
+            (ss.IndexStoreMainDict.parse_main_dict_line_for_token(line), line)
+            for line in lines
+        ]
+        l.sort()
+        tmp_fh = file(file_name, "wb", buffering=PKG_FILE_BUFSIZ)
+        tmp_fh.writelines((line for tok, line in l))
+        tmp_fh.close()
+
+
+def _index_manifests(task):
+        """Produces the sorted runs of main dictionary lines for a range of
+        manifests.  This runs in the worker processes of a parallel index
+        update.
+
+        The "task" parameter is a tuple of the number of the range and a list
+        of the package ids and manifest paths in it.
+
+        Returns a tuple of the number of the range, the number of runs written
+        for it, and the number of manifests in it."""
+
+        num, manifests = task
+        tmp_dir, excludes, log, max_size = _worker_state
+
+        nruns = 0
+        lines = []
+        nbytes = 0
+        for p_id, path in manifests:
+                new_dict = manifest.Manifest.search_dict(path, excludes,
+                    log=log)
+                for tok_tup, offsets in new_dict.iteritems():
+                        tok, action_type, subtype, fv = tok_tup
+                        lst = [(action_type, [(subtype, [(fv, [(p_id,
+                            list(offsets))])])])]
+                        s = ss.IndexStoreMainDict.transform_main_dict_line(tok,
+                            lst)
+                        lines.append(s)
+                        nbytes += len(s)
+                if nbytes >= max_size:
+                        _write_sorted_run(os.path.join(tmp_dir,
+                            "{0}{1}.{2}".format(SORT_FILE_PREFIX, num, nruns)),
+                            lines)
+                        nruns += 1
+                        lines = []
+                        nbytes = 0
+        if lines:
+                _write_sorted_run(os.path.join(tmp_dir,
+                    "{0}{1}.{2}".format(SORT_FILE_PREFIX, num, nruns)), lines)
+                nruns += 1
+        return num, nruns, len(manifests)
+
+
 class Indexer(object):
         """Indexer is a class designed to index a set of manifests or pkg plans
         and provide a compact representation on disk, which is quickly
@@ -83,7 +149,7 @@ class Indexer(object):
 
         def __init__(self, index_dir, get_manifest_func, get_manifest_path_func,
             progtrack=None, excludes=EmptyI, log=None,
-            sort_file_max_size=SORT_FILE_MAX_SIZE):
+            sort_file_max_size=SORT_FILE_MAX_SIZE, jobs=1):
                 self._num_keys = 0
                 self._num_manifests = 0
                 self._num_entries = 0
@@ -95,6 +161,10 @@ class Indexer(object):
                 if self.sort_file_max_size <= 0:
                         raise search_errors.IndexingException(
                             _("sort_file_max_size must be greater than 0"))
+                self.jobs = jobs
+                if self.jobs <= 0:
+                        raise search_errors.IndexingException(
+                            _("jobs must be greater than 0"))
 
                 # This structure was used to gather all index files into one
                 # location. If a new index structure is needed, the files can
@@ -130,6 +200,11 @@ class Indexer(object):
                     ss.InvertedDict(ss.FMRI_OFFSETS_FILE, self._data_manf)
                 self._data_fmri_offsets = self._data_dict["fmri_offsets"]
 
+                # The trigrams of the tokens are only rebuilt along with the
+                # main dictionary, and are an optional addition to the index,
+                # so they're kept apart from the other index files.
+                self._data_token_ngrams = None
+
                 self._index_dir = index_dir
                 self._tmp_dir = os.path.join(self._index_dir, "TMP")
 
@@ -218,6 +293,15 @@ class Indexer(object):
                                 d.close_file_handle()
                         pt.job_done(pt.JOB_READ_SEARCH)
 
+        def __open_sort_fh(self):
+                """Utility function used to open the next temporary file
+                used to produce a sorted main_dict file."""
+
+                self._sort_fh = open(os.path.join(self._tmp_dir,
+                    SORT_FILE_PREFIX + str(self._sort_file_num)), "wb",
+                    buffering=PKG_FILE_BUFSIZ)
+                self._sort_file_num += 1
+
         def __close_sort_fh(self):
                 """Utility fuction used to close and sort the temporary
                 files used to produce a sorted main_dict file."""
@@ -227,16 +311,9 @@ class Indexer(object):
                 tmp_file_name = os.path.join(self._tmp_dir,
                     SORT_FILE_PREFIX + str(self._sort_file_num - 1))
                 tmp_fh = file(tmp_file_name, "rb", buffering=PKG_FILE_BUFSIZ)
-                l = [
-                    (ss.IndexStoreMainDict.parse_main_dict_line_for_token(line),
-                    line)
-                    for line in tmp_fh
-                ]
-                tmp_fh.close()
-                l.sort()
-                tmp_fh = file(tmp_file_name, "wb", buffering=PKG_FILE_BUFSIZ)
-                tmp_fh.writelines((line for tok, line in l))
+                lines = tmp_fh.readlines()
                 tmp_fh.close()
+                _write_sorted_run(tmp_file_name, lines)
 
         def _add_terms(self, pfmri, new_dict):
                 """Adds tokens, and the actions generating them, to the current
@@ -260,11 +337,7 @@ class Indexer(object):
                         if len(s) + self._sort_file_bytes >= \
                             self.sort_file_max_size:
                                 self.__close_sort_fh()
-                                self._sort_fh = open(os.path.join(self._tmp_dir,
-                                    SORT_FILE_PREFIX +
-                                    str(self._sort_file_num)), "wb",
-                                    buffering=PKG_FILE_BUFSIZ)
-                                self._sort_file_num += 1
+                                self.__open_sort_fh()
                         self._sort_fh.write(s)
                         self._sort_file_bytes += len(s)
                 return
@@ -369,6 +442,10 @@ class Indexer(object):
 
                 removed_paths = []
 
+                if self.jobs > 1 and len(fmris) >= MIN_PARALLEL_INDEXED_PKGS:
+                        self.__process_fmris_parallel(fmris)
+                        return removed_paths
+
                 for added_fmri in fmris:
                         self._data_full_fmri.add_entity(
                             added_fmri.get_fmri(anarchy=True))
@@ -381,6 +458,68 @@ class Indexer(object):
                             self._progtrack.JOB_REBUILD_SEARCH)
                 return removed_paths
 
+        def __process_fmris_parallel(self, fmris):
+                """Splits the given fmris into ranges and has a pool of
+                processes produce the sorted temporary files for them.
+
+                Package ids are assigned here, in the order of the fmris, so
+                they don't depend on the number of processes.  Each process
+                gets an equal share of the memory that a single sort file may
+                take."""
+
+                global _worker_state
+
+                manifests = []
+                for added_fmri in fmris:
+                        self._data_full_fmri.add_entity(
+                            added_fmri.get_fmri(anarchy=True))
+                        manifests.append(
+                            (self._data_manf.get_id_and_add(added_fmri),
+                            self.get_manifest_path_func(added_fmri)))
+
+                # Several ranges per process keep the processes busy when
+                # manifests differ in size, and let progress be reported.
+                nranges = min(len(manifests), self.jobs * 4)
+                size = (len(manifests) + nranges - 1) // nranges
+                tasks = [
+                    (i, manifests[i * size:(i + 1) * size])
+                    for i in range((len(manifests) + size - 1) // size)
+                ]
+
+                # The pool's processes are forked, so they inherit the
+                # excludes and the log function, which can't be pickled.
+                _worker_state = (self._tmp_dir, self.excludes, self.__log,
+                    max(1, self.sort_file_max_size // self.jobs))
+                pool = multiprocessing.Pool(min(self.jobs, len(tasks)))
+                try:
+                        runs = {}
+                        for num, nruns, nmanifests in pool.imap_unordered(
+                            _index_manifests, tasks):
+                                runs[num] = nruns
+                                self._progtrack.job_add_progress(
+                                    self._progtrack.JOB_REBUILD_SEARCH,
+                                    nitems=nmanifests)
+                        pool.close()
+                except:
+                        pool.terminate()
+                        raise
+                finally:
+                        pool.join()
+                        _worker_state = None
+
+                # The runs are numbered as though this process had written
+                # them, after the temporary file that's currently open, which
+                # is then replaced by a new, empty one.
+                self.__close_sort_fh()
+                for num in sorted(runs):
+                        for i in range(runs[num]):
+                                portable.rename(os.path.join(self._tmp_dir,
+                                    "{0}{1}.{2}".format(SORT_FILE_PREFIX, num,
+                                    i)), os.path.join(self._tmp_dir,
+                                    SORT_FILE_PREFIX + str(self._sort_file_num)))
+                                self._sort_file_num += 1
+                self.__open_sort_fh()
+
         def _write_main_dict_line(self, file_handle, token,
             fv_fmri_pos_list_list, out_dir):
                 """Writes out the new main dictionary file and also adds the
@@ -408,6 +547,7 @@ class Indexer(object):
                 cur_location_int = file_handle.tell()
                 cur_location = str(cur_location_int)
                 self._data_token_offset.write_entity(token, cur_location)
+                self._data_token_ngrams.add_token(token)
 
                 for at, st_list in fv_fmri_pos_list_list:
                         self._progtrack.job_add_progress(
@@ -458,11 +598,15 @@ class Indexer(object):
                 """Produces a stream of ordered tokens and the associated
                 information for those tokens from the sorted temporary files
                 produced by _add_terms. In short, this is the merge part of the
-                merge sort being done on the tokens to be indexed."""
+                merge sort being done on the tokens to be indexed.
+
+                The temporary files are merged through a heap, which holds the
+                next line of each of them, so that finding the smallest token
+                doesn't take longer as the number of files grows."""
 
                 def get_line(fh):
                         """Helper function to make the initialization of the
-                        fh_dict easier to understand."""
+                        heap easier to understand."""
 
                         try:
                                 return \
@@ -471,72 +615,49 @@ class Indexer(object):
                         except StopIteration:
                                 return None
 
-                # Build a mapping from numbers to the file handle for the
-                # temporary sort file with that number.
-                fh_dict = dict([
-                    (i, open(os.path.join(self._tmp_dir,
-                    SORT_FILE_PREFIX + str(i)), "rb",
-                    buffering=PKG_FILE_BUFSIZ))
-                    for i in range(self._sort_file_num)
-                ])
-
-                cur_toks = {}
-                # Seed cur_toks with the first token from each temporary file.
-                # The line may not exist since, for a empty repo, an empty file
-                # is created.
-                for i in fh_dict.keys():
-                        line = get_line(fh_dict[i])
+                # Seed the heap with the first token from each temporary file.
+                # The number of the file breaks ties between tokens, so the
+                # information for a token is spliced together in the order of
+                # the files.  The line may not exist since, for a empty repo,
+                # an empty file is created.
+                heap = []
+                for i in range(self._sort_file_num):
+                        fh = open(os.path.join(self._tmp_dir,
+                            SORT_FILE_PREFIX + str(i)), "rb",
+                            buffering=PKG_FILE_BUFSIZ)
+                        line = get_line(fh)
                         if line is None:
-                                del fh_dict[i]
+                                fh.close()
                         else:
-                                cur_toks[i] = line
+                                heap.append((line[0], i, line[1], fh))
+                heapq.heapify(heap)
 
                 old_min_token = None
-                # cur_toks will have items deleted from it as files no longer
-                # have tokens to provide. When no files have tokens, the merge
-                # is done.
-                while cur_toks:
-                        min_token = None
-                        matches = []
-                        # Find smallest available token and the temporary files
-                        # which contain that token.
-                        for i in fh_dict.keys():
-                                cur_tok, info = cur_toks[i]
-                                if cur_tok is None:
-                                        continue
-                                if min_token is None or cur_tok < min_token:
-                                        min_token = cur_tok
-                                        matches = [i]
-                                elif cur_tok == min_token:
-                                        matches.append(i)
-                        assert min_token is not None
-                        assert len(matches) > 0
+                # Entries are removed from the heap as files no longer have
+                # tokens to provide. When no files have tokens, the merge is
+                # done.
+                while heap:
+                        min_token = heap[0][0]
                         res = None
-                        for i in matches:
-                                new_tok, new_info = cur_toks[i]
-                                assert new_tok == min_token
-                                try:
-                                        # Continue pulling the next tokens from
-                                        # and adding them to the result list as
-                                        # long as the token matches min_token.
-                                        while new_tok == min_token:
-                                                if res is None:
-                                                        res = new_info
-                                                else:
-                                                        self.__splice(res,
-                                                            new_info)
-                                                new_tok, new_info = \
-                                                    ss.IndexStoreMainDict.parse_main_dict_line(fh_dict[i].next())
-                                        cur_toks[i] = new_tok, new_info
-                                except StopIteration:
-                                        # When a StopIteration happens, the
-                                        # last line in the file has been read
-                                        # and processed. Delete all the
-                                        # information associated with that file
-                                        # so that we no longer check that file.
-                                        fh_dict[i].close()
-                                        del fh_dict[i]
-                                        del cur_toks[i]
+                        # Continue pulling the next tokens from the files and
+                        # adding them to the result list as long as the token
+                        # matches min_token.
+                        while heap and heap[0][0] == min_token:
+                                new_tok, i, new_info, fh = heap[0]
+                                if res is None:
+                                        res = new_info
+                                else:
+                                        self.__splice(res, new_info)
+                                line = get_line(fh)
+                                if line is None:
+                                        # The last line in the file has been
+                                        # read and processed, so it's no longer
+                                        # checked.
+                                        fh.close()
+                                        heapq.heappop(heap)
+                                else:
+                                        heapq.heapreplace(heap,
+                                            (line[0], i, line[1], fh))
                         assert res is not None
                         if old_min_token is not None and \
                             old_min_token >= min_token:
@@ -582,6 +703,7 @@ class Indexer(object):
 
                 self._data_token_offset.open_out_file(out_dir,
                     self.file_version_number)
+                self._data_token_ngrams = ss.IndexStoreNgrams(ss.NGRAM_FILE)
 
                 new_toks_available = True
                 new_toks_it = self._gen_new_toks_from_files()
@@ -669,6 +791,9 @@ class Indexer(object):
                                             new_toks_it.next()
                                 except StopIteration:
                                         new_toks_available = False
+
+                        self._data_token_ngrams.write_dict_file(out_dir,
+                            self.file_version_number)
                 finally:
                         if not self.empty_index:
                                 file_handle.close()
@@ -767,10 +892,7 @@ class Indexer(object):
 
                         elif input_type == IDX_INPUT_TYPE_FMRI:
                                 assert not self._sort_fh
-                                self._sort_fh = file(os.path.join(self._tmp_dir,
-                                    SORT_FILE_PREFIX +
-                                    str(self._sort_file_num)), "wb")
-                                self._sort_file_num += 1
+                                self.__open_sort_fh()
 
                                 self._progtrack.job_start(
                                     self._progtrack.JOB_REBUILD_SEARCH,
@@ -986,6 +1108,13 @@ class Indexer(object):
                                 shutil.move(
                                     os.path.join(source_dir, "__st_" + st),
                                     os.path.join(dest_dir, "__st_" + st))
+
+                        # The trigram file's moved last, as searches only use
+                        # it if its version matches that of the others.
+                        if self._data_token_ngrams is not None:
+                                shutil.move(os.path.join(source_dir,
+                                    ss.NGRAM_FILE),
+                                    os.path.join(dest_dir, ss.NGRAM_FILE))
                 shutil.rmtree(source_dir)
 
         def lock(self, blocking=False):
@@ -636,7 +636,7 @@ def get_data_digest(data, length=None, return_content=False,
         return hash_results, content.read()
 
 def compute_compressed_attrs(fname, file_path, data, size, compress_dir,
-    bufsz=64*1024, chash_attrs=None, chash_algs=None):
+    bufsz=64*1024, chash_attrs=None, chash_algs=None, compresslevel=9):
         """Returns the size and one or more hashes of the compressed data.  If
         the file located at file_path doesn't exist or isn't gzipped, it creates
         a file in compress_dir named fname.
@@ -644,6 +644,10 @@ def compute_compressed_attrs(fname, file_path, data, size, compress_dir,
         'chash_attrs' is a list of the chash attributes we should compute, with
         'chash_algs' being a dictionary that maps the attribute names to the
         algorithms used to compute them.
+
+        'compresslevel' is the level the data is compressed at if the file is
+        created.  The compressed data, and so its size and hashes, only
+        depend on the data and the level.
         """
 
         if chash_attrs is None:
@@ -669,7 +673,7 @@ def compute_compressed_attrs(fname, file_path, data, size, compress_dir,
 
         if fileneeded:
                 opath = os.path.join(compress_dir, fname)
-                ofile = PkgGzipFile(opath, "wb")
+                ofile = PkgGzipFile(opath, "wb", compresslevel)
 
                 nbuf = size // bufsz
 
@@ -27,6 +27,9 @@
 import atexit
 import collections
 import errno
+import hashlib
+import mmap
+import struct
 import tarfile as tf
 import pkg.pkggzip
 import pkg.pkgtarfile as ptf
@@ -70,7 +73,8 @@ class ArchiveIndex(object):
         """Class representing a pkg(5) archive table of contents and a set of
         interfaces to populate and retrieve entries.
 
-        Entries in this file are written in the following format:
+        In version 0 of the index, entries are written to a gzip-compressed
+        file in the following format:
 
             <name>NUL<offset>NUL<entry_size>NUL<size>NUL<typeflag>NULNL
 
@@ -94,11 +98,15 @@ class ArchiveIndex(object):
                 0 Regular File
                 1 Hard Link
                 2 Symbolic Link
-                5 Directory or subdirectory"""
+                5 Directory or subdirectory
+
+        Version 1 of the index holds the same information in the uncompressed
+        binary form described by ArchiveIndexMap, so that it can be used
+        directly from the archive without being extracted or read in full."""
 
         version = None
-        CURRENT_VERSION = 0
-        COMPATIBLE_VERSIONS = 0,
+        CURRENT_VERSION = 1
+        COMPATIBLE_VERSIONS = 0, 1
         ENTRY_FORMAT = "{0}\0{1:d}\0{2:d}\0{3:d}\0{4}\0\n"
 
         def __init__(self, name, mode="r", version=None):
@@ -125,6 +133,24 @@ class ArchiveIndex(object):
                 self.__closed = False
                 self.__name = name
                 self.__mode = mode + "b"
+                self.__entries = None
+                self.__map = None
+                if version > 0:
+                        self.__file = open(self.__name, self.__mode)
+                        if "w" in mode:
+                                # The table has to be sorted, so entries are
+                                # only written when the index is closed.
+                                self.__entries = []
+                        else:
+                                try:
+                                        self.__map = ArchiveIndexMap(
+                                            self.__file, name=self.__name)
+                                except:
+                                        self.__file.close()
+                                        raise
+                        self.version = version
+                        return
+
                 try:
                         self.__file = pkg.pkggzip.PkgGzipFile(self.__name,
                             self.__mode)
@@ -158,6 +184,11 @@ class ArchiveIndex(object):
                 """Add an entry for the given archive file to the table of
                 contents."""
 
+                if self.__entries is not None:
+                        self.__entries.append((name, offset, entry_size, size,
+                            typeflag))
+                        return
+
                 self.__file.write(self.ENTRY_FORMAT.format(name, offset,
                     entry_size, size, typeflag))
 
@@ -165,6 +196,11 @@ class ArchiveIndex(object):
                 """Returns a generator that yields tuples of the form (name,
                 offset) for each file in the index."""
 
+                if self.__map is not None:
+                        for name in self.__map:
+                                yield name, self.__map[name]
+                        return
+
                 self.__file.seek(0)
                 l = None
                 try:
@@ -199,12 +235,275 @@ class ArchiveIndex(object):
 
                 if self.__closed:
                         return
+                if self.__entries is not None:
+                        ArchiveIndexMap.write(self.__file, self.__entries)
+                        self.__entries = None
+                self.__map = None
                 if self.__file:
                         self.__file.close()
                         self.__file = None
                 self.__closed = True
 
 
+class ArchiveIndexMap(object):
+        """A read-only view of a version 1 archive index, used in place of
+        the dictionary of extraction offsets built from a version 0 index.
+        It provides the subset of the dictionary interface used by the
+        Archive class (get(), keys(), iteration, 'in', and len()) along with
+        lookups of entries by name prefix and of package files by hash.
+
+        The index consists of a fixed size header followed by two tables of
+        fixed width entries and a heap of names:
+
+            header      magic (8 bytes), version, the number of entries in
+                        the archive, and the number of package files
+
+            entries     for each file in the archive, in order of name, its
+                        offset, entry size, and size (as described for
+                        ArchiveIndex), the offset and length of its name in
+                        the heap, and its typeflag
+
+            files       for each package file (a file named 'file/<xx>/<hash>'
+                        where <xx> are the first two characters of <hash>), a
+                        64-bit hash of <hash> and the position of the file's
+                        entry in the entries table, ordered by the former and
+                        then by archive offset
+
+            heap        the name of each file in the archive
+
+        Both tables are sorted, so names and package files are found by a
+        binary search of the memory-mapped index without reading the rest of
+        it.  The map is released when the object is garbage collected, so
+        one can be shared between several Archive objects."""
+
+        MAGIC = "PKG5PIDX"
+        VERSION = 1
+
+        __header = struct.Struct("<8sIII")
+        __entry = struct.Struct("<QQQQHc")
+        __pfile = struct.Struct("<QI")
+        __hash = struct.Struct("<Q")
+
+        def __init__(self, fobj, start=0, size=None, base=0, name=None):
+                """'fobj' is the file object of the index or of an archive
+                containing it.
+
+                'start' is the offset of the index in the file.
+
+                'size' is the size of the index in bytes; if not provided,
+                the rest of the file is assumed.
+
+                'base' is the offset in the file that offsets in the index are
+                relative to; get() returns offsets relative to the start of
+                the file.
+
+                'name' is used to identify the index in any exceptions
+                raised; InvalidArchiveIndex is raised if the index is
+                not valid."""
+
+                if name is None:
+                        name = fobj.name
+                try:
+                        fsize = os.fstat(fobj.fileno()).st_size
+                except EnvironmentError as e:
+                        raise apx._convert_error(e)
+                if size is None:
+                        size = fsize - start
+                if size < self.__header.size or start + size > fsize:
+                        raise InvalidArchiveIndex(name)
+
+                try:
+                        self.__map = mmap.mmap(fobj.fileno(), start + size,
+                            access=mmap.ACCESS_READ)
+                except EnvironmentError as e:
+                        raise apx._convert_error(e)
+
+                magic, version, self.__count, self.__nfiles = \
+                    self.__header.unpack_from(self.__map, start)
+                self.__entries = start + self.__header.size
+                self.__files = self.__entries + \
+                    self.__count * self.__entry.size
+                self.__heap = self.__files + self.__nfiles * self.__pfile.size
+                if magic != self.MAGIC or version != self.VERSION or \
+                    self.__heap > start + size:
+                        self.__map.close()
+                        raise InvalidArchiveIndex(name)
+                self.__base = base
+                self.__name = name
+
+        def __len__(self):
+                return self.__count
+
+        def __contains__(self, name):
+                return self.__find(name) is not None
+
+        def __iter__(self):
+                for i in xrange(self.__count):
+                        yield self.__entry_name(i)
+
+        def __getitem__(self, name):
+                offset = self.get(name)
+                if offset is None:
+                        raise KeyError(name)
+                return offset
+
+        def __get_entry(self, i):
+                """Return the tuple of the fields of the entry at position 'i'
+                of the entries table."""
+
+                if i >= self.__count:
+                        raise InvalidArchiveIndex(self.__name)
+                return self.__entry.unpack_from(self.__map,
+                    self.__entries + i * self.__entry.size)
+
+        def __entry_name(self, i):
+                """Return the name of the entry at position 'i'."""
+
+                ignored, ignored, ignored, noff, nlen, ignored = \
+                    self.__get_entry(i)
+                noff += self.__heap
+                return self.__map[noff:noff + nlen]
+
+        def __bisect(self, name):
+                """Return the position of the first entry whose name is not
+                less than 'name'."""
+
+                lo, hi = 0, self.__count
+                while lo < hi:
+                        mid = (lo + hi) // 2
+                        if self.__entry_name(mid) < name:
+                                lo = mid + 1
+                        else:
+                                hi = mid
+                return lo
+
+        def __find(self, name):
+                """Return the entry for 'name', or None if there is none."""
+
+                i = self.__bisect(name)
+                if i < self.__count and self.__entry_name(i) == name:
+                        return self.__get_entry(i)
+                return None
+
+        @classmethod
+        def __hash_name(cls, fhash):
+                """Return the 64-bit hash of the package file hash 'fhash'."""
+
+                return cls.__hash.unpack_from(hashlib.sha1(fhash).digest())[0]
+
+        @staticmethod
+        def __file_hash(name):
+                """Return the hash of the package file named 'name', or None if
+                it isn't named like one."""
+
+                parts = name.rsplit("/", 3)
+                if len(parts) < 3 or parts[-3] != "file" or \
+                    parts[-2] != parts[-1][:2]:
+                        return None
+                return parts[-1]
+
+        def get(self, name, default=None):
+                """Return the offset in the file of the archive entry for
+                'name', or 'default' if it isn't in the archive."""
+
+                entry = self.__find(name)
+                if entry is None:
+                        return default
+                return self.__base + entry[0]
+
+        def keys(self):
+                """Return a list of the names of the entries in the archive."""
+
+                return list(self)
+
+        def names(self, prefix):
+                """Returns a generator that yields the names of the entries in
+                the archive that start with 'prefix', in order."""
+
+                for i in xrange(self.__bisect(prefix), self.__count):
+                        name = self.__entry_name(i)
+                        if not name.startswith(prefix):
+                                break
+                        yield name
+
+        def children(self, prefix):
+                """Returns a generator that yields the names of the entries in
+                the archive that start with 'prefix' and have no further '/'
+                after it, in order, without visiting the entries below them.
+                """
+
+                i = self.__bisect(prefix)
+                while i < self.__count:
+                        name = self.__entry_name(i)
+                        if not name.startswith(prefix):
+                                break
+                        child = prefix + name[len(prefix):].split("/", 1)[0]
+                        if name == child:
+                                yield name
+                                i += 1
+                        else:
+                                # All of the names below the child sort
+                                # before child + "0", as "0" follows "/".
+                                i = self.__bisect(child + "0")
+
+        def package_files(self, fhash):
+                """Returns a generator that yields the names of the package
+                files with hash 'fhash' in the order they were added to the
+                archive."""
+
+                h = self.__hash_name(fhash)
+                m = self.__map
+                lo, hi = 0, self.__nfiles
+                while lo < hi:
+                        mid = (lo + hi) // 2
+                        if self.__hash.unpack_from(m,
+                            self.__files + mid * self.__pfile.size)[0] < h:
+                                lo = mid + 1
+                        else:
+                                hi = mid
+
+                while lo < self.__nfiles:
+                        fh, i = self.__pfile.unpack_from(m,
+                            self.__files + lo * self.__pfile.size)
+                        if fh != h:
+                                break
+                        name = self.__entry_name(i)
+                        if self.__file_hash(name) == fhash:
+                                yield name
+                        lo += 1
+
+        @classmethod
+        def write(cls, fobj, entries):
+                """Write an index of 'entries', a list of tuples of the form
+                (name, offset, entry_size, size, typeflag) as described for
+                ArchiveIndex, to the file object 'fobj'."""
+
+                entries = sorted(
+                    (pkg.misc.force_bytes(e[0]),) + tuple(e[1:])
+                    for e in entries
+                )
+                files = []
+                for i, (name, offset, ignored, ignored, ignored) in \
+                    enumerate(entries):
+                        fhash = cls.__file_hash(name)
+                        if fhash is not None:
+                                files.append((cls.__hash_name(fhash), offset,
+                                    i))
+                files.sort()
+
+                fobj.write(cls.__header.pack(cls.MAGIC, cls.VERSION,
+                    len(entries), len(files)))
+                noff = 0
+                for name, offset, entry_size, size, typeflag in entries:
+                        fobj.write(cls.__entry.pack(offset, entry_size, size,
+                            noff, len(name), typeflag))
+                        noff += len(name)
+                for h, ignored, i in files:
+                        fobj.write(cls.__pfile.pack(h, i))
+                for e in entries:
+                        fobj.write(e[0])
+
+
 class InvalidArchive(ArchiveErrors):
         """Used to indicate that the specified archive is in a format not
         supported or recognized by this version of the pkg(5) Archive class.
@@ -282,10 +581,9 @@ class Archive(object):
         tar archive, except for those that are compressed.
         """
 
-        __idx_pfx = "pkg5.index."
-        __idx_sfx = ".gz"
-        __idx_name = "pkg5.index.{0}.gz"
-        __idx_ver = ArchiveIndex.CURRENT_VERSION
+        # The name of the archive index file for each version of the index.
+        __idx_names = ("pkg5.index.0.gz", "pkg5.index.1")
+        __idx_name = None
         __index = None
         __arc_tfile = None
         __arc_file = None
@@ -307,7 +605,7 @@ class Archive(object):
                 respectively.  An archive opened for writing may not be used for
                 any extraction operations, and must not already exist.
 
-                'archive_index', if supplied is the dictionary returned by
+                'archive_index', if supplied is the object returned by
                 self.get_index(), allowing multiple Archive objects to be open,
                 sharing the same index object, for efficient use of memory.
                 Using an existing archive_index requires mode='r'.
@@ -383,11 +681,11 @@ class Archive(object):
                                 self.__extract_offsets = archive_index
                                 return
 
-                        if not member.name.startswith(self.__idx_pfx) or \
-                            not member.name.endswith(self.__idx_sfx):
+                        if member.name not in self.__idx_names:
                                 return
                         else:
                                 self.__idx_name = member.name
+                                idx_ver = self.__idx_names.index(member.name)
 
                         comment = member.pax_headers.get("comment", "")
                         if not comment.startswith("pkg5.archive.version."):
@@ -401,6 +699,21 @@ class Archive(object):
                         if self.version not in self.COMPATIBLE_VERSIONS:
                                 raise InvalidArchive(self.__arc_name)
 
+                        if idx_ver > 0:
+                                # The index is used in place; the offset of the
+                                # member following it is the base that will be
+                                # used for all other extractions.
+                                try:
+                                        self.__extract_offsets = \
+                                            ArchiveIndexMap(self.__arc_file,
+                                            start=member.offset_data,
+                                            size=member.size,
+                                            base=self.__arc_tfile.offset,
+                                            name=self.__arc_name)
+                                except InvalidArchiveIndex:
+                                        raise InvalidArchive(self.__arc_name)
+                                return
+
                         # Create a temporary file to extract the index to,
                         # and then extract it from the archive.
                         fobj, idxfn = self.__mkstemp()
@@ -423,7 +736,7 @@ class Archive(object):
                         # Load archive index.
                         try:
                                 self.__index = ArchiveIndex(idxfn,
-                                    mode="r", version=self.__idx_ver)
+                                    mode="r", version=idx_ver)
                                 for name, offset in \
                                     self.__index.offsets():
                                         self.__extract_offsets[name] = \
@@ -448,7 +761,7 @@ class Archive(object):
                                         ti.mode = pkg.misc.PKG_FILE_MODE
                                 elif ti.isdir():
                                         ti.mode = pkg.misc.PKG_DIR_MODE
-                                if ti.name == "pkg5.index.0.gz":
+                                if ti.name == self.__idx_name:
                                         ti.pax_headers["comment"] = \
                                             "pkg5.archive.version.{0:d}".format(
                                             self.CURRENT_VERSION)
@@ -459,13 +772,15 @@ class Archive(object):
                                 return ti
                         self.__arc_tfile.gettarinfo = gettarinfo
 
-                        self.__idx_name = self.__idx_name.format(self.__idx_ver)
+                        idx_ver = ArchiveIndex.CURRENT_VERSION
+                        self.__idx_name = self.__idx_names[idx_ver]
 
                         # Create a temporary file to write the index to,
                         # and then create the index.
                         fobj, idxfn = self.__mkstemp()
                         fobj.close()
-                        self.__index = ArchiveIndex(idxfn, mode=arc_mode)
+                        self.__index = ArchiveIndex(idxfn, mode=arc_mode,
+                            version=idx_ver)
 
                         # Used to determine what the default publisher will be
                         # for the archive file at close().
@@ -517,6 +832,43 @@ class Archive(object):
                 except EnvironmentError as e:
                         raise apx._convert_error(e)
 
+        def __names(self, prefix, children=False):
+                """Private helper method that returns an iterable of the names
+                of the archive members starting with 'prefix'.  If 'children'
+                is True, only the names without a further '/' are included.
+                """
+
+                idx = self.__extract_offsets
+                if isinstance(idx, ArchiveIndexMap):
+                        if children:
+                                return idx.children(prefix)
+                        return idx.names(prefix)
+                return (
+                    name for name in idx
+                    if name.startswith(prefix) and
+                        (not children or "/" not in name[len(prefix):])
+                )
+
+        def __find_package_file(self, fhash):
+                """Private helper method that returns the name of the first
+                package file found in the archive for the given hash, or None
+                if there isn't one.
+                """
+
+                idx = self.__extract_offsets
+                if isinstance(idx, ArchiveIndexMap):
+                        for name in idx.package_files(fhash):
+                                return name
+                        return None
+
+                # Scan extract offsets index for the first instance of any
+                # package file seen for the hash.
+                hash_fname = os.path.join("file", fhash[:2], fhash)
+                for name in idx:
+                        if name.endswith(hash_fname):
+                                return name
+                return None
+
         def __mkdtemp(self):
                 """Creates a temporary directory for use during archive
                 operations, and return its absolute path.  The temporary
@@ -808,22 +1160,20 @@ class Archive(object):
 
                 # Determine whether any catalog files are present for this
                 # publisher in the archive.
-                for name in self.__extract_offsets:
-                        if name.startswith(catpath):
-                                # Any catalog file at all means this publisher
-                                # should be marked as being known to have one
-                                # and then the request passed on to extract_to.
-                                self.__catalogs[pub] = None
-                                return self.extract_to(partpath, path,
-                                    filename=part)
+                for name in self.__names(catpath):
+                        # Any catalog file at all means this publisher should
+                        # be marked as being known to have one and then the
+                        # request passed on to extract_to.
+                        self.__catalogs[pub] = None
+                        return self.extract_to(partpath, path, filename=part)
 
                 # No catalog data found for publisher; construct a catalog
                 # in memory based on packages found for publisher.
                 cat = pkg.catalog.Catalog(batch_mode=True)
                 manpath = os.path.join(pubpath, "pkg") + os.path.sep
                 lm = None
-                for name in self.__extract_offsets:
-                        if name.startswith(manpath) and name.count("/") == 4:
+                for name in self.__names(manpath):
+                        if name.count("/") == 4:
                                 ignored, stem, ver = name.rsplit("/", 2)
                                 stem = urllib.unquote(stem)
                                 ver = urllib.unquote(ver)
@@ -870,8 +1220,8 @@ class Archive(object):
                 'pub' is the prefix (name) of the publisher that the package
                 files are associated with.  If not provided, the first file
                 named after the given hash found in the archive will be used.
-                (This will be noticeably slower depending on the size of the
-                archive.)
+                (For archives without a version 1 index, this will be
+                noticeably slower depending on the size of the archive.)
                 """
 
                 assert not self.__closed and "r" in self.__mode
@@ -882,22 +1232,15 @@ class Archive(object):
                 self.__find_extract_offsets()
 
                 if not pub:
-                        # Scan extract offsets index for the first instance of
-                        # any package file seen for each hash and extract the
-                        # file as each is found.
+                        # Extract the first instance of any package file seen
+                        # for each hash as each is found.
                         hashes = set(hashes)
-
-                        for name in self.__extract_offsets:
-                                for fhash in hashes:
-                                        hash_fname = os.path.join("file",
-                                            fhash[:2], fhash)
-                                        if name.endswith(hash_fname):
-                                                self.extract_to(name, path,
-                                                    filename=fhash)
-                                                hashes.discard(fhash)
-                                                break
-                                if not hashes:
-                                        break
+                        for fhash in list(hashes):
+                                name = self.__find_package_file(fhash)
+                                if name is not None:
+                                        self.extract_to(name, path,
+                                            filename=fhash)
+                                        hashes.discard(fhash)
 
                         if hashes:
                                 # Any remaining hashes are for package files
@@ -1067,7 +1410,10 @@ class Archive(object):
         def get_index(self):
                 """Returns the index, and extract_offsets from an Archive
                 opened in read-only mode, allowing additional Archive objects
-                to reuse the index, in a memory-efficient manner."""
+                to reuse the index, in a memory-efficient manner.  This is a
+                dictionary mapping member names to their offsets in the
+                archive, or an ArchiveIndexMap for archives with a version 1
+                index."""
                 assert not self.__closed and "r" in self.__mode
                 if not self.__extract_offsets:
                         # If the extraction index doesn't exist, scan the
@@ -1087,8 +1433,8 @@ class Archive(object):
                 'pub' is the prefix (name) of the publisher that the package
                 files are associated with.  If not provided, the first file
                 named after the given hash found in the archive will be used.
-                (This will be noticeably slower depending on the size of the
-                archive.)
+                (For archives without a version 1 index, this will be
+                noticeably slower depending on the size of the archive.)
                 """
 
                 assert not self.__closed and "r" in self.__mode
@@ -1099,13 +1445,13 @@ class Archive(object):
                         self.__find_extract_offsets()
 
                 if not pub:
-                        # Scan extract offsets index for the first instance of
-                        # any package file seen for the hash and extract it.
-                        hash_fname = os.path.join("file", fhash[:2], fhash)
-                        for name in self.__extract_offsets:
-                                if name.endswith(hash_fname):
-                                        return self.get_file(name)
-                        raise UnknownArchiveFiles(self.__arc_name, [fhash])
+                        # Return the first instance of any package file seen
+                        # for the hash.
+                        name = self.__find_package_file(fhash)
+                        if name is None:
+                                raise UnknownArchiveFiles(self.__arc_name,
+                                    [fhash])
+                        return self.get_file(name)
 
                 return self.get_file(os.path.join("publisher", pub, "file",
                     fhash[:2], fhash))
@@ -1157,28 +1503,26 @@ class Archive(object):
                 # Search through offset index to find publishers
                 # in use.
                 self.__pubs = {}
-                for name in self.__extract_offsets:
-                        if name.count("/") == 1 and \
-                            name.startswith("publisher/"):
-                                ignored, pfx = name.split("/", 1)
-
-                                # See if this publisher has a .p5i file in the
-                                # archive (needed for signed packages).
-                                p5iname = os.path.join("publisher", pfx,
-                                    "pub.p5i")
-                                try:
-                                        fobj = self.get_file(p5iname)
-                                except UnknownArchiveFiles:
-                                        # No p5i; that's ok.
-                                        pub = pkg.client.publisher.Publisher(
-                                            pfx)
-                                else:
-                                        pubs = pkg.p5i.parse(fileobj=fobj)
-                                        assert len(pubs) == 1
-                                        pub = pubs[0][0]
-                                        assert pub
-
-                                self.__pubs[pfx] = pub
+                for name in self.__names("publisher/", children=True):
+                        ignored, pfx = name.split("/", 1)
+
+                        # See if this publisher has a .p5i file in the
+                        # archive (needed for signed packages).
+                        p5iname = os.path.join("publisher", pfx,
+                            "pub.p5i")
+                        try:
+                                fobj = self.get_file(p5iname)
+                        except UnknownArchiveFiles:
+                                # No p5i; that's ok.
+                                pub = pkg.client.publisher.Publisher(
+                                    pfx)
+                        else:
+                                pubs = pkg.p5i.parse(fileobj=fobj)
+                                assert len(pubs) == 1
+                                pub = pubs[0][0]
+                                assert pub
+
+                        self.__pubs[pfx] = pub
 
                 return self.__pubs.values()
 
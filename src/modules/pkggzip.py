@@ -48,7 +48,9 @@ class PkgGzipFile(gzip.GzipFile):
         # is present.  Bytes 5-8 are the MTIME field, zeroed in this case.
         # Byte 9 is the XFL (Extra Flags) field, set to 2 (compressor used
         # max compression).  The final bit is the OS type, set to 255 (for
-        # "unknown").
+        # "unknown").  The header is the same whatever the compression level,
+        # so that files compressed at any level are recognized as ours; the
+        # XFL field is only advisory.
         magic = "\037\213\010\000\000\000\000\000\002\377"
 
         def _write_gzip_header(self):
@@ -173,8 +173,10 @@ def load_passwd(dirpath):
         passwd_stamp = os.stat(passwd_file).st_mtime
         if passwd_stamp <= users_lastupdate.get(dirpath, -1):
                 return
-        users[dirpath] = user = {}
-        uids[dirpath] = uid = {}
+        # The new tables are only published once complete, since other
+        # threads may be looking up entries in the current ones.
+        user = {}
+        uid = {}
         f = file(passwd_file)
         for line in f:
                 arr = line.rstrip().split(":")
@@ -195,6 +197,8 @@ def load_passwd(dirpath):
                 # current pw_entry.
                 uid.setdefault(pw_entry.pw_uid, pw_entry)
 
+        users[dirpath] = user
+        uids[dirpath] = uid
         users_lastupdate[dirpath] = passwd_stamp
         f.close()
 
@@ -204,8 +208,10 @@ def load_groups(dirpath):
         group_stamp = os.stat(group_file).st_mtime
         if group_stamp <= groups_lastupdate.get(dirpath, -1):
                 return
-        groups[dirpath] = group = {}
-        gids[dirpath] = gid = {}
+        # The new tables are only published once complete, since other
+        # threads may be looking up entries in the current ones.
+        group = {}
+        gid = {}
         f = file(group_file)
         for line in f:
                 arr = line.rstrip().split(":")
@@ -225,6 +231,8 @@ def load_groups(dirpath):
                 # current pw_entry.
                 gid.setdefault(gr_entry.gr_gid, gr_entry)
 
+        groups[dirpath] = group
+        gids[dirpath] = gid
         groups_lastupdate[dirpath] = group_stamp
         f.close()
 
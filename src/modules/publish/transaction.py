@@ -29,12 +29,17 @@ repository.  Note that only the Transaction class should be used directly,
 though the other classes can be referred to for documentation purposes."""
 
 import os
+import shutil
+import tempfile
 import urllib
 import urlparse
 
+from pkg.client import global_settings
 from pkg.misc import EmptyDict
 import pkg.actions as actions
 import pkg.config as cfg
+import pkg.digest as digest
+import pkg.misc as misc
 import pkg.portable.util as os_util
 import pkg.server.repository as sr
 import pkg.client.api_errors as apx
@@ -194,7 +199,15 @@ class NullTransaction(object):
 
 
 class TransportTransaction(object):
-        """Provides a publishing interface that uses client transport."""
+        """Provides a publishing interface that uses client transport.
+
+        When publishing to a depot that supports it, the payloads of the
+        actions added to a transaction that was opened by the object are sent
+        at once, up to PKG_CLIENT_PUBLISH_CONCURRENCY of them at a time, and
+        the actions are only added, in order, once all of those have been
+        received; see add()."""
+
+        bufsz = 128 * 1024
 
         def __init__(self, origin_url, create_repo=False, pkg_name=None,
             repo_props=EmptyDict, trans_id=None, xport=None, pub=None,
@@ -213,6 +226,24 @@ class TransportTransaction(object):
                 self.transport = xport
                 self.publisher = pub
 
+                # Whether adding actions is deferred until their payloads have
+                # been sent, the actions that have been, each with its form as
+                # added and the hash name of its payload if that's to be sent,
+                # and a dictionary mapping those names to the paths of the
+                # files holding the payloads.
+                self.__deferring = False
+                self.__deferred = []
+                self.__files = {}
+                self.__spool_dir = None
+
+                # Whether each action added to a file repository has to be in
+                # the transaction's manifest before add() returns.  It may
+                # only be left pending in the repository, to have its payload
+                # compressed while the next is read, if the transaction was
+                # opened by this object, and so is closed by it in the same
+                # process.
+                self.__add_flush = True
+
                 if scheme == "file":
                         self.create_file_repo(repo_props=repo_props,
                             create_repo=create_repo)
@@ -241,7 +272,8 @@ class TransportTransaction(object):
 
                 try:
                         repo = sr.Repository(properties=repo_props,
-                            root=self.path)
+                            root=self.path, compress_jobs=
+                            global_settings.PKG_CLIENT_COMPRESS_JOBS or None)
                 except EnvironmentError as e:
                         raise TransactionOperationError(None, msg=_(
                             "An error occurred while trying to "
@@ -260,7 +292,12 @@ class TransportTransaction(object):
 
         def add(self, action):
                 """Adds an action and its related content to an in-flight
-                transaction.  Returns nothing."""
+                transaction.  Returns nothing.
+
+                If the transaction was opened by this object and is being
+                published to a depot, the action may only be added when
+                add_file() or close() is next called, once the payloads of it
+                and the actions added before it have been sent."""
 
                 try:
                         # Perform additional publication-time validation of
@@ -270,15 +307,163 @@ class TransportTransaction(object):
                         raise TransactionOperationError("add",
                             trans_id=self.trans_id, msg=str(e))
 
+                if self.__deferring:
+                        self.__defer(action)
+                        return
+
                 try:
                         self.transport.publish_add(self.publisher,
                             action=action, trans_id=self.trans_id,
-                            progtrack=self.progtrack)
+                            progtrack=self.progtrack, flush=self.__add_flush)
                 except apx.TransportError as e:
                         msg = str(e)
                         raise TransactionOperationError("add",
                             trans_id=self.trans_id, msg=msg)
 
+        def __defer(self, action):
+                """Records the action to be added by __flush(), once its
+                payload, if it's given one, has been sent along with those of
+                the other actions recorded."""
+
+                if not action.has_payload or action.data is None:
+                        # Either there's no payload, or it's named by the
+                        # action's hash and stored by the repository.
+                        self.__deferred.append((action, str(action), None))
+                        return
+
+                hash_attr, hash_val, hash_func = \
+                    digest.get_least_preferred_hash(None)
+                fhash, path, size = self.__read_payload(action.data(),
+                    hash_func())
+
+                # The action is added as it would be if its payload were sent
+                # with it, but for the payload being named.
+                attrs = action.attrs.copy()
+                attrs["pkg.size"] = str(size)
+                named = actions.types[action.name](None, **attrs)
+                if hash_attr == "hash":
+                        named.hash = fhash
+                else:
+                        named.attrs[hash_attr] = fhash
+                self.__deferred.append((action, str(named), fhash))
+
+                if size == 0:
+                        # Empty payloads aren't sent.
+                        pass
+                elif fhash in self.__files:
+                        # The payload is only sent once, but is accounted for
+                        # as if it were sent with each action.
+                        if path != self.__files[fhash]:
+                                self.__remove_spool(path)
+                        if self.progtrack:
+                                self.progtrack.upload_add_progress(size)
+                else:
+                        self.__files[fhash] = path
+
+        def __read_payload(self, fobj, hashobj):
+                """Reads the payload from the file object 'fobj', updating the
+                hash object 'hashobj' with it.  Returns a tuple of the hash
+                name of the payload, the path of a file holding it, and its
+                size.  Unless 'fobj' is a file that can be sent as is, what's
+                read is written to a file in a temporary directory."""
+
+                spool = None
+                path = None
+                size = 0
+                try:
+                        if isinstance(fobj, file) and \
+                            os.path.isfile(fobj.name):
+                                path = fobj.name
+                        else:
+                                if not self.__spool_dir:
+                                        self.__spool_dir = tempfile.mkdtemp(
+                                            dir=misc.config_temp_root(),
+                                            prefix="pkgsend-")
+                                fd, path = tempfile.mkstemp(
+                                    dir=self.__spool_dir)
+                                spool = os.fdopen(fd, "wb")
+
+                        while True:
+                                data = fobj.read(self.bufsz)
+                                if not data:
+                                        break
+                                hashobj.update(data)
+                                size += len(data)
+                                if spool:
+                                        spool.write(data)
+                finally:
+                        fobj.close()
+                        if spool:
+                                spool.close()
+
+                return hashobj.hexdigest(), path, size
+
+        def __remove_spool(self, path):
+                """Removes the file at 'path' if it's one that __read_payload()
+                wrote a payload to."""
+
+                if self.__spool_dir and \
+                    os.path.dirname(path) == self.__spool_dir:
+                        os.unlink(path)
+
+        def __discard(self):
+                """Discards the actions recorded by __defer(), and any payloads
+                that were written to temporary files for them."""
+
+                self.__deferred = []
+                self.__files = {}
+                if self.__spool_dir:
+                        shutil.rmtree(self.__spool_dir, ignore_errors=True)
+                        self.__spool_dir = None
+
+        def __flush(self):
+                """Sends the payloads of the actions recorded by __defer() at
+                once, and then adds the actions in the order they were
+                recorded."""
+
+                if not self.__deferred:
+                        return
+
+                deferred = self.__deferred
+                files = self.__files
+                self.__deferred = []
+                self.__files = {}
+
+                try:
+                        if files:
+                                self.transport.publish_add_files(
+                                    self.publisher, files,
+                                    trans_id=self.trans_id,
+                                    progtrack=self.progtrack)
+                except apx.TransportError as e:
+                        # Report the failure against the (first) action whose
+                        # payload couldn't be sent.
+                        failed = set(
+                            getattr(f, "request", None)
+                            for f in getattr(e, "exceptions", [e])
+                        )
+                        msg = str(e)
+                        for a, added, fhash in deferred:
+                                if fhash in failed:
+                                        msg = _("Unable to send the payload "
+                                            "of '{action}':\n{err}").format(
+                                            action=a, err=e)
+                                        break
+                        raise TransactionOperationError("add",
+                            trans_id=self.trans_id, msg=msg)
+                finally:
+                        for path in files.itervalues():
+                                self.__remove_spool(path)
+
+                try:
+                        self.transport.publish_add_actions(self.publisher,
+                            [added for a, added, fhash in deferred],
+                            trans_id=self.trans_id)
+                except apx.TransportError as e:
+                        # The depot names the action that couldn't be added.
+                        raise TransactionOperationError("add",
+                            trans_id=self.trans_id, msg=str(e))
+
         def add_file(self, pth):
                 """Adds an additional file to the inflight transaction so that
                 it will be available for retrieval once the transaction is
@@ -290,6 +475,10 @@ class TransportTransaction(object):
                             "be added is not a file.  The path given was {0}.").format(
                             pth)))
 
+                # Files are added after the actions that precede them, such
+                # as the signature action whose certificates they are.
+                self.__flush()
+
                 try:
                         self.transport.publish_add_file(self.publisher,
                             pth=pth, trans_id=self.trans_id)
@@ -312,6 +501,7 @@ class TransportTransaction(object):
                 """
 
                 if abandon:
+                        self.__discard()
                         try:
                                 state, fmri = self.transport.publish_abandon(
                                     self.publisher, trans_id=self.trans_id)
@@ -320,6 +510,10 @@ class TransportTransaction(object):
                                 raise TransactionOperationError("abandon",
                                     trans_id=self.trans_id, msg=msg)
                 else:
+                        try:
+                                self.__flush()
+                        finally:
+                                self.__discard()
                         try:
                                 state, fmri = self.transport.publish_close(
                                     self.publisher, trans_id=self.trans_id,
@@ -331,6 +525,24 @@ class TransportTransaction(object):
 
                 return state, fmri
 
+        def __start_deferring(self):
+                """Defers adding actions until their payloads have been sent
+                if the transaction is being published to a depot that allows
+                that, and the payloads may be sent at once."""
+
+                if self.scheme == "file":
+                        self.__add_flush = False
+                        return
+                if global_settings.PKG_CLIENT_PUBLISH_CONCURRENCY <= 1:
+                        return
+
+                try:
+                        self.__deferring = self.transport.supports_version(
+                            self.publisher, "add", [1]) > -1
+                except apx.TransportError:
+                        # Actions are added one at a time, as usual.
+                        pass
+
         def open(self):
                 """Starts an in-flight transaction. Returns a URL-encoded
                 transaction ID on success."""
@@ -353,6 +565,7 @@ class TransportTransaction(object):
                             msg=_("Unknown failure; no transaction ID provided"
                             " in response."))
 
+                self.__start_deferring()
                 return self.trans_id
 
         def append(self):
@@ -377,6 +590,7 @@ class TransportTransaction(object):
                             msg=_("Unknown failure; no transaction ID provided"
                             " in response."))
 
+                self.__start_deferring()
                 return self.trans_id        
 
         def refresh_index(self):
@@ -949,17 +949,18 @@ class TopQuery(object):
         def __str__(self):
                 return str(self.query)
 
-        def __keep(self, x):
-                """Determines whether the x'th result should be returned."""
-
-                return x >= self.start_point and \
-                    (self.num_to_return is None or
-                    x < self.num_to_return + self.start_point)
-        
         def finalize_results(self, it):
                 """Converts the internal result representation to the format
                 which is expected by the callers of search.  It also handles
-                returning only those results requested by the user."""
+                returning only those results requested by the user.  Once the
+                last of those has been returned, no more results are taken
+                from "it", so the search stops reading the index."""
+
+                start = max(self.start_point, 0)
+                stop = None
+                if self.num_to_return is not None:
+                        stop = max(start, self.start_point + self.num_to_return)
+                it = itertools.islice(it, start, stop)
 
                 # Need to replace "1" with current search version, or something
                 # similar
@@ -968,16 +969,12 @@ class TopQuery(object):
                         return (
                             (1, Query.RETURN_ACTIONS,
                             (fmri.PkgFmri(pfmri), fv, l))
-                            for x, (at, st, pfmri, fv, l)
-                            in enumerate(it)
-                            if self.__keep(x)
+                            for at, st, pfmri, fv, l in it
                         )
                 else:
                         return (
                             (1, Query.RETURN_PACKAGES, fmri.PkgFmri(pfmri))
-                            for x, pfmri
-                            in enumerate(it)
-                            if self.__keep(x)
+                            for pfmri in it
                         )
 
         def set_info(self, num_to_return, start_point, **kwargs):
@@ -1030,6 +1027,10 @@ class TermQuery(object):
 
         __dict_locks = {}
 
+        # The trigrams of the tokens for each index path; these are kept
+        # apart from the other index files as they're optional.
+        __ngram_dicts = {}
+
         has_non_wildcard_character = re.compile('.*[^\*\?].*')
 
         fmris = None
@@ -1064,6 +1065,7 @@ class TermQuery(object):
                 self._manifest_path_func = None
                 self._data_manf = None
                 self._data_token_offset = None
+                self._data_token_ngrams = None
                 self._data_main_dict = None
 
         def __init_gdd(self, path):
@@ -1136,6 +1138,7 @@ class TermQuery(object):
                 except KeyError:
                         pass
                 finally:
+                        cls.__ngram_dicts.pop(index_dir, None)
                         cls.__unlock_gdd(index_dir)
 
         def add_field_restrictions(self, pkg_name, action_type, key):
@@ -1279,9 +1282,31 @@ class TermQuery(object):
                         self._data_token_offset = tq_gdd["token_byte_offset"]
                         self._data_fmri_offsets = tq_gdd.get("fmri_offsets",
                             None)
+                        self._data_token_ngrams = self.__get_ngrams(ret)
                 finally:
                         self.__unlock_gdd(self._dir_path)
 
+        def __get_ngrams(self, version):
+                """Returns the trigrams of the tokens in the index if they were
+                written along with the index files of the given version, or
+                None otherwise.  The lock for the index must be held."""
+
+                ngrams = self.__ngram_dicts.get(self._dir_path)
+                try:
+                        if ngrams is not None and ngrams.version == version \
+                            and not ngrams.should_reread():
+                                return ngrams
+                        # As with the other dictionaries, a new object is used
+                        # so that searches in other threads aren't affected.
+                        ngrams = ss.IndexStoreNgrams(ss.NGRAM_FILE)
+                        if not ngrams.load(self._dir_path, version):
+                                ngrams = None
+                except (EnvironmentError, ValueError, IndexError,
+                    search_errors.InconsistentIndexException):
+                        ngrams = None
+                self.__ngram_dicts[self._dir_path] = ngrams
+                return ngrams
+
         def allow_version(self, v):
                 """Returns whether the query supports a query of version v."""
                 return True
@@ -1383,6 +1408,19 @@ class TermQuery(object):
                                 pkg_offsets.add(int(l))
                 return pkg_offsets
 
+        def __candidate_tokens(self, term):
+                """Returns the tokens which might match the glob pattern
+                'term'.  Where possible, these are narrowed down using the
+                trigrams of the tokens rather than returning all of them."""
+
+                keys = self._data_token_offset.get_keys()
+                if self._data_token_ngrams is None:
+                        return keys
+                ids = self._data_token_ngrams.get_candidates(term)
+                if ids is None or (ids and ids[-1] >= len(keys)):
+                        return keys
+                return [keys[i] for i in ids]
+
         def _search_internal(self, fmris):
                 """Searches the indexes in dir_path for any matches of query
                 and the results in self.res.  The method assumes the
@@ -1407,7 +1445,7 @@ class TermQuery(object):
                         # If the term has at least one non-wildcard character
                         # in it, do the glob search.
                         if TermQuery.has_non_wildcard_character.match(term):
-                                keys = self._data_token_offset.get_keys()
+                                keys = self.__candidate_tokens(term)
                                 matches = choose(keys, term, case_sensitive)
                                 offsets = set([
                                     self._data_token_offset.get_id(match)
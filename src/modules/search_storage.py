@@ -25,7 +25,9 @@
 #
 
 import os
+import array
 import errno
+import string
 import time
 import hashlib
 import urllib
@@ -33,7 +35,7 @@ import urllib
 import pkg.fmri as fmri
 import pkg.search_errors as search_errors
 import pkg.portable as portable
-from pkg.misc import PKG_FILE_BUFSIZ
+from pkg.misc import PKG_FILE_BUFSIZ, force_bytes
 
 FAST_ADD = 'fast_add.v1'
 FAST_REMOVE = 'fast_remove.v1'
@@ -43,6 +45,7 @@ MAIN_FILE = 'main_dict.ascii.v2'
 BYTE_OFFSET_FILE = 'token_byte_offset.v1'
 FULL_FMRI_HASH_FILE = 'full_fmri_list.hash'
 FMRI_OFFSETS_FILE = 'fmri_offsets.v1'
+NGRAM_FILE = 'token_ngrams.v1'
 
 def consistent_open(data_list, directory, timeout = 1):
         """Opens all data holders in data_list and ensures that the
@@ -547,6 +550,7 @@ class IndexStoreDictMutable(IndexStoreBase):
         def __init__(self, file_name):
                 IndexStoreBase.__init__(self, file_name)
                 self._dict = {}
+                self._keys = []
 
         def get_dict(self):
                 return self._dict
@@ -558,7 +562,9 @@ class IndexStoreDictMutable(IndexStoreBase):
                 return self._dict[entity]
 
         def get_keys(self):
-                return self._dict.keys()
+                """Returns the entities in the order they were read from the
+                file."""
+                return self._keys
 
         @staticmethod
         def __quote(str):
@@ -572,6 +578,7 @@ class IndexStoreDictMutable(IndexStoreBase):
                 and its number on each line.
                 """
                 self._dict.clear()
+                self._keys = []
                 for line in self._file_handle:
                         token, offset = line.split(" ")
                         if token[0] == "1":
@@ -580,6 +587,7 @@ class IndexStoreDictMutable(IndexStoreBase):
                                 token = token[1:]
                         offset = int(offset)
                         self._dict[token] = offset
+                        self._keys.append(token)
                 IndexStoreBase.read_dict_file(self)
 
         def open_out_file(self, use_dir, version_num):
@@ -610,6 +618,160 @@ class IndexStoreDictMutable(IndexStoreBase):
                 """
                 return 0
 
+class IndexStoreNgrams(IndexStoreBase):
+        """Class used to store the trigrams of the tokens in the main
+        dictionary.  For each trigram of the lowercased tokens, it stores the
+        positions in the token byte offset file of the tokens containing it.
+        This allows the tokens which might match a glob pattern to be found
+        without matching the pattern against every token."""
+
+        N = 3
+        __lower = string.maketrans(string.ascii_uppercase,
+            string.ascii_lowercase)
+
+        def __init__(self, file_name):
+                IndexStoreBase.__init__(self, file_name)
+                self._dict = {}
+                self._next_id = 0
+                self.version = None
+
+        @classmethod
+        def ngrams(cls, s):
+                """Returns the set of trigrams of the string 's'.  Only ASCII
+                characters are lowercased, as is done when matching patterns
+                without regard to case."""
+
+                s = force_bytes(s).translate(cls.__lower)
+                return set(s[i:i + cls.N] for i in range(len(s) - cls.N + 1))
+
+        @staticmethod
+        def literal_runs(pat):
+                """Returns the runs of characters in the glob pattern 'pat'
+                which must appear in any string matching it.  The pattern is
+                parsed as fnmatch.translate() does."""
+
+                runs = []
+                run = ""
+                i, n = 0, len(pat)
+                while i < n:
+                        c = pat[i]
+                        i += 1
+                        if c == "*" or c == "?":
+                                runs.append(run)
+                                run = ""
+                        elif c == "[":
+                                j = i
+                                if j < n and pat[j] == "!":
+                                        j += 1
+                                if j < n and pat[j] == "]":
+                                        j += 1
+                                while j < n and pat[j] != "]":
+                                        j += 1
+                                if j >= n:
+                                        # Without a closing bracket, the '['
+                                        # matches itself.
+                                        run += c
+                                else:
+                                        runs.append(run)
+                                        run = ""
+                                        i = j + 1
+                        else:
+                                run += c
+                runs.append(run)
+                return runs
+
+        def add_token(self, token):
+                """Adds the trigrams of the next token written to the token
+                byte offset file."""
+
+                for g in self.ngrams(token):
+                        try:
+                                self._dict[g].append(self._next_id)
+                        except KeyError:
+                                self._dict[g] = array.array("I",
+                                    [self._next_id])
+                self._next_id += 1
+
+        def __make_line(self, g):
+                """Returns the line for trigram 'g': the quoted trigram,
+                followed by the delta compressed positions of its tokens."""
+
+                old_i = 0
+                deltas = []
+                for i in self._dict[g]:
+                        deltas.append(str(i - old_i))
+                        old_i = i
+                return urllib.quote(g, "") + " " + " ".join(deltas)
+
+        def write_dict_file(self, path, version_num):
+                """Write the trigrams and their token positions out to the
+                file."""
+
+                IndexStoreBase._protected_write_dict_file(self, path,
+                    version_num, (
+                        self.__make_line(g)
+                        for g in sorted(self._dict)
+                    ))
+
+        def read_dict_file(self):
+                """Read a file written by the above function.  The token
+                positions are only decoded when they're needed."""
+
+                assert self._file_handle
+                self._dict.clear()
+                for l in self._file_handle:
+                        g, ids = l.split(" ", 1)
+                        self._dict[urllib.unquote(g)] = ids
+                IndexStoreBase.read_dict_file(self)
+
+        def load(self, directory, version):
+                """Read the file in 'directory' if it was written along with
+                the other index files of the given version.  Returns whether it
+                was read."""
+
+                try:
+                        if self.open(directory) != version:
+                                return False
+                        self.read_dict_file()
+                        self.version = version
+                finally:
+                        self.close_file_handle()
+                return True
+
+        def get_candidates(self, pat):
+                """Returns the sorted positions of the tokens which might match
+                the glob pattern 'pat', regardless of case, or None if the
+                pattern doesn't contain enough literal characters to tell."""
+
+                grams = set()
+                for run in self.literal_runs(pat):
+                        grams |= self.ngrams(run)
+                if not grams:
+                        return None
+
+                postings = sorted((self._dict.get(g, "") for g in grams),
+                    key=len)
+                res = None
+                for ids in postings:
+                        old_i = 0
+                        cur = set()
+                        for i in ids.split():
+                                old_i += int(i)
+                                cur.add(old_i)
+                        if res is None:
+                                res = cur
+                        else:
+                                res &= cur
+                        if not res:
+                                break
+                return sorted(res)
+
+        def count_entries_removed_during_partial_indexing(self):
+                """Returns the number of entries removed during a second phase
+                of indexing."""
+                return 0
+
+
 class IndexStoreSetHash(IndexStoreBase):
         def __init__(self, file_name):
                 IndexStoreBase.__init__(self, file_name)
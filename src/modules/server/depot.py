@@ -115,6 +115,7 @@ class DepotHTTP(_Depot):
             "close",
             "abandon",
             "add",
+            "have",
             "p5i",
             "publisher",
             "index",
@@ -271,10 +272,25 @@ class DepotHTTP(_Depot):
                         # This handles SIGUSR1
                         cherrypy.engine.subscribe("graceful", self.refresh)
 
+                # Stop the threads the repository compresses published
+                # payloads with when the server stops.
+                cherrypy.engine.subscribe("stop", self.repo.shutdown)
+
                 # Setup background task execution handler.
                 self.__bgtask = BackgroundTaskPlugin(cherrypy.engine)
                 self.__bgtask.subscribe()
 
+                # If requested, only save additions to the catalog to its
+                # update logs, and periodically save them to the catalog
+                # parts in the background.
+                interval = dconf.get_property("pkg",
+                    "catalog_compact_interval")
+                if interval > 0 and not repo.mirror and not repo.read_only \
+                    and repo.root:
+                        repo.defer_catalog = True
+                        self.__bgtask.schedule(interval,
+                            self.repo.compact_catalog)
+
         def _queue_refresh_index(self):
                 """Queues a background task to update search indexes.  This
                 method is a protected helper function for depot consumers."""
@@ -1195,10 +1211,110 @@ class DepotHTTP(_Depot):
             ]
         }
 
+        def add_1(self, *tokens):
+                """Adds the actions in the request body, one per line in
+                manifest form, to an in-flight transaction for the Transaction
+                ID specified in the request path, in the order given.  The
+                payload of an action is named by its hash, and must either
+                have been sent to the transaction using file/1 beforehand, or
+                be stored by the repository already; this allows a publisher
+                to send the payloads of many actions at once, and to then
+                add the actions themselves in a single request.  Returns no
+                output."""
+
+                try:
+                        # cherrypy decoded it, but we actually need it encoded.
+                        trans_id = urllib.quote(tokens[0], "")
+                except IndexError:
+                        trans_id = None
+
+                request = cherrypy.request
+                size = int(request.headers.get("Content-Length", 0))
+                if size > 0:
+                        lines = request.rfile.read(size).splitlines()
+                else:
+                        lines = []
+
+                def flush():
+                        # The content of the actions is stored while the
+                        # next ones are read, but the request can't return
+                        # until they're all in the manifest.
+                        try:
+                                self.repo.flush_transaction(trans_id)
+                        except srepo.RepositoryError as e:
+                                cherrypy.log("Request failed: {0}".format(
+                                    str(e)))
+                                raise cherrypy.HTTPError(httplib.BAD_REQUEST,
+                                    str(e))
+
+                for line in lines:
+                        line = line.strip()
+                        if not line:
+                                continue
+                        try:
+                                action = actions.fromstr(line)
+                        except actions.ActionError as e:
+                                flush()
+                                cherrypy.log("Request failed: {0}".format(
+                                    str(e)))
+                                raise cherrypy.HTTPError(httplib.BAD_REQUEST,
+                                    str(e))
+
+                        try:
+                                self.repo.add(trans_id, action, flush=False)
+                        except srepo.RepositoryError as e:
+                                # Assume a bad request was made, and name the
+                                # action that couldn't be added, as those
+                                # before it have been.
+                                flush()
+                                msg = _("Unable to add '{action}': "
+                                    "{err}").format(action=line, err=e)
+                                cherrypy.log("Request failed: {0}".format(msg))
+                                raise cherrypy.HTTPError(httplib.BAD_REQUEST,
+                                    msg)
+                flush()
+
+        add_1._cp_config = add_0._cp_config
+
+        def have_0(self, *tokens, **params):
+                """Request data contains application/x-www-form-urlencoded
+                entries with the hash names of files.  Outputs a text/plain
+                list of those that the repository stores, one per line, so
+                that a publisher can add actions referencing their content
+                without sending it."""
+
+                response = cherrypy.response
+                response.headers["Content-type"] = "text/plain; charset=utf-8"
+
+                pub = self._get_req_pub()
+                try:
+                        present = self.repo.has_files(params.values(),
+                            pub=pub)
+                except srepo.RepositoryUnknownPublisher:
+                        present = []
+                except srepo.RepositoryError as e:
+                        # Assume a bad request was made.  A 404 can't be
+                        # returned here as misc.versioned_urlopen will interpret
+                        # that to mean that the server doesn't support this
+                        # operation.
+                        raise cherrypy.HTTPError(httplib.BAD_REQUEST, str(e))
+                return "".join("{0}\n".format(h) for h in present)
+
+        have_0._cp_config = {
+            "tools.response_headers.on": True,
+            "tools.response_headers.headers": [
+                ("Pragma", "no-cache"),
+                ("Cache-Control", "no-cache, no-transform, must-revalidate"),
+                ("Expires", 0)
+            ]
+        }
+
         def __upload_file(self, *tokens):
                 """Adds a file to an in-flight transaction for the Transaction
                 ID specified in the request path.  The content is expected to be
-                in the request body.  Returns no output."""
+                in the request body, and to have the hash name that follows the
+                Transaction ID in the path, if there is one.  Returns no
+                output."""
 
                 try:
                         # cherrypy decoded it, but we actually need it encoded.
@@ -1215,9 +1331,10 @@ class DepotHTTP(_Depot):
                         raise cherrypy.HTTPError(httplib.BAD_REQUEST,
                             _("file/1 must be sent a file."))
                 data = request.rfile
+                fhash = tokens[1] if len(tokens) > 1 else None
 
                 try:
-                        self.repo.add_file(trans_id, data, size)
+                        self.repo.add_file(trans_id, data, size, fhash=fhash)
                 except srepo.RepositoryError as e:
                         # Assume a bad request was made.  A 404 can't be
                         # returned here as misc.versioned_urlopen will interpret
@@ -2308,6 +2425,7 @@ class BackgroundTaskPlugin(SimplePlugin):
                 SimplePlugin.__init__(self, bus)
                 self.__q = Queue.Queue(10)
                 self.__thread = None
+                self.__periodic = []
 
         def put(self, task, *args, **kwargs):
                 """Schedule the given task for background execution if queue
@@ -2317,9 +2435,35 @@ class BackgroundTaskPlugin(SimplePlugin):
                         raise Queue.Full()
                 self.__q.put_nowait((task, args, kwargs))
 
+        def schedule(self, interval, task, *args, **kwargs):
+                """Schedule the given task for background execution every
+                'interval' seconds, and once more when the plugin is stopped.
+                Periodic tasks don't count against the queue limit, and are
+                never run at the same time as any other task.
+                """
+                self.__periodic.append([time.time() + interval, interval,
+                    task, args, kwargs])
+
+        def __run_periodic(self, final=False):
+                """Run any periodic task that is due, or every periodic task
+                if 'final' is True."""
+                for entry in self.__periodic:
+                        due, interval, task, args, kwargs = entry
+                        now = time.time()
+                        if not final and now < due:
+                                continue
+                        entry[0] = now + interval
+                        try:
+                                task(*args, **kwargs)
+                        except:
+                                self.bus.log("Failure encountered executing "
+                                    "periodic task {0!r}.".format(task),
+                                    traceback=True)
+
         def run(self):
                 """Run any background task scheduled for execution."""
                 while self.__running:
+                        self.__run_periodic()
                         try:
                                 try:
                                         # A brief timeout here is necessary
@@ -2358,6 +2502,7 @@ class BackgroundTaskPlugin(SimplePlugin):
                         # Wait for the thread to terminate.
                         self.__thread.join()
                         self.__thread = None
+                        self.__run_periodic(final=True)
 
 
 class DepotConfig(object):
@@ -2389,6 +2534,8 @@ class DepotConfig(object):
             4: [
                 cfg.PropertySection("pkg", [
                     cfg.PropList("address"),
+                    cfg.PropInt("catalog_compact_interval",
+                        value_map={ "": 0 }),
                     cfg.PropDefined("cfg_file", allowed=["", "<pathname>"]),
                     cfg.Property("content_root"),
                     cfg.PropList("debug", allowed=["", "headers",
@@ -2397,6 +2544,7 @@ class DepotConfig(object):
                     cfg.PropList("disable_ops"),
                     cfg.PropDefined("image_root", allowed=["",
                         "<abspathname>"]),
+                    cfg.PropInt("index_jobs"),
                     cfg.PropDefined("inst_root", allowed=["", "<pathname>"]),
                     cfg.PropBool("ll_mirror"),
                     cfg.PropDefined("log_access", allowed=["", "stderr",
@@ -2410,6 +2558,9 @@ class DepotConfig(object):
                     cfg.PropPubURI("proxy_base"),
                     cfg.PropBool("readonly"),
                     cfg.PropInt("socket_timeout"),
+                    cfg.PropInt("search_cache_size",
+                        default=srepo.SEARCH_CACHE_MAX_SIZE,
+                        value_map={ "": srepo.SEARCH_CACHE_MAX_SIZE }),
                     cfg.PropInt("sort_file_max_size",
                         default=indexer.SORT_FILE_MAX_SIZE,
                         value_map={ "": indexer.SORT_FILE_MAX_SIZE }),
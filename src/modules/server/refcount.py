@@ -0,0 +1,255 @@
+#!/usr/bin/python2.7
+#
+# CDDL HEADER START
+#
+# The contents of this file are subject to the terms of the
+# Common Development and Distribution License (the "License").
+# You may not use this file except in compliance with the License.
+#
+# You can obtain a copy of the license at usr/src/OPENSOLARIS.LICENSE
+# or http://www.opensolaris.org/os/licensing.
+# See the License for the specific language governing permissions
+# and limitations under the License.
+#
+# When distributing Covered Code, include this CDDL HEADER in each
+# file and include the License file at usr/src/OPENSOLARIS.LICENSE.
+# If applicable, add the following below this CDDL HEADER, with the
+# fields enclosed by brackets "[]" replaced with your own identifying
+# information: Portions Copyright [yyyy] [name of copyright owner]
+#
+# CDDL HEADER END
+#
+
+#
+# Copyright 2026 OmniOS Community Edition (OmniOSce) Association.
+#
+
+"""Persistent index of the number of manifests in a repository store that
+reference each file.
+
+The index is kept in a dbm database (see anydbm) in its own directory.  For
+each file hash referenced by at least one manifest, it holds the number of
+manifests referencing it; for each manifest that has been counted, it holds
+a marker so that the same manifest is never counted twice.
+
+A file named 'dirty' is created in the directory before the database is
+changed and removed once the change is complete.  An index which is dirty,
+or which doesn't exist, can't be trusted; it must be rebuilt from the
+manifests in the repository before it can be used again.
+
+Counts may be higher than the true number of referencing manifests (for
+example, if manifests are removed without the index being told), but must
+never be lower; the result of a higher count is only that a file isn't
+removed when it could have been."""
+
+import anydbm
+import contextlib
+import errno
+import os
+import shutil
+import tempfile
+
+import pkg.portable as portable
+
+VERSION = "1"
+
+_VERSION_KEY = "version"
+_HASH_PREFIX = "h:"
+_MANIFEST_PREFIX = "m:"
+
+
+def _get(db, key, default=None):
+        """Not every dbm implementation provides get()."""
+
+        try:
+                return db[key]
+        except KeyError:
+                return default
+
+
+class RefCountIndex(object):
+        """A persistent index of the number of references to each file in a
+        repository store."""
+
+        def __init__(self, root):
+                """'root' is the directory in which the index is kept."""
+
+                self.root = root
+                self.__db_path = os.path.join(root, "refs")
+                self.__dirty_path = os.path.join(root, "dirty")
+                self.__depth = 0
+
+        def __open(self, flag="r"):
+                return contextlib.closing(anydbm.open(self.__db_path, flag))
+
+        @contextlib.contextmanager
+        def changing(self):
+                """Context manager which marks the index as dirty for the
+                duration of a change to the index or to the manifests it
+                describes.  The mark is only removed if the change completes
+                without raising an exception."""
+
+                if self.__depth == 0:
+                        open(self.__dirty_path, "wb").close()
+                self.__depth += 1
+                try:
+                        yield
+                finally:
+                        self.__depth -= 1
+                # Not reached if an exception was raised above.
+                if self.__depth == 0:
+                        portable.remove(self.__dirty_path)
+
+        def valid(self):
+                """Returns a boolean indicating whether the index exists and
+                can be trusted."""
+
+                if os.path.exists(self.__dirty_path):
+                        return False
+                try:
+                        with self.__open() as db:
+                                return _get(db, _VERSION_KEY) == VERSION
+                except (EnvironmentError, anydbm.error):
+                        return False
+
+        def has_manifest(self, key):
+                """Returns a boolean indicating whether the manifest named
+                'key' has been counted."""
+
+                with self.__open() as db:
+                        return _get(db, _MANIFEST_PREFIX + key) is not None
+
+        def update(self, add=(), remove=()):
+                """Update the index.  'remove' and 'add' are iterables of
+                tuples of the form (key, hashes), where 'key' names a manifest
+                and 'hashes' is the set of file hashes it references.  The
+                manifests in 'remove' are processed first; those which haven't
+                been counted are ignored, as are those in 'add' which already
+                have been.
+
+                Returns the set of hashes which are no longer referenced by any
+                manifest."""
+
+                unreferenced = set()
+                with self.changing():
+                        with self.__open("w") as db:
+                                for key, hashes in remove:
+                                        mkey = _MANIFEST_PREFIX + key
+                                        if _get(db, mkey) is None:
+                                                continue
+                                        del db[mkey]
+                                        for h in hashes:
+                                                hkey = _HASH_PREFIX + h
+                                                cnt = _get(db, hkey)
+                                                if cnt is None:
+                                                        # Not counted; assume
+                                                        # it's still in use.
+                                                        continue
+                                                cnt = int(cnt) - 1
+                                                if cnt > 0:
+                                                        db[hkey] = str(cnt)
+                                                        continue
+                                                del db[hkey]
+                                                unreferenced.add(h)
+
+                                for key, hashes in add:
+                                        mkey = _MANIFEST_PREFIX + key
+                                        if _get(db, mkey) is not None:
+                                                continue
+                                        db[mkey] = ""
+                                        for h in hashes:
+                                                hkey = _HASH_PREFIX + h
+                                                db[hkey] = str(
+                                                    int(_get(db, hkey, 0)) + 1)
+                                                unreferenced.discard(h)
+                return unreferenced
+
+        @staticmethod
+        def __count(manifests):
+                """Returns a tuple of the set of keys of 'manifests' and a
+                dictionary mapping each hash they reference to the number of
+                manifests that do so."""
+
+                keys = set()
+                counts = {}
+                for key, hashes in manifests:
+                        if key in keys:
+                                continue
+                        keys.add(key)
+                        for h in hashes:
+                                counts[h] = counts.get(h, 0) + 1
+                return keys, counts
+
+        def rebuild(self, manifests):
+                """Replace the index with one describing 'manifests', an
+                iterable of tuples of the form (key, hashes) for every manifest
+                in the repository store."""
+
+                keys, counts = self.__count(manifests)
+
+                parent = os.path.dirname(self.root)
+                if not os.path.exists(parent):
+                        os.makedirs(parent)
+                tmp_root = tempfile.mkdtemp(dir=parent,
+                    prefix=".{0}.".format(os.path.basename(self.root)))
+                try:
+                        db = anydbm.open(os.path.join(tmp_root, "refs"), "n")
+                        try:
+                                for key in keys:
+                                        db[_MANIFEST_PREFIX + key] = ""
+                                for h, cnt in counts.iteritems():
+                                        db[_HASH_PREFIX + h] = str(cnt)
+                                db[_VERSION_KEY] = VERSION
+                        finally:
+                                db.close()
+                        os.chmod(tmp_root, 0o755)
+
+                        # Replace the old index, if any.
+                        self.destroy()
+                        portable.rename(tmp_root, self.root)
+                except:
+                        shutil.rmtree(tmp_root, ignore_errors=True)
+                        raise
+
+        def check(self, manifests):
+                """Compare the index with 'manifests', an iterable of tuples of
+                the form (key, hashes) for every manifest in the repository
+                store.  Returns a list of tuples of the form (hash, recorded,
+                actual) for each hash whose count in the index doesn't match
+                the number of manifests referencing it, and a list of tuples
+                of the form (key, recorded, actual) for each manifest which is
+                only counted in the index or only present in 'manifests'."""
+
+                keys, counts = self.__count(manifests)
+
+                bad_hashes = []
+                bad_manifests = []
+                with self.__open() as db:
+                        for dkey in db.keys():
+                                if dkey.startswith(_HASH_PREFIX):
+                                        h = dkey[len(_HASH_PREFIX):]
+                                        recorded = int(db[dkey])
+                                        actual = counts.pop(h, 0)
+                                        if recorded != actual:
+                                                bad_hashes.append((h,
+                                                    recorded, actual))
+                                elif dkey.startswith(_MANIFEST_PREFIX):
+                                        key = dkey[len(_MANIFEST_PREFIX):]
+                                        if key in keys:
+                                                keys.remove(key)
+                                        else:
+                                                bad_manifests.append((key,
+                                                    True, False))
+
+                bad_hashes.extend((h, 0, cnt) for h, cnt in counts.iteritems())
+                bad_manifests.extend((key, False, True) for key in keys)
+                return sorted(bad_hashes), sorted(bad_manifests)
+
+        def destroy(self):
+                """Remove the index."""
+
+                try:
+                        shutil.rmtree(self.root)
+                except EnvironmentError as e:
+                        if e.errno != errno.ENOENT:
+                                raise
@@ -23,19 +23,24 @@
 
 import cStringIO
 import codecs
+import collections
 import datetime
 import errno
 import hashlib
 import logging
+import multiprocessing
 import os
 import os.path
 import shutil
 import stat
 import sys
 import tempfile
+import threading
 import urllib
 import zlib
 
+from multiprocessing.pool import ThreadPool
+
 from cryptography import x509
 from cryptography.hazmat.backends import default_backend
 
@@ -57,9 +62,11 @@ import pkg.portable as portable
 import pkg.misc as misc
 import pkg.nrlock
 import pkg.search_errors as se
+import pkg.search_storage as ss
 import pkg.query_parser as qp
 import pkg.server.catalog as old_catalog
 import pkg.server.query_parser as sqp
+import pkg.server.refcount as refcount
 import pkg.server.transaction as trans
 import pkg.pkgsubprocess as subprocess
 import pkg.version
@@ -83,6 +90,19 @@ REPO_FIX_ITEM = 0
 REPO_FIX_FAILED = 1
 
 VERIFY_DEPENDENCY = "dependency"
+
+# The number of packages whose manifests may be read ahead of the reporting
+# of their errors while files are being verified in parallel.
+_VERIFY_WINDOW = 64
+
+# The number of files whose results are kept while a repository is verified,
+# so that the files shared by packages read close together, such as the
+# versions of a package, are only verified once.
+_VERIFY_PAYLOADS = 16384
+
+# The approximate amount of memory, in bytes, that the results of searches may
+# be cached in.
+SEARCH_CACHE_MAX_SIZE = 32 * 1024 * 1024
 verify_default_checks = frozenset([
       VERIFY_DEPENDENCY,
 ])
@@ -377,6 +397,173 @@ class RepositorySigNoTrustAnchorDirError(RepositoryError):
                 return _("Unable to find trust anchor directory {0}").format(
                     self.data)
 
+# The name of the file in a repository store's catalog directory that records
+# when the catalog parts were last saved, while the changes made since have
+# only been saved to the catalog's update logs.
+_CATALOG_JOURNAL = "catalog.journal"
+
+class _CatalogCommit(object):
+        """A request to add a package to, or replace a package in, the catalog
+        of a repository store, waiting to be committed with any others made
+        at the same time."""
+
+        def __init__(self, pfmri, replace=False):
+                self.pfmri = pfmri
+                self.replace = replace
+                # Whether the request has been committed or has failed.
+                self.done = False
+                # The exception raised while committing the request, if any.
+                self.exc_info = None
+                # The time the change was made to the catalog.
+                self.op_time = None
+
+        def reraise(self):
+                """Raise the exception raised while committing the request, if
+                any."""
+
+                if self.exc_info:
+                        raise self.exc_info[0], self.exc_info[1], \
+                            self.exc_info[2]
+
+
+class _CompressPool(object):
+        """The pool of threads that the transactions of a repository compress
+        payloads with, shared by all of them.  The threads are only started
+        when first needed, and are stopped by stop()."""
+
+        def __init__(self, jobs):
+                self.__jobs = jobs
+                self.__lock = threading.Lock()
+                self.__pool = None
+
+        def get(self):
+                """Returns the pool of threads, or None if payloads are
+                compressed as they're read."""
+
+                with self.__lock:
+                        if self.__jobs <= 1:
+                                return None
+                        if not self.__pool:
+                                self.__pool = ThreadPool(self.__jobs)
+                        return self.__pool
+
+        def stop(self):
+                """Waits for the threads to finish compressing the payloads
+                they were given, and stops them.  Later callers of get() are
+                given a new pool."""
+
+                with self.__lock:
+                        pool = self.__pool
+                        self.__pool = None
+                if pool:
+                        pool.close()
+                        pool.join()
+
+        def __set_jobs(self, value):
+                # The threads are sized when they're started, so any that
+                # were started for the previous number are stopped.
+                self.stop()
+                with self.__lock:
+                        self.__jobs = value
+
+        jobs = property(lambda self: self.__jobs, __set_jobs,
+            doc="The number of payloads compressed at once.")
+
+
+class _SearchCache(object):
+        """A cache of the results of searches, keyed by publisher and query,
+        and bounded by the approximate amount of memory the results take.  The
+        least recently used results are discarded first, and all of the
+        results for a publisher are discarded when its search generation
+        changes."""
+
+        # The memory, in bytes, assumed to be taken by each result in addition
+        # to its strings; most of it is taken by the result's PkgFmri.
+        RESULT_OVERHEAD = 1024
+
+        def __init__(self, max_size):
+                self.__entries = collections.OrderedDict()
+                self.__generations = {}
+                self.__lock = threading.Lock()
+                self.__max_size = max_size
+                self.hits = 0
+                self.misses = 0
+                self.size = 0
+
+        def __len__(self):
+                return len(self.__entries)
+
+        def __discard(self, pub):
+                """Discard the results for the given publisher; the caller
+                must hold the lock."""
+
+                for key in [k for k in self.__entries if k[0] == pub]:
+                        self.size -= self.__entries.pop(key)[1]
+
+        def get(self, pub, query, generation):
+                """Returns an iterator over the cached results of the given
+                query for the given publisher, or None if they aren't cached.
+                'generation' is the current search generation of the
+                publisher."""
+
+                with self.__lock:
+                        if self.__generations.get(pub) != generation:
+                                self.__discard(pub)
+                                self.__generations[pub] = generation
+
+                        key = (pub, query)
+                        entry = self.__entries.pop(key, None)
+                        if entry is None:
+                                self.misses += 1
+                                return None
+                        self.__entries[key] = entry
+                        self.hits += 1
+                        return iter(entry[0])
+
+        def add(self, pub, query, generation, results):
+                """Returns a generator which yields the given results and,
+                once they have all been yielded, caches them.  Results which
+                would take more than an eighth of the cache aren't cached."""
+
+                limit = self.__max_size // 8
+                cached = []
+                size = 0
+                for res in results:
+                        if cached is not None:
+                                size += self.result_size(res)
+                                if size > limit:
+                                        cached = None
+                                else:
+                                        cached.append(res)
+                        yield res
+
+                if cached is None:
+                        return
+                with self.__lock:
+                        if self.__generations.get(pub) != generation:
+                                # The index was updated during the search.
+                                return
+                        key = (pub, query)
+                        old = self.__entries.pop(key, None)
+                        if old is not None:
+                                self.size -= old[1]
+                        self.__entries[key] = (cached, size)
+                        self.size += size
+                        while self.size > self.__max_size:
+                                key, old = self.__entries.popitem(last=False)
+                                self.size -= old[1]
+
+        @classmethod
+        def result_size(cls, res):
+                """Returns the approximate memory taken by a search result."""
+
+                v, return_type, vals = res
+                if return_type == qp.Query.RETURN_ACTIONS:
+                        pfmri, fv, l = vals
+                        return cls.RESULT_OVERHEAD + len(fv) + len(l)
+                return cls.RESULT_OVERHEAD
+
+
 class _RepoStore(object):
         """The _RepoStore object provides an interface for performing operations
         on a set of package data contained within a repository.  This class is
@@ -386,8 +573,14 @@ class _RepoStore(object):
         def __init__(self, allow_invalid=False, file_layout=None,
             file_root=None, log_obj=None, mirror=False, pub=None,
             read_only=False, root=None,
-            sort_file_max_size=indexer.SORT_FILE_MAX_SIZE, writable_root=None):
-                """Prepare the repository for use."""
+            sort_file_max_size=indexer.SORT_FILE_MAX_SIZE, writable_root=None,
+            compress_jobs=1, compress_level=9, index_jobs=1,
+            compress_pool=None):
+                """Prepare the repository for use.
+
+                'compress_pool' is the _CompressPool that transactions
+                compress payloads with; by default, the repository store has
+                its own."""
 
                 self.__catalog = None
                 self.__catalog_root = None
@@ -397,7 +590,9 @@ class _RepoStore(object):
                 self.__file_layout = file_layout
                 self.__file_root = None
                 self.__in_flight_trans = {}
+                self.__index_jobs = index_jobs
                 self.__read_only = read_only
+                self.__refs = None
                 self.__root = None
                 self.__sort_file_max_size = sort_file_max_size
                 self.__tmp_root = None
@@ -411,6 +606,15 @@ class _RepoStore(object):
                 self.mirror = mirror
                 self.publisher = pub
 
+                # The number of payloads transactions compress at once, the
+                # level they compress them at, and the threads they're
+                # compressed by.
+                self.compress_jobs = compress_jobs
+                self.compress_level = compress_level
+                if compress_pool is None:
+                        compress_pool = _CompressPool(compress_jobs)
+                self.compress_pool = compress_pool
+
                 # Set before root, since it's possible to have the
                 # file_root in an entirely different location.  The root
                 # will govern file_root, if a value for file_root is not
@@ -430,6 +634,20 @@ class _RepoStore(object):
                 self.__refresh_again = False
 
                 self.__lock = pkg.nrlock.NRLock()
+
+                # Catalog changes waiting to be committed, the condition used
+                # to wait for them to be, and whether a thread is committing
+                # them.
+                self.__commit_queue = []
+                self.__commit_cv = threading.Condition(threading.Lock())
+                self.__committing = False
+
+                # Whether changes to the catalog are only saved to its update
+                # logs until compact_catalog() is called, and the number of
+                # changes saved that way since its parts were last saved.
+                self.__defer_catalog = False
+                self.__catalog_pending = 0
+
                 if self.__tmp_root:
                         self.__lockfile = lockfile.LockFile(os.path.join(
                             self.__tmp_root, "lock"),
@@ -449,6 +667,9 @@ class _RepoStore(object):
 
         def __set_read_only(self, value):
                 old_ro = self.__read_only
+                if value and not old_ro:
+                        # Changes can't be saved once read-only.
+                        self.compact_catalog()
                 self.__read_only = value
                 if self.__catalog:
                         self.__catalog.read_only = value
@@ -505,6 +726,151 @@ class _RepoStore(object):
                 c.remove_package(pfmri)
                 c.add_package(pfmri, manifest=manifest)
 
+        def __commit_package(self, pfmri, replace=False):
+                """Add 'pfmri' to the catalog, or replace its entry if
+                'replace' is True, and save the catalog.
+
+                Changes requested by other threads while the catalog is being
+                saved are queued, and then committed together by one of them
+                with a single save of the catalog.  Each is applied separately,
+                so a change that fails doesn't prevent the others from being
+                committed."""
+
+                req = _CatalogCommit(pfmri, replace=replace)
+                cv = self.__commit_cv
+                with cv:
+                        self.__commit_queue.append(req)
+                        while self.__committing and not req.done:
+                                cv.wait()
+                        if not req.done:
+                                # Commit every change queued so far.
+                                batch = self.__commit_queue
+                                self.__commit_queue = []
+                                self.__committing = True
+
+                if not req.done:
+                        try:
+                                self.__commit_batch(batch)
+                        finally:
+                                with cv:
+                                        for r in batch:
+                                                r.done = True
+                                        self.__committing = False
+                                        cv.notify_all()
+                req.reraise()
+
+        def __apply_commits(self, batch):
+                """Apply the changes requested by the list of _CatalogCommit
+                objects 'batch' to the catalog in a single batch, recording the
+                exception raised for each change that fails in its request.
+                Returns the set of FMRIs changed.  Caller responsible for
+                repository locking."""
+
+                c = self.catalog
+                changed = set()
+                c.batch_mode = True
+                try:
+                        for req in batch:
+                                try:
+                                        if req.replace:
+                                                self.__replace_package(
+                                                    req.pfmri)
+                                        else:
+                                                self.__add_package(req.pfmri)
+                                except Exception:
+                                        req.exc_info = sys.exc_info()
+                                else:
+                                        req.op_time = c.last_modified
+                                        changed.add(req.pfmri)
+                finally:
+                        c.batch_mode = False
+                return changed
+
+        def __commit_batch(self, batch):
+                """Apply the changes requested by the list of _CatalogCommit
+                objects 'batch' to the catalog and save it once.  Exceptions
+                are recorded in the requests instead of being raised."""
+
+                try:
+                        self.__lock_rstore(blocking=True)
+                        try:
+                                last_saved = self.catalog.last_modified
+                                changed = self.__apply_commits(batch)
+                                if changed:
+                                        self.catalog.finalize(pfmris=changed)
+                                        self.__journal_commits(batch,
+                                            last_saved)
+                        finally:
+                                self.__unlock_rstore()
+                except:
+                        # The catalog couldn't be saved, so every change
+                        # that was applied has failed too.
+                        exc_info = sys.exc_info()
+                        for req in batch:
+                                if not req.exc_info:
+                                        req.exc_info = exc_info
+
+        def __journal_commits(self, batch, last_saved):
+                """Save the changes requested by the list of _CatalogCommit
+                objects 'batch' that were applied to the catalog, which was
+                last modified at 'last_saved' before they were.  If saving the
+                catalog is deferred, only its update logs and attributes are
+                saved, so that clients can retrieve the changes as incremental
+                updates at once, and the catalog journal records when its
+                parts were last saved; otherwise, the catalog is saved.
+                Caller responsible for repository locking."""
+
+                if not self.__defer_catalog or not last_saved:
+                        self.__save_catalog()
+                        return
+
+                if not self.__catalog_pending:
+                        # The journal must exist before the catalog
+                        # attributes no longer match its parts.
+                        try:
+                                with open(self.__catalog_journal, "wb") as f:
+                                        f.write("{0}\n".format(
+                                            catalog.datetime_to_ts(
+                                            last_saved)))
+                        except EnvironmentError:
+                                self.__save_catalog()
+                                return
+                self.catalog.save_updates()
+                self.__catalog_pending += len(
+                    [req for req in batch if not req.exc_info])
+
+        def __replay_catalog_journal(self):
+                """Bring the catalog parts up to date with the changes that were
+                only saved to the catalog's update logs, for instance because
+                the process that made them exited before compacting the
+                catalog, and then save the catalog.  Caller responsible for
+                repository locking."""
+
+                jpath = self.__catalog_journal
+                try:
+                        with open(jpath, "rb") as f:
+                                last_saved = catalog.ts_to_datetime(
+                                    f.read().strip())
+                except EnvironmentError as e:
+                        if e.errno == errno.ENOENT:
+                                return
+                        raise
+                except ValueError:
+                        # Incomplete; the process writing it must have exited
+                        # before any change was saved.
+                        last_saved = None
+
+                # If the parts were saved, but the process saving them exited
+                # before the journal could be removed, every part is listed
+                # with its signature data again.
+                stale = any(
+                    not any(k.startswith("signature-") for k in mdata)
+                    for mdata in self.catalog.parts.itervalues()
+                )
+                if last_saved and stale:
+                        self.catalog.replay_updates(last_saved)
+                self.__save_catalog()
+
         def __check_search(self):
                 if not self.index_root:
                         return
@@ -512,7 +878,8 @@ class _RepoStore(object):
                 ind = indexer.Indexer(self.index_root,
                     self._get_manifest, self.manifest,
                     log=self.__index_log,
-                    sort_file_max_size=self.__sort_file_max_size)
+                    sort_file_max_size=self.__sort_file_max_size,
+                    jobs=self.__index_jobs)
                 cie = False
                 try:
                         cie = ind.check_index_existence()
@@ -564,6 +931,125 @@ class _RepoStore(object):
                         raise
                 return m
 
+        @staticmethod
+        def __get_refs(m):
+                """Given a Manifest, return a set containing all of the hashes
+                of the files it references, as stored in the repository."""
+
+                hashes = set()
+                for a in m.gen_actions():
+                        if not a.has_payload:
+                                # Nothing to archive.
+                                continue
+
+                        # Action payload.
+                        hattr, hval, hfunc = \
+                            digest.get_least_preferred_hash(a)
+                        hashes.add(hval)
+
+                        # Signature actions have additional payloads.
+                        if a.name == "signature":
+                                for c in a.get_chain_certs(
+                                    least_preferred=True):
+                                        hashes.add(c)
+                return hashes
+
+        def __gen_manifest_refs(self, progtrack):
+                """Generate tuples of the form (key, hashes) for each manifest
+                in the repository store, where 'key' names the manifest and
+                'hashes' is the set of files it references, for use with the
+                reference count index."""
+
+                if not os.path.exists(self.manifest_root):
+                        return
+
+                slist = os.listdir(self.manifest_root)
+                total = sum(
+                    len(os.listdir(os.path.join(self.manifest_root, s)))
+                    for s in slist
+                )
+
+                progtrack.job_start(progtrack.JOB_REPO_ANALYZE_REPO,
+                    goal=total)
+                for name in slist:
+                        pdir = os.path.join(self.manifest_root, name)
+                        for ver in os.listdir(pdir):
+                                progtrack.job_add_progress(
+                                    progtrack.JOB_REPO_ANALYZE_REPO)
+                                try:
+                                        pfmri = self.__fmri_from_path(pdir,
+                                            ver)
+                                except Exception:
+                                        # Assume error is result of unexpected
+                                        # file in directory; just skip it and
+                                        # drive on.
+                                        continue
+                                yield pfmri.get_dir_path(), \
+                                    self.__get_refs(self._get_manifest(pfmri))
+                progtrack.job_done(progtrack.JOB_REPO_ANALYZE_REPO)
+
+        def __rebuild_refs(self, progtrack):
+                """Private version; caller responsible for repository
+                locking."""
+
+                self.__refs.rebuild(self.__gen_manifest_refs(progtrack))
+
+        def __update_rebuilt_refs(self, func, skipped, *args, **kwargs):
+                """Update the reference count index after the catalog has been
+                rebuilt using 'func', a method of the index, and the given
+                arguments.  If any manifests had to be 'skipped', the index is
+                discarded instead since the files they reference weren't
+                counted."""
+
+                refs = self.__refs
+                try:
+                        if not refs.valid() and func != refs.rebuild:
+                                return
+                        func(*args, **kwargs)
+                        if skipped:
+                                refs.destroy()
+                except EnvironmentError as e:
+                        # The index isn't needed for anything the rebuild is
+                        # for, and will be rebuilt when needed.
+                        self.__log(_("Unable to update the reference count "
+                            "index: {0}").format(e))
+
+        def _replace_manifest(self, pfmri, src_mpath):
+                """Move the manifest at 'src_mpath' into place as the manifest
+                for 'pfmri', updating the reference count index.  This function
+                should be private; but is protected instead due to its usage by
+                transactions."""
+
+                dest_mpath = self.manifest(pfmri)
+                key = pfmri.get_dir_path()
+
+                self.__lock_rstore(blocking=True)
+                try:
+                        refs = self.__refs
+                        if not refs.valid():
+                                # There's nothing to keep up to date.
+                                misc.makedirs(os.path.dirname(dest_mpath))
+                                portable.rename(src_mpath, dest_mpath)
+                                return
+
+                        m = pkg.manifest.Manifest(pfmri)
+                        m.set_content(pathname=src_mpath)
+                        add = [(key, self.__get_refs(m))]
+                        remove = []
+                        if os.path.exists(dest_mpath):
+                                # The package is being replaced.
+                                remove.append((key,
+                                    self.__get_refs(self._get_manifest(pfmri))))
+
+                        # The index is marked as dirty until it has been
+                        # updated to match the new manifest.
+                        with refs.changing():
+                                misc.makedirs(os.path.dirname(dest_mpath))
+                                portable.rename(src_mpath, dest_mpath)
+                                refs.update(add=add, remove=remove)
+                finally:
+                        self.__unlock_rstore()
+
         def __index_log(self, msg):
                 return self.__log(msg, "INDEX")
 
@@ -618,7 +1104,8 @@ class _RepoStore(object):
                                 ind = indexer.Indexer(self.index_root,
                                     self._get_manifest, self.manifest,
                                     log=self.__index_log,
-                                    sort_file_max_size=self.__sort_file_max_size)
+                                    sort_file_max_size=self.__sort_file_max_size,
+                                    jobs=self.__index_jobs)
                                 ind.lock(blocking=False)
                         except se.IndexLockedException:
                                 index_locked = True
@@ -720,7 +1207,8 @@ class _RepoStore(object):
                     self._get_manifest,
                     self.manifest,
                     log=self.__index_log,
-                    sort_file_max_size=self.__sort_file_max_size)
+                    sort_file_max_size=self.__sort_file_max_size,
+                    jobs=self.__index_jobs)
 
                 # To prevent issues with NFS consumers, attempt to lock the
                 # index first, but don't hold the lock as holding a lock while
@@ -775,6 +1263,7 @@ class _RepoStore(object):
                         self.catalog.log_updates = incremental
 
                         def add_package(f):
+                                key = f.get_dir_path()
                                 m = self._get_manifest(f, sig=True)
                                 if "pkg.fmri" in m:
                                         f = fmri.PkgFmri(m["pkg.fmri"])
@@ -782,36 +1271,66 @@ class _RepoStore(object):
                                         f.publisher = default_pub
                                 self.__add_package(f, manifest=m)
                                 self.__log(str(f))
+                                return key, self.__get_refs(m)
 
-                        # XXX eschew os.walk in favor of another os.listdir
-                        # here?
-                        for pkgpath in os.walk(self.manifest_root):
-                                if pkgpath[0] == self.manifest_root:
-                                        continue
+                        # Packages with corrupt manifests aren't added to the
+                        # catalog, so the files they reference can't be
+                        # counted.
+                        skipped = []
 
-                                for fname in os.listdir(pkgpath[0]):
-                                        try:
-                                                f = self.__fmri_from_path(
+                        def try_add_package(pkgpath, fname):
+                                try:
+                                        f = self.__fmri_from_path(pkgpath,
+                                            fname)
+                                        return add_package(f)
+                                except (apx.InvalidPackageErrors,
+                                    actions.ActionError,
+                                    fmri.FmriError,
+                                    pkg.version.VersionError) as e:
+                                        # Don't add packages with corrupt
+                                        # manifests to the catalog.
+                                        name = os.path.join(pkgpath, fname)
+                                        skipped.append(name)
+                                        self.__log(_("Skipping {name}; invalid "
+                                            "manifest: {error}").format(
+                                            name=name, error=e))
+                                except apx.DuplicateCatalogEntry as e:
+                                        # Raise dups if not in incremental
+                                        # mode.
+                                        if not incremental:
+                                                raise
+
+                        def gen_refs():
+                                """Add every package in the repository to the
+                                catalog, yielding the tuples needed to update
+                                the reference count index for each package
+                                added."""
+
+                                # XXX eschew os.walk in favor of another
+                                # os.listdir here?
+                                for pkgpath in os.walk(self.manifest_root):
+                                        if pkgpath[0] == self.manifest_root:
+                                                continue
+
+                                        for fname in os.listdir(pkgpath[0]):
+                                                entry = try_add_package(
                                                     pkgpath[0], fname)
-                                                add_package(f)
-                                        except (apx.InvalidPackageErrors,
-                                            actions.ActionError,
-                                            fmri.FmriError,
-                                            pkg.version.VersionError) as e:
-                                                # Don't add packages with
-                                                # corrupt manifests to the
-                                                # catalog.
-                                                name = os.path.join(pkgpath[0],
-                                                    fname)
-                                                self.__log(_("Skipping "
-                                                    "{name}; invalid "
-                                                    "manifest: {error}").format(
-                                                    name=name, error=e))
-                                        except apx.DuplicateCatalogEntry as e:
-                                                # Raise dups if not in
-                                                # incremental mode.
-                                                if not incremental:
-                                                        raise
+                                                if entry:
+                                                        yield entry
+
+                        refs = self.__refs
+                        if not refs or self.read_only:
+                                for entry in gen_refs():
+                                        pass
+                        elif incremental:
+                                # Only the packages which weren't in the
+                                # catalog before are yielded.
+                                added = list(gen_refs())
+                                self.__update_rebuilt_refs(refs.update,
+                                    skipped, add=added)
+                        else:
+                                self.__update_rebuilt_refs(refs.rebuild,
+                                    skipped, gen_refs())
 
                         # Private add_package doesn't automatically save catalog
                         # so that operations can be batched (there is
@@ -856,7 +1375,8 @@ class _RepoStore(object):
                     self._get_manifest,
                     self.manifest,
                     log=self.__index_log,
-                    sort_file_max_size=self.__sort_file_max_size)
+                    sort_file_max_size=self.__sort_file_max_size,
+                    jobs=self.__index_jobs)
                 ind.setup()
                 if not self.__search_available:
                         self.__index_log("Search Available")
@@ -889,6 +1409,12 @@ class _RepoStore(object):
                     not self.catalog.exists:
                         self.__save_catalog()
 
+                # Save the changes only saved to the catalog's update logs to
+                # its parts.
+                if not self.read_only and self.catalog_root and \
+                    self.catalog_version >= 1:
+                        self.__replay_catalog_journal()
+
                 self.__check_search()
 
         def __init_catalog(self, allow_invalid=False):
@@ -1048,26 +1574,30 @@ class _RepoStore(object):
 
                 # Ensure new catalog is created in a temporary location so that
                 # it can be renamed into place *after* creation to prevent
-                # unexpected failure causing future updates to fail.
+                # unexpected failure causing future updates to fail, and so
+                # that readers never see some of the new parts along with the
+                # old catalog attributes.
                 old_cat_root = self.catalog_root
                 tmp_cat_root = self.__mkdtemp()
 
                 try:
                         if os.path.exists(old_cat_root):
-                                # Now remove the temporary directory and then
-                                # copy the contents of the existing catalog
-                                # directory to the new, temporary name.  This
-                                # is necessary since the catalog only saves the
+                                # Link the contents of the existing catalog
+                                # directory into the temporary one.  This is
+                                # necessary since the catalog only saves the
                                 # data that has been loaded or changed, so new
                                 # parts will get written out, but old ones could
-                                # be lost.
-                                shutil.rmtree(tmp_cat_root)
-                                misc.copytree(old_cat_root, tmp_cat_root)
+                                # be lost.  Linking is safe as every catalog
+                                # file is saved by renaming a new file over
+                                # the old one, and its cost doesn't grow with
+                                # the size of the parts.
+                                self.__link_catalog(old_cat_root, tmp_cat_root)
 
                         # Ensure the permissions on the new temporary catalog
                         # directory are correct.
                         os.chmod(tmp_cat_root, misc.PKG_DIR_MODE)
                 except EnvironmentError as e:
+                        shutil.rmtree(tmp_cat_root, True)
                         # shutil.Error can contains a tuple of lists of errors.
                         # Some of the error entries may be a tuple others will
                         # be a string due to poor error handling in shutil.
@@ -1093,9 +1623,14 @@ class _RepoStore(object):
 
                 # Save the new catalog data in the temporary location.
                 self.__set_catalog_root(tmp_cat_root)
-                if lm:
-                        self.catalog.last_modified = lm
-                self.catalog.save()
+                try:
+                        if lm:
+                                self.catalog.last_modified = lm
+                        self.catalog.save()
+                except:
+                        self.__set_catalog_root(old_cat_root)
+                        shutil.rmtree(tmp_cat_root, True)
+                        raise
 
                 orig_cat_root = None
                 if os.path.exists(old_cat_root):
@@ -1115,6 +1650,35 @@ class _RepoStore(object):
                 # Set catalog version.
                 self.catalog_version = self.catalog.version
 
+                # The catalog parts are now up to date, so the catalog
+                # journal can be removed.
+                self.__catalog_pending = 0
+                try:
+                        portable.remove(self.__catalog_journal)
+                except EnvironmentError as e:
+                        if e.errno != errno.ENOENT:
+                                raise
+
+        @staticmethod
+        def __link_catalog(src, dst):
+                """Populate the catalog directory 'dst' with hard links to the
+                files in the catalog directory 'src', copying them instead if
+                they can't be linked."""
+
+                for name in os.listdir(src):
+                        s_path = os.path.join(src, name)
+                        d_path = os.path.join(dst, name)
+                        if os.path.isdir(s_path):
+                                misc.copytree(s_path, d_path)
+                                continue
+                        try:
+                                portable.link(s_path, d_path)
+                        except EnvironmentError as e:
+                                if e.errno not in (errno.EXDEV, errno.EPERM,
+                                    errno.EMLINK, errno.ENOTSUP):
+                                        raise
+                                misc.copyfile(s_path, d_path)
+
         def __set_catalog_root(self, root):
                 self.__catalog_root = root
                 if self.__catalog:
@@ -1131,6 +1695,8 @@ class _RepoStore(object):
                         self.index_root = os.path.join(root, "index")
                         self.manifest_root = os.path.join(root, "pkg")
                         self.trans_root = os.path.join(root, "trans")
+                        self.__refs = refcount.RefCountIndex(os.path.join(root,
+                            "refcount"))
                         if not self.file_root:
                                 self.__set_file_root(os.path.join(root, "file"))
                 else:
@@ -1139,6 +1705,7 @@ class _RepoStore(object):
                         self.index_root = None
                         self.manifest_root = None
                         self.trans_root = None
+                        self.__refs = None
 
         def __set_file_root(self, root):
                 self.__file_root = root
@@ -1182,7 +1749,8 @@ class _RepoStore(object):
                         index_inst = indexer.Indexer(self.index_root,
                             self._get_manifest, self.manifest,
                             log=self.__index_log,
-                            sort_file_max_size=self.__sort_file_max_size)
+                            sort_file_max_size=self.__sort_file_max_size,
+                            jobs=self.__index_jobs)
                         index_inst.server_update_index(fmris)
                         if not self.__search_available:
                                 self.__index_log("Search Available")
@@ -1207,9 +1775,29 @@ class _RepoStore(object):
                 except trans.TransactionError as e:
                         raise RepositoryError(e)
 
-        def add(self, trans_id, action):
+        def add(self, trans_id, action, flush=True):
                 """Adds an action and its content to a transaction with the
-                specified Transaction ID."""
+                specified Transaction ID.  If 'flush' is False, the action may
+                only be added to the transaction's manifest by a later call to
+                add() or flush_transaction(), which the caller must make before
+                considering it added."""
+
+                if self.mirror:
+                        raise RepositoryMirrorError()
+                if self.read_only:
+                        raise RepositoryReadOnlyError()
+                if not self.trans_root:
+                        raise RepositoryUnsupportedOperationError()
+
+                t = self.__get_transaction(trans_id)
+                try:
+                        t.add_content(action, flush=flush)
+                except trans.TransactionError as e:
+                        raise RepositoryError(e)
+
+        def flush_transaction(self, trans_id):
+                """Adds the actions left pending by add() to the manifest of
+                the transaction with the specified Transaction ID."""
 
                 if self.mirror:
                         raise RepositoryMirrorError()
@@ -1220,7 +1808,7 @@ class _RepoStore(object):
 
                 t = self.__get_transaction(trans_id)
                 try:
-                        t.add_content(action)
+                        t.flush()
                 except trans.TransactionError as e:
                         raise RepositoryError(e)
 
@@ -1243,7 +1831,7 @@ class _RepoStore(object):
                 finally:
                         self.__unlock_rstore()
 
-        def add_file(self, trans_id, data, size=None):
+        def add_file(self, trans_id, data, size=None, fhash=None):
                 """Adds a file to an in-flight transaction.
 
                 'trans_id' is the identifier of a transaction that
@@ -1254,6 +1842,9 @@ class _RepoStore(object):
 
                 'size' is an optional integer value indicating the size of
                 the provided payload.
+
+                'fhash' is an optional string naming the hash the payload is
+                expected to have.
                 """
 
                 if self.mirror:
@@ -1265,13 +1856,15 @@ class _RepoStore(object):
 
                 t = self.__get_transaction(trans_id)
                 try:
-                        t.add_file(data, size)
+                        t.add_file(data, size, fhash=fhash)
                 except trans.TransactionError as e:
                         raise RepositoryError(e)
                 return
 
         def add_package(self, pfmri):
-                """Adds the specified FMRI to the repository's catalog."""
+                """Adds the specified FMRI to the repository's catalog.  If
+                saving the catalog is deferred (see defer_catalog), the change
+                is only saved to the catalog's update logs."""
 
                 if self.mirror:
                         raise RepositoryMirrorError()
@@ -1280,12 +1873,7 @@ class _RepoStore(object):
                 if not self.catalog_root or self.catalog_version < 1:
                         raise RepositoryUnsupportedOperationError()
 
-                self.__lock_rstore(blocking=True)
-                try:
-                        self.__add_package(pfmri)
-                        self.__save_catalog()
-                finally:
-                        self.__unlock_rstore()
+                self.__commit_package(pfmri)
 
         def replace_package(self, pfmri):
                 """Replaces the information for the specified FMRI in the
@@ -1298,12 +1886,7 @@ class _RepoStore(object):
                 if not self.catalog_root or self.catalog_version < 1:
                         raise RepositoryUnsupportedOperationError()
 
-                self.__lock_rstore(blocking=True)
-                try:
-                        self.__replace_package(pfmri)
-                        self.__save_catalog()
-                finally:
-                        self.__unlock_rstore()
+                self.__commit_package(pfmri, replace=True)
 
         @property
         def catalog(self):
@@ -1326,6 +1909,21 @@ class _RepoStore(object):
                     log_updates=True, read_only=self.read_only)
                 return self.__catalog
 
+        def compact_catalog(self):
+                """Save the changes to the catalog that have only been saved to
+                its update logs, if any, to its parts, and remove the catalog
+                journal."""
+
+                if not self.__catalog_pending:
+                        return
+
+                self.__lock_rstore(blocking=True)
+                try:
+                        if self.__catalog_pending:
+                                self.__save_catalog()
+                finally:
+                        self.__unlock_rstore()
+
         def catalog_0(self):
                 """Returns a generator object for the full version of
                 the catalog contents.  Incremental updates are not provided
@@ -1376,7 +1974,25 @@ class _RepoStore(object):
                         raise RepositoryUnsupportedOperationError()
 
                 assert name
-                return os.path.normpath(os.path.join(self.catalog_root, name))
+                # Only the files that make up the catalog are offered; the
+                # catalog journal, for instance, is private to the
+                # repository.
+                attrs = catalog.CatalogAttrs(meta_root=self.catalog_root)
+                if name != attrs.name and name not in attrs.parts and \
+                    name not in attrs.updates:
+                        raise RepositoryNoSuchFileError(name)
+
+                if name in attrs.parts and \
+                    os.path.exists(self.__catalog_journal):
+                        # The part has to be brought up to date with the
+                        # changes clients have been told about before it can
+                        # be retrieved in full.
+                        if not self.__catalog_pending:
+                                raise RepositoryError(_("The catalog part "
+                                    "'{0}' is being updated by another "
+                                    "process.").format(name))
+                        self.compact_catalog()
+                return os.path.join(self.catalog_root, name)
 
         def reset_search(self):
                 """Discards currenty loaded search data so that it will be
@@ -1430,6 +2046,17 @@ class _RepoStore(object):
                         return fp
                 raise RepositoryFileNotFoundError(fhash)
 
+        def has_file(self, fhash):
+                """Returns a boolean value indicating whether the file specified
+                by the provided hash name is stored in a form that a
+                transaction can reference without its content being sent
+                again."""
+
+                try:
+                        return PkgGzipFile.test_is_pkggzipfile(self.file(fhash))
+                except RepositoryFileNotFoundError:
+                        return False
+
         def get_publisher(self):
                 """Return the Publisher object for this storage object or None
                 if not available.
@@ -1590,30 +2217,6 @@ class _RepoStore(object):
                 if not progtrack:
                         progtrack = progress.NullProgressTracker()
 
-                def get_hashes(pfmri):
-                        """Given an FMRI, return a set of tuples containing all
-                        of the hashes of the files its manifest references.
-                        Each tuple is of the form (hash value, hash function)"""
-
-                        m = self._get_manifest(pfmri)
-                        hashes = set()
-                        for a in m.gen_actions():
-                                if not a.has_payload:
-                                        # Nothing to archive.
-                                        continue
-
-                                # Action payload.
-                                hattr, hval, hfunc = \
-                                    digest.get_least_preferred_hash(a)
-                                hashes.add(hval)
-
-                                # Signature actions have additional payloads.
-                                if a.name == "signature":
-                                        for c in a.get_chain_certs(
-                                            least_preferred=True):
-                                                hashes.add(c)
-                        return hashes
-
                 self.__lock_rstore()
                 c = self.catalog
                 try:
@@ -1659,84 +2262,28 @@ class _RepoStore(object):
                         # This will also indirectly abort the operation should
                         # any of the packages not actually have a manifest in
                         # the repository.
-                        pfiles = set()
+                        prefs = []
                         progtrack.job_start(progtrack.JOB_REPO_ANALYZE_RM,
 			    goal=len(packages))
                         for pfmri in packages:
-                                pfiles.update(get_hashes(pfmri))
+                                prefs.append((pfmri.get_dir_path(),
+                                    self.__get_refs(self._get_manifest(pfmri))))
                                 progtrack.job_add_progress(
 				    progtrack.JOB_REPO_ANALYZE_RM)
                         progtrack.job_done(progtrack.JOB_REPO_ANALYZE_RM)
 
-                        # Now for the slow part; iterate over every manifest in
-                        # the repository (excluding the ones being removed) and
-                        # remove any hashes in use from the list to be removed.
-                        # However, if the package being removed doesn't have any
-                        # payloads, then we can skip checking all of the
-                        # packages in the repository for files in use.
-                        if pfiles:
-                                # Number of packages to check is total found in
-                                # repo minus number to be removed.
-                                slist = os.listdir(self.manifest_root)
-                                remaining = sum(
-                                    1
-                                    for s in slist
-                                    for v in os.listdir(os.path.join(
-                                        self.manifest_root, s))
-                                )
-
-                                progtrack.job_start(
-				    progtrack.JOB_REPO_ANALYZE_REPO,
-				    goal=remaining)
-                                for name in slist:
-                                        # Stem must be decoded before use.
-                                        try:
-                                                pname = urllib.unquote(name)
-                                        except Exception:
-                                                # Assume error is result of
-                                                # unexpected file in directory;
-                                                # just skip it and drive on.
-                                                continue
-
-                                        pdir = os.path.join(self.manifest_root,
-                                            name)
-                                        for ver in os.listdir(pdir):
-                                                if not pfiles:
-                                                        # Skip remaining entries
-                                                        # since no files are
-                                                        # safe to remove, but
-                                                        # update progress.
-                                                        progtrack.job_add_progress(progtrack.JOB_REPO_ANALYZE_REPO)
-                                                        continue
-
-                                                # Version must be decoded before
-                                                # use.
-                                                pver = urllib.unquote(ver)
-                                                try:
-                                                        pfmri = fmri.PkgFmri(
-                                                            "@".join((pname,
-                                                            pver)), publisher=self.publisher)
-                                                except Exception:
-                                                        # Assume error is result
-                                                        # of unexpected file in
-                                                        # directory; just skip
-                                                        # it and drive on.
-                                                        progtrack.job_add_progress(progtrack.JOB_REPO_ANALYZE_REPO)
-                                                        continue
-
-                                                if pfmri in packages:
-                                                        # Package is one of
-                                                        # those queued for
-                                                        # removal.
-                                                        progtrack.job_add_progress(progtrack.JOB_REPO_ANALYZE_REPO)
-                                                        continue
-
-                                                # Any files in use by another
-                                                # package can't be removed.
-                                                pfiles -= get_hashes(pfmri)
-						progtrack.job_add_progress(progtrack.JOB_REPO_ANALYZE_REPO)
-                                progtrack.job_done(
-				    progtrack.JOB_REPO_ANALYZE_REPO)
+                        # Files can only be removed once no other package
+                        # references them, which is tracked by the reference
+                        # count index.  If it hasn't been built yet or can't
+                        # be trusted, then, for the slow part, every manifest
+                        # in the repository (including the ones being removed)
+                        # must be read to build it.  However, if the packages
+                        # being removed don't have any payloads, then there
+                        # are no files to remove, so that can be skipped.
+                        refs = self.__refs
+                        if any(hashes for key, hashes in prefs) and \
+                            not refs.valid():
+                                self.__rebuild_refs(progtrack)
 
                         # Next, remove the manifests of the packages to be
                         # removed.  (This is done before removing the files
@@ -1753,6 +2300,10 @@ class _RepoStore(object):
 
                         # Next, remove any package files that are not
                         # referenced by other packages.
+                        if refs.valid():
+                                pfiles = refs.update(remove=prefs)
+                        else:
+                                pfiles = set()
                         progtrack.job_start(progtrack.JOB_REPO_RM_FILES,
                             goal=len(pfiles))
                         for h in pfiles:
@@ -1825,6 +2376,65 @@ class _RepoStore(object):
                 finally:
                         self.__unlock_rstore()
 
+        def check_refs(self, progtrack=None):
+                """Compares the reference count index with the manifests in the
+                repository.  Returns None if the index doesn't exist or can't be
+                trusted; otherwise, returns a tuple of the form (bad_hashes,
+                bad_manifests) as described by RefCountIndex.check()."""
+
+                if not self.manifest_root:
+                        raise RepositoryUnsupportedOperationError()
+                if not progtrack:
+                        progtrack = progress.NullProgressTracker()
+
+                self.__lock_rstore()
+                try:
+                        if not self.__refs.valid():
+                                return None
+                        return self.__refs.check(
+                            self.__gen_manifest_refs(progtrack))
+                finally:
+                        self.__unlock_rstore()
+
+        def discard_refs(self):
+                """Discards the reference count index.  This must be done
+                before adding, replacing, or removing manifests in the
+                repository by any means other than the methods provided by
+                this class; the index will be rebuilt when next needed."""
+
+                if not self.__refs:
+                        return
+
+                self.__lock_rstore(blocking=True)
+                try:
+                        self.__refs.destroy()
+                except EnvironmentError as e:
+                        raise apx._convert_error(e)
+                finally:
+                        self.__unlock_rstore()
+
+        def rebuild_refs(self, progtrack=None):
+                """Rebuilds the index of the number of packages that reference
+                each file in the repository, which is used to determine which
+                files can be removed along with packages."""
+
+                if self.mirror:
+                        raise RepositoryMirrorError()
+                if self.read_only:
+                        raise RepositoryReadOnlyError()
+                if not self.manifest_root:
+                        raise RepositoryUnsupportedOperationError()
+                if not progtrack:
+                        progtrack = progress.NullProgressTracker()
+
+                self.__lock_rstore()
+                try:
+                        self.__rebuild_refs(progtrack)
+                except EnvironmentError as e:
+                        raise apx._convert_error(e)
+                finally:
+                        self.__unlock_rstore()
+
         def __run_update_index(self):
                 """ Determines which fmris need to be indexed and passes them
                 to the indexer.
@@ -1850,7 +2460,8 @@ class _RepoStore(object):
                         ind = indexer.Indexer(self.index_root,
                             self._get_manifest, self.manifest,
                             log=self.__index_log,
-                            sort_file_max_size=self.__sort_file_max_size)
+                            sort_file_max_size=self.__sort_file_max_size,
+                            jobs=self.__index_jobs)
                         ind.setup()
                         if not self.__search_available:
                                 self.__index_log("Search Available")
@@ -1902,6 +2513,31 @@ class _RepoStore(object):
                 return (self.__search_available and self.index_root and
                     os.path.exists(self.index_root)) or self.__check_search()
 
+        def get_search_generation(self):
+                """Returns a value which changes whenever the search index or
+                the catalog of the repository storage object is updated, or
+                None if there's no search index."""
+
+                if not self.index_root or self.catalog_version == 0:
+                        return None
+
+                # A full update of the index replaces the token offsets file,
+                # but a fast update only replaces the update logs and the list
+                # of indexed packages, so all of them are part of the
+                # generation.
+                gen = []
+                for fname in (ss.BYTE_OFFSET_FILE, ss.FAST_ADD,
+                    ss.FAST_REMOVE, ss.FULL_FMRI_FILE):
+                        try:
+                                st = os.stat(os.path.join(self.index_root,
+                                    fname))
+                        except EnvironmentError:
+                                return None
+                        gen.append((st.st_dev, st.st_ino, st.st_mtime,
+                            st.st_size))
+                gen.append(self.catalog.last_modified)
+                return tuple(gen)
+
         def update_publisher(self, pub):
                 """Updates the configuration information for the publisher
                 defined by the provided Publisher object.
@@ -2101,7 +2737,11 @@ class _RepoStore(object):
                 try:
                         gzf = PkgGzipFile(fileobj=open(path, "rb"))
                         fhash = alg()
-                        fhash.update(gzf.read())
+                        while True:
+                                data = gzf.read(misc.PKG_FILE_BUFSIZ)
+                                if not data:
+                                        break
+                                fhash.update(data)
                         actual = fhash.hexdigest()
                         if actual != h:
                                 return (REPO_VERIFY_BADHASH, path,
@@ -2122,6 +2762,14 @@ class _RepoStore(object):
                         if gzf:
                                 gzf.close()
 
+        def __verify_payload(self, path, pfmri, h, alg):
+                """Check that the file at 'path' can be accessed, then perform
+                hash verification on it.  This is called by the worker threads
+                used by __gen_verify()."""
+
+                return self.__verify_perm(path, pfmri, h) or \
+                    self.__verify_hash(path, pfmri, h, alg=alg)
+
         def __verify_perm(self, path, pfmri, h):
                 """Check that we don't get any permissions errors when
                 trying to stat the given path."""
@@ -2249,9 +2897,15 @@ class _RepoStore(object):
                 return True, None
 
         def __gen_verify(self, progtrack, pub, trust_anchors,
-            sig_required_names, use_crls):
+            sig_required_names, use_crls, pool=None):
                 """A generator that produces verify errors, each a tuple
-                of the form (error_code, path, message, details)"""
+                of the form (error_code, path, message, details)
+
+                Each file in the repository is verified only once, however
+                many packages reference it.  If 'pool' is provided, files are
+                verified by its threads while the manifests of the packages
+                that follow are read; the errors produced are the same, and in
+                the same order, either way."""
                 # We may not have a manifest_root directory if no
                 # packages have ever been published for this publisher.
                 if not os.path.exists(self.manifest_root):
@@ -2298,10 +2952,61 @@ class _RepoStore(object):
                             {"permissionspath": path, "pub": pub.prefix})
                 progtrack.repo_verify_end_pkg(None)
 
+                # The result of verifying each (file name, hash, hash
+                # function) referenced by the packages read most recently:
+                # None, or an error tuple naming the first package to reference
+                # it.  Only the last _VERIFY_PAYLOADS used are kept.
+                payloads = collections.OrderedDict()
+                # The AsyncResult for each file still being verified by
+                # 'pool'.
+                running = {}
+                # A tuple of the form (pfmri, errors, payload) for each
+                # package whose errors have yet to be produced, in the order
+                # their manifests were read.  'payload' is a list of tuples of
+                # the form (key, result, error) where 'key' is a key of
+                # 'payloads', or None if 'error' was found without reading the
+                # file, and 'result' is the AsyncResult for the file if it was
+                # still being verified, or None.
+                pending = collections.deque()
+
+                def add_payload(key, err):
+                        payloads[key] = err
+                        if len(payloads) > _VERIFY_PAYLOADS:
+                                payloads.popitem(last=False)
+
+                def gen_pending(limit=0):
+                        """Produce the errors for the packages in 'pending'
+                        until no more than 'limit' remain."""
+
+                        while len(pending) > limit:
+                                pfmri, errors, payload = pending.popleft()
+                                for key, result, err in payload:
+                                        if result is not None:
+                                                err = result.get()
+                                                if key in running:
+                                                        del running[key]
+                                                        add_payload(key, err)
+                                        if not err:
+                                                continue
+                                        error, path, reason = err
+                                        # The file may have been verified
+                                        # for another package.
+                                        if "pkg" in reason:
+                                                reason = dict(reason,
+                                                    pkg=pfmri)
+                                        errors.append((error, path, reason))
+
+                                progtrack.repo_verify_start_pkg(pfmri)
+                                for err in errors:
+                                        yield self.__build_verify_error(*err)
+                                progtrack.repo_verify_end_pkg(fmri)
+
                 for name in mflist:
                         pdir = os.path.join(self.manifest_root, name)
                         err = self.__verify_perm(pdir, None, None)
                         if err:
+                                for perr in gen_pending():
+                                        yield perr
                                 yield self.__build_verify_error(*err)
                                 continue
 
@@ -2312,6 +3017,8 @@ class _RepoStore(object):
                                 # Assume error is result of an
                                 # unexpected file in the directory. We
                                 # don't know the FMRI here, so use None.
+                                for perr in gen_pending():
+                                        yield perr
                                 progtrack.repo_verify_start_pkg(None)
                                 progtrack.repo_verify_add_progress(None)
                                 yield self.__build_verify_error(
@@ -2336,6 +3043,8 @@ class _RepoStore(object):
                                         # Assume the error is result of an
                                         # unexpected file in the directory. We
                                         # don't know the FMRI here, so use None.
+                                        for perr in gen_pending():
+                                                yield perr
                                         progtrack.repo_verify_start_pkg(None)
                                         progtrack.repo_verify_add_progress(None)
                                         yield self.__build_verify_error(
@@ -2344,27 +3053,26 @@ class _RepoStore(object):
                                         progtrack.repo_verify_end_pkg(None)
                                         continue
 
-                                progtrack.repo_verify_start_pkg(pfmri)
                                 err = self.__verify_manifest(path, pfmri)
                                 if err:
                                         # with a bad manifest, we can go no
                                         # further
+                                        for perr in gen_pending():
+                                                yield perr
+                                        progtrack.repo_verify_start_pkg(pfmri)
                                         yield self.__build_verify_error(*err)
                                         progtrack.repo_verify_end_pkg(None)
                                         continue
 
                                 hashes, errors = self.__get_hashes(path, pfmri)
-                                for err in errors:
-                                        yield self.__build_verify_error(*err)
 
                                 # verify manifest signatures
-                                errs = self.__verify_signature(path, pfmri, pub,
-                                    trust_anchors, sig_required_names, use_crls)
-                                for err in errs:
-                                        yield self.__build_verify_error(*err)
+                                errors.extend(self.__verify_signature(path,
+                                    pfmri, pub, trust_anchors,
+                                    sig_required_names, use_crls))
 
                                 # verify payload delivered by this pkg
-                                errors = []
+                                payload = []
                                 for fname, h, alg in hashes:
                                         try:
                                                 path = self.cache_store.lookup(
@@ -2375,34 +3083,55 @@ class _RepoStore(object):
                                                 # within the repository, then
                                                 # we'll do the best we can to
                                                 # report the problem.
-                                                errors.append((REPO_VERIFY_PERM,
+                                                payload.append((None, None,
+                                                    (REPO_VERIFY_PERM,
                                                     pfmri, {"hash": fname,
                                                     "err": _("Permission "
-                                                    "denied.", "path", h)}))
+                                                    "denied.", "path", h)})))
                                                 continue
 
-                                        err = self.__verify_perm(path, pfmri, h)
-                                        if err:
-                                                errors.append(err)
-                                                continue
-                                        err = self.__verify_hash(path, pfmri, h,
-                                            alg=alg)
-                                        if err:
-                                                errors.append(err)
-                                for err in errors:
-                                        yield self.__build_verify_error(*err)
-
-                                progtrack.repo_verify_end_pkg(fmri)
+                                        key = (fname, h, alg)
+                                        if key in running:
+                                                payload.append((key,
+                                                    running[key], None))
+                                        elif key in payloads:
+                                                # Keep it as recently used.
+                                                err = payloads.pop(key)
+                                                add_payload(key, err)
+                                                payload.append((key, None,
+                                                    err))
+                                        elif pool:
+                                                running[key] = pool.apply_async(
+                                                    self.__verify_payload,
+                                                    (path, pfmri, h, alg))
+                                                payload.append((key,
+                                                    running[key], None))
+                                        else:
+                                                err = self.__verify_payload(
+                                                    path, pfmri, h, alg)
+                                                add_payload(key, err)
+                                                payload.append((key, None,
+                                                    err))
+
+                                pending.append((pfmri, errors, payload))
+                                for err in gen_pending(_VERIFY_WINDOW):
+                                        yield err
+
+                for err in gen_pending():
+                        yield err
                 progtrack.job_done(progtrack.JOB_REPO_VERIFY_REPO)
 
         def verify(self, pub=None, progtrack=None,
-            trust_anchor_dir=None, sig_required_names=None, use_crls=False):
+            trust_anchor_dir=None, sig_required_names=None, use_crls=False,
+            jobs=1):
                 """A generator which verifies the contents of the repository
                 store, checking for several different types of errors.
                 No modifying operations may be performed until complete.
 
                 'progtrack' is an optional ProgressTracker object.
 
+                'jobs' is the number of files to verify at once.
+
                 'trust_anchor_dir' is set in the repository configuration and
                 corresponds to the image property of the same name.
 
@@ -2458,16 +3187,23 @@ class _RepoStore(object):
                         trust_anchors.setdefault(s, [])
                         trust_anchors[s].append(trusted_ca)
 
+                pool = None
                 self.__lock_rstore()
                 try:
+                        if jobs > 1:
+                                pool = ThreadPool(jobs)
                         for err in self.__gen_verify(progtrack, pub,
-                            trust_anchors, sig_required_names, use_crls):
+                            trust_anchors, sig_required_names, use_crls,
+                            pool=pool):
                                 yield err
                 except (Exception, EnvironmentError) as e:
                         import traceback
                         traceback.print_exc(e)
                         raise apx._convert_error(e)
                 finally:
+                        if pool:
+                                pool.terminate()
+                                pool.join()
                         self.__unlock_rstore()
                         shutil.rmtree(tmp_metaroot)
 
@@ -2631,7 +3367,20 @@ class _RepoStore(object):
                 entry = c.get_entry(pfmri)
                 return entry is not None
 
+        def __set_defer_catalog(self, value):
+                self.__defer_catalog = value
+                if not value:
+                        self.compact_catalog()
+
+        @property
+        def __catalog_journal(self):
+                return os.path.join(self.catalog_root, _CATALOG_JOURNAL)
+
         catalog_root = property(lambda self: self.__catalog_root)
+        defer_catalog = property(lambda self: self.__defer_catalog,
+            __set_defer_catalog, doc="Whether additions to the catalog are "
+            "only saved to its update logs until compact_catalog() is "
+            "called, instead of the catalog parts being saved after each.")
         file_layout = property(lambda self: self.__file_layout)
         file_root = property(lambda self: self.__file_root)
         read_only = property(lambda self: self.__read_only, __set_read_only)
@@ -2646,8 +3395,20 @@ class Repository(object):
         def __init__(self, allow_invalid=False, cfgpathname=None, create=False,
             file_root=None, log_obj=None, mirror=False,
             properties=misc.EmptyDict, read_only=False, root=None,
-            sort_file_max_size=indexer.SORT_FILE_MAX_SIZE, writable_root=None):
-                """Prepare the repository for use."""
+            sort_file_max_size=indexer.SORT_FILE_MAX_SIZE, writable_root=None,
+            compress_jobs=None, index_jobs=None, search_cache_size=0):
+                """Prepare the repository for use.
+
+                'compress_jobs' is the number of payloads transactions
+                compress at once; by default, it's the number of CPUs.
+
+                'index_jobs' is the number of processes that read manifests
+                when the search indexes are rebuilt; by default, it's the
+                number of CPUs.
+
+                'search_cache_size' is the approximate amount of memory, in
+                bytes, that the results of searches are cached in; by default,
+                they aren't cached."""
 
                 # This lock is used to protect the repository from multiple
                 # threads modifying it at the same time.  This must be set
@@ -2676,6 +3437,17 @@ class Repository(object):
                 # Initialize.
                 self.__cfgpathname = cfgpathname
                 self.__cfg = None
+                if compress_jobs is None:
+                        compress_jobs = multiprocessing.cpu_count()
+                self.__compress_jobs = compress_jobs
+                self.__compress_pool = _CompressPool(compress_jobs)
+                self.__defer_catalog = False
+                if index_jobs is None:
+                        index_jobs = multiprocessing.cpu_count()
+                self.__index_jobs = index_jobs
+                self.__search_cache = None
+                if search_cache_size:
+                        self.__search_cache = _SearchCache(search_cache_size)
                 self.__mirror = mirror
                 self.__read_only = read_only
                 self.__rstores = None
@@ -2843,7 +3615,10 @@ class Repository(object):
                             mirror=self.mirror,
                             read_only=self.read_only,
                             root=self.root,
-                            writable_root=self.writable_root)
+                            writable_root=self.writable_root,
+                            compress_jobs=self.__compress_jobs,
+                            compress_pool=self.__compress_pool,
+                            index_jobs=self.__index_jobs)
                         self.__rstores[rstore.publisher] = rstore
 
                 if not self.root:
@@ -2904,6 +3679,31 @@ class Repository(object):
                         self.log_obj.log(msg=msg, context=context,
                             severity=severity)
 
+        def __set_compress_jobs(self, value):
+                self.__prop_lock.acquire()
+                try:
+                        self.__compress_jobs = value
+                        self.__compress_pool.jobs = value
+                        for rstore in self.rstores:
+                                rstore.compress_jobs = value
+                finally:
+                        self.__prop_lock.release()
+
+        def __get_compress_level(self):
+                if self.version < 4:
+                        return 9
+                return self.cfg.get_property("repository",
+                    "compression-level")
+
+        def __set_defer_catalog(self, value):
+                self.__prop_lock.acquire()
+                try:
+                        self.__defer_catalog = value
+                        for rstore in self.rstores:
+                                rstore.defer_catalog = value
+                finally:
+                        self.__prop_lock.release()
+
         def __set_mirror(self, value):
                 self.__prop_lock.acquire()
                 try:
@@ -3010,7 +3810,12 @@ class Repository(object):
                     log_obj=self.log_obj, mirror=self.mirror, pub=pub,
                     read_only=self.read_only, root=root,
                     sort_file_max_size=self.__sort_file_max_size,
-                    writable_root=writ_root)
+                    writable_root=writ_root,
+                    compress_jobs=self.__compress_jobs,
+                    compress_level=self.compress_level,
+                    compress_pool=self.__compress_pool,
+                    index_jobs=self.__index_jobs)
+                rstore.defer_catalog = self.__defer_catalog
                 self.__rstores[pub] = rstore
                 return rstore
 
@@ -3022,13 +3827,16 @@ class Repository(object):
                 rstore = self.get_trans_rstore(trans_id)
                 return rstore.abandon(trans_id)
 
-        def add(self, trans_id, action):
+        def add(self, trans_id, action, flush=True):
                 """Adds an action and its content to a transaction with the
-                specified Transaction ID.
+                specified Transaction ID.  If 'flush' is False, the action may
+                only be added to the transaction's manifest by a later call to
+                add() or flush_transaction(), which the caller must make before
+                considering it added.
                 """
 
                 rstore = self.get_trans_rstore(trans_id)
-                return rstore.add(trans_id, action)
+                return rstore.add(trans_id, action, flush=flush)
 
         def add_publisher(self, pub, skip_config=False):
                 """Creates a repository storage area for the publisher defined
@@ -3047,11 +3855,16 @@ class Repository(object):
                 # Create the new repository storage area.
                 rstore = self.__new_rstore(pub.prefix)
 
-                if skip_config:
-                        return
-
-                # Update the publisher's configuration.
                 try:
+                        # Since it's empty, its reference count index can be
+                        # created now so that it's kept up to date from the
+                        # start.
+                        rstore.rebuild_refs()
+
+                        if skip_config:
+                                return
+
+                        # Update the publisher's configuration.
                         rstore.update_publisher(pub)
                 except:
                         # If the above fails, be certain to delete the new
@@ -3171,8 +3984,21 @@ class Repository(object):
                                 # publisher so treat as invalid FMRI.
                                 raise RepositoryUnqualifiedFMRIError(pfmri)
                         raise
+                # The compression level may have been changed since the
+                # repository store was created.
+                rstore.compress_level = self.compress_level
                 return rstore.append(client_release, pfmri)
 
+        def compact_catalog(self, pub=None):
+                """Save the changes to the catalog of each repository store,
+                or only that of the publisher 'pub', that have only been
+                saved to its update logs, to its parts."""
+
+                for rstore in self.rstores:
+                        if pub and rstore.publisher != pub:
+                                continue
+                        rstore.compact_catalog()
+
         def catalog_0(self, pub=None):
                 """Returns a generator object for the full version of
                 the catalog contents.  Incremental updates are not provided
@@ -3241,6 +4067,33 @@ class Repository(object):
                 # Not found in any repository store.
                 raise RepositoryFileNotFoundError(fhash)
 
+        def flush_transaction(self, trans_id):
+                """Adds the actions left pending by add() to the manifest of
+                the transaction with the specified Transaction ID.
+                """
+
+                rstore = self.get_trans_rstore(trans_id)
+                return rstore.flush_transaction(trans_id)
+
+        def has_files(self, hashes, pub=None):
+                """Returns the subset of the given list of file hash names
+                that are stored in a form that a transaction can reference
+                without their content being sent again.
+
+                'pub' is the prefix of the publisher to check the files of.
+                If not specified, every publisher's files are checked.
+                """
+
+                if pub:
+                        rstores = [self.get_pub_rstore(pub)]
+                else:
+                        rstores = self.rstores
+                return [
+                    fhash
+                    for fhash in hashes
+                    if any(rstore.has_file(fhash) for rstore in rstores)
+                ]
+
         def get_catalog(self, pub=None):
                 """Return the catalog object for the given publisher.
 
@@ -3349,6 +4202,15 @@ class Repository(object):
                     "version": 1, # Version of status structure.
                 }
 
+                cache = self.__search_cache
+                if cache is not None:
+                        rdata["repository"]["search-cache"] = {
+                            "entries": len(cache),
+                            "hits": cache.hits,
+                            "misses": cache.misses,
+                            "size": cache.size,
+                        }
+
                 for rstore in self.rstores:
                         if not rstore.publisher:
                                 continue
@@ -3457,6 +4319,7 @@ class Repository(object):
                         # A publisher was provided, but no repository storage
                         # object exists yet, so add one.
                         rstore = self.__new_rstore(pfmri.publisher)
+                rstore.compress_level = self.compress_level
                 return rstore.open(client_release, pfmri)
 
         def get_matching_fmris(self, patterns, pubs=misc.EmptyI):
@@ -3637,12 +4500,13 @@ class Repository(object):
                                 continue
                         rstore.add_content(refresh_index=refresh_index)
 
-        def add_file(self, trans_id, data, size=None):
+        def add_file(self, trans_id, data, size=None, fhash=None):
                 """Adds a file to a transaction with the specified Transaction
                 ID."""
 
                 rstore = self.get_trans_rstore(trans_id)
-                return rstore.add_file(trans_id, data=data, size=size)
+                return rstore.add_file(trans_id, data=data, size=size,
+                    fhash=fhash)
 
         def rebuild(self, build_catalog=True, build_index=False, pub=None):
                 """Rebuilds the repository catalog and search indexes using the
@@ -3664,6 +4528,33 @@ class Repository(object):
                         rstore.rebuild(build_catalog=build_catalog,
                             build_index=build_index)
 
+        def check_refs(self, pub=None, progtrack=None):
+                """Compares the reference count index of each publisher's
+                repository store (or only that of 'pub') with the manifests in
+                it.  Returns a dictionary mapping publisher prefix to the
+                result of _RepoStore.check_refs()."""
+
+                result = {}
+                for rstore in self.rstores:
+                        if not rstore.publisher:
+                                continue
+                        if pub and rstore.publisher != pub:
+                                continue
+                        result[rstore.publisher] = rstore.check_refs(
+                            progtrack=progtrack)
+                return result
+
+        def rebuild_refs(self, pub=None, progtrack=None):
+                """Rebuilds the reference count index of each publisher's
+                repository store (or only that of 'pub')."""
+
+                for rstore in self.rstores:
+                        if not rstore.publisher:
+                                continue
+                        if pub and rstore.publisher != pub:
+                                continue
+                        rstore.rebuild_refs(progtrack=progtrack)
+
         def reload(self):
                 """Reloads the repository state information."""
 
@@ -3687,14 +4578,49 @@ class Repository(object):
                                 continue
                         rstore.reset_search()
 
+        def shutdown(self):
+                """Stops the threads the repository's transactions compress
+                payloads with, once they've finished the payloads they were
+                given.  Transactions opened later start them again."""
+
+                self.__compress_pool.stop()
+
         def search(self, queries, pub=None):
                 """Searches the index for each query in the list of queries.
                 Each entry should be the output of str(Query), or a Query
                 object.
+
+                The results of each query are cached once they have all been
+                retrieved, until the search index or catalog of the publisher
+                changes.
                 """
 
                 rstore = self.get_pub_rstore(pub)
-                return rstore.search(queries)
+                cache = self.__search_cache
+                generation = None
+                if cache is not None:
+                        generation = rstore.get_search_generation()
+                if generation is None:
+                        return rstore.search(queries)
+
+                res_list = []
+                for q in queries:
+                        try:
+                                if not isinstance(q, qp.Query):
+                                        q = sqp.Query.fromstr(q)
+                        except sqp.QueryException:
+                                # Let the repository store report the error.
+                                return rstore.search(queries)
+
+                        # The string form of a parsed query is used as the
+                        # key, so equivalent forms of a query share results.
+                        key = str(q)
+                        res = cache.get(rstore.publisher, key, generation)
+                        if res is None:
+                                res = cache.add(rstore.publisher, key,
+                                    generation, rstore.search([q])[0])
+                        res_list.append(res)
+                return res_list
 
         def supports(self, op, ver):
                 """Returns a boolean value indicating whether the specified
@@ -3733,12 +4659,15 @@ class Repository(object):
                 rstore.update_publisher(pub)
 
         def verify(self, pubs=[], allowed_checks=[],
-            force_dep_check=False, ignored_dep_files=[], progtrack=None):
+            force_dep_check=False, ignored_dep_files=[], progtrack=None,
+            jobs=1):
                 """A generator that verifies that repository content matches
                 expected state for all or specified publishers.
 
                 'progtrack' is an optional ProgressTracker object.
 
+                'jobs' is the number of files to verify at once.
+
                 'pubs' is an optional publisher list to limit the
                 operation to.
 
@@ -3778,7 +4707,7 @@ class Repository(object):
                         for verify_tuple in rstore.verify(progtrack=progtrack,
                             pub=pub, trust_anchor_dir=trust_anchor_dir,
                             sig_required_names=sig_required_names,
-                            use_crls=use_crls):
+                            use_crls=use_crls, jobs=jobs):
                                 yield verify_tuple
 
                 if VERIFY_DEPENDENCY in allowed_checks:
@@ -4218,6 +5147,16 @@ class Repository(object):
 
         catalog_requests = property(lambda self: self.__catalog_requests)
         cfg = property(lambda self: self.__cfg)
+        compress_jobs = property(lambda self: self.__compress_jobs,
+            __set_compress_jobs, doc="The number of payloads each transaction "
+            "compresses at once.")
+        compress_level = property(__get_compress_level, doc="The level "
+            "payloads are compressed at when they're published.")
+        defer_catalog = property(lambda self: self.__defer_catalog,
+            __set_defer_catalog, doc="Whether additions to the catalog of each "
+            "repository store are only saved to its update logs until "
+            "compact_catalog() is called, instead of the catalog parts being "
+            "saved after each.")
         file_requests = property(lambda self: self.__file_requests)
         file_root = property(lambda self: self.__file_root)
         manifest_requests = property(lambda self: self.__manifest_requests)
@@ -4331,7 +5270,9 @@ class RepositoryConfig(object):
                     cfg.Property("trust-anchor-directory",
                         default="/etc/ssl/pkg/"),
                     cfg.PropList("signature-required-names"),
-                    cfg.PropBool("check-certificate-revocation", default=False)
+                    cfg.PropBool("check-certificate-revocation", default=False),
+                    cfg.PropInt("compression-level", default=9, minimum=0,
+                        maximum=9),
                 ]),
             ],
         }
@@ -26,11 +26,13 @@
 
 from __future__ import print_function
 import calendar
+import collections
 import datetime
 import errno
 import os
 import re
 import shutil
+import tempfile
 import time
 import urllib
 
@@ -41,6 +43,8 @@ import pkg.manifest
 import pkg.misc as misc
 import pkg.portable as portable
 
+from pkg.pkggzip import PkgGzipFile
+
 try:
         import pkg.elf as elf
         haveelf = True
@@ -132,6 +136,215 @@ class TransactionAlreadyOpenError(TransactionError):
                     self.data)
 
 
+class _HashingFile(object):
+        """A write-only file object that passes the data written to it on to
+        another, updating a set of hash objects with it."""
+
+        def __init__(self, fobj, hashes):
+                self.__fobj = fobj
+                self.__hashes = hashes
+
+        def write(self, data):
+                for h in self.__hashes.itervalues():
+                        h.update(data)
+                self.__fobj.write(data)
+
+        def flush(self):
+                self.__fobj.flush()
+
+
+class _Payload(object):
+        """The content of an action or file being added to a Transaction,
+        read in a single pass with bounded memory use.
+
+        As the content is read, it's hashed with each of the given
+        algorithms, and written in compressed form to a temporary file in
+        the transaction directory, while the compressed data is hashed in
+        turn.  If it's an ELF object, it's also written uncompressed to a
+        temporary file, for the ELF information to be extracted from, as it
+        is if compression is deferred.  The caller is responsible for
+        calling cleanup() once it's done with the object.
+
+        Once the content has been read, store() doesn't depend on anything
+        but the object itself, so it can be called by another thread."""
+
+        ELF_MAGIC = "\x7fELF"
+
+        bufsz = 128 * 1024
+
+        def __init__(self, tdir, fobj, size, hash_attrs, hash_algs,
+            compress=True, check_elf=False, compresslevel=9):
+                """Read 'size' bytes of content from the file object 'fobj'.
+
+                'tdir' is the transaction directory.
+
+                'hash_attrs' is the list of the hash attributes to compute,
+                with 'hash_algs' being a dictionary mapping them to the
+                algorithms used to compute them.
+
+                'compress' is a boolean indicating whether the content should
+                be compressed as it's read; if not, it's only compressed by
+                store() if necessary.
+
+                'check_elf' is a boolean indicating whether the content should
+                be checked for being an ELF object.
+
+                'compresslevel' is the level the content is compressed at."""
+
+                self.__dir = tdir
+                self.__level = compresslevel
+                self.__size = size
+                self.__cpath = None
+                self.__cfile = None
+                self.__gzfile = None
+                self.__chashes = None
+                self.__rfile = None
+                self.elf_path = None
+                self.raw_path = None
+
+                hashes = dict(
+                    (attr, hash_algs[attr]())
+                    for attr in hash_attrs
+                )
+
+                try:
+                        self.__read(fobj, size, hashes, compress, check_elf)
+                finally:
+                        self.__close()
+
+                self.hashes = dict(
+                    (attr, h.hexdigest())
+                    for attr, h in hashes.iteritems()
+                )
+
+        def __tempfile(self):
+                fd, path = tempfile.mkstemp(dir=self.__dir, prefix=".temp-")
+                # The compressed file is moved into the repository as is.
+                os.fchmod(fd, misc.PKG_FILE_MODE)
+                return path, os.fdopen(fd, "wb")
+
+        def __start_compression(self):
+                self.__chashes = dict(
+                    (attr, digest.CHASH_ALGS[attr]())
+                    for attr in digest.DEFAULT_CHASH_ATTRS
+                )
+                self.__cpath, self.__cfile = self.__tempfile()
+                self.__gzfile = PkgGzipFile(mode="wb",
+                    compresslevel=self.__level,
+                    fileobj=_HashingFile(self.__cfile, self.__chashes))
+
+        def __read(self, fobj, size, hashes, compress, check_elf):
+                head = ""
+                started = False
+                length = size
+                while length > 0:
+                        data = fobj.read(min(self.bufsz, length))
+                        if data == "":
+                                break
+                        length -= len(data)
+
+                        if not started:
+                                # Enough of the content has to be read to
+                                # tell whether it's an ELF object before
+                                # anything is written.
+                                head += data
+                                if len(head) < len(self.ELF_MAGIC) and \
+                                    length > 0:
+                                        continue
+                                data = head
+                                head = None
+                                started = True
+
+                                is_elf = check_elf and \
+                                    data.startswith(self.ELF_MAGIC)
+                                if compress:
+                                        self.__start_compression()
+                                if is_elf or not compress:
+                                        self.raw_path, self.__rfile = \
+                                            self.__tempfile()
+                                if is_elf:
+                                        self.elf_path = self.raw_path
+
+                        for h in hashes.itervalues():
+                                h.update(data)
+                        if self.__gzfile:
+                                self.__gzfile.write(data)
+                        if self.__rfile:
+                                self.__rfile.write(data)
+
+                if not started:
+                        for h in hashes.itervalues():
+                                h.update(head)
+                        if compress:
+                                self.__start_compression()
+                                self.__gzfile.write(head)
+                        else:
+                                self.raw_path, self.__rfile = \
+                                    self.__tempfile()
+                                self.__rfile.write(head)
+
+        def __close(self):
+                if self.__gzfile:
+                        self.__gzfile.close()
+                        self.__gzfile = None
+                if self.__cfile:
+                        self.__cfile.close()
+                        self.__cfile = None
+                if self.__rfile:
+                        self.__rfile.close()
+                        self.__rfile = None
+
+        def store(self, fname, dst_path):
+                """Returns a tuple of the size and the hashes of the content in
+                compressed form, and leaves that in the transaction directory
+                as 'fname' unless 'dst_path', the path of a compressed file
+                in the repository with the same content, is given."""
+
+                if dst_path:
+                        return misc.compute_compressed_attrs(fname, dst_path,
+                            None, self.__size, self.__dir)
+
+                if not self.__cpath:
+                        # Compression was deferred, so the content has to be
+                        # compressed now.
+                        with open(self.raw_path, "rb") as f:
+                                try:
+                                        self.__start_compression()
+                                        while True:
+                                                data = f.read(self.bufsz)
+                                                if data == "":
+                                                        break
+                                                self.__gzfile.write(data)
+                                finally:
+                                        self.__close()
+
+                csize = os.stat(self.__cpath).st_size
+                os.rename(self.__cpath, os.path.join(self.__dir, fname))
+                self.__cpath = None
+                return str(csize), self.__chashes
+
+        def store_raw(self, path):
+                """Leaves the content, which must not have been compressed as
+                it was read, in the transaction directory as 'path'."""
+
+                os.rename(self.raw_path, path)
+                self.raw_path = self.elf_path = None
+
+        def cleanup(self):
+                """Remove any temporary files left in the transaction
+                directory."""
+
+                for path in (self.__cpath, self.raw_path):
+                        if not path:
+                                continue
+                        try:
+                                os.unlink(path)
+                        except EnvironmentError as e:
+                                if e.errno != errno.ENOENT:
+                                        raise
+                self.__cpath = self.raw_path = self.elf_path = None
+
+
 class Transaction(object):
         """A Transaction is a server-side object used to represent the set of
         incoming changes to a package.  Manipulation of Transaction objects in
@@ -153,6 +366,14 @@ class Transaction(object):
                 self.types_found = set()
                 self.append_trans = False
                 self.remaining_payload_cnt = 0
+                # Actions yet to be added to the manifest, in the order they
+                # were added, each with the job storing its content, if any.
+                self.__pending = collections.deque()
+                # The hash names of the files sent by add_file().
+                self.__files = set()
+                # Why the transaction failed, if the content of an action or
+                # file couldn't be stored; it can then only be abandoned.
+                self.__failed = None
 
         def get_basename(self):
                 assert self.open_time
@@ -380,6 +601,13 @@ class Transaction(object):
                 if not os.path.exists(self.dir):
                         raise TransactionUnknownIDError(self.get_basename())
 
+                try:
+                        with open(os.path.join(self.dir, "failed"), "rb") as f:
+                                self.__failed = f.read()
+                except EnvironmentError as e:
+                        if e.errno != errno.ENOENT:
+                                raise
+
                 tmode = "rb"
                 if not rstore.read_only:
                         # The mode is important especially when dealing with
@@ -421,6 +649,15 @@ class Transaction(object):
                 trans_id = self.get_basename()
                 pkg_fmri = split_trans_id(trans_id)[1]
 
+                self.__check_failed()
+
+                # All of the content has to be stored, and all of the actions
+                # added to the manifest, before the package can be published.
+                try:
+                        self.__flush()
+                finally:
+                        self.__wait_pending()
+
                 # set package state to SUBMITTED
                 pkg_state = "SUBMITTED"
 
@@ -443,6 +680,8 @@ class Transaction(object):
 
         def abandon(self):
                 # state transition from TRANSACTING to ABANDONED
+                self.__wait_pending()
+                self.__pending.clear()
                 try:
                         shutil.rmtree(self.dir)
                 except EnvironmentError as e:
@@ -450,9 +689,18 @@ class Transaction(object):
                                 raise
                 return "ABANDONED"
 
-        def add_content(self, action):
+        def add_content(self, action, flush=True):
                 """Adds the content of the provided action (if applicable) to
-                the Transaction."""
+                the Transaction.
+
+                If 'flush' is False, and payloads are compressed by a pool of
+                threads, the action may be left pending until its content has
+                been stored, and only be added to the manifest by a later call
+                to add_content() or flush().  The caller is then responsible
+                for calling flush() before the action is considered added, as
+                pending actions are lost if the process exits."""
+
+                self.__check_failed()
 
                 # Perform additional publication-time validation of actions
                 # before further processing is done.
@@ -470,90 +718,68 @@ class Transaction(object):
                         # XXX hack for empty files
                         action.data = lambda: open(os.devnull, "rb")
 
+                sent = None
+                if action.has_payload and action.data is None:
+                        # The content may have been sent to the transaction
+                        # by add_file() beforehand, in which case it's read
+                        # back, as if it had been sent with the action.
+                        sent = self.__open_file(
+                            digest.get_least_preferred_hash(action)[1])
+                        if sent:
+                                action.data = lambda: sent
+
+                job = None
                 if action.data is not None:
-                        # get all hashes for this action
-                        hashes, data = misc.get_data_digest(action.data(),
-                            length=size, return_content=True,
-                            hash_attrs=digest.DEFAULT_HASH_ATTRS,
-                            hash_algs=digest.HASH_ALGS)
-
-                        # set the hash member for backwards compatibility and
-                        # remove it from the dictionary
-                        action.hash = hashes.pop("hash", None)
-                        action.attrs.update(hashes)
-
-                        # now set the hash value that will be used for storing
-                        # the file in the repository.
-                        hash_attr, hash_val, hash_func = \
-                            digest.get_least_preferred_hash(action)
-                        fname = hash_val
-
-                        # Extract ELF information
-                        # XXX This needs to be modularized.
-                        if haveelf and data[:4] == "\x7fELF":
-                                elf_name = os.path.join(self.dir,
-                                    ".temp-{0}".format(fname))
-                                elf_file = open(elf_name, "wb")
-                                elf_file.write(data)
-                                elf_file.close()
-
-                                try:
-                                        elf_info = elf.get_info(elf_name)
-                                except elf.ElfError as e:
-                                        raise TransactionContentError(e)
+                        # The content is read once, and hashed and compressed
+                        # as it's read.  If the repository appears to store
+                        # it already, compression is deferred until that can
+                        # be confirmed by its hash.  If payloads are
+                        # compressed by a pool of threads, the content is
+                        # only spooled to disk as it's read, and compressed
+                        # by one of them while the next is read; the action
+                        # is added to the manifest once that's done.
+                        pool = self.rstore.compress_pool.get()
+                        hint = digest.get_least_preferred_hash(action)[1]
+                        try:
+                                payload = _Payload(self.dir, action.data(),
+                                    size, digest.DEFAULT_HASH_ATTRS,
+                                    digest.HASH_ALGS, compress=not pool and
+                                    not self.__stored_file(hint),
+                                    check_elf=haveelf,
+                                    compresslevel=self.rstore.compress_level)
+                        finally:
+                                if sent:
+                                        sent.close()
+                        try:
+                                fname = self.__add_payload(action, payload)
+                        except:
+                                payload.cleanup()
+                                raise
 
+                        if pool:
+                                job = pool.apply_async(self.__store_payload,
+                                    (payload, fname))
+                        else:
                                 try:
-                                        # Check which content checksums to
-                                        # compute and add to the action
-                                        elf256 = "pkg.content-type.sha256"
-                                        elf1 = "elfhash"
-
-                                        if elf256 in \
-                                            digest.DEFAULT_CONTENT_HASH_ATTRS:
-                                                get_sha256 = True
-                                        else:
-                                                get_sha256 = False
-
-                                        if elf1 in \
-                                            digest.DEFAULT_CONTENT_HASH_ATTRS:
-                                                get_sha1 = True
-                                        else:
-                                                get_sha1 = False
-
-                                        dyn = elf.get_dynamic(
-                                            elf_name, sha1=get_sha1,
-                                            sha256=get_sha256)
-
-                                        if get_sha1:
-                                                action.attrs[elf1] = dyn[elf1]
-
-                                        if get_sha256:
-                                                action.attrs[elf256] = \
-                                                    dyn[elf256]
-
-                                except elf.ElfError:
-                                        pass
-                                action.attrs["elfbits"] = str(elf_info["bits"])
-                                action.attrs["elfarch"] = elf_info["arch"]
-                                os.unlink(elf_name)
-
-                        try:
-                                dst_path = self.rstore.file(fname)
-                        except Exception as e:
-                                # The specific exception can't be named here due
-                                # to the cyclic dependency between this class
-                                # and the repository class.
-                                if getattr(e, "data", "") != fname:
+                                        csize, chashes = self.__store_payload(
+                                            payload, fname)
+                                except Exception as e:
+                                        self.__fail(e)
                                         raise
-                                dst_path = None
-
-                        csize, chashes = misc.compute_compressed_attrs(
-                            fname, dst_path, data, size, self.dir)
-                        for attr in chashes:
-                                action.attrs[attr] = chashes[attr].hexdigest()
-                        action.attrs["pkg.csize"] = csize
-                        chash = None
-                        data = None
+                                self.__set_compressed_attrs(action, csize,
+                                    chashes)
+                elif action.has_payload:
+                        # No content was provided, so if the repository
+                        # already stores the payload, reference it.  The
+                        # compressed attributes the action was published with
+                        # elsewhere may not match the file stored here, so
+                        # they're recomputed from that file.
+                        fname = digest.get_least_preferred_hash(action)[1]
+                        dst_path = self.__stored_file(fname)
+                        if dst_path:
+                                self.__set_compressed_attrs(action,
+                                    *misc.compute_compressed_attrs(fname,
+                                    dst_path, None, size, self.dir))
 
                 self.remaining_payload_cnt = \
                     len(action.attrs.get("chain.sizes", "").split())
@@ -605,28 +831,76 @@ class Transaction(object):
                             type=action.name, action=action))
 
                 # Now that the action is known to be sane, we can add it to the
-                # manifest.
-                tfpath = os.path.join(self.dir, "manifest")
-                tfile = file(tfpath, "ab+")
-                print(action, file=tfile)
-                tfile.close()
+                # manifest, once it and those before it have been stored.  No
+                # more than a couple of payloads for each thread in the pool
+                # are left waiting to be compressed, to bound the space their
+                # content takes up.
+                self.__pending.append((action, job))
+                if flush:
+                        self.__flush()
+                else:
+                        self.__flush(2 * self.rstore.compress_jobs)
 
                 self.types_found.add(action.name)
 
-        def add_file(self, f, size=None):
-                """Adds the file to the Transaction."""
-                hashes, data = misc.get_data_digest(f, length=size,
-                    return_content=True, hash_attrs=digest.DEFAULT_HASH_ATTRS,
-                    hash_algs=digest.HASH_ALGS)
-
-                if size is None:
-                        size = len(data)
+        def add_file(self, f, size=None, fhash=None):
+                """Adds the file to the Transaction.  If 'fhash' is given, it's
+                the hash name the file is expected to have."""
+
+                self.__check_failed()
+
+                closefobj = False
+                if isinstance(f, basestring):
+                        if size is None:
+                                size = os.stat(f).st_size
+                        f = open(f, "rb")
+                        closefobj = True
+
+                # Without a hash name, these may be the certificates of a
+                # signature action, whose compressed sizes and hashes the
+                # signer computed at the default level, so the repository's
+                # level isn't used.  Otherwise, they're the payloads of actions
+                # yet to be added, which are only compressed when those are, so
+                # they're kept as they are.
+                try:
+                        payload = _Payload(self.dir, f, size,
+                            digest.DEFAULT_HASH_ATTRS, digest.HASH_ALGS,
+                            compress=fhash is None)
+                finally:
+                        if closefobj:
+                                f.close()
 
                 try:
                         # We don't have an Action yet, so passing None is fine.
                         default_hash_attr = digest.get_least_preferred_hash(
                             None)[0]
-                        fname = hashes[default_hash_attr]
+                        fname = payload.hashes[default_hash_attr]
+                        if fhash is not None and fname != fhash:
+                                raise TransactionContentError(_("expected "
+                                    "content with hash {0}, but received "
+                                    "{1}").format(fhash, fname))
+                        dst_path = self.__stored_file(fname)
+                        try:
+                                if fhash is None:
+                                        payload.store(fname, dst_path)
+                                elif not dst_path:
+                                        payload.store_raw(
+                                            self.__raw_file(fname))
+                        except Exception as e:
+                                self.__fail(e)
+                                raise
+                finally:
+                        payload.cleanup()
+
+                self.__files.add(fname)
+                self.remaining_payload_cnt -= 1
+
+        def __stored_file(self, fname):
+                """Returns the path of the file with the given hash name in
+                the repository, if it's stored in the compressed form that
+                transactions produce, or None otherwise."""
+
+                try:
                         dst_path = self.rstore.file(fname)
                 except Exception as e:
                         # The specific exception can't be named here due
@@ -634,16 +908,186 @@ class Transaction(object):
                         # and the repository class.
                         if getattr(e, "data", "") != fname:
                                 raise
-                        dst_path = None
+                        return None
 
-                csize, chashes = misc.compute_compressed_attrs(fname, dst_path,
-                    data, size, self.dir,
-                    chash_attrs=digest.DEFAULT_CHASH_ATTRS,
-                    chash_algs=digest.CHASH_ALGS)
-                chashes = None
-                data = None
+                if not PkgGzipFile.test_is_pkggzipfile(dst_path):
+                        return None
+                return dst_path
 
-                self.remaining_payload_cnt -= 1
+        def __raw_file(self, fname):
+                """Returns the path in the transaction directory of the
+                uncompressed content with the given hash name."""
+
+                return os.path.join(self.dir, ".raw-" + fname)
+
+        def __open_file(self, fname):
+                """Returns a file object for reading the content with the given
+                hash name if it was sent to the transaction by add_file(), or
+                None otherwise."""
+
+                if fname not in self.__files:
+                        return None
+                try:
+                        return open(self.__raw_file(fname), "rb")
+                except EnvironmentError as e:
+                        if e.errno != errno.ENOENT:
+                                raise
+                path = os.path.join(self.dir, fname)
+                if not os.path.exists(path):
+                        # The repository stored it already.
+                        path = self.__stored_file(fname)
+                        if not path:
+                                return None
+                return PkgGzipFile(path, "rb")
+
+        def __add_payload(self, action, payload):
+                """Sets the attributes of 'action' derived from its content,
+                which has been read into the _Payload object 'payload', other
+                than those of the compressed content, and returns the name the
+                content is stored under."""
+
+                # set the hash member for backwards compatibility and
+                # remove it from the dictionary
+                hashes = payload.hashes.copy()
+                action.hash = hashes.pop("hash", None)
+                action.attrs.update(hashes)
+
+                # now set the hash value that will be used for storing
+                # the file in the repository.
+                hash_attr, hash_val, hash_func = \
+                    digest.get_least_preferred_hash(action)
+                fname = hash_val
+
+                # Extract ELF information
+                # XXX This needs to be modularized.
+                if payload.elf_path:
+                        elf_name = payload.elf_path
+                        try:
+                                elf_info = elf.get_info(elf_name)
+                        except elf.ElfError as e:
+                                raise TransactionContentError(e)
+
+                        try:
+                                # Check which content checksums to
+                                # compute and add to the action
+                                elf256 = "pkg.content-type.sha256"
+                                elf1 = "elfhash"
+
+                                if elf256 in \
+                                    digest.DEFAULT_CONTENT_HASH_ATTRS:
+                                        get_sha256 = True
+                                else:
+                                        get_sha256 = False
+
+                                if elf1 in \
+                                    digest.DEFAULT_CONTENT_HASH_ATTRS:
+                                        get_sha1 = True
+                                else:
+                                        get_sha1 = False
+
+                                dyn = elf.get_dynamic(
+                                    elf_name, sha1=get_sha1,
+                                    sha256=get_sha256)
+
+                                if get_sha1:
+                                        action.attrs[elf1] = dyn[elf1]
+
+                                if get_sha256:
+                                        action.attrs[elf256] = \
+                                            dyn[elf256]
+
+                        except elf.ElfError:
+                                pass
+                        action.attrs["elfbits"] = str(elf_info["bits"])
+                        action.attrs["elfarch"] = elf_info["arch"]
+
+                return fname
+
+        def __store_payload(self, payload, fname):
+                """Leaves the compressed content of the _Payload object
+                'payload' in the transaction directory as 'fname' if the
+                repository doesn't already store it, and returns a tuple of
+                its size and hashes.  This may be called by a thread in the
+                pool."""
+
+                try:
+                        return payload.store(fname, self.__stored_file(fname))
+                finally:
+                        payload.cleanup()
+
+        @staticmethod
+        def __set_compressed_attrs(action, csize, chashes):
+                for attr in chashes:
+                        action.attrs[attr] = chashes[attr].hexdigest()
+                action.attrs["pkg.csize"] = csize
+
+        def __fail(self, e):
+                """Records that the content of an action or file couldn't be
+                stored because of the exception 'e', so that every later
+                operation other than abandon() fails, even in another
+                process."""
+
+                self.__failed = str(e)
+                try:
+                        with open(os.path.join(self.dir, "failed"), "wb") as f:
+                                f.write(self.__failed)
+                except EnvironmentError:
+                        pass
+
+        def __check_failed(self):
+                if self.__failed is not None:
+                        raise TransactionOperationError(_("The content of an "
+                            "action could not be stored, so the transaction "
+                            "must be abandoned: {0}").format(self.__failed))
+
+        def flush(self):
+                """Adds the actions left pending by add_content() to the
+                manifest, once their content has been stored."""
+
+                self.__flush()
+
+        def __wait_pending(self):
+                """Waits for the content of the pending actions to be stored,
+                or to fail to be."""
+
+                for action, job in self.__pending:
+                        if job:
+                                job.wait()
+
+        def __flush(self, limit=0):
+                """Adds the pending actions to the manifest in the order they
+                were added to the Transaction, as far as their content has
+                been stored.  While more than 'limit' actions are pending, the
+                content of the first is waited for.  Any error storing it is
+                raised here, and the transaction fails."""
+
+                self.__check_failed()
+
+                tfile = None
+                try:
+                        while self.__pending:
+                                action, job = self.__pending[0]
+                                if job and not job.ready() and \
+                                    len(self.__pending) <= limit:
+                                        break
+                                self.__pending.popleft()
+                                if job:
+                                        try:
+                                                csize, chashes = job.get()
+                                        except Exception as e:
+                                                self.__fail(e)
+                                                raise
+                                        self.__set_compressed_attrs(action,
+                                            csize, chashes)
+
+                                if not tfile:
+                                        tfpath = os.path.join(self.dir,
+                                            "manifest")
+                                        tfile = file(tfpath, "ab+")
+                                print(action, file=tfile)
+                finally:
+                        if tfile:
+                                tfile.close()
 
         def accept_publish(self, add_to_catalog=True):
                 """Transaction meets consistency criteria, and can be published.
@@ -701,14 +1145,12 @@ class Transaction(object):
 
                 # mv manifest to pkg_name / version
                 src_mpath = os.path.join(self.dir, "manifest")
-                dest_mpath = self.rstore.manifest(self.fmri)
-                misc.makedirs(os.path.dirname(dest_mpath))
-                portable.rename(src_mpath, dest_mpath)
+                self.rstore._replace_manifest(self.fmri, src_mpath)
 
                 # Move each file to file_root, with appropriate directory
                 # structure.
                 for f in os.listdir(self.dir):
-                        if f == "append":
+                        if f == "append" or f.startswith(".raw-"):
                                 continue
                         src_path = os.path.join(self.dir, f)
                         self.rstore.cache_store.insert(f, src_path)
@@ -153,11 +153,13 @@ Subcommands:
          [--key ssl_key ... --cert ssl_cert ...] [pkg_fmri_pattern ...]
 
      pkgrepo rebuild [-p publisher ...] -s repo_uri_or_path [--key ssl_key ...
-         --cert ssl_cert ...] [--no-catalog] [--no-index]
+         --cert ssl_cert ...] [--jobs number] [--no-catalog] [--no-index]
 
      pkgrepo refresh [-p publisher ...] -s repo_uri_or_path [--key ssl_key ...
          --cert ssl_cert ...] [--no-catalog] [--no-index]
 
+     pkgrepo refcount [--check] [-p publisher ...] -s repo_uri_or_path
+
      pkgrepo remove [-n] [-p publisher ...] -s repo_uri_or_path
          pkg_fmri_pattern ...
 
@@ -166,7 +168,7 @@ Subcommands:
          section/property[+|-]=([value]) ...
 
      pkgrepo verify [-d] [-p publisher ...] [-i ignored_dep_file ...]
-         [--disable verification ...] -s repo_uri_or_path
+         [--disable verification ...] [--jobs number] -s repo_uri_or_path
 
      pkgrepo fix [-v] [-p publisher ...] -s repo_uri_or_path
 
@@ -260,11 +262,15 @@ def subcmd_remove(conf, args):
         return EXIT_OK
 
 
-def get_repo(conf, allow_invalid=False, read_only=True, subcommand=None):
+def get_repo(conf, allow_invalid=False, read_only=True, subcommand=None,
+    index_jobs=None):
         """Return the repository object for current program configuration.
 
         'allow_invalid' specifies whether potentially corrupt repositories are
-        allowed; should only be True if performing a rebuild operation."""
+        allowed; should only be True if performing a rebuild operation.
+
+        'index_jobs' is the number of processes used to rebuild search
+        indexes; by default, it's the number of CPUs."""
 
         repo_uri = conf["repo_uri"]
         if repo_uri.scheme != "file":
@@ -276,7 +282,7 @@ def get_repo(conf, allow_invalid=False, read_only=True, subcommand=None):
                 # Bad URI?
                 raise sr.RepositoryInvalidError(str(repo_uri))
         return sr.Repository(allow_invalid=allow_invalid, read_only=read_only,
-            root=path)
+            root=path, index_jobs=index_jobs)
 
 
 def setup_transport(conf, subcommand=None, prefix=None, verbose=False,
@@ -1162,13 +1168,14 @@ were found in the repository."""))
         return rval
 
 
-def __rebuild_local(subcommand, conf, pubs, build_catalog, build_index):
+def __rebuild_local(subcommand, conf, pubs, build_catalog, build_index,
+    jobs):
         """In an attempt to allow operations on potentially corrupt
         repositories, 'local' repositories (filesystem-basd ones) are handled
         separately."""
 
         repo = get_repo(conf, allow_invalid=build_catalog, read_only=False,
-            subcommand=subcommand)
+            subcommand=subcommand, index_jobs=jobs)
 
         rpubs = set(repo.publishers)
         if not pubs:
@@ -1225,9 +1232,10 @@ def subcmd_rebuild(conf, args):
         build_index = True
         key = None
         cert = None
+        jobs = None
 
         opts, pargs = getopt.getopt(args, "p:s:", ["no-catalog", "no-index",
-            "key=", "cert="])
+            "key=", "cert=", "jobs="])
         pubs = set()
         for opt, arg in opts:
                 if opt == "-p":
@@ -1237,6 +1245,14 @@ def subcmd_rebuild(conf, args):
                         pubs.add(arg)
                 elif opt == "-s":
                         conf["repo_uri"] = parse_uri(arg)
+                elif opt == "--jobs":
+                        try:
+                                jobs = int(arg)
+                                if jobs < 1:
+                                        raise ValueError()
+                        except ValueError:
+                                usage(_("--jobs must be a positive integer."),
+                                    cmd=subcommand)
                 elif opt == "--no-catalog":
                         build_catalog = False
                 elif opt == "--no-index":
@@ -1260,7 +1276,11 @@ def subcmd_rebuild(conf, args):
 
         if conf["repo_uri"].scheme == "file":
                 return __rebuild_local(subcommand, conf, pubs, build_catalog,
-                    build_index)
+                    build_index, jobs)
+
+        if jobs is not None:
+                usage(_("--jobs can only be used with file system based "
+                    "repositories."), cmd=subcommand)
 
         return __rebuild_remote(subcommand, conf, pubs, key, cert,
             build_catalog, build_index)
@@ -1330,6 +1350,91 @@ def subcmd_refresh(conf, args):
         return rval
 
 
+def subcmd_refcount(conf, args):
+        """Rebuild or check the index of the number of packages referencing
+        each file in the repository, which is used when removing packages."""
+
+        subcommand = "refcount"
+        check = False
+
+        opts, pargs = getopt.getopt(args, "p:s:", ["check"])
+        pubs = set()
+        for opt, arg in opts:
+                if opt == "-p":
+                        if not misc.valid_pub_prefix(arg):
+                                error(_("Invalid publisher prefix '{0}'").format(
+                                    arg), cmd=subcommand)
+                        pubs.add(arg)
+                elif opt == "-s":
+                        conf["repo_uri"] = parse_uri(arg)
+                elif opt == "--check":
+                        check = True
+
+        if pargs:
+                usage(_("command does not take operands"), cmd=subcommand)
+
+        if not conf.get("repo_uri", None):
+                usage(_("A package repository location must be provided "
+                    "using -s."), cmd=subcommand)
+
+        repo = get_repo(conf, read_only=check, subcommand=subcommand)
+
+        if "all" in pubs:
+                pubs = set()
+
+        rpubs = set(repo.publishers)
+        if not pubs:
+                found = rpubs
+        else:
+                found = rpubs & pubs
+        notfound = pubs - found
+
+        rval = EXIT_OK
+        if found and notfound:
+                rval = EXIT_PARTIAL
+        elif pubs and not found:
+                error(_("no matching publishers found"), cmd=subcommand)
+                return EXIT_OOPS
+
+        progtrack = get_tracker()
+        if not check:
+                logger.info(_("Initiating reference count index rebuild."))
+                for pfx in sorted(found):
+                        repo.rebuild_refs(pub=pfx, progtrack=progtrack)
+                return rval
+
+        bad = False
+        for pfx in sorted(found):
+                result = repo.check_refs(pub=pfx, progtrack=progtrack)[pfx]
+                if result is None:
+                        error(_("The reference count index for publisher "
+                            "{0} is missing or incomplete; use 'pkgrepo "
+                            "refcount' to rebuild it.").format(pfx),
+                            cmd=subcommand)
+                        bad = True
+                        continue
+
+                bad_hashes, bad_manifests = result
+                for h, recorded, actual in bad_hashes:
+                        logger.info(_("{pub}: file {hash}: {recorded:d} "
+                            "references recorded; {actual:d} found").format(
+                            pub=pfx, hash=h, recorded=recorded, actual=actual))
+                for key, recorded, actual in bad_manifests:
+                        if recorded:
+                                logger.info(_("{pub}: package {key}: counted, "
+                                    "but not found").format(pub=pfx, key=key))
+                        else:
+                                logger.info(_("{pub}: package {key}: found, "
+                                    "but not counted").format(pub=pfx,
+                                    key=key))
+                if bad_hashes or bad_manifests:
+                        bad = True
+
+        if bad:
+                return EXIT_OOPS
+        return rval
+
+
 def subcmd_set(conf, args):
         """Set repository properties."""
 
@@ -1630,9 +1735,10 @@ def subcmd_verify(conf, args):
         subcommand = "verify"
         __load_verify_msgs()
 
-        opts, pargs = getopt.getopt(args, "dp:s:i:", ["disable="])
+        opts, pargs = getopt.getopt(args, "dp:s:i:", ["disable=", "jobs="])
         allowed_checks = set(sr.verify_default_checks)
         force_dep_check = False
+        jobs = 1
         ignored_dep_files = []
         pubs = set()
         for opt, arg in opts:
@@ -1656,6 +1762,14 @@ def subcmd_verify(conf, args):
                                     sr.verify_default_checks)), cmd=subcommand)
                 elif opt == "-i":
                         ignored_dep_files.append(arg)
+                elif opt == "--jobs":
+                        try:
+                                jobs = int(arg)
+                                if jobs < 1:
+                                        raise ValueError()
+                        except ValueError:
+                                usage(_("--jobs must be a positive integer."),
+                                    cmd=subcommand)
 
         if pargs:
                 usage(_("command does not take operands"), cmd=subcommand)
@@ -1706,7 +1820,8 @@ def subcmd_verify(conf, args):
 
         for verify_tuple in repo.verify(pubs=found_pubs,
             allowed_checks=allowed_checks, force_dep_check=force_dep_check,
-            ignored_dep_files=ignored_dep_files, progtrack=progtrack):
+            ignored_dep_files=ignored_dep_files, progtrack=progtrack,
+            jobs=jobs):
                 report_error(verify_tuple)
 
         if bad_fmris:
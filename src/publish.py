@@ -449,8 +449,14 @@ def trans_publish(repo_uri, fargs):
                         t.close(abandon=True)
                         raise
 
-        pkg_state, pkg_fmri = t.close(abandon=False,
-            add_to_catalog=add_to_catalog)
+        try:
+                # When publishing to a depot, the actions may only be added
+                # now, once all of their payloads have been sent.
+                pkg_state, pkg_fmri = t.close(abandon=False,
+                    add_to_catalog=add_to_catalog)
+        except:
+                t.close(abandon=True)
+                raise
         for val in (pkg_state, pkg_fmri):
                 if val is not None:
                         msg(val)
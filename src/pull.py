@@ -30,9 +30,11 @@ import getopt
 import gettext
 import locale
 import os
+import Queue
 import shutil
 import sys
 import tempfile
+import threading
 import traceback
 import urllib
 import warnings
@@ -69,6 +71,9 @@ dest_xport = None
 targ_pub = None
 target = None
 
+# The number of payload hashes to ask the target about at once.
+PAYLOAD_QUERY_SIZE = 1000
+
 def error(text):
         """Emit an error message prefixed by the command name """
 
@@ -95,7 +100,7 @@ def usage(usage_error=None, retcode=2):
         msg(_("""\
 Usage:
         pkgrecv [-aknrv] [-s src_uri] [-d (path|dest_uri)] [-c cache_dir]
-            [-m match] [--raw] [--key src_key --cert src_cert]
+            [-m match] [--raw] [--jobs jobs] [--key src_key --cert src_cert]
             [--dkey dest_key --dcert dest_cert]
             (fmri|pattern) ...
         pkgrecv [-s src_repo_uri] --newest
@@ -157,6 +162,12 @@ Options:
                         Cloning will leave the destination repository altered in
                         case of an error.
 
+        --jobs jobs     When republishing, the number of packages to
+                        republish at once.  While packages are republished,
+                        the files for the packages that follow them are
+                        retrieved, up to this many packages ahead.  The
+                        default is 1.
+
         --newest        List the most recent versions of the packages available
                         from the specified repository and exit.  (All other
                         options except -s will be ignored.)
@@ -313,14 +324,123 @@ def get_sizes(mfst):
                                 getb += a.get_action_chain_csize()
         return getb, getf, sendb, sendcb
 
-def add_hashes_to_multi(mfst, multi):
+def add_hashes_to_multi(mfst, multi, present=frozenset()):
         """Takes a manifest and a multi object and adds the hashes to the multi
-        object."""
+        object.  The payloads whose hashes are in 'present' aren't added."""
 
         for a in mfst.gen_actions():
-                if a.has_payload:
+                if a.has_payload and a.hash not in present:
                         multi.add_action(a)
 
+def add_payload_sizes(mfst, payloads):
+        """Takes a manifest and a dictionary mapping payload hashes to lists
+        of the form [get_bytes, get_files, send_bytes], and adds the sizes of
+        the payload of each of the manifest's actions, other than signatures,
+        to it."""
+
+        for a in mfst.gen_actions():
+                if a.has_payload and a.name != "signature":
+                        sizes = payloads.setdefault(a.hash, [0, 0, 0])
+                        sizes[0] += get_pkg_otw_size(a)
+                        sizes[1] += 1
+                        sizes[2] += int(a.attrs.get("pkg.size", 0))
+
+def get_present_payloads(targ_pub, hashes):
+        """Returns the set of the payload hashes in 'hashes' that the target
+        repository already stores.  If the target can't say, as older depots
+        can't, the set is empty."""
+
+        present = set()
+        hashes = list(hashes)
+        try:
+                for i in range(0, len(hashes), PAYLOAD_QUERY_SIZE):
+                        present.update(dest_xport.publish_have(targ_pub,
+                            hashes[i:i + PAYLOAD_QUERY_SIZE]))
+        except apx.TransportError:
+                # This includes the target not supporting the query.  Nothing
+                # is lost but the chance to skip the payloads it has; they're
+                # transferred as usual.
+                return frozenset()
+        return present
+
+def run_pipeline(items, stages, jobs):
+        """Pass each of 'items' through each of 'stages' in turn.  'stages'
+        is a list of tuples of the form (func, nthreads); each item is passed
+        to the first stage's function, what that returns to the second's,
+        and so on.
+
+        If 'jobs' is greater than one, the first stage is run by the calling
+        thread and each of the others by 'nthreads' threads of its own, so
+        that different items can be in different stages at once; at most
+        'jobs' items wait to enter each stage.  Otherwise, each item passes
+        through every stage before the next is started.
+
+        If a stage raises an exception, no more items are started, and the
+        first such exception is raised once the items already started have
+        been finished or dropped."""
+
+        if jobs <= 1:
+                for item in items:
+                        for func, nthreads in stages:
+                                item = func(item)
+                return
+
+        failed = []
+        # Put in a stage's queue to stop one of its threads.
+        done = object()
+
+        def run_stage(func, inq, outq):
+                while True:
+                        item = inq.get()
+                        if item is done:
+                                return
+                        if failed:
+                                # Drop the item.
+                                continue
+                        try:
+                                item = func(item)
+                        except:
+                                failed.append(sys.exc_info())
+                                continue
+                        if outq:
+                                outq.put(item)
+
+        queues = [Queue.Queue(jobs) for s in stages[1:]]
+        threads = []
+        for (func, nthreads), inq, outq in zip(stages[1:], queues,
+            queues[1:] + [None]):
+                sthreads = []
+                for i in range(nthreads):
+                        t = threading.Thread(target=run_stage,
+                            args=(func, inq, outq))
+                        t.daemon = True
+                        t.start()
+                        sthreads.append(t)
+                threads.append(sthreads)
+
+        func = stages[0][0]
+        try:
+                for item in items:
+                        if failed:
+                                break
+                        item = func(item)
+                        if queues:
+                                queues[0].put(item)
+        except:
+                failed.insert(0, sys.exc_info())
+
+        # Each stage's threads are stopped once all of the items have
+        # left the stage before it.
+        for inq, sthreads in zip(queues, threads):
+                for t in sthreads:
+                        inq.put(done)
+                for t in sthreads:
+                        t.join()
+
+        if failed:
+                exc_info = failed[0]
+                raise exc_info[0], exc_info[1], exc_info[2]
+
 def prune(fmri_list, all_versions, all_timestamps):
         """Returns a filtered version of fmri_list based on the provided
         parameters."""
@@ -395,6 +515,7 @@ def main_func():
         publishers = []
         clone = False
         verbose = False
+        jobs = 1
 
         temp_root = misc.config_temp_root()
 
@@ -408,7 +529,7 @@ def main_func():
         try:
                 opts, pargs = getopt.getopt(sys.argv[1:], "ac:D:d:hkm:np:rs:v",
                     ["cert=", "key=", "dcert=", "dkey=", "newest", "raw",
-                    "debug=", "clone"])
+                    "debug=", "clone", "jobs="])
         except getopt.GetoptError as e:
                 usage(_("Illegal option -- {0}").format(e.opt))
 
@@ -435,6 +556,14 @@ def main_func():
                         DebugValues.set_value(key, value)
                 elif opt == "-h":
                         usage(retcode=0)
+                elif opt == "--jobs":
+                        try:
+                                jobs = int(arg)
+                                if jobs < 1:
+                                        raise ValueError()
+                        except ValueError:
+                                usage(_("--jobs takes a positive integer "
+                                    "argument, not {0}").format(arg))
                 elif opt == "-k":
                         keep_compressed = True
                 elif opt == "-m":
@@ -546,7 +675,7 @@ def main_func():
                 return archive_pkgs(*args)
 
         # Normal package transfer allows operations on a per-package basis.
-        return transfer_pkgs(*args)
+        return transfer_pkgs(*args, jobs=jobs)
 
 def check_processed(any_matched, any_unmatched, total_processed):
         # Reduce unmatched patterns to those that were unmatched for all
@@ -974,6 +1103,11 @@ def clone_repo(pargs, target, list_newest, all_versions, all_timestamps,
                 old_gti = tracker.mfst_fetch
                 tracker.mfst_fetch = progress.GoalTrackerItem(
                     _("Reading Manifests"))
+                if not dry_run:
+                        # Manifests are moved into place directly below, so
+                        # the repository's index of file references can't be
+                        # kept up to date.
+                        repo.get_pub_rstore(src_pub.prefix).discard_refs()
                 tracker.manifest_fetch_start(len(to_add))
                 for f, i in to_add:
                         try:
@@ -1124,9 +1258,10 @@ def clone_repo(pargs, target, list_newest, all_versions, all_timestamps,
 
 def transfer_pkgs(pargs, target, list_newest, all_versions, all_timestamps,
     keep_compressed, raw, recursive, dry_run, verbose, dest_xport_cfg, src_uri,
-    dkey, dcert):
+    dkey, dcert, jobs=1):
         """Retrieve source package data and optionally republish it as each
-        package is retrieved.
+        package is retrieved.  'jobs' is the number of packages to republish
+        at once.
         """
 
         global cache_dir, download_start, xport, xport_cfg, dest_xport, targ_pub
@@ -1239,9 +1374,30 @@ def transfer_pkgs(pargs, target, list_newest, all_versions, all_timestamps,
                         msg(_("Retrieving and evaluating {0:d} package(s)...").format(
                             npkgs))
 
+                # Try prefetching the manifests in bulk first for faster,
+                # parallel transport.  Retryable errors during prefetch are
+                # ignored and manifests are retrieved again during the
+                # evaluation below.
+                fetchlist = [
+                    (f, None)
+                    for f in matches
+                    if not (republish and targ_cat.get_entry(f)) and
+                        not os.path.exists(xport_cfg.get_pkg_pathname(f))
+                ]
+                if fetchlist:
+                        xport.prefetch_manifests(fetchlist, progtrack=tracker)
+
+                        # As for --clone, change the output of mfst_fetch
+                        # since otherwise we would see "Download Manifests
+                        # x/y" twice.
+                        tracker.mfst_fetch = progress.GoalTrackerItem(
+                            _("Reading Manifests"))
+                del fetchlist
+
                 tracker.manifest_fetch_start(npkgs)
 
                 pkgs_to_get = []
+                payloads = {}
                 while matches:
                         f = matches.pop()
                         if republish and targ_cat.get_entry(f):
@@ -1262,10 +1418,24 @@ def transfer_pkgs(pargs, target, list_newest, all_versions, all_timestamps,
                                 # uncompressed data as already compressed data
                                 # is not supported for publication.
                                 send_bytes += sendb
+                                add_payload_sizes(m, payloads)
 
                         tracker.manifest_fetch_progress(completion=True)
                 tracker.manifest_fetch_done()
 
+                # Payloads the target already stores are neither retrieved
+                # nor sent; the actions added for them reference the target's
+                # copies.
+                present = frozenset()
+                if payloads:
+                        present = get_present_payloads(targ_pub, payloads)
+                        for h in present:
+                                getb, getf, sendb = payloads[h]
+                                get_bytes -= getb
+                                get_files -= getf
+                                send_bytes -= sendb
+                del payloads
+
                 # Next, retrieve and store the content for each package.
                 tracker.republish_set_goal(len(pkgs_to_get), get_bytes,
                     send_bytes)
@@ -1301,15 +1471,70 @@ def transfer_pkgs(pargs, target, list_newest, all_versions, all_timestamps,
                         cleanup()
                         continue
 
-                processed = 0
-                pkgs_to_get = sorted(pkgs_to_get)
-                for f in pkgs_to_get:
-                        tracker.republish_start_pkg(f)
+                if not targ_pub and republish:
+                        targ_pub = transport.setup_publisher(target,
+                            src_pub.prefix, dest_xport, dest_xport_cfg,
+                            remote_prefix=True, ssl_key=dkey, ssl_cert=dcert)
+
+                # Packages are retrieved, republished, and then removed from
+                # the temporary directories in turn; if jobs is greater than
+                # one, these stages are run for different packages at once.
+                # The progress tracker is then used by several threads.
+                ptracker = tracker
+                if jobs > 1:
+                        ptracker = progress.LockedProgressTracker(tracker)
+
+                # A Transport's operations are serialized, so each thread
+                # republishing packages uses its own.  For a filesystem-based
+                # target, they share the Repository object, which may be used
+                # by several threads at once.
+                xports = Queue.Queue()
+                if republish and jobs > 1:
+                        frepo = None
+                        if target.startswith("file://"):
+                                try:
+                                        frepo = sr.Repository(
+                                            root=publisher.RepositoryURI(
+                                            target).get_pathname())
+                                except sr.RepositoryError as e:
+                                        abort(err=e)
+                        for i in range(jobs):
+                                wxport = dest_xport.copy()
+                                if frepo:
+                                        wxport.publish_cache_repository(
+                                            targ_pub, frepo)
+                                xports.put(wxport)
+                else:
+                        xports.put(dest_xport)
+
+                def retrieve(f):
+                        global download_start
+
+                        if republish:
+                                # Dump data retrieved for previous packages to
+                                # conserve space; it has been copied to their
+                                # package directories.
+                                try:
+                                        shutil.rmtree(xport_cfg.incoming_root)
+                                        if cache_dir in tmpdirs:
+                                                # If cache_dir is listed in
+                                                # tmpdirs, then it's safe to
+                                                # dump cache contents.
+                                                # Otherwise, it's a user cache
+                                                # directory and shouldn't be
+                                                # dumped.
+                                                shutil.rmtree(cache_dir)
+                                                misc.makedirs(cache_dir)
+                                except EnvironmentError as e:
+                                        raise apx._convert_error(e)
+                                misc.makedirs(xport_cfg.incoming_root)
+
+                        ptracker.republish_start_pkg(f)
                         pkgdir = xport_cfg.get_pkg_dir(f)
                         mfile = xport.multi_file_ni(src_pub, pkgdir,
-                            not keep_compressed, tracker)
+                            not keep_compressed, ptracker)
                         m = get_manifest(f, xport_cfg)
-                        add_hashes_to_multi(m, mfile)
+                        add_hashes_to_multi(m, mfile, present)
 
                         if mfile:
                                 download_start = True
@@ -1317,8 +1542,19 @@ def transfer_pkgs(pargs, target, list_newest, all_versions, all_timestamps,
 
                         if not republish:
                                 # Nothing more to do for this package.
-                                tracker.republish_end_pkg(f)
-                                continue
+                                ptracker.republish_end_pkg(f)
+                        return f
+
+                def republish_pkg(f):
+                        wxport = xports.get()
+                        try:
+                                _republish_pkg(f, wxport)
+                        finally:
+                                xports.put(wxport)
+                        return f
+
+                def _republish_pkg(f, wxport):
+                        m = get_manifest(f, xport_cfg)
 
                         # Get first line of original manifest so that inclusion
                         # of the scheme can be determined.
@@ -1334,73 +1570,83 @@ def transfer_pkgs(pargs, target, list_newest, all_versions, all_timestamps,
                         # can be aborted.
                         trans_id = get_basename(f)
 
-                        if not targ_pub:
-                                targ_pub = transport.setup_publisher(target,
-                                    src_pub.prefix, dest_xport, dest_xport_cfg,
-                                    remote_prefix=True, ssl_key=dkey,
-                                    ssl_cert=dcert)
+                        t = trans.Transaction(target, pkg_name=pkg_name,
+                            trans_id=trans_id, xport=wxport,
+                            pub=targ_pub, progtrack=ptracker)
 
+                        # Remove any previous failed attempt to
+                        # to republish this package.
                         try:
-                                t = trans.Transaction(target, pkg_name=pkg_name,
-                                    trans_id=trans_id, xport=dest_xport,
-                                    pub=targ_pub, progtrack=tracker)
-
-                                # Remove any previous failed attempt to
-                                # to republish this package.
-                                try:
-                                        t.close(abandon=True)
-                                except:
-                                        # It might not exist already.
-                                        pass
-
-                                t.open()
-                                for a in m.gen_actions():
-                                        if a.name == "set" and \
-                                            a.attrs.get("name", "") in ("fmri",
-                                            "pkg.fmri"):
-                                                # To be consistent with the
-                                                # server, the fmri can't be
-                                                # added to the manifest.
-                                                continue
-
-                                        if hasattr(a, "hash"):
-                                                fname = os.path.join(pkgdir,
-                                                    a.hash)
-                                                a.data = lambda: open(fname,
-                                                    "rb")
-                                        t.add(a)
-                                        if a.name == "signature":
-                                                # We always store content in the
-                                                # repository by the least-
-                                                # preferred hash.
-                                                for fp in a.get_chain_certs(
-                                                    least_preferred=True):
-                                                        fname = os.path.join(
-                                                            pkgdir, fp)
-                                                        t.add_file(fname)
-                                # Always defer catalog update.
-                                t.close(add_to_catalog=False)
-                        except trans.TransactionError as e:
-                                abort(err=e)
-
-                        # Dump data retrieved so far after each successful
-                        # republish to conserve space.
+                                t.close(abandon=True)
+                        except:
+                                # It might not exist already.
+                                pass
+
+                        t.open()
+                        for a in m.gen_actions():
+                                if a.name == "set" and \
+                                    a.attrs.get("name", "") in ("fmri",
+                                    "pkg.fmri"):
+                                        # To be consistent with the
+                                        # server, the fmri can't be
+                                        # added to the manifest.
+                                        continue
+
+                                if hasattr(a, "hash") and \
+                                    a.hash not in present:
+                                        fname = os.path.join(pkgdir,
+                                            a.hash)
+                                        a.data = lambda: open(fname,
+                                            "rb")
+                                t.add(a)
+                                if a.name == "signature":
+                                        # We always store content in the
+                                        # repository by the least-
+                                        # preferred hash.
+                                        for fp in a.get_chain_certs(
+                                            least_preferred=True):
+                                                fname = os.path.join(
+                                                    pkgdir, fp)
+                                                t.add_file(fname)
+                        # Always defer catalog update.
+                        t.close(add_to_catalog=False)
+
+                def clean_pkg(f):
+                        # Dump the package's data after each successful
+                        # republish to conserve space.  If the destination
+                        # has an incoming directory of its own, that's dumped
+                        # too; otherwise it's left to retrieve(), as later
+                        # packages may be downloaded into it meanwhile.
+                        dest_incoming = dest_xport_cfg.incoming_root
                         try:
-                                shutil.rmtree(dest_xport_cfg.incoming_root)
-                                shutil.rmtree(pkgdir)
-                                if cache_dir in tmpdirs:
-                                        # If cache_dir is listed in tmpdirs,
-                                        # then it's safe to dump cache contents.
-                                        # Otherwise, it's a user cache directory
-                                        # and shouldn't be dumped.
-                                        shutil.rmtree(cache_dir)
-                                        misc.makedirs(cache_dir)
+                                shutil.rmtree(xport_cfg.get_pkg_dir(f))
+                                if dest_incoming != xport_cfg.incoming_root:
+                                        shutil.rmtree(dest_incoming)
                         except EnvironmentError as e:
                                 raise apx._convert_error(e)
-                        misc.makedirs(dest_xport_cfg.incoming_root)
+                        if dest_incoming != xport_cfg.incoming_root:
+                                misc.makedirs(dest_incoming)
+                        ptracker.republish_end_pkg(f)
+                        return f
+
+                stages = [(retrieve, 1)]
+                if republish:
+                        stages.extend([(republish_pkg, jobs), (clean_pkg, 1)])
+
+                pkgs_to_get = sorted(pkgs_to_get)
+                try:
+                        run_pipeline(pkgs_to_get, stages, jobs)
+                except trans.TransactionError as e:
+                        abort(err=e)
+                finally:
+                        while not xports.empty():
+                                wxport = xports.get()
+                                if wxport is not dest_xport:
+                                        wxport.shutdown()
 
-                        processed += 1
-                        tracker.republish_end_pkg(f)
+                processed = 0
+                if republish:
+                        processed = len(pkgs_to_get)
 
                 tracker.republish_done()
                 tracker.reset()
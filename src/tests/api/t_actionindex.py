@@ -0,0 +1,92 @@
+#!/usr/bin/python2.7
+#
+# CDDL HEADER START
+#
+# The contents of this file are subject to the terms of the
+# Common Development and Distribution License (the "License").
+# You may not use this file except in compliance with the License.
+#
+# You can obtain a copy of the license at usr/src/OPENSOLARIS.LICENSE
+# or http://www.opensolaris.org/os/licensing.
+# See the License for the specific language governing permissions
+# and limitations under the License.
+#
+# When distributing Covered Code, include this CDDL HEADER in each
+# file and include the License file at usr/src/OPENSOLARIS.LICENSE.
+# If applicable, add the following below this CDDL HEADER, with the
+# fields enclosed by brackets "[]" replaced with your own identifying
+# information: Portions Copyright [yyyy] [name of copyright owner]
+#
+# CDDL HEADER END
+#
+
+#
+# Copyright 2026 OmniOS Community Edition (OmniOSce) Association.
+#
+
+import testutils
+if __name__ == "__main__":
+        testutils.setup_environment("../../../proto")
+import pkg5unittest
+
+import os
+import unittest
+
+import pkg.client.actionindex as actionindex
+
+
+class TestActionIndex(pkg5unittest.Pkg5TestCase):
+
+        def __write(self, actdict, timestamp=1):
+                path = os.path.join(self.test_root, "actions.index")
+                with open(path, "wb") as f:
+                        actionindex.write(f, timestamp, actdict)
+                return path
+
+        def test_lookup(self):
+                """Verify that every pair written can be found, and that
+                pairs which weren't written can't."""
+
+                actdict = {}
+                for i in range(1000):
+                        actdict[("file", "usr/bin/f{0:d}".format(i))] = \
+                            (i * 100, i % 3 + 1)
+                        actdict[("dir", "usr/bin/f{0:d}".format(i))] = \
+                            (i * 100 + 50, 1)
+                actdict[("user", "has spaces")] = (12, 2)
+
+                idx = actionindex.ActionIndex(self.__write(actdict,
+                    timestamp=1234))
+                self.assertEqual(idx.timestamp, 1234)
+                self.assertEqual(len(idx), len(actdict))
+                for pair, val in actdict.iteritems():
+                        self.assertEqual(idx.get(pair), val)
+                self.assertEqual(idx.get(("link", "usr/bin/f1")), None)
+                self.assertEqual(idx.get(("file", "usr/bin/f1000"), 7), 7)
+                idx.close()
+
+                idx = actionindex.ActionIndex(self.__write({}))
+                self.assertEqual(len(idx), 0)
+                self.assertEqual(idx.get(("file", "usr/bin/f1")), None)
+                idx.close()
+
+        def test_invalid(self):
+                """Verify that files which aren't indexes are rejected."""
+
+                path = os.path.join(self.test_root, "actions.index")
+                for content in ("", "VERSION 2\n1\n", "PKG5AIDX" + "\0" * 32):
+                        with open(path, "wb") as f:
+                                f.write(content)
+                        self.assertRaises(ValueError,
+                            actionindex.ActionIndex, path)
+
+                # A truncated table.
+                path = self.__write({ ("file", "a"): (1, 1),
+                    ("file", "b"): (2, 1) })
+                with open(path, "r+b") as f:
+                        f.truncate(40)
+                self.assertRaises(ValueError, actionindex.ActionIndex, path)
+
+
+if __name__ == "__main__":
+        unittest.main()
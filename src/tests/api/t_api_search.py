@@ -42,6 +42,7 @@ import pkg.fmri as fmri
 import pkg.indexer as indexer
 import pkg.portable as portable
 import pkg.search_storage as ss
+import pkg.server.repository as sr
 
 
 class TestApiSearchBasics(pkg5unittest.SingleDepotTestCase):
@@ -2597,6 +2598,106 @@ class TestApiSearchBasics_nonP(TestApiSearchBasics):
                 self._search_op(api_obj, False, "depend::space_pkg",
                     expected_result)
 
+        def test_search_cache(self):
+                """Verify that the repository caches the results of searches
+                until its search index changes, and counts the hits and misses
+                of the cache."""
+
+                durl = self.dc.get_depot_url()
+                self.pkgsend_bulk(durl, self.example_pkg10)
+                repo = sr.Repository(read_only=True,
+                    root=self.dc.get_repodir(), search_cache_size=1024 * 1024)
+
+                def get_query(text):
+                        return query_parser.Query(text, False,
+                            query_parser.Query.RETURN_PACKAGES, None, None)
+
+                def search(q):
+                        return set(
+                            (pfmri.pkg_name, str(pfmri.version.release))
+                            for v, return_type, pfmri in repo.search([q])[0]
+                        )
+
+                def counts():
+                        status = repo.get_status()["repository"]
+                        return (status["search-cache"]["hits"],
+                            status["search-cache"]["misses"])
+
+                q = get_query("example_pkg")
+                expected = set([("example_pkg", "1.0")])
+                self.assertEqual(search(str(q)), expected)
+                self.assertEqual(counts(), (0, 1))
+                # The query can be repeated as a string or as a Query object.
+                self.assertEqual(search(str(q)), expected)
+                self.assertEqual(search(q), expected)
+                self.assertEqual(counts(), (2, 1))
+
+                # Results which haven't all been retrieved aren't cached.
+                q2 = get_query("example_path")
+                repo.search([str(q2)])
+                self.assertEqual(search(str(q2)), expected)
+                self.assertEqual(counts(), (2, 3))
+
+                # Updating the index discards the cached results.
+                self.pkgsend_bulk(durl, self.example_pkg11)
+                repo.reload()
+                self.assertEqual(search(str(q)),
+                    set([("example_pkg", "1.0"), ("example_pkg", "1.1")]))
+                self.assertEqual(counts(), (2, 4))
+                self.assertEqual(search(str(q)),
+                    set([("example_pkg", "1.0"), ("example_pkg", "1.1")]))
+                self.assertEqual(counts(), (3, 4))
+
+                # Without a cache size, nothing is cached.
+                repo = sr.Repository(read_only=True,
+                    root=self.dc.get_repodir())
+                self.assertEqual(search(str(q)),
+                    set([("example_pkg", "1.0"), ("example_pkg", "1.1")]))
+                self.assert_("search-cache" not in
+                    repo.get_status()["repository"])
+
+        def test_search_cache_index_update(self):
+                """Verify that cached search results are discarded when the
+                search index of the repository is updated, whether the update
+                is a full or a fast one."""
+
+                rpath = os.path.join(self.test_root, "search_cache_repo")
+                self.create_repo(rpath,
+                    properties={ "publisher": { "prefix": "test" } })
+                rurl = "file://{0}".format(rpath)
+                self.pkgsend_bulk(rurl, self.example_pkg10, refresh_index=True)
+                repo = sr.Repository(read_only=True, root=rpath,
+                    search_cache_size=1024 * 1024)
+
+                q = str(query_parser.Query("example_pkg", False,
+                    query_parser.Query.RETURN_PACKAGES, None, None))
+
+                def search():
+                        return set(
+                            (pfmri.pkg_name, str(pfmri.version.release))
+                            for v, return_type, pfmri in repo.search([q])[0]
+                        )
+
+                self.assertEqual(search(), set([("example_pkg", "1.0")]))
+
+                # The index is updated by another process, so this object
+                # doesn't see the change of the catalog.
+                self.pkgsend_bulk(rurl, self.example_pkg11, refresh_index=True)
+                self.assertEqual(search(),
+                    set([("example_pkg", "1.0"), ("example_pkg", "1.1")]))
+
+                # A fast update of the index only replaces the update logs
+                # and the list of indexed packages.
+                rstore = repo.get_pub_rstore()
+                for fname in (ss.FAST_ADD, ss.FAST_REMOVE,
+                    ss.FULL_FMRI_FILE):
+                        generation = rstore.get_search_generation()
+                        fpath = os.path.join(rstore.index_root, fname)
+                        shutil.copy(fpath, fpath + ".new")
+                        os.rename(fpath + ".new", fpath)
+                        self.assertNotEqual(generation,
+                            rstore.get_search_generation())
+
 
 class TestApiSearchMulti(pkg5unittest.ManyDepotTestCase):
 
@@ -515,6 +515,10 @@ class TestCatalog(pkg5unittest.Pkg5TestCase):
                 # Verify that the newly saved catalog will validate.
                 c.validate()
 
+                # Verify that saving the catalog left no temporary files
+                # behind.
+                self.assertEqual(sorted(os.listdir(cpath)), sorted(old_sigs))
+
                 # Next, retrieve the stored catalog.
                 c = catalog.Catalog(meta_root=cpath, log_updates=True)
                 pkg_list = [f for f in c.fmris()]
@@ -1107,14 +1111,88 @@ class TestCatalog(pkg5unittest.Pkg5TestCase):
                         pname = os.path.join(nc.meta_root, fname)
                         portable.remove(pname)
 
+                # And leave behind a temporary file such as an interrupted
+                # save would.
+                self.make_file(os.path.join(nc.meta_root,
+                    ".catalog.base.C.tmpxyz"), "")
+
                 # Verify that destroy actually removes the files.
                 nc = catalog.Catalog(meta_root=cpath)
                 nc.destroy()
 
                 for fname in os.listdir(nc.meta_root):
+                        fname = fname.lstrip(".")
                         self.assertFalse(fname.startswith("catalog.") or \
                             fname.startswith("update."))
 
+        def test_11_indexed(self):
+                """Verify that entries are looked up in the index of an indexed
+                catalog without loading its parts, and that the index isn't
+                used once it no longer matches the part."""
+
+                def get_entries(cat, pfmris, info_needed):
+                        return [
+                            cat.get_entry(f, info_needed=info_needed)
+                            for f in pfmris
+                        ]
+
+                def get_versions(cat, stems):
+                        return [
+                            (stem, [
+                                (str(ver), sorted(str(f) for f in fmris))
+                                for ver, fmris in cat.fmris_by_version(stem)
+                            ])
+                            for stem in stems
+                        ]
+
+                cpath = self.create_test_dir("test-11")
+                nc = catalog.Catalog(meta_root=cpath, indexed=True)
+                pfmris = list(self.c.fmris())
+                for f in pfmris:
+                        nc.add_package(f, manifest=self.__gen_manifest(f))
+                nc.save()
+
+                for name in nc.parts:
+                        self.assertTrue(os.path.exists(os.path.join(cpath,
+                            name + ".idx")))
+
+                info_needed = [catalog.Catalog.DEPENDENCY,
+                    catalog.Catalog.SUMMARY]
+                stems = ["test", "apkg", "zpkg", "nosuchpkg"]
+                unknown = fmri.PkgFmri("pkg://extra/test@1.0,5.11-1")
+                expected = get_entries(catalog.Catalog(meta_root=cpath),
+                    pfmris + [unknown], info_needed)
+                expected_versions = get_versions(
+                    catalog.Catalog(meta_root=cpath), stems)
+                self.assertEqual(expected[-1], None)
+
+                ic = catalog.Catalog(meta_root=cpath, indexed=True)
+                self.assertEqual(get_entries(ic, pfmris + [unknown],
+                    info_needed), expected)
+                self.assertEqual(get_versions(ic, stems), expected_versions)
+                for name in ic.parts:
+                        self.assertFalse(ic.get_part(name).loaded)
+
+                # Loading a part doesn't change the results.
+                ic.get_part("catalog.base.C").load()
+                self.assertEqual(get_entries(ic, pfmris, info_needed),
+                    expected[:-1])
+
+                # Change the catalog without updating the index, and verify
+                # that the index is then ignored.
+                nc = catalog.Catalog(meta_root=cpath)
+                nc.remove_package(pfmris[0])
+                nc.save()
+                ic = catalog.Catalog(meta_root=cpath, indexed=True)
+                self.assertEqual(ic.get_entry(pfmris[0]), None)
+                self.assertEqual(get_entries(ic, pfmris[1:], info_needed),
+                    expected[1:-1])
+
+                # Verify that destroy removes the index too.
+                ic.destroy()
+                for fname in os.listdir(cpath):
+                        self.assertFalse(fname.endswith(".idx"))
+
 
 class TestEmptyCatalog(pkg5unittest.Pkg5TestCase):
         """Basic functionality tests for empty catalogs."""
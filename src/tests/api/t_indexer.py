@@ -28,8 +28,10 @@ if __name__ == "__main__":
 import pkg5unittest
 
 import unittest
+import pkg.fmri as fmri
 import pkg.indexer as indexer
 import pkg.search_errors as se
+import pkg.search_storage as ss
 
 import os
 import sys
@@ -108,5 +110,110 @@ class TestIndexer(pkg5unittest.Pkg5TestCase):
                         self.assert_(len(open(os.path.join(ind._tmp_dir,
                             file)).readlines()) <= 1)
 
+        def test_token_ngrams(self):
+                """Verify that the trigrams of the tokens are written along
+                with the main dictionary, and that they find the tokens which
+                might match a pattern."""
+
+                ind = self.__prep_indexer(200)
+                ind._Indexer__close_sort_fh()
+                ind.empty_index = True
+                ind._progtrack.job_start(ind._progtrack.JOB_REBUILD_SEARCH,
+                    goal=2)
+                out_dir = os.path.join(self.test_root, "out")
+                os.mkdir(out_dir)
+                ind._update_index([], out_dir)
+
+                tokens = ss.IndexStoreDictMutable(ss.BYTE_OFFSET_FILE)
+                version = tokens.open(out_dir)
+                tokens.read_dict_file()
+                tokens.close_file_handle()
+                keys = tokens.get_keys()
+
+                # The trigrams must only be used with the index files they
+                # were written with.
+                ngrams = ss.IndexStoreNgrams(ss.NGRAM_FILE)
+                self.assert_(not ngrams.load(out_dir, version + 1))
+                self.assert_(ngrams.load(out_dir, version))
+
+                for pat, expected in (
+                    ("*OPT*", ["optional", "test1/optional"]),
+                    ("2009*Z", ["20091105T190147Z", "20091105T190153Z"]),
+                    ("*1/co*", ["test1/core"]),
+                    ("*xyz*", [])):
+                        self.assertEqual(expected,
+                            [keys[i] for i in ngrams.get_candidates(pat)])
+
+                # Patterns without three consecutive literal characters can't
+                # be narrowed down.
+                self.assertEqual(ngrams.get_candidates("co?e"), None)
+                self.assertEqual(["a", "cd", "e", "f", "gh[ij"],
+                    ss.IndexStoreNgrams.literal_runs("a[b]cd*e?f[!]x]gh[ij"))
+                shutil.rmtree(ind._tmp_dir)
+
+        def test_parallel_rebuild(self):
+                """Verify that an index rebuilt by several processes has the
+                same contents as one rebuilt by a single process."""
+
+                mdir = os.path.join(self.test_root, "manifests")
+                os.mkdir(mdir)
+                fmris = []
+                for i in range(indexer.MIN_PARALLEL_INDEXED_PKGS + 10):
+                        pfmri = fmri.PkgFmri("pkg://test/pkg{0:d}@1.{1:d},"
+                            "5.11-0:20200101T000000Z".format(i, i % 7))
+                        fmris.append(pfmri)
+                        with open(os.path.join(mdir, pfmri.pkg_name),
+                            "wb") as fh:
+                                fh.write("set name=pkg.fmri value={0}\n"
+                                    "set name=pkg.summary value=\"pkg "
+                                    "{1:d}\"\n".format(pfmri, i % 13))
+                                for j in range(i % 5 + 1):
+                                        fh.write("dir group=bin mode=0755 "
+                                            "owner=root path=usr/lib/dir{0:d}/"
+                                            "sub{1:d}\n".format(i % 11, j))
+
+                def get_contents(jobs, limit):
+                        idx_dir = os.path.join(self.test_root,
+                            "index.{0:d}.{1:d}".format(jobs, limit))
+                        os.mkdir(idx_dir)
+                        ind = indexer.Indexer(idx_dir, None,
+                            lambda f: os.path.join(mdir, f.pkg_name),
+                            sort_file_max_size=limit, jobs=jobs)
+                        ind.rebuild_index_from_scratch(fmris)
+
+                        # The order of the entries for a token may depend
+                        # on how the manifests were split up, so only the
+                        # entries themselves are compared.
+                        res = {}
+                        with open(os.path.join(idx_dir, ss.MAIN_FILE),
+                            "rb") as fh:
+                                fh.next()
+                                for line in fh:
+                                        tok, at_lst = ss.IndexStoreMainDict.\
+                                            parse_main_dict_line(line)
+                                        res[tok] = set(
+                                            (at, st, fv, int(p_id),
+                                                tuple(m_off_set))
+                                            for at, st_list in at_lst
+                                            for st, fv_list in st_list
+                                            for fv, p_list in fv_list
+                                            for p_id, m_off_set in p_list
+                                        )
+                        for name in (ss.MANIFEST_LIST, ss.BYTE_OFFSET_FILE):
+                                with open(os.path.join(idx_dir, name),
+                                    "rb") as fh:
+                                        res[name] = fh.read()
+                        return res
+
+                expected = get_contents(1, indexer.SORT_FILE_MAX_SIZE)
+                self.assert_(expected)
+                self.assertEqual(expected,
+                    get_contents(3, indexer.SORT_FILE_MAX_SIZE))
+                # A small sort file size makes each process write many runs.
+                self.assertEqual(expected, get_contents(3, 1000))
+
+                self.assertRaises(se.IndexingException, indexer.Indexer,
+                    self.test_root, None, None, jobs=0)
+
 if __name__ == "__main__":
         unittest.main()
@@ -146,7 +146,7 @@ class TestP5P(pkg5unittest.SingleDepotTestCase):
 
                 # Expected list of archive members for archive containing foo.
                 self.foo_expected = [
-                    "pkg5.index.0.gz",
+                    "pkg5.index.1",
                     "publisher",
                     "publisher/test",
                     "publisher/test/pkg",
@@ -167,7 +167,7 @@ class TestP5P(pkg5unittest.SingleDepotTestCase):
                 # Expected list of archive members for archive containing foo
                 # and quux (sorted).
                 self.multi_expected = [
-                    "pkg5.index.0.gz",
+                    "pkg5.index.1",
                     "pkg5.repository",
                     "publisher",
                     "publisher/test",
@@ -209,12 +209,12 @@ class TestP5P(pkg5unittest.SingleDepotTestCase):
                 assert os.path.exists(arc_path)
                 arc = ptf.PkgTarFile(name=arc_path, mode="r")
                 fm = arc.firstmember
-                self.assertEqual(fm.name, "pkg5.index.0.gz")
+                self.assertEqual(fm.name, "pkg5.index.1")
                 comment = fm.pax_headers.get("comment", "")
                 self.assertEqual(comment, "pkg5.archive.version.0")
 
                 # Verify basic expected content exists.
-                expected = ["pkg5.index.0.gz", "publisher", "pkg5.repository"]
+                expected = ["pkg5.index.1", "publisher", "pkg5.repository"]
                 actual = [m.name for m in arc.getmembers()]
                 self.assertEqualDiff(expected, actual)
 
@@ -258,7 +258,7 @@ class TestP5P(pkg5unittest.SingleDepotTestCase):
                 # directories.
                 actual = [m.name for m in members]
                 self.assertEqual(len(actual), 11)
-                expected = ["pkg5.index.0.gz", "publisher",
+                expected = ["pkg5.index.1", "publisher",
                     pkg.misc.relpath(self.test_root, "/"),
                     pkg.misc.relpath(tmp_root, "/")
                 ]
@@ -273,7 +273,7 @@ class TestP5P(pkg5unittest.SingleDepotTestCase):
                         # All archive members should be a file or directory.
                         self.assert_(member.isreg() or member.isdir())
 
-                        if member.name == "pkg5.index.0.gz":
+                        if member.name == "pkg5.index.1":
                                 assert member.isreg()
                                 comment = member.pax_headers.get("comment", "")
                                 self.assertEqual(comment,
@@ -820,7 +820,7 @@ class TestP5P(pkg5unittest.SingleDepotTestCase):
                 arc = ptf.PkgTarFile(name=arc_path, mode="w")
                 for dirpath, dirnames, filenames in os.walk(ext_dir):
                         map(add_entry,
-                            [f for f in filenames if f != "pkg5.index.0.gz"])
+                            [f for f in filenames if f != "pkg5.index.1"])
                         map(add_entry, dirnames)
                 arc.close()
 
@@ -913,7 +913,7 @@ class TestP5P(pkg5unittest.SingleDepotTestCase):
                         if m.name.endswith("/" + dest_fhash):
                                 dest_offset = m.offset
                                 trunc_sz = m.offset_data + int(m.size / 2)
-                        elif m.name.endswith("pkg5.index.0.gz"):
+                        elif m.name.endswith("pkg5.index.1"):
                                 idx_data_offset = m.offset_data
                         elif m.name.endswith("/" + src_fhash):
                                 # Calculate size of source entry.
@@ -1014,5 +1014,79 @@ class TestP5P(pkg5unittest.SingleDepotTestCase):
                 arc.close()
                 os.unlink(arc_path)
 
+        def test_07_index_versions(self):
+                """Verify that archives with either version of the archive
+                index can be read, and that a version 1 index can be used to
+                find archive members and package files directly."""
+
+                repo = self.get_repo(self.dc.get_repodir())
+                for ver in (0, 1):
+                        arc_path = os.path.join(self.test_root,
+                            "index{0:d}.p5p".format(ver))
+                        orig_ver = pkg.p5p.ArchiveIndex.CURRENT_VERSION
+                        try:
+                                pkg.p5p.ArchiveIndex.CURRENT_VERSION = ver
+                                arc = pkg.p5p.Archive(arc_path, mode="w")
+                                arc.add_repo_package(self.foo, repo)
+                                arc.add_repo_package(self.quux, repo)
+                                arc.close()
+                        finally:
+                                # Ensure this is reset to the right value.
+                                pkg.p5p.ArchiveIndex.CURRENT_VERSION = orig_ver
+
+                        # Read the offsets of all members from the archive.
+                        arc = ptf.PkgTarFile(name=arc_path, mode="r")
+                        idx_name = arc.firstmember.name
+                        offsets = dict(
+                            (m.name, m.offset) for m in arc.getmembers()
+                            if m.name != idx_name
+                        )
+                        arc.close()
+                        self.assertEqual(idx_name,
+                            ("pkg5.index.0.gz", "pkg5.index.1")[ver])
+
+                        # The index should contain the same offsets.
+                        arc = pkg.p5p.Archive(arc_path, mode="r")
+                        idx = arc.get_index()
+                        self.assertEqualDiff(sorted(offsets),
+                            sorted(idx.keys()))
+                        for name, offset in offsets.iteritems():
+                                self.assertEqual(idx.get(name), offset)
+                        self.assertEqual(idx.get("publisher/tes"), None)
+
+                        # Package files should be found by hash, with or
+                        # without the publisher.
+                        for name in offsets:
+                                if name.count("/") != 4 or \
+                                    name.split("/")[2] != "file":
+                                        continue
+                                pub, fhash = name.split("/")[1::3]
+                                expected = arc.get_file(name).read()
+                                for p in (pub, None):
+                                        fobj = arc.get_package_file(fhash,
+                                            pub=p)
+                                        self.assertEqual(fobj.read(),
+                                            expected)
+                        self.assertRaisesStringify(pkg.p5p.UnknownArchiveFiles,
+                            arc.get_package_file, "a")
+                        self.assertEqualDiff(["test", "test2"],
+                            sorted(p.prefix for p in arc.get_publishers()))
+                        arc.close()
+
+                        if ver == 0:
+                                self.assertEqual(type(idx), dict)
+                                continue
+
+                        self.assert_(isinstance(idx, pkg.p5p.ArchiveIndexMap))
+                        self.assertEqualDiff(
+                            ["publisher/test", "publisher/test2"],
+                            list(idx.children("publisher/")))
+                        self.assertEqualDiff(
+                            sorted(
+                                name for name in offsets
+                                if name.startswith("publisher/test2/")
+                            ),
+                            list(idx.names("publisher/test2/")))
+
 if __name__ == "__main__":
         unittest.main()
@@ -45,6 +45,8 @@ import shutil
 import urllib
 import urlparse
 
+from cStringIO import StringIO
+
 from pkg.client.debugvalues import DebugValues
 
 PKG_CLIENT_NAME = "pkg"
@@ -216,6 +218,21 @@ class TestPkgApiInstall(pkg5unittest.SingleDepotTestCase):
             add file tmp/motd mode=0644 owner=root group=bin path=etc/motd
             close"""
 
+        dlpkgs = """
+            open dla@1.0
+            add file tmp/libc.so.1 mode=0444 owner=root group=bin path=dla/libc.so.1
+            add file tmp/cat mode=0444 owner=root group=bin path=dla/cat
+            close
+            open dlb@1.0
+            add file tmp/baz mode=0444 owner=root group=bin path=dlb/baz
+            close
+            open dlc@1.0
+            add file tmp/motd mode=0444 owner=root group=bin path=dlc/motd
+            add file tmp/cat mode=0444 owner=root group=bin path=dlc/cat
+            close
+            open dld@1.0
+            close"""
+
         misc_files = [ "tmp/libc.so.1", "tmp/cat", "tmp/baz", "tmp/motd" ]
 
         def setUp(self):
@@ -285,6 +302,63 @@ class TestPkgApiInstall(pkg5unittest.SingleDepotTestCase):
                 self.assertRaises(api_errors.PlanExecutionError,
                     lambda *args, **kwargs: api_obj.execute_plan())
 
+        def test_download_progress(self):
+                """Verify that the files of several packages can be downloaded
+                from a depot at once while their progress is tracked, and that
+                each package is reported as started before any data arrives
+                for it and as done once it has all arrived."""
+
+                class RecordingTracker(progress.CommandLineProgressTracker):
+                        def __init__(self, output_file):
+                                progress.CommandLineProgressTracker.__init__(
+                                    self, output_file=output_file)
+                                self.calls = []
+
+                        def download_start_pkg(self, pkgfmri):
+                                self.calls.append(("start", pkgfmri.pkg_name))
+                                progress.CommandLineProgressTracker.\
+                                    download_start_pkg(self, pkgfmri)
+
+                        def download_end_pkg(self, pkgfmri):
+                                self.calls.append(("end", pkgfmri.pkg_name))
+                                progress.CommandLineProgressTracker.\
+                                    download_end_pkg(self, pkgfmri)
+
+                        def download_add_progress(self, nfiles, nbytes,
+                            cachehit=False):
+                                self.calls.append(("progress", None))
+                                progress.CommandLineProgressTracker.\
+                                    download_add_progress(self, nfiles, nbytes,
+                                    cachehit=cachehit)
+
+                self.dc.start()
+                self.pkgsend_bulk(self.durl, self.dlpkgs)
+                api_obj = self.image_create(self.durl)
+
+                sio = StringIO()
+                tracker = RecordingTracker(sio)
+                api_obj.progresstracker = tracker
+                self.__do_install(api_obj, ["dla", "dlb", "dlc", "dld"])
+                self.pkg("verify")
+
+                started = set()
+                ended = set()
+                for call, name in tracker.calls:
+                        if call == "start":
+                                self.assertTrue(name not in started)
+                                started.add(name)
+                        elif call == "end":
+                                self.assertTrue(name in started)
+                                self.assertTrue(name not in ended)
+                                ended.add(name)
+                        else:
+                                # Progress is only made once the download
+                                # has started.
+                                self.assertTrue(started)
+                self.assertEqualDiff(["dla", "dlb", "dlc", "dld"],
+                    sorted(ended))
+                self.assertTrue("Download" in sio.getvalue())
+
         def test_basics_1(self):
                 """ Send empty package foo@1.0, install and uninstall """
 
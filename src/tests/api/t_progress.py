@@ -408,5 +408,33 @@ class TestMultiProgressTracker(pkg5unittest.Pkg5TestCase):
                 self.assertRaises(progress.ProgressTrackerException,
                     progress.MultiProgressTracker, [])
 
+
+class TestLockedProgressTracker(pkg5unittest.Pkg5TestCase):
+        def test_locked(self):
+                """Test that a Locked tracker passes calls through, including
+                calls made from several threads at once."""
+
+                sio = StringIO.StringIO()
+                t = progress.FunctionProgressTracker(output_file=sio)
+                lt = progress.LockedProgressTracker(t)
+                progress.test_progress_tracker(lt, gofast=True)
+                self.assert_(len(sio.getvalue()) > 100)
+                self.assert_("republish_end_pkg(" in sio.getvalue())
+
+                t = progress.QuietProgressTracker()
+                lt = progress.LockedProgressTracker(t)
+                lt.republish_set_goal(1, 0, 1000 * 8)
+
+                def upload():
+                        for i in range(1000):
+                                lt.upload_add_progress(1)
+
+                threads = [threading.Thread(target=upload) for i in range(8)]
+                for th in threads:
+                        th.start()
+                for th in threads:
+                        th.join()
+                self.assertEqual(t.repub_send_bytes.items, 1000 * 8)
+
 if __name__ == "__main__":
         unittest.main()
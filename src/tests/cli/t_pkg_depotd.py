@@ -40,6 +40,7 @@ import urllib
 import urllib2
 import urlparse
 
+import pkg.catalog as catalog
 import pkg.client.publisher as publisher
 import pkg.depotcontroller as dc
 import pkg.fmri as fmri
@@ -727,6 +728,81 @@ class TestDepotController(pkg5unittest.CliTestCase):
                 self.__dc.start_expected_fail()
                 self.assertFalse(self.__dc.is_alive())
 
+        def test_catalog_compact_interval(self):
+                """Verify that packages published to a depot deferring
+                catalog saves are offered to clients at once as incremental
+                updates, and added to the catalog parts when they're
+                retrieved, the catalog is compacted, or the repository is next
+                opened for modification."""
+
+                def get_catalog_fmris():
+                        repo = sr.Repository(root=self.__dc.get_repodir(),
+                            read_only=True)
+                        return sorted(
+                            f.pkg_name
+                            for f in repo.get_catalog("test").fmris()
+                        )
+
+                self.make_misc_files(TestPkgDepot.misc_files)
+                self.__dc.set_port(self.next_free_port)
+                durl = self.__dc.get_depot_url()
+                jpath = os.path.join(self.__dc.get_repodir(), "publisher",
+                    "test", "catalog", "catalog.journal")
+
+                # With a long interval, the catalog parts are only saved when
+                # a client retrieves one of them.
+                self.__dc.set_catalog_compact_interval(3600)
+                self.__dc.start()
+                self.pkgsend_bulk(durl, TestPkgDepot.foo10)
+                self.assertTrue(os.path.exists(jpath))
+                self.assertEqual(get_catalog_fmris(), [])
+                self.image_create(durl)
+                self.assertFalse(os.path.exists(jpath))
+                self.assertEqual(get_catalog_fmris(), ["foo"])
+                self.pkg("list -a foo")
+
+                # Packages published later are offered to the client as an
+                # incremental update while the parts are out of date; the
+                # journal only records when the parts were last saved.
+                self.pkgsend_bulk(durl, TestPkgDepot.bar10)
+                with open(jpath, "rb") as f:
+                        catalog.ts_to_datetime(f.read().strip())
+                self.assertEqual(get_catalog_fmris(), ["foo"])
+                self.pkg("refresh")
+                self.pkg("list -a bar")
+
+                # Only the files listed in the catalog attributes are served.
+                try:
+                        urllib2.urlopen("{0}/catalog/1/catalog.journal".format(
+                            durl))
+                except urllib2.HTTPError as e:
+                        self.assertEqual(e.code, httplib.NOT_FOUND)
+                else:
+                        self.fail("catalog journal was served")
+
+                # The depot is killed without compacting the catalog, so the
+                # packages published since the parts were last saved are
+                # added to them when the repository is next opened for
+                # modification.
+                self.__dc.stop()
+                self.assertEqual(get_catalog_fmris(), ["foo"])
+                self.__dc.get_repo()
+                self.assertFalse(os.path.exists(jpath))
+                self.assertEqual(get_catalog_fmris(), ["bar", "foo"])
+
+                # With a short interval, the catalog is compacted soon after
+                # a package is published.
+                self.__dc.set_catalog_compact_interval(1)
+                self.__dc.start()
+                self.pkgsend_bulk(durl, TestPkgDepot.quux10)
+                timeout = time.time() + 30
+                while "quux" not in get_catalog_fmris() and \
+                    time.time() < timeout:
+                        time.sleep(0.5)
+                self.assertEqual(get_catalog_fmris(), ["bar", "foo", "quux"])
+                self.assertFalse(os.path.exists(jpath))
+                self.pkg("refresh")
+                self.pkg("list -a quux")
 
 class TestDepotOutput(pkg5unittest.SingleDepotTestCase):
         # Since these tests are output sensitive, the depots should be purged
@@ -35,6 +35,7 @@ import os
 import platform
 import re
 import shutil
+import simplejson as json
 import socket
 import subprocess
 import stat
@@ -276,6 +277,14 @@ class TestPkgInstallBasics(pkg5unittest.SingleDepotTestCase):
             add file tmp/cat mode=0555 owner=root group=bin sysattr=hidden,horst path=/p3/cat
             close """
 
+        filelist10 = """
+            open filelist@1.0,5.11-0
+            add dir mode=0755 owner=root group=bin path=/flist
+            add file tmp/libc.so.1 mode=0555 owner=root group=bin path=/flist/libc.so.1
+            add file tmp/cat mode=0555 owner=root group=bin path=/flist/cat
+            add file tmp/baz mode=0555 owner=root group=bin path=/flist/baz
+            close """
+
         misc_files = [ "tmp/libc.so.1", "tmp/cat", "tmp/baz" ]
 
         def setUp(self):
@@ -1025,6 +1034,58 @@ class TestPkgInstallBasics(pkg5unittest.SingleDepotTestCase):
                 afobj.close()
                 self.pkg("install a16189", exit=1)
 
+        def test_solver_cache(self):
+                """Verify that the dependency information used by the solver
+                is cached for the image's known catalog, that a damaged cache
+                is ignored, and that the cache isn't kept once the known
+                catalog changes."""
+
+                plist = self.pkgsend_bulk(self.rurl, (self.foo10, self.bar10))
+                self.image_create(self.rurl)
+
+                cache_path = self.get_img_file_path(
+                    "var/pkg/state/solver_cache")
+                self.pkg("install -n bar")
+                with open(cache_path, "rb") as f:
+                        version, key, entries = json.load(f)
+                self.assertTrue([
+                    fstr for fstr in entries
+                    if fstr.startswith("test/bar@1.0")
+                ])
+
+                # The same plan is made using the cache, or if the cache
+                # can't be read.
+                self.pkg("install -n --parsable=0 bar")
+                self.assertEqual(sorted(plist),
+                    sorted(json.loads(self.output)["add-packages"]))
+                with open(cache_path, "wb") as f:
+                        f.write("garbage")
+                self.pkg("install -n --parsable=0 bar")
+                self.assertEqual(sorted(plist),
+                    sorted(json.loads(self.output)["add-packages"]))
+
+                # Packages from alternate sources aren't in the known catalog
+                # on disk, so they aren't cached.
+                arepo = os.path.join(self.test_root, "solver_cache_alt")
+                self.create_repo(arepo,
+                    properties={ "publisher": { "prefix": "test" } })
+                self.pkgsend_bulk("file://" + arepo, (self.foo12, self.bar11))
+                self.pkg("install -n -g {0} bar@1.1".format(arepo))
+                with open(cache_path, "rb") as f:
+                        version, key, entries = json.load(f)
+                self.assertFalse([
+                    fstr for fstr in entries
+                    if fstr.startswith("test/bar@1.1")
+                ])
+                self.pkg("install -n bar@1.1", exit=1)
+
+                # Newer versions are found once the catalog is refreshed.
+                self.pkgsend_bulk(self.rurl, (self.foo12, self.bar11))
+                self.pkg("refresh")
+                self.assertFalse(os.path.exists(cache_path))
+                self.pkg("install bar")
+                self.pkg("list bar@1.1 foo@1.2")
+
         def test_install_fuzz(self):
                 """Verify that packages delivering files with whitespace in
                 their paths can be installed or exact-installed, updated, and
@@ -1048,6 +1109,33 @@ class TestPkgInstallBasics(pkg5unittest.SingleDepotTestCase):
 
                 self.pkg("uninstall -vvv fuzzy")
 
+        def test_install_filelist(self):
+                """Verify that small files are retrieved from a depot using
+                batched filelist requests, and individually if batching is
+                disabled."""
+
+                self.pkgsend_bulk(self.durl, self.filelist10)
+                logpath = self.dc.get_logpath()
+
+                def count_filelist_requests():
+                        with open(logpath, "r") as f:
+                                return f.read().count("/filelist/0/")
+
+                self.image_create(self.durl)
+                start = count_filelist_requests()
+                self.pkg("install filelist")
+                self.pkg("verify filelist")
+                self.assertEqual(count_filelist_requests(), start + 1)
+                self.pkg("uninstall filelist")
+                self.image_destroy()
+
+                self.image_create(self.durl)
+                start = count_filelist_requests()
+                self.pkg("install filelist",
+                    env_arg={"PKG_CLIENT_FILELIST_MAX_SIZE": "0"})
+                self.pkg("verify filelist")
+                self.assertEqual(count_filelist_requests(), start)
+
         def test_sysattrs(self):
                 """Test install with setting system attributes."""
 
@@ -4561,6 +4649,51 @@ adm:NP:6445::::::
                 self.pkg("uninstall usertest")
                 self.pkg("verify")
 
+        def test_usertest_many_install(self):
+                """Ensure that users and groups installed in the same plan,
+                which share one read and write of the user database files,
+                are each given their own uid and gid, and can be used by the
+                actions that follow them."""
+
+                manyusers = """
+                    open manyusers@1.0,5.11-0
+                    add depend fmri=pkg:/basics@1.0 type=require
+                    """
+                for i in range(5):
+                        manyusers += """
+                    add group groupname=grp{0:d}
+                    add user username=usr{0:d} group=grp{0:d} group-list=grp{1:d}
+                    add dir mode=0755 owner=usr{0:d} group=grp{0:d} path=/home{0:d}
+                    """.format(i, (i + 1) % 5)
+                manyusers += "close"
+
+                self.pkgsend_bulk(self.rurl, (self.basics0, manyusers))
+                self.image_create(self.rurl)
+                self.pkg("install basics")
+                self.pkg("install manyusers")
+                self.pkg("verify")
+
+                api_inst = self.get_img_api_obj()
+                img = api_inst.img
+                uids = set()
+                gids = set()
+                for i in range(5):
+                        uid = img.get_user_by_name("usr{0:d}".format(i))
+                        gid = img.get_group_by_name("grp{0:d}".format(i))
+                        uids.add(uid)
+                        gids.add(gid)
+                        st = os.stat(os.path.join(self.get_img_path(),
+                            "home{0:d}".format(i)))
+                        self.assertEqual((st.st_uid, st.st_gid), (uid, gid))
+                self.assertEqual(len(uids), 5)
+                self.assertEqual(len(gids), 5)
+
+                self.pkg("uninstall manyusers")
+                self.pkg("verify")
+                with open(os.path.join(self.get_img_path(), "etc",
+                    "passwd")) as f:
+                        self.assert_("usr0" not in f.read())
+
         def test_primordial_usergroup_install(self):
                 """Ensure that we can install user and group actions in the same
                 transaction as /etc/passwd, /etc/group, etc."""
@@ -9569,6 +9702,66 @@ adm
                 self.pkg("uninstall pkg2", exit=1)
                 self.pkg("verify pkg2")
 
+        def __get_fast_lookups(self):
+                """Return the contents of the image's fast lookup database in
+                a form that doesn't depend on when it was written or on the
+                order of the actions for each name and key."""
+
+                cdir = os.path.join(self.get_img_path(), "var/pkg/cache")
+                with open(os.path.join(cdir, "actions.stripped")) as f:
+                        f.readline()
+                        f.readline()
+                        stripped = sorted(f)
+                with open(os.path.join(cdir, "actions.offsets")) as f:
+                        f.readline()
+                        f.readline()
+                        offsets = [
+                            (l.split(None, 3)[0], l.split(None, 3)[2:])
+                            for l in f
+                        ]
+                with open(os.path.join(cdir, "keys.conflicting")) as f:
+                        conflicting = f.readlines()
+                return stripped, offsets, conflicting
+
+        def test_fast_lookups_incremental(self):
+                """Verify that the fast lookup database updated after each
+                operation matches one created from scratch."""
+
+                self.image_create(self.rurl)
+
+                def check():
+                        self.assertTrue(not os.path.exists(os.path.join(
+                            self.get_img_path(), "var/pkg/cache",
+                            "actions.offsets.prev")))
+                        updated = self.__get_fast_lookups()
+                        self.get_img_api_obj().img._create_fast_lookups()
+                        self.assertEqual(updated, self.__get_fast_lookups())
+                        return updated
+
+                self.pkg("install dupfilesp1 implicitdirs2")
+                check()
+                self.pkg("-D broken-conflicting-action-handling=1 install "
+                    "dupfilesp2@0 dupfilesp3")
+                stripped, offsets, conflicting = check()
+                self.assertEqual(conflicting, ["dir/pathname\n"])
+                self.pkg("update dupfilesp2")
+                check()
+                self.pkg("uninstall dupfilesp3")
+                stripped, offsets, conflicting = check()
+                self.assertEqual(conflicting, [])
+                self.pkg("uninstall implicitdirs2")
+                check()
+
+                # A database that can't be used is rebuilt.
+                cache = os.path.join(self.get_img_path(), "var/pkg/cache")
+                with open(os.path.join(cache, "actions.offsets"), "ab") as f:
+                        f.write("file 1 1 bogus\n")
+                self.pkg("install implicitdirs2")
+                check()
+                os.unlink(os.path.join(cache, "actions.stripped"))
+                self.pkg("uninstall implicitdirs2")
+                check()
+
         def test_overlay_files_install(self):
                 """Test the behaviour of pkg(1) when actions for editable files
                 overlay other actions."""
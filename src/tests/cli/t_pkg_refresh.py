@@ -70,7 +70,7 @@ class TestPkgRefreshMulti(pkg5unittest.ManyDepotTestCase):
         def setUp(self):
                 # This test suite needs actual depots.
                 pkg5unittest.ManyDepotTestCase.setUp(self, ["test1", "test2",
-                    "test1", "test1"], start_depots=True)
+                    "test1", "test1"], start_depots=True, image_count=2)
 
                 self.durl1 = self.dcs[1].get_depot_url()
                 self.durl2 = self.dcs[2].get_depot_url()
@@ -224,6 +224,52 @@ class TestPkgRefreshMulti(pkg5unittest.ManyDepotTestCase):
                     "foo 1.2-0 ---\n"
                 self.checkAnswer(expected, self.output)
 
+        def test_concurrent_refresh(self):
+                """Verify that retrieving the catalogs for several publishers
+                and origins at once gives the same result as retrieving them
+                one at a time, for both full and incremental refreshes."""
+
+                self.pkgsend_bulk(self.durl1, self.foo10)
+                self.pkgsend_bulk(self.durl2, self.foo12)
+                self.pkgsend_bulk(self.durl3, self.foo11)
+
+                # Image 0 retrieves catalogs one at a time, image 1 several
+                # at once.
+                conc = ("1", "4")
+
+                def refresh_all(args="", exit=0):
+                        output = []
+                        for i in (0, 1):
+                                self.set_image(i)
+                                self.pkg("refresh {0}".format(args), exit=exit,
+                                    env_arg={ "PKG_CLIENT_REFRESH_CONCURRENCY":
+                                    conc[i] })
+                                self.pkg("list -afH pkg:/foo pkg:/food")
+                                output.append(self.output)
+                        self.assertEqualDiff(output[0], output[1])
+                        return output[0]
+
+                for i in (0, 1):
+                        self.set_image(i)
+                        self.image_create(self.durl1, prefix="test1")
+                        self.pkg("set-publisher -g " + self.durl3 + " test1")
+                        self.pkg("set-publisher -O " + self.durl2 + " test2")
+                out = refresh_all("--full")
+                self.assert_("1.1-0" in out and "1.2-0" in out)
+
+                self.pkgsend_bulk(self.durl1, self.food12)
+                self.pkgsend_bulk(self.durl2, self.foo121)
+                out = refresh_all()
+                self.assert_("food" in out and "1.2.1-0" in out)
+
+                # A publisher whose origin can't be reached fails as it would
+                # otherwise, without preventing the others from refreshing.
+                self.dcs[2].stop()
+                self.pkgsend_bulk(self.durl3, self.foo1)
+                out = refresh_all(exit=1)
+                self.assert_("foo 1-0 " in self.reduce_spaces(out))
+                self.dcs[2].start()
+
         def test_set_publisher_induces_full_refresh(self):
                 self.pkgsend_bulk(self.durl3, self.foo11)
                 self.pkgsend_bulk(self.durl3, self.foo10)
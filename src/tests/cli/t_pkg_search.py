@@ -635,6 +635,32 @@ adm:NP:6445::::::
                 self.pkg("search -s {0} '*'".format(durl))
                 self.pkg("search -l '*'", exit=1)
 
+        def test_result_limit(self):
+                """Test that -n limits the number of results displayed for
+                both local and remote search."""
+
+                durl = self.dc.get_depot_url()
+                self.pkgsend_bulk(durl, self.example_pkg10)
+                self.image_create(durl)
+
+                self.pkg("search -n 0 '*'", exit=2)
+                self.pkg("search -n -1 '*'", exit=2)
+                self.pkg("search -n foo '*'", exit=2)
+
+                self.pkg("search -H '*'")
+                total = len(self.output.splitlines())
+                self.assertTrue(total > 2)
+                self.pkg("search -H -n 2 '*'")
+                self.assertEqual(len(self.output.splitlines()), 2)
+                self.pkg("search -H -n {0:d} '*'".format(total + 1))
+                self.assertEqual(len(self.output.splitlines()), total)
+                self.pkg("search -H -p -n 1 '*'")
+                self.assertEqual(len(self.output.splitlines()), 1)
+
+                self.pkg("install example_pkg")
+                self.pkg("search -H -l -n 2 '*'")
+                self.assertEqual(len(self.output.splitlines()), 2)
+
         def test_local_0(self):
                 """Install one package, and run the search suite."""
                 # Need to retain that -l works as expected
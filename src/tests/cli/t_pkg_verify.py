@@ -30,6 +30,7 @@ import pkg5unittest
 import os
 import pkg.portable as portable
 import shutil
+import simplejson as json
 import subprocess
 import tempfile
 import time
@@ -232,6 +233,78 @@ class TestPkgVerify(pkg5unittest.SingleDepotTestCase):
                 self.output.index("etc/preserved")
                 self.output.index("editable file has been changed")
 
+        def test_04_verify_cache(self):
+                """Verify that files which haven't changed since their content
+                was last verified aren't read again unless --rehash is used,
+                and that files which have changed are."""
+
+                self.image_create(self.rurl)
+                self.pkg("install foo")
+                # Files changed very recently aren't recorded in the cache.
+                time.sleep(3)
+
+                self.pkg_verify("foo")
+                cache_path = os.path.join(self.get_img_api_obj().img.imgdir,
+                    "cache", "verify")
+                with open(cache_path, "rb") as f:
+                        version, entries = json.load(f)
+                fpath = os.path.join(self.get_img_path(), "usr", "bin",
+                    "bobcat")
+                fhash = entries[fpath][-1]
+
+                # Changing the content of a file is noticed even if its
+                # modification time is restored.
+                st = os.stat(fpath)
+                with open(fpath, "wb") as f:
+                        f.write("x")
+                os.utime(fpath, (st.st_atime, st.st_mtime))
+                self.pkg_verify("foo", exit=1)
+
+                # A file whose metadata matches the cache isn't read, so
+                # recording the expected hash for the damaged file hides the
+                # damage until --rehash is used.
+                st = os.stat(fpath)
+                entries[fpath] = [st.st_dev, st.st_ino, st.st_size,
+                    st.st_mtime, st.st_ctime, fhash]
+                with open(cache_path, "wb") as f:
+                        json.dump((version, entries), f)
+                self.pkg_verify("foo")
+                self.pkg_verify("--rehash foo", exit=1)
+                self.pkg_verify("foo", exit=1)
+
+                self.pkg("fix --rehash foo")
+                self.pkg_verify("foo")
+
+        def test_05_verify_concurrency(self):
+                """Verify that the output of verify and fix doesn't depend on
+                the number of threads used to verify file system objects."""
+
+                self.image_create(self.rurl)
+                self.pkg("install foo")
+
+                # Damage several of the objects delivered by the package.
+                img_path = self.get_img_path()
+                portable.remove(os.path.join(img_path, "usr", "bin", "bobcat"))
+                os.chmod(os.path.join(img_path, "usr", "bin", "ls"), 0o600)
+                os.chmod(os.path.join(img_path, "etc", "security"), 0o700)
+                with open(os.path.join(img_path, "etc", "name_to_major"),
+                    "ab") as f:
+                        f.write("zigit 104\n")
+
+                self.pkg_verify("-v foo", exit=1)
+                expected = self.output
+                for jobs in (4, 0):
+                        self.pkg("set-property verify-concurrency {0:d}".format(
+                            jobs))
+                        self.pkg_verify("-v foo", exit=1)
+                        self.assertEqualDiff(expected, self.output)
+
+                self.pkg("set-property verify-concurrency -1", exit=1)
+
+                self.pkg("set-property verify-concurrency 4")
+                self.pkg("fix foo")
+                self.pkg_verify("foo")
+
         def test_verify_changed_manifest(self):
                 """Test that running package verify won't change the manifest of
                 an installed package even if it has changed in the repository.
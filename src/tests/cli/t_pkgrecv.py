@@ -1035,6 +1035,111 @@ Estimated transfer size: 528.00 B
                 self.pkgrecv(self.dpath1, "-d {0} -v \*".format(self.tempdir))
                 self.assert_("dry-run" not in self.output)
 
+        def test_14_jobs(self):
+                """Verify that republishing several packages at once gives the
+                same result as republishing them one at a time."""
+
+                self.pkgrecv(self.durl1, "-d {0} --jobs 0 \*".format(
+                    self.tempdir), exit=2)
+                self.pkgrecv(self.durl1, "-d {0} --jobs foo \*".format(
+                    self.tempdir), exit=2)
+
+                rpaths = []
+                for jobs in (1, 4):
+                        rpath = os.path.join(self.test_root,
+                            "jobs{0:d}".format(jobs))
+                        self.pkgrepo("create {0}".format(rpath))
+                        self.pkgrepo("set -s {0} publisher/prefix=test1".format(
+                            rpath))
+                        self.pkgrecv(self.durl1, "-d file://{0} --jobs {1:d} "
+                            "\*".format(rpath, jobs))
+                        rpaths.append(rpath)
+
+                # The same packages, with the same manifests and files, should
+                # have been republished.
+                outputs = []
+                for rpath in rpaths:
+                        self.pkgrepo("list -F tsv -H -s {0}".format(rpath))
+                        outputs.append(self.output)
+                self.assertEqualDiff(outputs[0], outputs[1])
+                self.assertEqual(len(outputs[0].splitlines()),
+                    len(self.published))
+
+                repos = [self.get_repo(rpath) for rpath in rpaths]
+                for s in self.published:
+                        f = fmri.PkgFmri(s)
+                        mfsts = []
+                        for repo in repos:
+                                m = manifest.Manifest(f)
+                                m.set_content(pathname=repo.manifest(f))
+                                mfsts.append(m)
+                        self.assertEqualDiff(str(mfsts[0]), str(mfsts[1]))
+                        for a in mfsts[0].gen_actions():
+                                if not a.has_payload:
+                                        continue
+                                for repo in repos:
+                                        self.assert_(os.path.exists(
+                                            repo.file(a.hash)))
+
+                # The packages should also be republished to a repository
+                # served by a depot.
+                self.pkgrecv(self.durl1, "-d {0} --jobs 4 \*".format(
+                    self.durl2))
+                self.wait_repo(self.dpath2)
+                self.pkgrepo("list -F tsv -H -s {0}".format(self.durl2))
+                self.assertEqualDiff(outputs[0], self.output)
+
+        def test_15_present_payloads(self):
+                """Verify that payloads the target repository already has
+                aren't retrieved or sent again, and that the packages are
+                republished just as they would be otherwise."""
+
+                bronze10 = fmri.PkgFmri(self.published[2])
+                bronze20 = fmri.PkgFmri(self.published[3])
+
+                # Of bronze@2.0's six payloads, those of /usr/bin/sh,
+                # /etc/bronze1, and /etc/amber2 are also bronze@1.0's.
+                expected = "Files to retrieve: 3\n"
+
+                full = os.path.join(self.test_root, "full")
+                self.pkgrepo("create {0}".format(full))
+                self.pkgrecv(self.durl1, "-d {0} {1}".format(full, bronze20))
+
+                rpath = os.path.join(self.test_root, "present")
+                self.pkgrepo("create {0}".format(rpath))
+                self.pkgrecv(self.durl1, "-d {0} {1}".format(rpath, bronze10))
+                self.pkgrecv(self.durl1, "-d {0} -n -v {1}".format(rpath,
+                    bronze20))
+                self.assert_(expected in self.reduceSpaces(self.output),
+                    self.output)
+                self.pkgrecv(self.durl1, "-d {0} {1}".format(rpath, bronze20))
+
+                frepo = self.get_repo(full)
+                prepo = self.get_repo(rpath)
+                fm = manifest.Manifest(bronze20)
+                fm.set_content(pathname=frepo.manifest(bronze20))
+                pm = manifest.Manifest(bronze20)
+                pm.set_content(pathname=prepo.manifest(bronze20))
+                self.assertEqualDiff(str(fm), str(pm))
+                for a in pm.gen_actions():
+                        if a.has_payload:
+                                self.assert_(os.path.exists(
+                                    prepo.file(a.hash)))
+
+                # A depot should be asked which payloads it has.
+                self.pkgrecv(self.durl1, "-d {0} {1}".format(self.durl2,
+                    bronze10))
+                self.pkgrecv(self.durl1, "-d {0} -v {1}".format(self.durl2,
+                    bronze20))
+                self.assert_(expected in self.reduceSpaces(self.output),
+                    self.output)
+                self.wait_repo(self.dpath2)
+                self.pkg("contents -g {0} -m {1}".format(self.durl2,
+                    bronze20))
+                dm = manifest.Manifest(bronze20)
+                dm.set_content(self.output)
+                self.assertEqualDiff(str(fm), str(dm))
+
 
 class TestPkgrecvHTTPS(pkg5unittest.HTTPSTestClass):
 
@@ -43,6 +43,7 @@ import pkg.client.api_errors as apx
 import pkg.p5p
 import shutil
 import tempfile
+import threading
 import time
 import urllib
 import urlparse
@@ -3550,6 +3551,151 @@ publisher\tprefix\t""
                 # publisher will not result in partial failure.
                 self.pkgrepo("contents -s {0} zoo".format(repo_path))
 
+        def test_41_refcount(self):
+                """Verify that the refcount subcommand works as expected and
+                that the reference count index is kept up to date."""
+
+                repo_path = os.path.join(self.test_root, "refcount-repo")
+                self.create_repo(repo_path)
+                self.pkgrepo("set -s {0} publisher/prefix=test".format(
+                    repo_path))
+                plist = self.pkgsend_bulk(repo_path, (self.tree10,
+                    self.amber10, self.truck10))
+
+                # Verify graceful exit if invalid or incomplete set of
+                # options specified.
+                self.pkgrepo("refcount", exit=2)
+                self.pkgrepo("refcount -s {0} bogus".format(repo_path), exit=2)
+                self.pkgrepo("refcount -s {0}".format(self.durl), exit=2)
+                self.pkgrepo("refcount -s {0} -p nosuchpub".format(repo_path),
+                    exit=1)
+
+                # Verify that the index can be built and checked.
+                self.pkgrepo("refcount -s {0}".format(repo_path))
+                self.pkgrepo("refcount --check -s {0}".format(repo_path))
+
+                # Verify that publication and removal keep the index up to
+                # date, and that files still referenced by other packages
+                # aren't removed.
+                self.pkgsend_bulk(repo_path, self.truck20)
+                self.pkgrepo("refcount --check -s {0}".format(repo_path))
+                self.pkgrepo("remove -s {0} truck".format(repo_path))
+                self.pkgrepo("refcount --check -s {0}".format(repo_path))
+                repo = self.get_repo(repo_path)
+                repo.file(self.fhashes["tmp/empty"])
+                repo.file(self.fhashes["tmp/truck1"])
+                self.assertRaises(sr.RepositoryFileNotFoundError, repo.file,
+                    self.fhashes["tmp/truck2"])
+
+                # Verify that an index which can't be trusted is reported
+                # and is rebuilt when packages are removed.
+                rstore = repo.get_pub_rstore("test")
+                open(os.path.join(rstore.root, "refcount", "dirty"),
+                    "wb").close()
+                self.pkgrepo("refcount --check -s {0}".format(repo_path),
+                    exit=1)
+                self.pkgrepo("remove -s {0} tree".format(repo_path))
+                self.pkgrepo("refcount --check -s {0}".format(repo_path))
+                repo = self.get_repo(repo_path)
+                for f in ("tmp/empty", "tmp/truck1", "tmp/truck2"):
+                        self.assertRaises(sr.RepositoryFileNotFoundError,
+                            repo.file, self.fhashes[f])
+
+                # Verify that a manifest that wasn't counted is reported.
+                rstore = repo.get_pub_rstore("test")
+                rstore.discard_refs()
+                mpath = repo.manifest(fmri.PkgFmri(plist[1]))
+                self.pkgrepo("refcount -s {0}".format(repo_path))
+                shutil.copy(mpath, os.path.join(os.path.dirname(mpath),
+                    os.path.basename(mpath).replace("1.0", "1.1", 1)))
+                self.pkgrepo("refcount --check -s {0}".format(repo_path),
+                    exit=1)
+                self.assert_("not counted" in self.output)
+
+        def test_42_verify_jobs(self):
+                """Verify that files are verified in parallel, and only once,
+                when --jobs is used, and that the same errors are reported."""
+
+                repo_path = self.dc.get_repodir()
+
+                # Verify graceful exit for invalid job counts.
+                for arg in ("0", "-1", "bogus"):
+                        self.pkgrepo("-s {0} verify --jobs {1}".format(
+                            repo_path, arg), exit=2)
+
+                # The tree and truck packages all deliver tmp/truck1.
+                fmris = self.pkgsend_bulk(repo_path, (self.tree10,
+                    self.amber10, self.amber20, self.truck10, self.truck20))
+                self.pkgrepo("-s {0} verify --jobs 4".format(repo_path))
+
+                bad_hash_path = self.__inject_badhash("tmp/truck1")
+                bad_gzip_path = self.__inject_badhash("tmp/truck2",
+                    valid_gzip=False)
+                self.pkgrepo("-s {0} verify".format(repo_path), exit=1)
+                expected = self.output
+
+                # The error for a shared file must be reported for each
+                # package that references it, in the same order.
+                self.pkgrepo("-s {0} verify --jobs 4".format(repo_path),
+                    exit=1)
+                self.assertEqualDiff(expected, self.output)
+                self.assertEqual(
+                    self.output.count("ERROR: Invalid file hash"), 3)
+                self.assertEqual(
+                    self.output.count("ERROR: Corrupted gzip file"), 1)
+                self.assert_(bad_hash_path in self.output)
+                self.assert_(bad_gzip_path in self.output)
+                for f in (fmris[0], fmris[3], fmris[4]):
+                        self.assert_(f in self.output)
+                for f in (fmris[1], fmris[2]):
+                        self.assert_(f not in self.output)
+
+        def test_43_concurrent_add(self):
+                """Verify that packages added to the catalog concurrently are
+                all committed, and that a failure to add one doesn't prevent
+                the others from being added."""
+
+                repo_path = os.path.join(self.test_root, "concurrent-repo")
+                self.create_repo(repo_path)
+                self.pkgrepo("set -s {0} publisher/prefix=test".format(
+                    repo_path))
+                plist = self.pkgsend_bulk(repo_path, (self.tree10,
+                    self.amber10, self.amber20, self.truck10, self.truck20),
+                    no_catalog=True)
+                pfmris = [fmri.PkgFmri(p) for p in plist]
+
+                repo = self.get_repo(repo_path)
+                added = []
+                failed = []
+                def add_package(pfmri):
+                        try:
+                                repo.add_package(pfmri)
+                        except apx.DuplicateCatalogEntry:
+                                failed.append(pfmri)
+                        else:
+                                added.append(pfmri)
+
+                # amber@1.0 is added twice, so one attempt must fail.
+                threads = [
+                    threading.Thread(target=add_package, args=(f,))
+                    for f in pfmris + [pfmris[1]]
+                ]
+                for t in threads:
+                        t.start()
+                for t in threads:
+                        t.join()
+                self.assertEqual(failed, [pfmris[1]])
+                self.assertEqual(sorted(added), sorted(pfmris))
+
+                # Verify that the saved catalog contains every package.
+                repo = self.get_repo(repo_path)
+                cat = repo.get_catalog("test")
+                self.assertEqual(sorted(cat.fmris()), sorted(pfmris))
+                self.assertEqual(cat.package_version_count, len(pfmris))
+                self.pkgrepo("list -s {0} -H".format(repo_path))
+                for p in ("tree", "amber", "truck"):
+                        self.assert_(p in self.output)
+
 
 class TestPkgrepoHTTPS(pkg5unittest.HTTPSTestClass):
 
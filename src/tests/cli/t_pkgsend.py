@@ -27,6 +27,7 @@ if __name__ == "__main__":
         testutils.setup_environment("../../../proto")
 import pkg5unittest
 
+import cStringIO
 import grp
 import os
 import pkg.fmri as fmri
@@ -42,6 +43,7 @@ import urllib2
 from pkg import misc
 from pkg.actions import fromstr
 from pkg.digest import DEFAULT_HASH_FUNC
+from pkg.pkggzip import PkgGzipFile
 import pkg.portable as portable
 
 try:
@@ -1405,6 +1407,229 @@ path=dir-foo/subdir-foo/subdirfile-foo\n""".format(
                 self.assertEqualDiff(self.reduceSpaces(expected),
                     self.reduceSpaces(actual))
 
+        def test_28_payload_sizes(self):
+                """Verify that payloads of any size, including those read in
+                several parts and those too short to be checked for being
+                ELF objects, are stored compressed with the right attributes.
+                """
+
+                furi = self.dc.get_repo_url()
+                contents = {}
+                for size in (1, 3, 4, 128 * 1024 - 1, 128 * 1024,
+                    3 * 128 * 1024 + 5):
+                        contents["payload{0:d}".format(size)] = \
+                            (str(size) * size)[:size]
+
+                mfpath = os.path.join(self.test_root, "payload_sizes.mf")
+                with open(mfpath, "wb") as mf:
+                        mf.write("set name=pkg.fmri value=pkg:/payloads@1.0\n")
+                        for path in self.make_misc_files(contents):
+                                mf.write("file {0} path={1} owner=root "
+                                    "group=sys mode=0644\n".format(path,
+                                    os.path.basename(path)))
+                rc, out = self.pkgsend("", "-s {0} publish {1}".format(furi,
+                    mfpath))
+                pfmri = fmri.PkgFmri(out.splitlines()[0])
+
+                repo = self.dc.get_repo()
+                m = manifest.Manifest(pfmri)
+                m.set_content(pathname=repo.manifest(pfmri))
+                for a in m.gen_actions_by_type("file"):
+                        content = contents[a.attrs["path"]]
+                        self.assertEqual(a.hash, misc.get_data_digest(
+                            cStringIO.StringIO(content), len(content),
+                            hash_func=DEFAULT_HASH_FUNC)[0])
+                        self.assertEqual(a.attrs["pkg.size"],
+                            str(len(content)))
+
+                        # The stored file should be compressed, and its size
+                        # and hashes should be those recorded.
+                        path = repo.file(a.hash)
+                        self.assert_(PkgGzipFile.test_is_pkggzipfile(path))
+                        gz = PkgGzipFile(path, "rb")
+                        self.assertEqual(gz.read(), content)
+                        gz.close()
+                        csize, chashes = misc.compute_compressed_attrs(a.hash,
+                            path, None, len(content), self.test_root)
+                        self.assertEqual(a.attrs["pkg.csize"], csize)
+                        for attr in chashes:
+                                self.assertEqual(a.attrs[attr],
+                                    chashes[attr].hexdigest())
+
+        def test_29_compression_level(self):
+                """Verify that payloads are compressed at the level set for
+                the repository, and that their compressed size and hashes only
+                depend on their content and that level."""
+
+                contents = {}
+                for i in range(1, 9):
+                        contents["level{0:d}".format(i)] = "".join(
+                            "{0:d} {1:d}\n".format(i, n)
+                            for n in range(i * 20000))
+
+                mfpath = os.path.join(self.test_root, "level.mf")
+                with open(mfpath, "wb") as mf:
+                        mf.write("set name=pkg.fmri value=pkg:/level@1.0\n")
+                        for path in self.make_misc_files(contents):
+                                mf.write("file {0} path={1} owner=root "
+                                    "group=sys mode=0644\n".format(path,
+                                    os.path.basename(path)))
+
+                chashes = {}
+                for level in (9, 1):
+                        rpath = os.path.join(self.test_root,
+                            "level{0:d}".format(level))
+                        self.create_repo(rpath, properties={
+                            "publisher": { "prefix": "test" } })
+                        if level != 9:
+                                self.pkgrepo("set -s {0} "
+                                    "repository/compression-level={1:d}".format(
+                                    rpath, level))
+                        rc, out = self.pkgsend("", "-s {0} publish {1}".format(
+                            rpath, mfpath))
+                        pfmri = fmri.PkgFmri(out.splitlines()[0])
+
+                        repo = self.get_repo(rpath)
+                        m = manifest.Manifest(pfmri)
+                        m.set_content(pathname=repo.manifest(pfmri))
+                        for a in m.gen_actions_by_type("file"):
+                                content = contents[a.attrs["path"]]
+                                path = repo.file(a.hash)
+                                gz = PkgGzipFile(path, "rb")
+                                self.assertEqual(gz.read(), content)
+                                gz.close()
+
+                                csize, expected = \
+                                    misc.compute_compressed_attrs(a.hash,
+                                    None, content, len(content),
+                                    self.test_root, compresslevel=level)
+                                os.unlink(os.path.join(self.test_root, a.hash))
+                                self.assertEqual(a.attrs["pkg.csize"], csize)
+                                for attr in expected:
+                                        self.assertEqual(a.attrs[attr],
+                                            expected[attr].hexdigest())
+                                chashes.setdefault(a.hash, set()).add(
+                                    a.attrs["chash"])
+
+                # Compression at another level results in different content
+                # being stored.
+                for h in chashes:
+                        self.assertEqual(len(chashes[h]), 2)
+
+                # Levels that aren't valid for gzip are rejected.
+                self.pkgrepo("set -s {0} repository/compression-level=10".format(
+                    rpath), exit=1)
+
+        def test_30_concurrent_publication(self):
+                """Verify that a package whose payloads are sent to a depot
+                at once is published just as one whose actions are sent one
+                at a time, and that failures are reported against the action
+                concerned."""
+
+                contents = {
+                    "conc0": "zero\n",
+                    "conc1": "one\n" * 10000,
+                    "conc2": "zero\n",
+                    "conc3": "",
+                }
+                for i in range(4, 20):
+                        contents["conc{0:d}".format(i)] = \
+                            "{0:d}\n".format(i) * (i * 1000)
+                paths = self.make_misc_files(contents)
+
+                def publish(name, env_arg=None, extra=""):
+                        mfpath = os.path.join(self.test_root,
+                            "{0}.mf".format(name))
+                        with open(mfpath, "wb") as mf:
+                                mf.write("set name=pkg.fmri "
+                                    "value=pkg:/{0}@1.0\n".format(name))
+                                mf.write(extra)
+                                for path in sorted(paths):
+                                        mf.write("file {0} path=conc/{1} "
+                                            "owner=root group=sys "
+                                            "mode=0644\n".format(path,
+                                            os.path.basename(path)))
+                                mf.write("dir path=conc owner=root group=sys "
+                                    "mode=0755\n")
+                                mf.write("link path=conc/link target=conc0\n")
+                        return self.pkgsend(durl, "publish {0}".format(mfpath),
+                            env_arg=env_arg, exit=1 if extra else 0)
+
+                def get_actions(out):
+                        pfmri = fmri.PkgFmri([
+                            l for l in out.splitlines()
+                            if l.startswith("pkg:")
+                        ][0])
+                        with open(repo.manifest(pfmri), "rb") as f:
+                                return [
+                                    l for l in f.read().splitlines()
+                                    if not l.startswith("set name=pkg.fmri")
+                                ]
+
+                durl = self.dc.get_depot_url()
+                repo = self.dc.get_repo()
+                rc, out = publish("conc")
+                expected = get_actions(out)
+                rc, out = publish("seq",
+                    env_arg={ "PKG_CLIENT_PUBLISH_CONCURRENCY": "1" })
+                self.assertEqualDiff("\n".join(expected),
+                    "\n".join(get_actions(out)))
+
+                for a in expected:
+                        if not a.startswith("file "):
+                                continue
+                        act = fromstr(a)
+                        gz = PkgGzipFile(repo.file(act.hash), "rb")
+                        self.assertEqual(gz.read(),
+                            contents[os.path.basename(act.attrs["path"])])
+                        gz.close()
+
+                # An action that can't be added is named, and the transaction
+                # is abandoned.
+                publish("obs", extra="set name=pkg.obsolete value=true\n")
+                self.assertTrue("path=conc/conc0" in self.errout, self.errout)
+                for dirpath, dirnames, filenames in os.walk(
+                    self.dc.get_repodir()):
+                        if os.path.basename(dirpath) == "trans":
+                                self.assertEqual(dirnames + filenames, [])
+
+        def test_31_separate_adds(self):
+                """Verify that the actions added to a transaction in a file
+                repository by separate pkgsend processes are all published
+                when their payloads are compressed by a pool of threads."""
+
+                contents = {}
+                for i in range(1, 9):
+                        contents["sep{0:d}".format(i)] = \
+                            "{0:d}\n".format(i) * (i * 10000)
+                paths = self.make_misc_files(contents)
+
+                furl = "file://{0}".format(self.dc.get_repodir())
+                env = { "PKG_CLIENT_COMPRESS_JOBS": "4" }
+                self.pkgsend(furl, "open sep@1.0", env_arg=env)
+                for path in sorted(paths):
+                        self.pkgsend(furl, "add file {0} path=sep/{1} "
+                            "owner=root group=sys mode=0644".format(path,
+                            os.path.basename(path)), env_arg=env)
+                rc, pfmri = self.pkgsend(furl, "close", env_arg=env)
+
+                repo = self.dc.get_repo()
+                with open(repo.manifest(fmri.PkgFmri(pfmri)), "rb") as f:
+                        files = [
+                            fromstr(l)
+                            for l in f.read().splitlines()
+                            if l.startswith("file ")
+                        ]
+                self.assertEqual(
+                    sorted(os.path.basename(a.attrs["path"]) for a in files),
+                    sorted(contents))
+                for a in files:
+                        self.assertTrue("pkg.csize" in a.attrs)
+                        gz = PkgGzipFile(repo.file(a.hash), "rb")
+                        self.assertEqual(gz.read(),
+                            contents[os.path.basename(a.attrs["path"])])
+                        gz.close()
+
 
 class TestPkgsendHardlinks(pkg5unittest.CliTestCase):
 
@@ -0,0 +1,165 @@
+#!/usr/bin/python2.7
+#
+# CDDL HEADER START
+#
+# The contents of this file are subject to the terms of the
+# Common Development and Distribution License (the "License").
+# You may not use this file except in compliance with the License.
+#
+# You can obtain a copy of the license at usr/src/OPENSOLARIS.LICENSE
+# or http://www.opensolaris.org/os/licensing.
+# See the License for the specific language governing permissions
+# and limitations under the License.
+#
+# When distributing Covered Code, include this CDDL HEADER in each
+# file and include the License file at usr/src/OPENSOLARIS.LICENSE.
+# If applicable, add the following below this CDDL HEADER, with the
+# fields enclosed by brackets "[]" replaced with your own identifying
+# information: Portions Copyright [yyyy] [name of copyright owner]
+#
+# CDDL HEADER END
+#
+
+#
+# Copyright 2026 OmniOS Community Edition (OmniOSce) Association.
+#
+
+#
+# actdictbench - benchmark loading the image's fast lookup database and
+# looking up the actions for a plan in it, using the text actions.offsets
+# file and the binary actions.index file.
+#
+# Each run is made in a child process so that the growth in its maximum
+# resident set size can be reported.
+#
+
+from __future__ import print_function
+
+import getopt
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+import pkg.client.actionindex as actionindex
+
+TIMESTAMP = 1234567890
+
+def usage():
+        print("Usage: actdictbench.py [-n nkeys] [-l nlookups]",
+            file=sys.stderr)
+        sys.exit(2)
+
+def make_actdict(nkeys):
+        """Return a dictionary shaped like that of an image delivering
+        'nkeys' distinct paths."""
+
+        actdict = {}
+        offset = 20
+        for i in xrange(nkeys):
+                name = ("file", "dir", "link")[i % 3]
+                key = "usr/share/bench/d{0:d}/{1:s}{2:d}".format(i // 100,
+                    name, i)
+                actdict[(name, key)] = offset, 1
+                offset += 160
+        return actdict
+
+def write_files(tmpdir, actdict):
+        offsets_path = os.path.join(tmpdir, "actions.offsets")
+        with open(offsets_path, "wb") as f:
+                f.write("VERSION 2\n{0:d}\n".format(TIMESTAMP))
+                for (name, key), (offset, cnt) in sorted(actdict.iteritems()):
+                        f.write("{0} {1} {2} {3}\n".format(name, offset, cnt,
+                            key))
+
+        index_path = os.path.join(tmpdir, "actions.index")
+        with open(index_path, "wb") as f:
+                actionindex.write(f, TIMESTAMP, actdict)
+        return offsets_path, index_path
+
+def load_text(path):
+        # This is the parsing done by Image._load_actdict().
+        actdict = {}
+        with open(path, "rb") as of:
+                of.readline()
+                of.readline()
+                for line in of:
+                        actname, offset, cnt, key_attr = \
+                            line.rstrip().split(None, 3)
+                        actdict[(actname, key_attr)] = (int(offset), int(cnt))
+        return actdict
+
+def load_index(path):
+        return actionindex.ActionIndex(path)
+
+def measure(loader, path, lookups):
+        """Return the time taken to load 'path' with 'loader', the time taken
+        to look up each of 'lookups' in the result, and the growth in the
+        maximum resident set size in kilobytes."""
+
+        rfd, wfd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+                os.close(rfd)
+                rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+                start = time.time()
+                actdict = loader(path)
+                loaded = time.time()
+                for pair in lookups:
+                        assert actdict.get(pair, None) is not None
+                done = time.time()
+                rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss
+                os.write(wfd, "{0!r} {1!r} {2:d}".format(loaded - start,
+                    done - loaded, rss))
+                os._exit(0)
+
+        os.close(wfd)
+        with os.fdopen(rfd, "rb") as f:
+                result = f.read()
+        os.waitpid(pid, 0)
+        load, lookup, rss = result.split()
+        return float(load), float(lookup), int(rss)
+
+if __name__ == "__main__":
+        nkeys = 500000
+        nlookups = 10000
+
+        try:
+                opts, pargs = getopt.getopt(sys.argv[1:], "l:n:")
+        except getopt.GetoptError:
+                usage()
+
+        for opt, arg in opts:
+                if opt == "-l":
+                        nlookups = int(arg)
+                elif opt == "-n":
+                        nkeys = int(arg)
+
+        tmpdir = tempfile.mkdtemp(prefix="actdictbench.")
+        try:
+                actdict = make_actdict(nkeys)
+                lookups = random.sample(actdict.keys(),
+                    min(nlookups, nkeys))
+                offsets_path, index_path = write_files(tmpdir, actdict)
+                del actdict
+
+                print("{0:d} keys, {1:d} lookups".format(nkeys,
+                    len(lookups)))
+                print("{0:>12s} {1:>12s} {2:>12s} {3:>12s}".format("",
+                    "load", "lookups", "rss (kB)"))
+                for name, loader, path in (
+                    ("text", load_text, offsets_path),
+                    ("binary", load_index, index_path)):
+                        for i in (1, 2, 3):
+                                load, lookup, rss = measure(loader, path,
+                                    lookups)
+                                print("{0:>12s} {1:>12f} {2:>12f} "
+                                    "{3:>12d}".format(name, load, lookup,
+                                    rss))
+        except KeyboardInterrupt:
+                pass
+        finally:
+                shutil.rmtree(tmpdir)
@@ -0,0 +1,160 @@
+#!/usr/bin/python2.7
+#
+# CDDL HEADER START
+#
+# The contents of this file are subject to the terms of the
+# Common Development and Distribution License (the "License").
+# You may not use this file except in compliance with the License.
+#
+# You can obtain a copy of the license at usr/src/OPENSOLARIS.LICENSE
+# or http://www.opensolaris.org/os/licensing.
+# See the License for the specific language governing permissions
+# and limitations under the License.
+#
+# When distributing Covered Code, include this CDDL HEADER in each
+# file and include the License file at usr/src/OPENSOLARIS.LICENSE.
+# If applicable, add the following below this CDDL HEADER, with the
+# fields enclosed by brackets "[]" replaced with your own identifying
+# information: Portions Copyright [yyyy] [name of copyright owner]
+#
+# CDDL HEADER END
+#
+
+#
+# Copyright 2026 OmniOS Community Edition (OmniOSce) Association.
+#
+
+#
+# catalogbench - benchmark the catalog operations behind 'pkg info' (looking
+# up the dependency and summary entries of a few packages) and 'pkg list -a'
+# (iterating over the summary entries of every package), with and without
+# the index of the entries in each catalog part.
+#
+# Each run is made in a child process so that the growth in its maximum
+# resident set size can be reported.
+#
+
+from __future__ import print_function
+
+import getopt
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+import pkg.catalog as catalog
+import pkg.fmri as fmri
+import pkg.manifest as manifest
+
+PUBLISHER = "bench"
+
+def usage():
+        print("Usage: catalogbench.py [-n npkgs] [-l nlookups]",
+            file=sys.stderr)
+        sys.exit(2)
+
+def make_catalog(path, npkgs):
+        """Create an indexed catalog at 'path' containing 'npkgs' packages
+        with two versions each, and return their FMRIs."""
+
+        cat = catalog.Catalog(batch_mode=True, meta_root=path, sign=False,
+            indexed=True)
+        pfmris = []
+        for i in xrange(npkgs):
+                for ver in ("1.0", "2.0"):
+                        f = fmri.PkgFmri("pkg://{0}/bench/pkg{1:d}@{2},"
+                            "5.11-0:20260101T000000Z".format(PUBLISHER, i,
+                            ver))
+                        m = manifest.Manifest(f)
+                        m.set_content(
+                            "set name=pkg.fmri value={0}\n"
+                            "set name=pkg.summary value=\"Package {1:d}\"\n"
+                            "set name=pkg.description value=\"The benchmark "
+                            "package number {1:d}, version {2}.\"\n"
+                            "set name=info.classification "
+                            "value=org.opensolaris.category.2008:System/Core\n"
+                            "set name=variant.arch value=i386 value=sparc\n"
+                            "depend fmri=bench/pkg{3:d} type=require\n"
+                            "depend fmri=bench/pkg{4:d} type=require\n".format(
+                            f, i, ver, (i + 1) % npkgs, (i + 7) % npkgs))
+                        cat.add_package(f, manifest=m)
+                        pfmris.append(f)
+        cat.finalize()
+        cat.save()
+        return pfmris
+
+def info(path, indexed, lookups):
+        cat = catalog.Catalog(meta_root=path, read_only=True, indexed=indexed)
+        for f in lookups:
+                assert cat.get_entry(f, info_needed=[catalog.Catalog.DEPENDENCY,
+                    catalog.Catalog.SUMMARY]) is not None
+
+def list_all(path, indexed, lookups):
+        cat = catalog.Catalog(meta_root=path, read_only=True, indexed=indexed)
+        for f, entry in cat.entries(info_needed=[catalog.Catalog.SUMMARY]):
+                pass
+
+def measure(func, path, indexed, lookups):
+        """Return the time taken to run 'func' and the growth in the maximum
+        resident set size in kilobytes."""
+
+        rfd, wfd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+                os.close(rfd)
+                rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+                start = time.time()
+                func(path, indexed, lookups)
+                elapsed = time.time() - start
+                rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss
+                os.write(wfd, "{0!r} {1:d}".format(elapsed, rss))
+                os._exit(0)
+
+        os.close(wfd)
+        with os.fdopen(rfd, "rb") as f:
+                result = f.read()
+        os.waitpid(pid, 0)
+        elapsed, rss = result.split()
+        return float(elapsed), int(rss)
+
+if __name__ == "__main__":
+        npkgs = 20000
+        nlookups = 5
+
+        try:
+                opts, pargs = getopt.getopt(sys.argv[1:], "l:n:")
+        except getopt.GetoptError:
+                usage()
+
+        for opt, arg in opts:
+                if opt == "-l":
+                        nlookups = int(arg)
+                elif opt == "-n":
+                        npkgs = int(arg)
+
+        tmpdir = tempfile.mkdtemp(prefix="catalogbench.")
+        try:
+                pfmris = make_catalog(tmpdir, npkgs)
+                lookups = random.sample(pfmris, min(nlookups, len(pfmris)))
+                del pfmris
+
+                print("{0:d} packages, {1:d} lookups".format(npkgs,
+                    len(lookups)))
+                print("{0:>12s} {1:>12s} {2:>12s} {3:>12s}".format("",
+                    "", "time", "rss (kB)"))
+                for name, func in (("info", info), ("list", list_all)):
+                        for label, indexed in (("json", False),
+                            ("indexed", True)):
+                                for i in (1, 2, 3):
+                                        elapsed, rss = measure(func, tmpdir,
+                                            indexed, lookups)
+                                        print("{0:>12s} {1:>12s} {2:>12f} "
+                                            "{3:>12d}".format(name, label,
+                                            elapsed, rss))
+        except KeyboardInterrupt:
+                pass
+        finally:
+                shutil.rmtree(tmpdir)
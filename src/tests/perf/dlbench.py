@@ -0,0 +1,174 @@
+#!/usr/bin/python2.7
+#
+# CDDL HEADER START
+#
+# The contents of this file are subject to the terms of the
+# Common Development and Distribution License (the "License").
+# You may not use this file except in compliance with the License.
+#
+# You can obtain a copy of the license at usr/src/OPENSOLARIS.LICENSE
+# or http://www.opensolaris.org/os/licensing.
+# See the License for the specific language governing permissions
+# and limitations under the License.
+#
+# When distributing Covered Code, include this CDDL HEADER in each
+# file and include the License file at usr/src/OPENSOLARIS.LICENSE.
+# If applicable, add the following below this CDDL HEADER, with the
+# fields enclosed by brackets "[]" replaced with your own identifying
+# information: Portions Copyright [yyyy] [name of copyright owner]
+#
+# CDDL HEADER END
+#
+
+#
+# Copyright 2026 OmniOS Community Edition (OmniOSce) Association.
+#
+
+#
+# dlbench - benchmark the download phase of a plan that installs many
+# packages, retrieving files one package at a time (-D serial-download)
+# and with a single plan-wide download queue.
+#
+# The packages are published to a new repository and served by a local
+# pkg.depotd unless a depot that already contains them is given with -s.
+# The times reported are for the whole install; only the download phase
+# differs between the two.  A remote depot shows the effect of network
+# latency, which is what the plan-wide queue hides.
+#
+
+from __future__ import print_function
+
+import getopt
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import pkg.actions as actions
+import pkg.depotcontroller as depotcontroller
+import pkg.server.repository as sr
+
+PUBLISHER = "bench"
+
+def usage():
+        print("Usage: dlbench.py [-n npkgs] [-f nfiles] [-s depot_url]\n"
+            "           [-d depotd_path] [-k pkg_path]", file=sys.stderr)
+        sys.exit(2)
+
+def publish(repo, npkgs, nfiles):
+        """Publish 'npkgs' packages that each deliver 'nfiles' small files
+        with unique content to the Repository object 'repo'."""
+
+        for i in xrange(npkgs):
+                pfmri = "pkg://{0}/bench/pkg{1:d}@1.0,5.11-0".format(
+                    PUBLISHER, i)
+                trans_id = repo.open("5.11", pfmri)
+                repo.add(trans_id, actions.fromstr("dir mode=0755 owner=root "
+                    "group=bin path=bench/pkg{0:d}".format(i)))
+                for j in xrange(nfiles):
+                        content = "{0:d}.{1:d}\n".format(i, j) * (64 * (j + 1))
+                        a = actions.fromstr("file NOHASH mode=0644 owner=root "
+                            "group=bin path=bench/pkg{0:d}/f{1:d} "
+                            "pkg.size={2:d}".format(i, j, len(content)))
+
+                        def opener(content=content):
+                                fd, fn = tempfile.mkstemp()
+                                os.write(fd, content)
+                                os.close(fd)
+                                f = open(fn, "rb")
+                                os.unlink(fn)
+                                return f
+                        a.data = opener
+                        repo.add(trans_id, a)
+                repo.close(trans_id)
+
+def run(pkg_path, args):
+        cmd = [pkg_path] + args
+        p = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT)
+        out = p.communicate()[0]
+        if p.returncode != 0:
+                print("{0} failed:\n{1}".format(" ".join(cmd), out),
+                    file=sys.stderr)
+                sys.exit(1)
+
+def time_install(pkg_path, depot_url, tmpdir, debug=None):
+        """Create a new image and return the number of seconds taken to
+        install all of the benchmark packages into it."""
+
+        img = tempfile.mkdtemp(dir=tmpdir)
+        run(pkg_path, ["image-create", "--full", "-p",
+            "{0}={1}".format(PUBLISHER, depot_url), img])
+
+        args = ["-R", img]
+        if debug:
+                args.extend(["-D", debug])
+        args.extend(["install", "--no-index", "--no-backup-be",
+            "bench/*"])
+
+        start = time.time()
+        run(pkg_path, args)
+        elapsed = time.time() - start
+
+        shutil.rmtree(img)
+        return elapsed
+
+if __name__ == "__main__":
+        npkgs = 1000
+        nfiles = 4
+        depot_url = None
+        depotd_path = "/usr/lib/pkg.depotd"
+        pkg_path = "/usr/bin/pkg"
+
+        try:
+                opts, pargs = getopt.getopt(sys.argv[1:], "d:f:k:n:s:")
+        except getopt.GetoptError:
+                usage()
+
+        for opt, arg in opts:
+                if opt == "-d":
+                        depotd_path = arg
+                elif opt == "-f":
+                        nfiles = int(arg)
+                elif opt == "-k":
+                        pkg_path = arg
+                elif opt == "-n":
+                        npkgs = int(arg)
+                elif opt == "-s":
+                        depot_url = arg
+
+        tmpdir = tempfile.mkdtemp(prefix="dlbench.")
+        dc = None
+        try:
+                if not depot_url:
+                        repodir = os.path.join(tmpdir, "repo")
+                        repo = sr.repository_create(repodir,
+                            properties={ "publisher": {
+                            "prefix": PUBLISHER } })
+                        publish(repo, npkgs, nfiles)
+
+                        dc = depotcontroller.DepotController()
+                        dc.set_depotd_path(depotd_path)
+                        dc.set_repodir(repodir)
+                        dc.set_readonly()
+                        dc.set_logpath(os.path.join(tmpdir, "depot.log"))
+                        dc.start()
+                        depot_url = dc.get_depot_url()
+
+                print("download phase of a {0:d} package plan, {1:d} "
+                    "files per package".format(npkgs, nfiles))
+                for name, debug in (("per-package", "serial-download=1"),
+                    ("plan-wide", None)):
+                        for i in (1, 2, 3):
+                                t = time_install(pkg_path, depot_url, tmpdir,
+                                    debug=debug)
+                                print("{0:>20f}  {1:>12s} {2:>8.1f} "
+                                    "pkgs/sec".format(t, name, npkgs / t))
+        except KeyboardInterrupt:
+                pass
+        finally:
+                if dc:
+                        dc.stop()
+                shutil.rmtree(tmpdir)
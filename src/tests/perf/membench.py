@@ -22,18 +22,27 @@
 
 #
 # Copyright (c) 2010, 2015, Oracle and/or its affiliates. All rights reserved.
+# Copyright 2026 OmniOS Community Edition (OmniOSce) Association.
 #
 
 #
-# membench - benchmark memory usage of various objects
+# membench - benchmark memory usage of various objects, and of a repository
+# adding a file to a transaction
 #
 
 from __future__ import print_function
 
+import gettext
+import pkg.actions as actions
+import pkg.client.publisher as publisher
 import pkg.fmri as fmri
+import pkg.server.repository as sr
 import pkg.version as version
+import resource
+import shutil
 import sys
 import os
+import tempfile
 import pkg.misc as misc
 
 def dotseq(num):
@@ -77,3 +86,39 @@ for func in funcs:
         else:
                 os.wait()
 
+def payload(size):
+        """Add a file of 'size' bytes to a transaction in a new repository, and
+        return the growth in the maximum resident set size in kilobytes."""
+
+        tmpdir = tempfile.mkdtemp(prefix="membench.")
+        try:
+                path = os.path.join(tmpdir, "payload")
+                with open(path, "wb") as f:
+                        chunk = os.urandom(1024 * 1024)
+                        for n in xrange(size // len(chunk)):
+                                f.write(chunk)
+                repo = sr.repository_create(os.path.join(tmpdir, "repo"))
+                repo.add_publisher(publisher.Publisher("bench"))
+                trans_id = repo.open("5.11", "pkg://bench/payload@1.0")
+
+                a = actions.fromstr("file payload path=payload mode=0644 "
+                    "owner=root group=bin pkg.size={0:d}".format(
+                    os.stat(path).st_size))
+                a.data = lambda: open(path, "rb")
+                rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+                repo.add(trans_id, a)
+                return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss
+        finally:
+                shutil.rmtree(tmpdir)
+
+gettext.install("pkg", "/usr/share/locale")
+
+for mb in (16, 64, 256):
+        print("#", "payload", mb, "MB")
+        pid = os.fork()
+        if pid == 0:
+                print("payload", "{0:d} MB added, maximum resident set size "
+                    "grew by {1:d} kB".format(mb, payload(mb * 1024 * 1024)))
+                sys.exit(0)
+        else:
+                os.wait()
@@ -602,6 +602,9 @@ def do_reversion(pub, ref_pub, target_repo, ref_xport, changes, ignores):
                 msg(_("\nReversioning packages (dry-run)."))
         else:
                 msg(_("\nReversioning packages."))
+                # Manifests are replaced directly below, so the repository's
+                # index of file references can't be kept up to date.
+                target_repo.get_pub_rstore(pub).discard_refs()
 
         # Start the main pass. Reversion packages from reversioned_pkgs to the
         # version in the ref repo. For packages which don't get reversioned,